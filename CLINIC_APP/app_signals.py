@@ -1,4 +1,34 @@
-from PyQt5.QtCore import QObject, pyqtSignal
+import os
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+# Cửa sổ gộp thay đổi (ms): mọi post() trong khoảng này được phát thành MỘT lần `changes`
+# (và mỗi signal cũ tương ứng cũng chỉ phát một lần). 0 = gộp các post() của cùng một lượt xử lý sự kiện.
+CHANGE_WINDOW_MS = max(0, int(os.environ.get('CLINIC_CHANGE_WINDOW_MS', '150') or 0))
+
+
+class ChangeSet:
+    """Các bảng và id dòng đã thay đổi trong một cửa sổ gộp (payload của app_signals.changes)."""
+
+    def __init__(self, tables):
+        # bảng -> set id dòng; None = không rõ dòng nào (coi như cả bảng)
+        self._tables = tables
+
+    def tables(self):
+        return set(self._tables)
+
+    def touches(self, *tables):
+        return any(t in self._tables for t in tables)
+
+    def ids(self, table):
+        """Các id đã đổi của `table`: set rỗng nếu bảng không đổi, None nếu không rõ dòng (đọc lại cả bảng)."""
+        if table not in self._tables:
+            return set()
+        ids = self._tables[table]
+        return None if ids is None else set(ids)
+
+    def __repr__(self):
+        return f"ChangeSet({self._tables!r})"
 
 
 class AppSignals(QObject):
@@ -9,6 +39,54 @@ class AppSignals(QObject):
     medication_dispensed = pyqtSignal()
     # Được phát khi một tài khoản người dùng mới được tạo: (username, role, full_name)
     user_created = pyqtSignal(str, str, str)
+    # Danh mục thuốc (tên, giá, tồn kho) vừa được đọc lại — xem forms/drug_catalog_model.py
+    drug_catalog_changed = pyqtSignal()
+    # Thay đổi dữ liệu đã gộp (ChangeSet): màn hình chỉ cập nhật các bảng/dòng bị ảnh hưởng
+    changes = pyqtSignal(object)
+    # Nội bộ: đưa post() từ thread bất kỳ về GUI thread (AutoConnection -> QueuedConnection)
+    _posted = pyqtSignal(str, object, object)
+
+    def __init__(self):
+        super().__init__()
+        self._pending = {}
+        self._pending_signals = []
+        self._timer = None
+        self._posted.connect(self._enqueue)
+
+    def post(self, table, ids=None, signals=('data_changed',)):
+        """Báo bảng `table` vừa thay đổi (ids: id các dòng bị ảnh hưởng, None = không rõ).
+
+        Các post() trong CHANGE_WINDOW_MS được gộp: `changes` phát một lần với ChangeSet của tất cả
+        bảng/dòng, sau đó mỗi signal cũ trong `signals` (tên thuộc tính, vd. 'medication_dispensed')
+        phát đúng một lần cho các màn hình chưa chuyển sang `changes`.
+        """
+        self._posted.emit(table, None if ids is None else tuple(ids), tuple(signals))
+
+    def _enqueue(self, table, ids, signals):
+        if ids is None or self._pending.get(table, ()) is None:
+            self._pending[table] = None
+        else:
+            self._pending.setdefault(table, set()).update(ids)
+        for name in signals:
+            if name not in self._pending_signals:
+                self._pending_signals.append(name)
+        if self._timer is None:
+            self._timer = QTimer(self)
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self.flush)
+        if not self._timer.isActive():
+            self._timer.start(CHANGE_WINDOW_MS)
+
+    def flush(self):
+        """Phát ngay các thay đổi đang chờ (không chờ hết cửa sổ gộp)."""
+        if self._timer is not None:
+            self._timer.stop()
+        pending, names = self._pending, self._pending_signals
+        self._pending, self._pending_signals = {}, []
+        if pending:
+            self.changes.emit(ChangeSet(pending))
+        for name in names:
+            getattr(self, name).emit()
 
 
 app_signals = AppSignals()
@@ -0,0 +1,96 @@
+"""
+Theo dõi thay đổi do tiến trình khác ghi vào clinic.db (vd. chạy tiếp tân + bác sĩ cùng lúc bằng
+scripts/run_dual_login.py, hoặc web đặt lịch dat_lich_web.py).
+
+- Trigger ghi (bảng, id dòng) của mỗi INSERT/UPDATE/DELETE vào change_log (database._m014_change_log).
+- poll() trên kết nối riêng chỉ hỏi PRAGMA data_version (không đọc bảng nào); con số này chỉ đổi khi
+  một kết nối KHÁC vừa commit. Khi đó mới đọc các dòng change_log có id > lần đọc trước.
+- Kết quả được đưa vào app_signals.post() (xem forms/live_updates.py), nên màn hình nhận thay đổi
+  từ tiến trình khác giống hệt thay đổi trong tiến trình.
+
+- Các dòng change_log cũ hơn CHANGE_LOG_MAX_AGE_HOURS được xoá khi khởi động (forms/live_updates.py)
+  và định kỳ mỗi PRUNE_INTERVAL_SECONDS trong poll(), nên máy để mở nhiều ngày không làm bảng lớn mãi.
+  Lần dọn là một transaction ghi: poll() giao nó cho `submit` (live_updates dùng db_executor) để
+  GUI thread không phải chờ khoá ghi.
+
+Thay đổi của chính tiến trình này cũng được đọc lại (kết nối theo dõi không phân biệt nguồn);
+các listener đã chỉ cập nhật dòng bị ảnh hưởng / so phiên bản nên lần lặp lại này không tốn kém.
+"""
+import sqlite3
+import time
+
+from database import DB_NAME, get_change_log_head, prune_change_log
+
+# Quá nhiều dòng mới một lúc (import hàng loạt...): báo cả bảng thay vì liệt kê từng id
+MAX_ROWS_PER_POLL = 2000
+# Tuổi tối đa (giờ) của dòng change_log và chu kỳ dọn (giây)
+CHANGE_LOG_MAX_AGE_HOURS = 24
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class ChangeFeed:
+    def __init__(self, db_path=DB_NAME, clock=time.monotonic, submit=None):
+        """submit(fn): chạy fn ở nơi khác (vd. worker thread); mặc định gọi luôn fn()."""
+        self._db_path = db_path
+        self._conn = None
+        self._data_version = None
+        self._clock = clock
+        self._submit = submit or (lambda fn: fn())
+        self._next_prune = clock() + PRUNE_INTERVAL_SECONDS
+        self.last_id = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._db_path, timeout=5.0, isolation_level=None,
+                                         check_same_thread=False)
+        return self._conn
+
+    def start(self):
+        """Bắt đầu theo dõi từ thời điểm hiện tại (bỏ qua lịch sử cũ trong change_log)."""
+        self.last_id = get_change_log_head()
+        self._data_version = self._connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def poll(self):
+        """Các thay đổi mới kể từ lần gọi trước: {bảng: set(id) | None (cả bảng)}; {} nếu không có gì."""
+        if self.last_id is None:
+            self.start()
+            return {}
+        if self._clock() >= self._next_prune:
+            self._next_prune = self._clock() + PRUNE_INTERVAL_SECONDS
+            self._submit(self.prune)
+        conn = self._connection()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return {}
+        self._data_version = version
+        rows = conn.execute(
+            "SELECT id, bang, dong_id FROM change_log WHERE id > ? ORDER BY id LIMIT ?",
+            (self.last_id, MAX_ROWS_PER_POLL + 1)).fetchall()
+        if not rows:
+            return {}
+        changes = {}
+        if len(rows) > MAX_ROWS_PER_POLL:
+            head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()[0]
+            for (bang,) in conn.execute("SELECT DISTINCT bang FROM change_log WHERE id > ? AND id <= ?",
+                                        (self.last_id, head)):
+                changes[bang] = None
+            self.last_id = head
+            return changes
+        for _, bang, dong_id in rows:
+            changes.setdefault(bang, set()).add(dong_id)
+        self.last_id = rows[-1][0]
+        return changes
+
+    def prune(self):
+        """Xoá các dòng change_log cũ hơn CHANGE_LOG_MAX_AGE_HOURS. Trả về số dòng đã xoá."""
+        try:
+            return prune_change_log(CHANGE_LOG_MAX_AGE_HOURS)
+        except sqlite3.Error as e:
+            # DB đang bận (tiến trình khác giữ khoá ghi): lần dọn sau sẽ thử lại
+            print(f"Không dọn được change_log: {e}")
+            return 0
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,162 @@
+"""
+API JSON (v1) của web đặt lịch cho kiosk / ứng dụng di động, đăng ký vào app trong dat_lich_web.py.
+
+    GET /api/v1/appointments?ho_ten=...&so_cccd=...&limit=20&cursor=...
+    GET /api/v1/patients/<id>/visits?limit=20&cursor=...
+
+- Phân trang keyset: trang sau lấy bằng `next_cursor` của trang trước ((ngay_gio, id) của lịch hẹn,
+  (ngay_lap, id) của lần khám) nên trang nào cũng chỉ đọc `limit` dòng theo index.
+- ETag lấy từ bộ đếm thay đổi (ho_so_phien_ban của bệnh nhân / phiên bản 'lich_hen'): client gửi
+  If-None-Match và nhận 304 mà server không cần chạy truy vấn dữ liệu nào.
+- Nén gzip khi client chấp nhận và nội dung đủ lớn.
+"""
+import base64
+import gzip
+import hashlib
+import json
+
+from flask import Blueprint, Response, jsonify, request
+
+from database import (pool, get_data_version, get_patient_ehr, get_patient_record_version,
+                      search_appointments)
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# Nội dung nhỏ hơn ngưỡng này gửi nguyên (nén không lợi)
+GZIP_MIN_BYTES = 512
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def _api_error(e):
+    return jsonify(error=str(e)), e.status
+
+
+def _limit():
+    try:
+        return max(1, min(MAX_LIMIT, int(request.args.get('limit', DEFAULT_LIMIT))))
+    except ValueError:
+        raise ApiError("limit phải là số nguyên")
+
+
+def encode_cursor(ngay, row_id):
+    raw = json.dumps([ngay, row_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(ngay, id) từ cursor của trang trước; None nếu không có cursor."""
+    if not cursor:
+        return None
+    try:
+        ngay, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(ngay), int(row_id)
+    except (ValueError, TypeError):
+        raise ApiError("cursor không hợp lệ")
+
+
+def _etag(prefix, version):
+    # Phiên bản dữ liệu + tham số truy vấn (trang/bộ lọc khác nhau có ETag khác nhau)
+    args = hashlib.sha1(request.query_string).hexdigest()[:12]
+    return f"{prefix}-v{version}-{args}"
+
+
+def _not_modified(etag):
+    """Phản hồi 304 nếu client đã có bản ứng với `etag`, ngược lại None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    resp = Response(status=304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
+def _json(payload, etag):
+    resp = jsonify(payload)
+    resp.set_etag(etag, weak=True)
+    # Client luôn hỏi lại bằng If-None-Match (rẻ: 304 không có thân)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@api.after_request
+def gzip_response(resp):
+    resp.vary.add('Accept-Encoding')
+    if (resp.status_code != 200 or resp.direct_passthrough or 'Content-Encoding' in resp.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return resp
+    data = resp.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return resp
+    resp.set_data(gzip.compress(data, compresslevel=6))
+    resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+
+@api.route('/appointments', methods=['GET'])
+def appointments():
+    ho_ten = request.args.get('ho_ten', '').strip()
+    so_cccd = request.args.get('so_cccd', '').strip()
+    if not ho_ten:
+        raise ApiError("Thiếu tham số ho_ten")
+    limit = _limit()
+    before = decode_cursor(request.args.get('cursor'))
+
+    etag = _etag('lh', get_data_version('lich_hen'))
+    cached = _not_modified(etag)
+    if cached is not None:
+        return cached
+
+    rows = search_appointments(ho_ten, so_cccd or None, limit=limit + 1, before=before)
+    page = rows[:limit]
+    items = [{'id': r[0], 'ho_ten': r[1], 'ngay_gio': r[2], 'bac_si': r[3], 'loai_kham': r[4],
+              'trang_thai': r[5], 'nguoi_dat': r[6]} for r in page]
+    next_cursor = encode_cursor(page[-1][2], page[-1][0]) if len(rows) > limit else None
+    return _json({'items': items, 'next_cursor': next_cursor}, etag)
+
+
+def _visit_json(v):
+    return {
+        'id': v['id'], 'so_phieu': v['so_phieu'], 'ngay_lap': v['ngay_lap'], 'bac_si': v['bac_si'],
+        'phong_kham': v['phong_kham'], 'chan_doan': v['chan_doan'], 'ket_luan': v['ket_luan'],
+        'icd10': v['icd10'], 'di_ung_thuoc': v['di_ung_thuoc'], 'ghi_chu_kham': v['ghi_chu_kham'],
+        'don_thuoc': [{
+            'id': d['id'], 'ngay_ke': d['ngay_ke'], 'so_ngay': d['so_ngay'],
+            'ngay_tai_kham': d['ngay_tai_kham'], 'chan_doan': d['chan_doan'], 'loi_dan': d['loi_dan'],
+            'thuoc': [dict(zip(('ten_thuoc', 'so_luong', 'sang', 'trua', 'chieu', 'toi', 'lieu_dung', 'ghi_chu'), m))
+                      for m in d['meds']],
+        } for d in v['don_thuoc']],
+    }
+
+
+@api.route('/patients/<int:pid>/visits', methods=['GET'])
+def patient_visits(pid):
+    limit = _limit()
+    before = decode_cursor(request.args.get('cursor'))
+
+    etag = _etag(f'bn{pid}', get_patient_record_version(pid))
+    cached = _not_modified(etag)
+    if cached is not None:
+        return cached
+
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, ho_ten, ngay_sinh, dien_thoai, so_cccd FROM benh_nhan WHERE id = ?", (pid,))
+        patient = cur.fetchone()
+    if not patient:
+        raise ApiError("Không tìm thấy bệnh nhân", 404)
+
+    visits = get_patient_ehr(pid, before=before, limit=limit + 1)
+    page = visits[:limit]
+    next_cursor = encode_cursor(page[-1]['ngay_lap'], page[-1]['id']) if len(visits) > limit else None
+    return _json({
+        'patient': dict(zip(('id', 'ho_ten', 'ngay_sinh', 'dien_thoai', 'so_cccd'), patient)),
+        'items': [_visit_json(v) for v in page],
+        'next_cursor': next_cursor,
+    }, etag)
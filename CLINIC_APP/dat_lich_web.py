@@ -1,35 +1,71 @@
-from flask import Flask, render_template_string, request, redirect, url_for, flash, g
-import sqlite3
 import os
+import secrets
+
+from flask import Flask, render_template, request, redirect, url_for, flash, g, jsonify
+from jinja2 import ChoiceLoader, DictLoader
+from database import (pool, get_patient_ehr, search_patients, search_appointments, get_doctor_names,
+                      get_free_slots, book_appointment, reschedule_appointment, set_appointment_status,
+                      SlotFullError)
+from ref_cache import reference_cache
+from dat_lich_api import api
 
 app = Flask(__name__)
-app.secret_key = 'your_secret_key'
-DB_PATH = os.path.join(os.path.dirname(__file__), 'data', 'clinic.db')
+# Khoá ký cookie phiên / flash: lấy từ môi trường, không để trong mã nguồn (wsgi.py bắt buộc phải có)
+app.secret_key = os.environ.get('CLINIC_WEB_SECRET_KEY') or None
+# API JSON cho kiosk / di động: /api/v1/... (xem dat_lich_api.py)
+app.register_blueprint(api)
+
+
+def get_db():
+  # Mỗi request mượn đúng MỘT kết nối của pool (xem pin_connection); các helper và
+  # pool.read()/pool.write() trong database.py chạy lồng trên chính kết nối này
+  db = getattr(g, '_database', None)
+  if db is None:
+    db = g._database = pool.acquire()
+  return db
+
+
+@app.before_request
+def pin_connection():
+  get_db()
+
+
+@app.teardown_appcontext
+def close_connection(exception):
+  # Trả kết nối về pool (rollback nếu request bỏ dở transaction); kết nối thật vẫn mở cho request sau
+  db = g.pop('_database', None)
+  if db is not None:
+    db.close()
+
+
+# Số ngày tới hiển thị khung giờ trống trên form đặt lịch
+SLOT_DAYS = 14
+
+# Lịch hẹn gần đây đổi thường xuyên hơn danh sách bác sĩ: TTL ngắn, và bỏ ngay khi web ghi lich_hen
+RECENT_APPOINTMENTS_TTL = 10
 
 
 def get_bacsi_list():
-  conn = sqlite3.connect(DB_PATH)
-  cur = conn.cursor()
-  cur.execute("SELECT ten FROM nhan_su WHERE chuc_vu='Bác sĩ' ORDER BY ten ASC")
-  bacsi = [r[0] for r in cur.fetchall()]
-  conn.close()
-  return bacsi
+  # Danh sách bác sĩ dùng chung qua reference_cache (xem database.get_doctor_names)
+  return get_doctor_names()
 
 def get_loai_kham_list():
   # Return predefined visit types
   return ["Khám tư vấn", "Tái khám", "Khám theo yêu cầu"]
 
 
+def _load_recent_appointments(limit):
+  cur = get_db().cursor()
+  cur.execute("SELECT ho_ten, ngay_gio, bac_si, loai_kham, trang_thai, dien_thoai, dia_chi FROM lich_hen ORDER BY id DESC LIMIT ?", (limit,))
+  return cur.fetchall()
+
+
 def get_recent_appointments(limit=5):
-  conn = sqlite3.connect(DB_PATH)
-  cur = conn.cursor()
   try:
-    cur.execute("SELECT ho_ten, ngay_gio, bac_si, loai_kham, trang_thai, dien_thoai, dia_chi FROM lich_hen ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
+    rows = reference_cache.get(('lich_hen_gan_day', limit), lambda: _load_recent_appointments(limit),
+                               RECENT_APPOINTMENTS_TTL, depends=('lich_hen',))
   except Exception:
     rows = []
-  finally:
-    conn.close()
   return rows
 
 # HTML form template
@@ -87,7 +123,10 @@ FORM_HTML = '''
           </div>
           <div class="col-md-6">
             <label class="form-label required" for="ngay_gio">Ngày & Giờ khám</label>
-            <input class="form-control" id="ngay_gio" name="ngay_gio" type="datetime-local" required>
+            <!-- Chỉ các khung còn chỗ của bác sĩ đã chọn (tải từ /slots) -->
+            <select class="form-select" id="ngay_gio" name="ngay_gio" required>
+              <option value="" disabled selected>Chọn bác sĩ trước...</option>
+            </select>
           </div>
 
           <div class="col-md-6">
@@ -160,6 +199,41 @@ FORM_HTML = '''
         </div>
       </div>
 
+    <script>
+      (function(){
+        var doctor = document.getElementById('bac_si');
+        var slots = document.getElementById('ngay_gio');
+        if(!doctor || !slots) return;
+        function option(value, text, disabled){
+          var o = document.createElement('option');
+          o.value = value; o.textContent = text; o.disabled = !!disabled;
+          return o;
+        }
+        doctor.addEventListener('change', function(){
+          slots.innerHTML = '';
+          slots.appendChild(option('', 'Đang tải khung giờ...', true));
+          fetch('{{ url_for('free_slots') }}?bac_si=' + encodeURIComponent(doctor.value))
+            .then(function(r){ return r.json(); })
+            .then(function(data){
+              slots.innerHTML = '';
+              if(!data.slots.length){
+                slots.appendChild(option('', 'Bác sĩ đã kín lịch ' + data.days + ' ngày tới', true));
+                return;
+              }
+              slots.appendChild(option('', 'Chọn khung giờ...', true));
+              data.slots.forEach(function(s){
+                slots.appendChild(option(s.bat_dau, s.bat_dau + ' (còn ' + s.con_trong + ' chỗ)'));
+              });
+              slots.selectedIndex = 0;
+            })
+            .catch(function(){
+              slots.innerHTML = '';
+              slots.appendChild(option('', 'Không tải được khung giờ', true));
+            });
+        });
+      })();
+    </script>
+
     <!-- Bootstrap JS (CDN) -->
     <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js"></script>
   </body>
@@ -262,37 +336,30 @@ def dat_lich():
       return redirect(url_for('dat_lich'))
 
     try:
-      conn = sqlite3.connect(DB_PATH)
-      cur = conn.cursor()
-      cur.execute("""
-        INSERT INTO lich_hen (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, dien_thoai, dia_chi)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-      """, (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, "Đã đặt lịch", dien_thoai, dia_chi))
-      conn.commit()
-      conn.close()
+      # Giữ chỗ trong khung giờ của bác sĩ cùng transaction với INSERT (không thể đặt quá sức chứa)
+      book_appointment(ho_ten, ngay_gio, bac_si or None, loai_kham, ghi_chu, "Đã đặt lịch",
+                       dien_thoai=dien_thoai, dia_chi=dia_chi)
       flash('Đặt lịch thành công!')
       # Redirect to avoid duplicate form submission
       return redirect(url_for('dat_lich'))
+    except SlotFullError as e:
+      goi_y = ', '.join(b for b, _ in e.goi_y[:3])
+      flash(f'Khung giờ {e.bat_dau} của bác sĩ {e.bac_si} vừa hết chỗ.' + (f' Còn trống: {goi_y}' if goi_y else ''))
+      return redirect(url_for('dat_lich'))
     except Exception as e:
       # Bubble up a friendly error message
       flash(f'Không thể lưu lịch hẹn: {e}')
       return redirect(url_for('dat_lich'))
 
-  return render_template_string(FORM_HTML, bacsi_list=bacsi_list, loai_kham_list=loai_kham_list, recent_appointments=recent_appointments)
+  return render_template('dat_lich.html', bacsi_list=bacsi_list, loai_kham_list=loai_kham_list, recent_appointments=recent_appointments)
 
 
-def get_db():
-  db = getattr(g, '_database', None)
-  if db is None:
-    db = g._database = sqlite3.connect(DB_PATH)
-  return db
-
-
-@app.teardown_appcontext
-def close_connection(exception):
-  db = getattr(g, '_database', None)
-  if db is not None:
-    db.close()
+@app.route('/slots', methods=['GET'])
+def free_slots():
+  # Khung giờ còn chỗ của một bác sĩ trong SLOT_DAYS ngày tới (form đặt lịch gọi khi chọn bác sĩ)
+  bac_si = request.args.get('bac_si', '').strip()
+  slots = get_free_slots(bac_si, days=SLOT_DAYS) if bac_si else []
+  return jsonify(days=SLOT_DAYS, slots=[{'bat_dau': b, 'con_trong': n} for b, n in slots])
 
 
 @app.route('/my_appointments', methods=['GET', 'POST'])
@@ -303,28 +370,62 @@ def my_appointments():
   if request.method == 'POST':
     ho_ten = request.form.get('ho_ten', '').strip()
     so_cccd = request.form.get('so_cccd', '').strip()
-    db = get_db()
-    cur = db.cursor()
-    query = "SELECT id, ho_ten, ngay_gio, bac_si, loai_kham, trang_thai, nguoi_dat FROM lich_hen WHERE ho_ten LIKE ?"
-    params = [f"%{ho_ten}%"]
-    if so_cccd:
-      query += " AND so_cccd = ?"
-      params.append(so_cccd)
-    cur.execute(query, params)
-    appointments = cur.fetchall()
-  return render_template_string(MY_APPTS_HTML, appointments=appointments, ho_ten=ho_ten, so_cccd=so_cccd)
+    # Tìm qua bảng FTS lich_hen_fts (không dấu, khớp tiền tố) thay cho LIKE '%...%'
+    appointments = search_appointments(ho_ten, so_cccd or None)
+  return render_template('lich_hen_cua_toi.html', appointments=appointments, ho_ten=ho_ten, so_cccd=so_cccd)
 
 
 @app.route('/my_appointments/cancel/<int:lid>', methods=['POST'])
 def my_appointments_cancel(lid):
-  db = get_db()
-  cur = db.cursor()
-  cur.execute("UPDATE lich_hen SET trang_thai = ? WHERE id = ?", ('Đã hủy', lid))
-  db.commit()
+  set_appointment_status(lid, 'Đã hủy')
   flash('Đã hủy lịch hẹn.')
   return redirect(url_for('my_appointments'))
 
 
+EDIT_APPT_HTML = '''
+<!doctype html>
+<html lang="vi"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1"><title>Sửa lịch hẹn</title>
+<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
+<link href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/bootstrap-icons.css" rel="stylesheet">
+</head>
+<body><div class="container" style="max-width:680px;margin:32px auto;">
+<h4>Sửa lịch hẹn</h4>
+<form method="post">
+  <div class="mb-3">
+    <label class="form-label required">Họ và tên</label>
+    <input name="ho_ten" class="form-control" value="{{ ho_ten }}" required>
+  </div>
+  <div class="mb-3">
+    <label class="form-label">Ngày & giờ</label>
+    <div class="input-group">
+      <input id="ngay_gio_input" name="ngay_gio" type="datetime-local" class="form-control" value="{{ ngay_gio }}">
+      <button type="button" class="btn btn-outline-secondary" id="picker_btn" title="Chọn ngày"><i class="bi bi-calendar"></i></button>
+    </div>
+  </div>
+  <div class="mb-3"><label class="form-label">Ghi chú</label><textarea name="ghi_chu" class="form-control">{{ ghi_chu }}</textarea></div>
+  <button class="btn btn-primary">Lưu</button>
+  <a class="btn btn-outline-secondary" href="/my_appointments">Hủy</a>
+</form>
+</div>
+<script>
+  (function(){
+    var btn = document.getElementById('picker_btn');
+    var inp = document.getElementById('ngay_gio_input');
+    if(btn && inp){
+      btn.addEventListener('click', function(e){
+        // Try to open native picker if available, otherwise focus
+        if(typeof inp.showPicker === 'function'){
+          try{ inp.showPicker(); return; }catch(e){}
+        }
+        inp.focus();
+      });
+    }
+  })();
+</script>
+</body></html>
+'''
+
+
 @app.route('/my_appointments/edit/<int:lid>', methods=['GET', 'POST'])
 def my_appointments_edit(lid):
   db = get_db()
@@ -333,8 +434,15 @@ def my_appointments_edit(lid):
     ho_ten_new = request.form.get('ho_ten', '').strip()
     ngay_gio = request.form.get('ngay_gio')
     ghi_chu = request.form.get('ghi_chu')
-    cur.execute('UPDATE lich_hen SET ho_ten = ?, ngay_gio = ?, ghi_chu = ? WHERE id = ?', (ho_ten_new, ngay_gio, ghi_chu, lid))
-    db.commit()
+    try:
+      # Chuyển chỗ giữ sang khung giờ mới (trả chỗ cũ) trong một transaction
+      reschedule_appointment(lid, ngay_gio, ho_ten=ho_ten_new, ghi_chu=ghi_chu)
+    except SlotFullError as e:
+      flash(f'Khung giờ {e.bat_dau} đã hết chỗ, lịch hẹn giữ nguyên giờ cũ.')
+      return redirect(url_for('my_appointments_edit', lid=lid))
+    except ValueError as e:
+      flash(f'{e}. Lịch hẹn giữ nguyên giờ cũ.')
+      return redirect(url_for('my_appointments_edit', lid=lid))
     flash('Cập nhật lịch hẹn thành công.')
     return redirect(url_for('my_appointments'))
   cur.execute('SELECT id, ho_ten, ngay_gio, bac_si, loai_kham, trang_thai, ghi_chu, nguoi_dat FROM lich_hen WHERE id = ?', (lid,))
@@ -342,119 +450,27 @@ def my_appointments_edit(lid):
   if not row:
     flash('Không tìm thấy lịch hẹn.')
     return redirect(url_for('my_appointments'))
-  edit_html = '''
-  <!doctype html>
-  <html lang="vi"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1"><title>Sửa lịch hẹn</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/bootstrap-icons.css" rel="stylesheet">
-  </head>
-  <body><div class="container" style="max-width:680px;margin:32px auto;">
-  <h4>Sửa lịch hẹn</h4>
-  <form method="post">
-    <div class="mb-3">
-      <label class="form-label required">Họ và tên</label>
-      <input name="ho_ten" class="form-control" value="{{ ho_ten }}" required>
-    </div>
-    <div class="mb-3">
-      <label class="form-label">Ngày & giờ</label>
-      <div class="input-group">
-        <input id="ngay_gio_input" name="ngay_gio" type="datetime-local" class="form-control" value="{{ ngay_gio }}">
-        <button type="button" class="btn btn-outline-secondary" id="picker_btn" title="Chọn ngày"><i class="bi bi-calendar"></i></button>
-      </div>
-    </div>
-    <div class="mb-3"><label class="form-label">Ghi chú</label><textarea name="ghi_chu" class="form-control">{{ ghi_chu }}</textarea></div>
-    <button class="btn btn-primary">Lưu</button>
-    <a class="btn btn-outline-secondary" href="/my_appointments">Hủy</a>
-  </form>
-  </div>
-  <script>
-    (function(){
-      var btn = document.getElementById('picker_btn');
-      var inp = document.getElementById('ngay_gio_input');
-      if(btn && inp){
-        btn.addEventListener('click', function(e){
-          // Try to open native picker if available, otherwise focus
-          if(typeof inp.showPicker === 'function'){
-            try{ inp.showPicker(); return; }catch(e){}
-          }
-          inp.focus();
-        });
-      }
-    })();
-  </script>
-  </body></html>
-  '''
-  return render_template_string(edit_html, ho_ten=row[1], ngay_gio=row[2], ghi_chu=row[6])
+  return render_template('sua_lich_hen.html', ho_ten=row[1], ngay_gio=row[2], ghi_chu=row[6])
 
 
 # Helper functions for EHR search
 def find_patient_by_name_cccd(ho_ten, so_cccd):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT id, ho_ten, ngay_sinh, dien_thoai, so_cccd FROM benh_nhan WHERE ho_ten = ? AND so_cccd = ? LIMIT 1", (ho_ten, so_cccd))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return cur.fetchone()
 
 
-def find_patients_by_partial_name(name_part, limit=20):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    # Use LIKE search for partial match; keep parameterized queries
-    q = "SELECT id, ho_ten, ngay_sinh, dien_thoai, so_cccd FROM benh_nhan WHERE ho_ten LIKE ? ORDER BY ho_ten LIMIT ?"
-    cur.execute(q, (f"%{name_part}%", limit))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+EHR_PAGE_SIZE = 20
 
 
-def get_patient_visits(pid):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    # get phieu_kham (visits) for patient
-    cur.execute("SELECT id, so_phieu, ngay_lap, bac_si, phong_kham FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY datetime(ngay_lap) DESC", (pid,))
-    visits = []
-    pk_rows = cur.fetchall()
-    for pk in pk_rows:
-        pkid, so_phieu, ngay_lap, bac_si, phong_kham = pk
-        # latest detailed exam record for this visit
-        cur.execute("SELECT chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (pkid,))
-        detail = cur.fetchone() or ('', '', '', '', '')
-        chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham = detail
-
-        # prescriptions for this visit
-        cur.execute("SELECT id, ngay_ke, so_ngay, ngay_tai_kham, chan_doan, loi_dan FROM don_thuoc WHERE phieu_kham_id = ? ORDER BY ngay_ke DESC", (pkid,))
-        pres_rows = []
-        for p in cur.fetchall():
-            don_id, ngay_ke, so_ngay, ngay_tai_kham, don_chan_doan, loi_dan = p
-            cur.execute("SELECT ten_thuoc, so_luong, sang, trua, chieu, toi, lieu_dung, ghi_chu FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_id,))
-            meds = cur.fetchall()
-            pres_rows.append({
-                'id': don_id,
-                'ngay_ke': ngay_ke,
-                'so_ngay': so_ngay,
-                'ngay_tai_kham': ngay_tai_kham,
-                'chan_doan': don_chan_doan,
-                'loi_dan': loi_dan,
-                'meds': meds,
-            })
+def find_patients_by_partial_name(name_part, page=1, per_page=EHR_PAGE_SIZE):
+    # Tìm toàn văn (FTS5, không dấu) xếp theo độ liên quan; trả về (rows, total) của một trang
+    return search_patients(name_part, page=page, per_page=per_page)
 
-        visits.append({
-            'id': pkid,
-            'so_phieu': so_phieu,
-            'ngay_lap': ngay_lap,
-            'bac_si': bac_si,
-            'phong_kham': phong_kham,
-            'chan_doan': chan_doan,
-            'ket_luan': ket_luan,
-            'icd10': icd10,
-            'di_ung_thuoc': di_ung_thuoc,
-            'ghi_chu_kham': ghi_chu_kham,
-            'don_thuoc': pres_rows,
-        })
 
-    conn.close()
-    return visits
+def get_patient_visits(pid):
+    # Tải toàn bộ lần khám + đơn thuốc với số truy vấn cố định (xem database.get_patient_ehr)
+    return get_patient_ehr(pid)
 
 
 # EHR (hồ sơ bệnh án) search template + route
@@ -545,12 +561,25 @@ EHR_TEMPLATE = r'''
 
       {% if candidates %}
         <hr>
-        <h5>Những bản ghi khả dĩ</h5>
+        <h5>Những bản ghi khả dĩ <small class="text-muted">({{ total }} kết quả)</small></h5>
         <div class="list-group mb-3">
           {% for c in candidates %}
             <a href="{{ url_for('ehr_by_id', pid=c[0]) }}" class="list-group-item list-group-item-action">{{ c[1] }} — ID:{{ c[0] }} — {{ c[4] or 'CCCD trống' }} — {{ c[2] or '—' }}</a>
           {% endfor %}
         </div>
+        {% if pages > 1 %}
+          <nav>
+            <ul class="pagination pagination-sm">
+              <li class="page-item {{ 'disabled' if page <= 1 else '' }}">
+                <a class="page-link" href="{{ url_for('ehr_search', q=query, page=page - 1) }}">«</a>
+              </li>
+              <li class="page-item disabled"><span class="page-link">Trang {{ page }}/{{ pages }}</span></li>
+              <li class="page-item {{ 'disabled' if page >= pages else '' }}">
+                <a class="page-link" href="{{ url_for('ehr_search', q=query, page=page + 1) }}">»</a>
+              </li>
+            </ul>
+          </nav>
+        {% endif %}
       {% endif %}
 
     </div>
@@ -576,6 +605,9 @@ def ehr_search():
     patient = None
     visits = None
     candidates = None
+    query = ''
+    page = 1
+    total = 0
 
     if request.method == 'POST':
         ho_ten = request.form.get('ho_ten', '').strip()
@@ -586,6 +618,7 @@ def ehr_search():
             flash('Vui lòng nhập họ tên để tìm hồ sơ.')
             return redirect(url_for('ehr_search'))
 
+        query = ho_ten
         # if CCCD provided attempt exact match
         if so_cccd:
             row = find_patient_by_name_cccd(ho_ten, so_cccd)
@@ -594,33 +627,41 @@ def ehr_search():
                 visits = get_patient_visits(patient[0])
             else:
                 # not exact found -- fall through to partial search
-                candidates = find_patients_by_partial_name(ho_ten)
+                candidates, total = find_patients_by_partial_name(ho_ten)
                 if not candidates:
                     flash('Không tìm thấy bệnh nhân khớp với thông tin cung cấp.')
                     return redirect(url_for('ehr_search'))
         else:
             # partial name search
-            candidates = find_patients_by_partial_name(ho_ten)
-            if len(candidates) == 1:
+            candidates, total = find_patients_by_partial_name(ho_ten)
+            if total == 1:
                 patient = candidates[0]
                 visits = get_patient_visits(patient[0])
                 candidates = None
-            elif len(candidates) == 0:
+            elif total == 0:
                 flash('Không tìm thấy bệnh nhân khớp với tên cung cấp.')
                 return redirect(url_for('ehr_search'))
+    elif request.args.get('q', '').strip():
+        # Các trang tiếp theo của danh sách ứng viên (link phân trang)
+        query = request.args.get('q', '').strip()
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+        except ValueError:
+            page = 1
+        candidates, total = find_patients_by_partial_name(query, page=page)
 
-    return render_template_string(EHR_TEMPLATE, patient=patient, visits=visits, candidates=candidates)
+    pages = (total + EHR_PAGE_SIZE - 1) // EHR_PAGE_SIZE
+    return render_template('ehr.html', patient=patient, visits=visits, candidates=candidates,
+                                  query=query, page=page, pages=pages, total=total)
 
 
 @app.route('/ehr/patient/<int:pid>', methods=['GET'])
 def ehr_by_id(pid):
     row = None
     try:
-      conn = sqlite3.connect(DB_PATH)
-      cur = conn.cursor()
+      cur = get_db().cursor()
       cur.execute("SELECT id, ho_ten, ngay_sinh, dien_thoai, so_cccd FROM benh_nhan WHERE id = ? LIMIT 1", (pid,))
       row = cur.fetchone()
-      conn.close()
     except Exception:
       row = None
 
@@ -629,7 +670,26 @@ def ehr_by_id(pid):
       return redirect(url_for('ehr_search'))
 
     visits = get_patient_visits(pid)
-    return render_template_string(EHR_TEMPLATE, patient=row, visits=visits, candidates=None)
+    return render_template('ehr.html', patient=row, visits=visits, candidates=None)
+
+# Các template được biên dịch MỘT lần khi nạp module (render_template_string biên dịch lại nguồn
+# ở mỗi request). Jinja giữ bản đã biên dịch trong cache của app.jinja_env; DictLoader chỉ so chuỗi
+# nguồn khi kiểm tra cập nhật nên không đọc file nào.
+TEMPLATES = {
+    'dat_lich.html': FORM_HTML,
+    'lich_hen_cua_toi.html': MY_APPTS_HTML,
+    'sua_lich_hen.html': EDIT_APPT_HTML,
+    'ehr.html': EHR_TEMPLATE,
+}
+app.jinja_env.loader = ChoiceLoader([DictLoader(TEMPLATES), app.jinja_env.loader])
+for _name in TEMPLATES:
+    app.jinja_env.get_template(_name)
+
 
 if __name__ == '__main__':
+    # Server phát triển (debugger bật, một tiến trình); chạy thật dùng `python wsgi.py`
+    if not app.secret_key:
+        # Khoá tạm cho phiên phát triển: phiên đăng nhập / flash mất khi khởi động lại
+        app.secret_key = secrets.token_hex(32)
+        print("CLINIC_WEB_SECRET_KEY chưa đặt: dùng khoá ngẫu nhiên tạm thời (chỉ cho server phát triển)")
     app.run(debug=True, port=5000)
@@ -1,48 +1,74 @@
 import os
+import re
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os as _os
 import hashlib
 import binascii
 import secrets
+import threading
+from contextlib import nullcontext
+from db_pool import ConnectionManager
+from ref_cache import reference_cache, STAFF_TTL
 
-DB_NAME = os.path.join(os.path.dirname(__file__), "data", "clinic.db")
+# CLINIC_DB_PATH: chạy trên bản sao DB khác (vd. scripts/load_test_dat_lich_web.py)
+DB_NAME = os.environ.get('CLINIC_DB_PATH') or os.path.join(os.path.dirname(__file__), "data", "clinic.db")
+
+# Số giây một kết nối chờ khóa ghi trước khi báo 'database is locked' (busy handler của sqlite3).
+# Các khối ghi dùng BEGIN IMMEDIATE nên người ghi xếp hàng ở đây thay vì lỗi giữa transaction.
+DB_BUSY_TIMEOUT = float(os.environ.get('CLINIC_DB_BUSY_TIMEOUT', '20') or 20)
+
+
+# Pool kết nối dùng chung cho toàn ứng dụng (database.py, các form, dat_lich_web)
+pool = ConnectionManager(DB_NAME, timeout=DB_BUSY_TIMEOUT)
+
+# lower() của SQLite chỉ xử lý ký tự ASCII; tìm kiếm không phân biệt hoa thường với tên tiếng Việt dùng hàm này
+pool.create_function('lower_unicode', 1, lambda s: s.lower() if isinstance(s, str) else s)
 
 
 def get_connection():
     """
-    Tạo kết nối đến database với các thiết lập tối ưu:
+    Lấy kết nối tới database từ pool dùng chung:
+    - mỗi thread tái sử dụng một kết nối, PRAGMA (WAL...) chỉ chạy một lần
     - timeout: chờ tối đa 20 giây nếu database bị khóa
     - isolation_level: None để tự động commit
-    - check_same_thread: False để cho phép truy cập từ nhiều thread
+    - close() chỉ trả kết nối về pool, không đóng thật
+
+    Với code mới nên dùng `pool.read()` / `pool.write()` dạng context manager.
     """
     try:
-        conn = sqlite3.connect(DB_NAME, 
-                             timeout=20.0,
-                             isolation_level=None,
-                             check_same_thread=False)
-        # Enable WAL mode để tối ưu hiệu suất và tránh lock
-        conn.execute('PRAGMA journal_mode=WAL')
-        return conn
+        return pool.acquire()
     except sqlite3.Error as e:
         print(f"Lỗi khi kết nối database: {e}")
         raise
 
 
-def initialize_database():
-    conn = get_connection()
-    cursor = conn.cursor()
-    # Bảng bác sĩ
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS bac_si (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ten TEXT NOT NULL,
-            chuyen_khoa TEXT
-        )
-    """)
+# --- Migration theo phiên bản ---
+# Mỗi bước migration là một hàm nhận cursor, idempotent, KHÔNG tự commit.
+# Tất cả bước còn thiếu chạy chung trong một transaction; phiên bản đã áp dụng
+# được ghi vào bảng schema_version nên lần khởi động sau chỉ cần một truy vấn.
+# Khi thay đổi lược đồ (thêm cột, bảng, index...), thêm một bước mới vào cuối MIGRATIONS.
+
+def _table_columns(cur, table):
+    cur.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in cur.fetchall()]
+
+
+def _table_exists(cur, table):
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cur.fetchone() is not None
+
+
+def _add_column_if_missing(cur, table, column, decl):
+    if column not in _table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        print(f"Đã thêm cột '{column}' vào bảng {table}")
 
-    # New unified staff table (nhan_su) to support multiple roles: Bác sĩ, Tiếp tân, Dược sĩ
-    cursor.execute("""
+
+def _m001_base_schema(cur):
+    """Tạo toàn bộ bảng và đưa các DB cũ về cùng lược đồ."""
+    # Bảng nhân sự thống nhất (nhan_su) cho các vai trò: Bác sĩ, Tiếp tân, Dược sĩ
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS nhan_su (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ten TEXT NOT NULL,
@@ -50,53 +76,27 @@ def initialize_database():
             phong_kham TEXT
         )
     """)
-    
-    # Migration: if nhan_su has old 'chuyen_khoa' column, rename it to 'phong_kham'
-    try:
-        cursor.execute("PRAGMA table_info(nhan_su)")
-        cols = [r[1] for r in cursor.fetchall()]
-        if 'chuyen_khoa' in cols and 'phong_kham' not in cols:
-            print("Migrating nhan_su: renaming chuyen_khoa → phong_kham...")
-            conn.execute('BEGIN')
-            cursor.execute("""
-                CREATE TABLE nhan_su_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ten TEXT NOT NULL,
-                    chuc_vu TEXT NOT NULL DEFAULT 'Bác sĩ',
-                    phong_kham TEXT
-                )
-            """)
-            cursor.execute("""
-                INSERT INTO nhan_su_new (id, ten, chuc_vu, phong_kham)
-                SELECT id, ten, chuc_vu, chuyen_khoa FROM nhan_su
-            """)
-            cursor.execute("DROP TABLE nhan_su")
-            cursor.execute("ALTER TABLE nhan_su_new RENAME TO nhan_su")
-            conn.commit()
-            print("✅ Migration complete: nhan_su column renamed")
-    except Exception as e:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        print(f"⚠️ Migration warning: {e}")
-    
-    # If nhan_su is empty but bac_si has data, migrate existing doctors into nhan_su
-    try:
-        cursor.execute("SELECT COUNT(*) FROM nhan_su")
-        cnt_n = cursor.fetchone()[0]
-        if cnt_n == 0:
-            cursor.execute("SELECT COUNT(*) FROM bac_si")
-            cnt_b = cursor.fetchone()[0]
-            if cnt_b > 0:
-                cursor.execute("INSERT INTO nhan_su (ten, chuc_vu, phong_kham) SELECT ten, 'Bác sĩ', chuyen_khoa FROM bac_si")
-                print(f"Migrated {cnt_b} rows from bac_si to nhan_su")
-    except Exception:
-        # If any error (e.g., bac_si doesn't exist), ignore and continue
-        pass
+    # DB cũ: đổi tên cột chuyen_khoa → phong_kham
+    cols = _table_columns(cur, 'nhan_su')
+    if 'chuyen_khoa' in cols and 'phong_kham' not in cols:
+        print("Migrating nhan_su: renaming chuyen_khoa → phong_kham...")
+        cur.execute("""
+            CREATE TABLE nhan_su_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ten TEXT NOT NULL,
+                chuc_vu TEXT NOT NULL DEFAULT 'Bác sĩ',
+                phong_kham TEXT
+            )
+        """)
+        cur.execute("""
+            INSERT INTO nhan_su_new (id, ten, chuc_vu, phong_kham)
+            SELECT id, ten, chuc_vu, chuyen_khoa FROM nhan_su
+        """)
+        cur.execute("DROP TABLE nhan_su")
+        cur.execute("ALTER TABLE nhan_su_new RENAME TO nhan_su")
 
     # Bảng phòng khám
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS phong_kham (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ten TEXT NOT NULL,
@@ -104,9 +104,8 @@ def initialize_database():
         )
     """)
 
-    # Không tạo dữ liệu mẫu - cho phép người dùng nhập thông tin thực vào
     # Bảng lịch hẹn (đặt lịch khám)
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS lich_hen (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             benh_nhan_id INTEGER,
@@ -117,12 +116,42 @@ def initialize_database():
             ghi_chu TEXT,
             trang_thai TEXT DEFAULT 'chờ duyệt',
             nguoi_dat TEXT,
+            dien_thoai TEXT,
+            dia_chi TEXT,
             FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
         )
     """)
-
-    # Tạo bảng benh_nhan (thông tin bệnh nhân)
-    cursor.execute("""
+    # DB cũ: đổi cột phong_kham → loai_kham trong lich_hen
+    cols = _table_columns(cur, 'lich_hen')
+    if 'phong_kham' in cols and 'loai_kham' not in cols:
+        cur.execute("""
+            CREATE TABLE lich_hen_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                benh_nhan_id INTEGER,
+                ho_ten TEXT NOT NULL,
+                ngay_gio TEXT NOT NULL,
+                bac_si TEXT,
+                loai_kham TEXT,
+                ghi_chu TEXT,
+                trang_thai TEXT DEFAULT 'chờ duyệt',
+                nguoi_dat TEXT,
+                FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
+            )
+        """)
+        cur.execute("""
+            INSERT INTO lich_hen_new (id, benh_nhan_id, ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, nguoi_dat)
+            SELECT id, benh_nhan_id, ho_ten, ngay_gio, bac_si, phong_kham, ghi_chu, trang_thai, NULL FROM lich_hen
+        """)
+        cur.execute("DROP TABLE lich_hen")
+        cur.execute("ALTER TABLE lich_hen_new RENAME TO lich_hen")
+        print("✅ Đã migrate cột phong_kham → loai_kham trong bảng lich_hen")
+    _add_column_if_missing(cur, 'lich_hen', 'nguoi_dat', 'TEXT')
+    # số điện thoại / địa chỉ bệnh nhân tại thời điểm đặt
+    _add_column_if_missing(cur, 'lich_hen', 'dien_thoai', 'TEXT')
+    _add_column_if_missing(cur, 'lich_hen', 'dia_chi', 'TEXT')
+
+    # Bảng benh_nhan (thông tin bệnh nhân)
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS benh_nhan (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ho_ten TEXT NOT NULL,
@@ -138,39 +167,9 @@ def initialize_database():
             loai_kham TEXT
         )
     """)
-    # Nếu bảng đã tồn tại trước khi thêm cột mới, kiểm tra và thêm cột ghi_chu_kham nếu cần
-    cursor.execute("PRAGMA table_info(chi_tiet_phieu_kham)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    if 'ghi_chu_kham' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE chi_tiet_phieu_kham ADD COLUMN ghi_chu_kham TEXT")
-            print("Đã thêm cột 'ghi_chu_kham' vào bảng chi_tiet_phieu_kham")
-        except Exception:
-            # Nếu ALTER TABLE không khả dụng (rất hiếm), bỏ qua và để CREATE TABLE xử lý cho lần tạo mới
-            pass
-    # kiểm tra và thêm cột chidinh_cls nếu cần
-    cursor.execute("PRAGMA table_info(chi_tiet_phieu_kham)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    if 'chidinh_cls' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE chi_tiet_phieu_kham ADD COLUMN chidinh_cls TEXT")
-            print("Đã thêm cột 'chidinh_cls' vào bảng chi_tiet_phieu_kham")
-        except Exception:
-            pass
-    
-    # Kiểm tra và thêm cột gia_thuoc vào danh_muc_thuoc nếu cần
-    cursor.execute("PRAGMA table_info(danh_muc_thuoc)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    if 'gia_thuoc' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE danh_muc_thuoc ADD COLUMN gia_thuoc REAL DEFAULT 0")
-            print("Đã thêm cột 'gia_thuoc' vào bảng danh_muc_thuoc")
-        except Exception:
-            pass
 
-# Bảng phiếu khám
-    # Create phieu_kham WITHOUT the old 'chan_doan' column (we keep diagnosis in chi_dinh)
-    cursor.execute("""
+    # Bảng phiếu khám (không còn cột 'chan_doan' cũ — chẩn đoán nằm ở chi_dinh)
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS phieu_kham (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             so_phieu TEXT,
@@ -182,45 +181,30 @@ def initialize_database():
             FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
         )
     """)
-
-    # Migration: if an existing phieu_kham table had a 'chan_doan' column, remove it
-    try:
-        cursor.execute("PRAGMA table_info(phieu_kham)")
-        pk_cols = [r[1] for r in cursor.fetchall()]
-        if 'chan_doan' in pk_cols:
-            print("Found legacy column 'chan_doan' in phieu_kham — migrating to remove it...")
-            # Create a new table without the chan_doan column, copy data, replace table
-            conn.execute('BEGIN')
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS phieu_kham_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    so_phieu TEXT,
-                    benh_nhan_id INTEGER,
-                    ngay_lap TEXT,
-                    bac_si TEXT,
-                    phong_kham TEXT,
-                    tong_tien REAL DEFAULT 0,
-                    FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
-                )
-            """)
-            # Copy existing data, ignoring 'chan_doan'
-            cursor.execute("""
-                INSERT INTO phieu_kham_new (id, so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien)
-                SELECT id, so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien FROM phieu_kham
-            """)
-            cursor.execute("DROP TABLE phieu_kham")
-            cursor.execute("ALTER TABLE phieu_kham_new RENAME TO phieu_kham")
-            conn.commit()
-            print("Migration complete: removed 'chan_doan' from phieu_kham")
-    except Exception as e:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        print(f"Warning: phieu_kham migration failed or unnecessary: {e}")
+    if 'chan_doan' in _table_columns(cur, 'phieu_kham'):
+        print("Found legacy column 'chan_doan' in phieu_kham — migrating to remove it...")
+        cur.execute("""
+            CREATE TABLE phieu_kham_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                so_phieu TEXT,
+                benh_nhan_id INTEGER,
+                ngay_lap TEXT,
+                bac_si TEXT,
+                phong_kham TEXT,
+                tong_tien REAL DEFAULT 0,
+                FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
+            )
+        """)
+        cur.execute("""
+            INSERT INTO phieu_kham_new (id, so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien)
+            SELECT id, so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien FROM phieu_kham
+        """)
+        cur.execute("DROP TABLE phieu_kham")
+        cur.execute("ALTER TABLE phieu_kham_new RENAME TO phieu_kham")
+        print("Migration complete: removed 'chan_doan' from phieu_kham")
 
     # Bảng chỉ định dịch vụ
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS chi_dinh (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             so_chi_dinh TEXT,
@@ -229,28 +213,16 @@ def initialize_database():
             so_luong INTEGER DEFAULT 1,
             don_gia REAL,
             thanh_tien REAL,
+            kham_lam_sang TEXT,
+            chan_doan_ban_dau TEXT,
             FOREIGN KEY (phieu_kham_id) REFERENCES phieu_kham(id)
         )
     """)
+    _add_column_if_missing(cur, 'chi_dinh', 'kham_lam_sang', 'TEXT')
+    _add_column_if_missing(cur, 'chi_dinh', 'chan_doan_ban_dau', 'TEXT')
 
-    # Kiểm tra và thêm cột kham_lam_sang và chan_doan vào chi_dinh nếu cần
-    cursor.execute("PRAGMA table_info(chi_dinh)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    if 'kham_lam_sang' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE chi_dinh ADD COLUMN kham_lam_sang TEXT")
-            print("Đã thêm cột 'kham_lam_sang' vào bảng chi_dinh")
-        except Exception:
-            pass
-    if 'chan_doan_ban_dau' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE chi_dinh ADD COLUMN chan_doan_ban_dau TEXT")
-            print("Đã thêm cột 'chan_doan_ban_dau' vào bảng chi_dinh")
-        except Exception:
-            pass
-
-    # Tạo bảng tiep_don (tiếp đón khám)
-    cursor.execute("""
+    # Bảng tiep_don (tiếp đón khám)
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS tiep_don (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ma_hoso TEXT,
@@ -271,39 +243,14 @@ def initialize_database():
             FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
         )
     """)
-    
-    # Kiểm tra và thêm các cột nhip_tho, nhip_tim vào tiep_don nếu cần
-    cursor.execute("PRAGMA table_info(tiep_don)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    # Nếu thiếu cột chieu_cao (phiên bản cũ của DB), thêm vào
-    if 'chieu_cao' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE tiep_don ADD COLUMN chieu_cao REAL")
-            print("Đã thêm cột 'chieu_cao' vào bảng tiep_don")
-        except Exception:
-            pass
-    if 'nhip_tho' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE tiep_don ADD COLUMN nhip_tho INTEGER")
-            print("Đã thêm cột 'nhip_tho' vào bảng tiep_don")
-        except Exception:
-            pass
-    if 'nhip_tim' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE tiep_don ADD COLUMN nhip_tim INTEGER")
-            print("Đã thêm cột 'nhip_tim' vào bảng tiep_don")
-        except Exception:
-            pass
-    # Thêm cột da_kham để đánh dấu đã khám/hủy khám nếu cần
-    if 'da_kham' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE tiep_don ADD COLUMN da_kham INTEGER DEFAULT 0")
-            print("Đã thêm cột 'da_kham' vào bảng tiep_don")
-        except Exception:
-            pass
+    _add_column_if_missing(cur, 'tiep_don', 'chieu_cao', 'REAL')
+    _add_column_if_missing(cur, 'tiep_don', 'nhip_tho', 'INTEGER')
+    _add_column_if_missing(cur, 'tiep_don', 'nhip_tim', 'INTEGER')
+    # da_kham: đánh dấu đã khám/hủy khám
+    _add_column_if_missing(cur, 'tiep_don', 'da_kham', 'INTEGER DEFAULT 0')
 
     # Bảng chi tiết phiếu khám
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS chi_tiet_phieu_kham (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             phieu_kham_id INTEGER NOT NULL,
@@ -322,23 +269,16 @@ def initialize_database():
             kham_lam_sang TEXT,
             chan_doan TEXT,
             ket_luan TEXT,
-                ghi_chu_kham TEXT,
-                FOREIGN KEY (phieu_kham_id) REFERENCES phieu_kham(id) ON DELETE CASCADE
+            ghi_chu_kham TEXT,
+            FOREIGN KEY (phieu_kham_id) REFERENCES phieu_kham(id) ON DELETE CASCADE
         )
     """)
-
-    # Đảm bảo cột chieu_cao có trong chi_tiet_phieu_kham (migration cho DB cũ)
-    cursor.execute("PRAGMA table_info(chi_tiet_phieu_kham)")
-    _existing = [r[1] for r in cursor.fetchall()]
-    if 'chieu_cao' not in _existing:
-        try:
-            cursor.execute("ALTER TABLE chi_tiet_phieu_kham ADD COLUMN chieu_cao REAL")
-            print("Đã thêm cột 'chieu_cao' vào bảng chi_tiet_phieu_kham")
-        except Exception:
-            pass
+    _add_column_if_missing(cur, 'chi_tiet_phieu_kham', 'ghi_chu_kham', 'TEXT')
+    _add_column_if_missing(cur, 'chi_tiet_phieu_kham', 'chidinh_cls', 'TEXT')
+    _add_column_if_missing(cur, 'chi_tiet_phieu_kham', 'chieu_cao', 'REAL')
 
     # Bảng thanh_toan (ghi nhận thu tiền từ dịch vụ / thuốc)
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS thanh_toan (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ngay TEXT,
@@ -349,7 +289,7 @@ def initialize_database():
     """)
 
     # Bảng đơn thuốc
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS don_thuoc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             phieu_kham_id INTEGER NOT NULL,
@@ -370,9 +310,13 @@ def initialize_database():
             FOREIGN KEY (phieu_kham_id) REFERENCES phieu_kham(id) ON DELETE CASCADE
         )
     """)
+    # Cột phục vụ xuất thuốc
+    _add_column_if_missing(cur, 'don_thuoc', 'da_xuat', 'INTEGER DEFAULT 0')
+    _add_column_if_missing(cur, 'don_thuoc', 'xuat_boi_user_id', 'INTEGER')
+    _add_column_if_missing(cur, 'don_thuoc', 'ngay_xuat', 'TEXT')
 
     # Bảng danh mục ICD10
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS danh_muc_icd10 (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             code TEXT UNIQUE NOT NULL,
@@ -381,7 +325,7 @@ def initialize_database():
     """)
 
     # Bảng danh mục thuốc
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS danh_muc_thuoc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ma_thuoc TEXT UNIQUE NOT NULL,
@@ -391,9 +335,10 @@ def initialize_database():
             ton_kho INTEGER DEFAULT 0
         )
     """)
+    _add_column_if_missing(cur, 'danh_muc_thuoc', 'gia_thuoc', 'REAL DEFAULT 0')
 
     # Bảng lịch sử nhập thuốc
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS nhap_thuoc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ngay TEXT,
@@ -406,7 +351,7 @@ def initialize_database():
     """)
 
     # Bảng chi tiết đơn thuốc
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS chi_tiet_don_thuoc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             don_thuoc_id INTEGER NOT NULL,
@@ -416,7 +361,7 @@ def initialize_database():
             don_vi TEXT,
             sang TEXT,
             trua TEXT,
-            chieu TEXT, 
+            chieu TEXT,
             toi TEXT,
             lieu_dung TEXT,
             ghi_chu TEXT,
@@ -424,52 +369,24 @@ def initialize_database():
             FOREIGN KEY (ma_thuoc) REFERENCES danh_muc_thuoc(ma_thuoc)
         )
     """)
-    
-    # Bảng mẫu đơn (templates)
-    cursor.execute("""
+
+    # Bảng mẫu đơn (templates) — các cột dùng bởi forms/don_thuoc.py
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS don_mau (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ten_mau TEXT,
-            ngay_tao TEXT
+            ngay_tao TEXT,
+            chan_doan TEXT,
+            loi_dan TEXT,
+            bac_si TEXT,
+            quay_thuoc TEXT,
+            nguoi_lap_phieu TEXT
         )
     """)
+    for col in ('chan_doan', 'loi_dan', 'bac_si', 'quay_thuoc', 'nguoi_lap_phieu'):
+        _add_column_if_missing(cur, 'don_mau', col, 'TEXT')
 
-    # Migration: ensure don_mau has columns expected by forms/don_thuoc.py
-    cursor.execute("PRAGMA table_info(don_mau)")
-    _cols = [r[1] for r in cursor.fetchall()]
-    # Add commonly referenced columns if missing
-    if 'chan_doan' not in _cols:
-        try:
-            cursor.execute("ALTER TABLE don_mau ADD COLUMN chan_doan TEXT")
-            print("Đã thêm cột 'chan_doan' vào bảng don_mau")
-        except Exception:
-            pass
-    if 'loi_dan' not in _cols:
-        try:
-            cursor.execute("ALTER TABLE don_mau ADD COLUMN loi_dan TEXT")
-            print("Đã thêm cột 'loi_dan' vào bảng don_mau")
-        except Exception:
-            pass
-    if 'bac_si' not in _cols:
-        try:
-            cursor.execute("ALTER TABLE don_mau ADD COLUMN bac_si TEXT")
-            print("Đã thêm cột 'bac_si' vào bảng don_mau")
-        except Exception:
-            pass
-    if 'quay_thuoc' not in _cols:
-        try:
-            cursor.execute("ALTER TABLE don_mau ADD COLUMN quay_thuoc TEXT")
-            print("Đã thêm cột 'quay_thuoc' vào bảng don_mau")
-        except Exception:
-            pass
-    if 'nguoi_lap_phieu' not in _cols:
-        try:
-            cursor.execute("ALTER TABLE don_mau ADD COLUMN nguoi_lap_phieu TEXT")
-            print("Đã thêm cột 'nguoi_lap_phieu' vào bảng don_mau")
-        except Exception:
-            pass
-
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS chi_tiet_don_mau (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             don_mau_id INTEGER NOT NULL,
@@ -488,7 +405,7 @@ def initialize_database():
     """)
 
     # Bảng đơn thuốc bổ sung
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS don_thuoc_bo_sung (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             phieu_kham_id INTEGER NOT NULL,
@@ -503,42 +420,13 @@ def initialize_database():
             bac_si TEXT,
             quay_thuoc TEXT,
             nguoi_lap_phieu TEXT,
+            xuat_thuoc INTEGER DEFAULT 0,
             FOREIGN KEY (phieu_kham_id) REFERENCES phieu_kham(id) ON DELETE CASCADE
         )
     """)
+    _add_column_if_missing(cur, 'don_thuoc_bo_sung', 'xuat_thuoc', 'INTEGER DEFAULT 0')
 
-    # Migration: ensure don_thuoc has dispensing columns
-    cursor.execute("PRAGMA table_info(don_thuoc)")
-    _don_cols = [r[1] for r in cursor.fetchall()]
-    if 'da_xuat' not in _don_cols:
-        try:
-            cursor.execute("ALTER TABLE don_thuoc ADD COLUMN da_xuat INTEGER DEFAULT 0")
-            print("Đã thêm cột 'da_xuat' vào bảng don_thuoc")
-        except Exception:
-            pass
-    if 'xuat_boi_user_id' not in _don_cols:
-        try:
-            cursor.execute("ALTER TABLE don_thuoc ADD COLUMN xuat_boi_user_id INTEGER")
-            print("Đã thêm cột 'xuat_boi_user_id' vào bảng don_thuoc")
-        except Exception:
-            pass
-    if 'ngay_xuat' not in _don_cols:
-        try:
-            cursor.execute("ALTER TABLE don_thuoc ADD COLUMN ngay_xuat TEXT")
-            print("Đã thêm cột 'ngay_xuat' vào bảng don_thuoc")
-        except Exception:
-            pass
-
-    # Migration: ensure don_thuoc_bo_sung has xuat_thuoc column
-    cursor.execute("PRAGMA table_info(don_thuoc_bo_sung)")
-    _don_bo_sung_cols = [r[1] for r in cursor.fetchall()]
-    if 'xuat_thuoc' not in _don_bo_sung_cols:
-        try:
-            cursor.execute("ALTER TABLE don_thuoc_bo_sung ADD COLUMN xuat_thuoc INTEGER DEFAULT 0")
-            print("Đã thêm cột 'xuat_thuoc' vào bảng don_thuoc_bo_sung")
-        except Exception as e:
-            print(f"Lỗi khi thêm cột 'xuat_thuoc': {e}")
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS chi_tiet_don_thuoc_bo_sung (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             don_thuoc_bo_sung_id INTEGER NOT NULL,
@@ -556,10 +444,9 @@ def initialize_database():
             FOREIGN KEY (ma_thuoc) REFERENCES danh_muc_thuoc(ma_thuoc)
         )
     """)
-    conn.commit()
 
     # Bảng lịch sử xuất thuốc
-    cursor.execute("""
+    cur.execute("""
         CREATE TABLE IF NOT EXISTS lich_su_xuat_thuoc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             don_thuoc_id INTEGER NOT NULL,
@@ -572,10 +459,9 @@ def initialize_database():
             FOREIGN KEY (don_thuoc_id) REFERENCES don_thuoc(id) ON DELETE CASCADE
         )
     """)
-    conn.commit()
 
     # Bảng users để quản lý đăng nhập
-    cursor.execute('''
+    cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -585,73 +471,60 @@ def initialize_database():
             full_name TEXT
         )
     ''')
-    conn.commit()
-
-    # Nếu chưa có user nào, tạo user admin mặc định (mật khẩu 'admin')
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
-    if user_count == 0:
-        try:
-            # tạo admin mặc định — người dùng nên đổi mật khẩu khi lần đầu đăng nhập
-            create_user('admin', 'admin', role='admin')
-            print("Đã tạo user 'admin' mặc định với mật khẩu 'admin'. Vui lòng đổi mật khẩu ngay.")
-        except Exception:
-            pass
-
-    # Bảng tiếp tân (receptionist)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tiep_tan (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ten TEXT NOT NULL,
-            user_id INTEGER UNIQUE,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-    conn.commit()
-
-    # Backup and drop legacy tables `bac_si` and `tiep_tan` if they exist.
-    # We export CSV backups into data/backups for safety before dropping.
-    try:
-        backup_dir = os.path.join(os.path.dirname(__file__), 'data', 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        for tbl in ('bac_si', 'tiep_tan'):
+    _add_column_if_missing(cur, 'users', 'full_name', 'TEXT')
+
+    # Bảng user_sessions theo dõi đăng nhập/đăng xuất
+    cur.execute("CREATE TABLE IF NOT EXISTS user_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, login_time TEXT, logout_time TEXT)")
+
+
+def _m002_legacy_staff_tables(cur):
+    """Chuyển bác sĩ từ bảng cũ `bac_si` sang nhan_su, sao lưu CSV rồi xoá `bac_si`/`tiep_tan`."""
+    cur.execute("SELECT COUNT(*) FROM nhan_su")
+    if cur.fetchone()[0] == 0 and _table_exists(cur, 'bac_si'):
+        cur.execute("SELECT COUNT(*) FROM bac_si")
+        cnt_b = cur.fetchone()[0]
+        if cnt_b > 0:
+            cur.execute("INSERT INTO nhan_su (ten, chuc_vu, phong_kham) SELECT ten, 'Bác sĩ', chuyen_khoa FROM bac_si")
+            print(f"Migrated {cnt_b} rows from bac_si to nhan_su")
+
+    backup_dir = os.path.join(os.path.dirname(__file__), 'data', 'backups')
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    for tbl in ('bac_si', 'tiep_tan'):
+        if not _table_exists(cur, tbl):
+            continue
+        cur.execute(f"SELECT * FROM {tbl}")
+        rows = cur.fetchall()
+        cols = [d[0] for d in cur.description] if cur.description else []
+        if rows:
+            # best-effort: lỗi ghi file sao lưu không chặn migration
             try:
-                cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (tbl,))
-                if cursor.fetchone():
-                    # export to CSV
-                    cursor.execute(f"SELECT * FROM {tbl}")
-                    rows = cursor.fetchall()
-                    cols = [d[0] for d in cursor.description] if cursor.description else []
-                    if rows:
-                        out_path = os.path.join(backup_dir, f"{tbl}_backup_{timestamp}.csv")
-                        try:
-                            import csv as _csv
-                            with open(out_path, 'w', newline='', encoding='utf-8') as f:
-                                writer = _csv.writer(f)
-                                writer.writerow(cols)
-                                writer.writerows(rows)
-                        except Exception:
-                            pass
-                    # drop table
-                    try:
-                        cursor.execute(f"DROP TABLE IF EXISTS {tbl}")
-                        conn.commit()
-                    except Exception:
-                        pass
+                import csv as _csv
+                os.makedirs(backup_dir, exist_ok=True)
+                out_path = os.path.join(backup_dir, f"{tbl}_backup_{timestamp}.csv")
+                with open(out_path, 'w', newline='', encoding='utf-8') as f:
+                    writer = _csv.writer(f)
+                    writer.writerow(cols)
+                    writer.writerows(rows)
             except Exception:
-                # ignore errors per-table and continue with next table
                 pass
-    except Exception:
-        # best-effort backup/drop; ignore failures
-        pass
+        cur.execute(f"DROP TABLE IF EXISTS {tbl}")
 
-    # Không tạo dữ liệu mẫu cho danh_muc_thuoc - cho phép người dùng nhập dữ liệu thực
 
-    # Thêm một số mã ICD10 mẫu nếu bảng danh_muc_icd10 trống
-    cursor.execute("SELECT COUNT(*) FROM danh_muc_icd10")
-    icd10_count = cursor.fetchone()[0]
-    if icd10_count == 0:
+def _m003_seed_data(cur):
+    """Dữ liệu khởi tạo: tài khoản admin mặc định và một số mã ICD10 mẫu."""
+    # Nếu chưa có user nào, tạo user admin mặc định (mật khẩu 'admin')
+    cur.execute("SELECT COUNT(*) FROM users")
+    if cur.fetchone()[0] == 0:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cur.execute(
+            "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)",
+            ('admin', _hash_password('admin'), 'admin', now),
+        )
+        print("Đã tạo user 'admin' mặc định với mật khẩu 'admin'. Vui lòng đổi mật khẩu ngay.")
+
+    # Không tạo dữ liệu mẫu cho danh_muc_thuoc - cho phép người dùng nhập dữ liệu thực
+    cur.execute("SELECT COUNT(*) FROM danh_muc_icd10")
+    if cur.fetchone()[0] == 0:
         sample_icd10 = [
             ("J45", "Hen phế quản"),
             ("J06", "Nhiễm trùng đường hô hấp trên"),
@@ -669,91 +542,769 @@ def initialize_database():
             ("N39", "Các rối loạn về tiểu tiện khác"),
             ("L20", "Viêm da dị ứng"),
         ]
-        cursor.executemany(
+        cur.executemany(
             "INSERT OR IGNORE INTO danh_muc_icd10 (code, description) VALUES (?, ?)",
             sample_icd10
         )
-        conn.commit()
 
     # 🧹 Chỉ reset ID nếu database trống (để không ảnh hưởng dữ liệu thật)
-    cursor.execute("SELECT COUNT(*) FROM benh_nhan")
-    benhnhan_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM tiep_don")
-    tiepdon_count = cursor.fetchone()[0]
-
+    cur.execute("SELECT COUNT(*) FROM benh_nhan")
+    benhnhan_count = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM tiep_don")
+    tiepdon_count = cur.fetchone()[0]
     if benhnhan_count == 0 and tiepdon_count == 0:
-        cursor.execute("DELETE FROM sqlite_sequence;")
+        cur.execute("DELETE FROM sqlite_sequence")
         print("🔁 Đã reset lại ID tự động vì database đang trống.")
-    
-    # Migration: Rename phong_kham to loai_kham in lich_hen table
-    cursor.execute("PRAGMA table_info(lich_hen)")
-    existing_cols_lich_hen = [r[1] for r in cursor.fetchall()]
-    
-    # Thêm cột nguoi_dat nếu chưa có
-    if 'nguoi_dat' not in existing_cols_lich_hen:
-        try:
-            cursor.execute("ALTER TABLE lich_hen ADD COLUMN nguoi_dat TEXT")
-            print("Đã thêm cột 'nguoi_dat' vào bảng lich_hen")
-        except Exception:
-            pass
 
-    # Thêm cột dien_thoai nếu chưa có (số điện thoại bệnh nhân tại thời điểm đặt)
-    if 'dien_thoai' not in existing_cols_lich_hen:
-        try:
-            cursor.execute("ALTER TABLE lich_hen ADD COLUMN dien_thoai TEXT")
-            print("Đã thêm cột 'dien_thoai' vào bảng lich_hen")
-        except Exception:
-            pass
 
-    # Thêm cột dia_chi nếu chưa có (địa chỉ bệnh nhân tại thời điểm đặt)
-    if 'dia_chi' not in existing_cols_lich_hen:
-        try:
-            cursor.execute("ALTER TABLE lich_hen ADD COLUMN dia_chi TEXT")
-            print("Đã thêm cột 'dia_chi' vào bảng lich_hen")
-        except Exception:
-            pass
-    
-    if 'phong_kham' in existing_cols_lich_hen and 'loai_kham' not in existing_cols_lich_hen:
-        try:
-            # SQLite doesn't support direct ALTER COLUMN RENAME in older versions
-            # Use CREATE TABLE AS SELECT approach
-            cursor.execute("""
-                CREATE TABLE lich_hen_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    benh_nhan_id INTEGER,
-                    ho_ten TEXT NOT NULL,
-                    ngay_gio TEXT NOT NULL,
-                    bac_si TEXT,
-                    loai_kham TEXT,
-                    ghi_chu TEXT,
-                    trang_thai TEXT DEFAULT 'chờ duyệt',
-                    nguoi_dat TEXT,
-                    FOREIGN KEY (benh_nhan_id) REFERENCES benh_nhan(id)
-                )
-            """)
-            cursor.execute("""
-                INSERT INTO lich_hen_new (id, benh_nhan_id, ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, nguoi_dat)
-                SELECT id, benh_nhan_id, ho_ten, ngay_gio, bac_si, phong_kham, ghi_chu, trang_thai, NULL FROM lich_hen
+def _m004_prescription_flags(cur):
+    """Cột trạng thái đơn thuốc và bảng thuoc_khac (trước đây được ALTER/CREATE lúc chạy trong form kê đơn)."""
+    # da_luu: đã lưu; da_gui_cong_duoc: đã gửi tới cổng dược
+    for tbl in ('don_thuoc', 'don_thuoc_bo_sung'):
+        _add_column_if_missing(cur, tbl, 'da_luu', 'INTEGER DEFAULT 0')
+        _add_column_if_missing(cur, tbl, 'da_gui_cong_duoc', 'INTEGER DEFAULT 0')
+
+    # Bảng 'thuốc khác' lưu các mục thuốc do người dùng tự nhập
+    if _table_exists(cur, 'thuoc_khac'):
+        cols = _table_columns(cur, 'thuoc_khac')
+        if ('created_by' not in cols) and ('created_at' not in cols) and ('don_thuoc_id' in cols):
+            return
+        # Lược đồ cũ: chuyển sang bảng mới, giữ lại ten_thuoc/don_vi/ghi_chu
+        cur.execute("""
+            CREATE TABLE thuoc_khac_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ten_thuoc TEXT NOT NULL,
+                don_vi TEXT,
+                ghi_chu TEXT,
+                don_thuoc_id INTEGER
+            )
+        """)
+        copy_cols = [c for c in ('ten_thuoc', 'don_vi', 'ghi_chu') if c in cols]
+        if copy_cols:
+            src_cols = ', '.join(copy_cols)
+            cur.execute(f"INSERT INTO thuoc_khac_new ({src_cols}) SELECT {src_cols} FROM thuoc_khac")
+        cur.execute("DROP TABLE thuoc_khac")
+        cur.execute("ALTER TABLE thuoc_khac_new RENAME TO thuoc_khac")
+    else:
+        cur.execute("""
+            CREATE TABLE thuoc_khac (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ten_thuoc TEXT NOT NULL,
+                don_vi TEXT,
+                ghi_chu TEXT,
+                don_thuoc_id INTEGER
+            )
+        """)
+
+
+def _m005_indexes(cur):
+    """Tạo các index phụ trong INDEXES."""
+    ensure_indexes(cur.connection)
+
+
+def _rebuild_doanh_thu_ngay(cur):
+    """Tính lại toàn bộ bảng tổng hợp doanh_thu_ngay từ thanh_toan."""
+    version = _bump_data_version(cur, 'doanh_thu')
+    cur.execute("DELETE FROM doanh_thu_ngay")
+    cols = _table_columns(cur, 'doanh_thu_ngay')
+    if 'so_giao_dich' in cols:
+        cur.execute("""
+            INSERT INTO doanh_thu_ngay (ngay, dich_vu, thuoc, tong, so_giao_dich, phien_ban)
+            SELECT COALESCE(DATE(ngay), ''),
+                   TOTAL(CASE WHEN loai = 'Dịch vụ' THEN so_tien ELSE 0 END),
+                   TOTAL(CASE WHEN loai = 'Thuốc' THEN so_tien ELSE 0 END),
+                   TOTAL(so_tien),
+                   COUNT(*),
+                   ?
+            FROM thanh_toan
+            GROUP BY COALESCE(DATE(ngay), '')
+        """, (version,))
+    else:
+        # Lược đồ của migration 6 (chưa có so_giao_dich)
+        cur.execute("""
+            INSERT INTO doanh_thu_ngay (ngay, dich_vu, thuoc, tong, phien_ban)
+            SELECT COALESCE(DATE(ngay), ''),
+                   TOTAL(CASE WHEN loai = 'Dịch vụ' THEN so_tien ELSE 0 END),
+                   TOTAL(CASE WHEN loai = 'Thuốc' THEN so_tien ELSE 0 END),
+                   TOTAL(so_tien),
+                   ?
+            FROM thanh_toan
+            GROUP BY COALESCE(DATE(ngay), '')
+        """, (version,))
+
+
+def _m006_revenue_rollup(cur):
+    """Bảng tổng hợp doanh thu theo ngày và bộ đếm phiên bản dữ liệu."""
+    # Mỗi lần ghi vào một nhóm dữ liệu (vd. 'doanh_thu') thì phien_ban tăng 1;
+    # màn hình chỉ cần so sánh số này để biết có gì mới hay không.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS phien_ban_du_lieu (
+            ten TEXT PRIMARY KEY,
+            phien_ban INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # ngay = DATE(thanh_toan.ngay) ('' nếu không đọc được ngày);
+    # phien_ban = phiên bản 'doanh_thu' lần cuối dòng này thay đổi
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS doanh_thu_ngay (
+            ngay TEXT PRIMARY KEY,
+            dich_vu REAL NOT NULL DEFAULT 0,
+            thuoc REAL NOT NULL DEFAULT 0,
+            tong REAL NOT NULL DEFAULT 0,
+            phien_ban INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    ensure_indexes(cur.connection)
+    _rebuild_doanh_thu_ngay(cur)
+
+
+def _revenue_trigger_body(sign, row):
+    """Câu lệnh cộng (sign='+') hoặc trừ (sign='-') một bản ghi thanh_toan (NEW/OLD) vào doanh_thu_ngay."""
+    count = 1 if sign == '+' else -1
+    return f"""
+        INSERT INTO doanh_thu_ngay (ngay, dich_vu, thuoc, tong, so_giao_dich, phien_ban)
+        VALUES (
+            COALESCE(DATE({row}.ngay), ''),
+            {sign}(CASE WHEN {row}.loai = 'Dịch vụ' THEN COALESCE({row}.so_tien, 0) ELSE 0 END),
+            {sign}(CASE WHEN {row}.loai = 'Thuốc' THEN COALESCE({row}.so_tien, 0) ELSE 0 END),
+            {sign}COALESCE({row}.so_tien, 0),
+            {count},
+            (SELECT phien_ban FROM phien_ban_du_lieu WHERE ten = 'doanh_thu')
+        )
+        ON CONFLICT(ngay) DO UPDATE SET
+            dich_vu = dich_vu + excluded.dich_vu,
+            thuoc = thuoc + excluded.thuoc,
+            tong = tong + excluded.tong,
+            so_giao_dich = so_giao_dich + excluded.so_giao_dich,
+            phien_ban = excluded.phien_ban;
+    """
+
+
+_BUMP_REVENUE_VERSION = """
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES ('doanh_thu', 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1;
+"""
+
+
+def _m007_revenue_triggers(cur):
+    """Duy trì doanh_thu_ngay bằng trigger trên thanh_toan (mọi đường ghi, kể cả web / SQL trực tiếp)."""
+    _add_column_if_missing(cur, 'doanh_thu_ngay', 'so_giao_dich', 'INTEGER NOT NULL DEFAULT 0')
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_thanh_toan_doanh_thu_insert
+        AFTER INSERT ON thanh_toan
+        BEGIN
+            {_BUMP_REVENUE_VERSION}
+            {_revenue_trigger_body('+', 'NEW')}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_thanh_toan_doanh_thu_update
+        AFTER UPDATE OF ngay, loai, so_tien ON thanh_toan
+        BEGIN
+            {_BUMP_REVENUE_VERSION}
+            {_revenue_trigger_body('-', 'OLD')}
+            {_revenue_trigger_body('+', 'NEW')}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_thanh_toan_doanh_thu_delete
+        AFTER DELETE ON thanh_toan
+        BEGIN
+            {_BUMP_REVENUE_VERSION}
+            {_revenue_trigger_body('-', 'OLD')}
+        END
+    """)
+    _rebuild_doanh_thu_ngay(cur)
+
+
+def _patient_changed_body(id_expr):
+    """Tăng phiên bản 'benh_nhan' và đánh dấu bệnh nhân `id_expr` vừa thay đổi."""
+    return f"""
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES ('benh_nhan', 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1;
+        INSERT INTO benh_nhan_thay_doi (benh_nhan_id, phien_ban)
+        VALUES ({id_expr}, (SELECT phien_ban FROM phien_ban_du_lieu WHERE ten = 'benh_nhan'))
+        ON CONFLICT(benh_nhan_id) DO UPDATE SET phien_ban = excluded.phien_ban;
+    """
+
+
+def _m008_patient_change_tracking(cur):
+    """Ghi nhận bệnh nhân thay đổi (thông tin hoặc mã hồ sơ) để chỉ mục bệnh nhân cập nhật tăng dần."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS benh_nhan_thay_doi (
+            benh_nhan_id INTEGER PRIMARY KEY,
+            phien_ban INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    ensure_indexes(cur.connection)
+    triggers = (
+        ("trg_benh_nhan_tim_kiem_insert", "AFTER INSERT ON benh_nhan", "", "NEW.id"),
+        ("trg_benh_nhan_tim_kiem_update", "AFTER UPDATE ON benh_nhan", "", "NEW.id"),
+        ("trg_benh_nhan_tim_kiem_delete", "AFTER DELETE ON benh_nhan", "", "OLD.id"),
+        # Mã hồ sơ mới nhất lấy từ tiep_don
+        ("trg_tiep_don_tim_kiem_insert", "AFTER INSERT ON tiep_don",
+         "WHEN NEW.benh_nhan_id IS NOT NULL", "NEW.benh_nhan_id"),
+        ("trg_tiep_don_tim_kiem_update", "AFTER UPDATE OF ma_hoso, benh_nhan_id ON tiep_don",
+         "WHEN NEW.benh_nhan_id IS NOT NULL", "NEW.benh_nhan_id"),
+        ("trg_tiep_don_tim_kiem_update_old", "AFTER UPDATE OF benh_nhan_id ON tiep_don",
+         "WHEN OLD.benh_nhan_id IS NOT NULL AND OLD.benh_nhan_id IS NOT NEW.benh_nhan_id", "OLD.benh_nhan_id"),
+        ("trg_tiep_don_tim_kiem_delete", "AFTER DELETE ON tiep_don",
+         "WHEN OLD.benh_nhan_id IS NOT NULL", "OLD.benh_nhan_id"),
+    )
+    for name, event, when, id_expr in triggers:
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name}
+            {event}
+            {when}
+            BEGIN
+                {_patient_changed_body(id_expr)}
+            END
+        """)
+
+
+# --- Tìm kiếm toàn văn (FTS5) ---
+# Mỗi mục: (bảng FTS, bảng nguồn, các cột, trọng số bm25 theo cột). rowid của bảng FTS = id bảng nguồn.
+FTS_TABLES = (
+    ("benh_nhan_fts", "benh_nhan", ("ho_ten", "dien_thoai", "dia_chi", "so_cccd"), (10.0, 5.0, 1.0, 5.0)),
+    ("chi_tiet_phieu_kham_fts", "chi_tiet_phieu_kham", ("chan_doan", "ket_luan", "kham_lam_sang"), (5.0, 3.0, 1.0)),
+    ("lich_hen_fts", "lich_hen", ("ho_ten", "dien_thoai", "ghi_chu"), (10.0, 5.0, 1.0)),
+)
+
+# Tìm không dấu ("nguyen" khớp "Nguyễn"): tokenizer unicode61 bỏ dấu thanh/dấu mũ.
+# đ/Đ là chữ cái riêng chứ không phải dấu nên được đổi thành d/D trước khi đưa vào FTS
+# (trong trigger) và trong câu tìm kiếm. Đặt CLINIC_FTS_UNACCENT=0 rồi chạy
+# `python database.py --rebuild-fts` để tìm phân biệt dấu.
+FTS_UNACCENT = os.environ.get('CLINIC_FTS_UNACCENT', '1') != '0'
+
+
+def _fts_value(expr, unaccent):
+    if not unaccent:
+        return expr
+    return f"replace(replace({expr}, 'đ', 'd'), 'Đ', 'D')"
+
+
+def _create_fts(cur, unaccent):
+    """(Tạo lại) các bảng FTS, trigger đồng bộ và nạp dữ liệu hiện có."""
+    tokenizer = f"unicode61 remove_diacritics {2 if unaccent else 0}"
+    for fts, source, columns, weights in FTS_TABLES:
+        for suffix in ("insert", "update", "delete"):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{fts}_{suffix}")
+        cur.execute(f"DROP TABLE IF EXISTS {fts}")
+        cur.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({', '.join(columns)}, tokenize='{tokenizer}')")
+        # rank (ORDER BY rank) dùng bm25 với trọng số theo cột: khớp họ tên xếp trên khớp địa chỉ
+        cur.execute(f"INSERT INTO {fts} ({fts}, rank) VALUES ('rank', 'bm25({', '.join(map(str, weights))})')")
+        cols = ", ".join(columns)
+        new_values = ", ".join(_fts_value(f"NEW.{c}", unaccent) for c in columns)
+        cur.execute(f"INSERT INTO {fts} (rowid, {cols}) SELECT id, "
+                    f"{', '.join(_fts_value(c, unaccent) for c in columns)} FROM {source}")
+        cur.execute(f"""
+            CREATE TRIGGER trg_{fts}_insert AFTER INSERT ON {source}
+            BEGIN
+                INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER trg_{fts}_update AFTER UPDATE OF id, {cols} ON {source}
+            BEGIN
+                DELETE FROM {fts} WHERE rowid = OLD.id;
+                INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER trg_{fts}_delete AFTER DELETE ON {source}
+            BEGIN
+                DELETE FROM {fts} WHERE rowid = OLD.id;
+            END
+        """)
+
+
+def _m009_full_text_search(cur):
+    """Bảng FTS5 cho bệnh nhân, chẩn đoán/kết luận khám và lịch hẹn, đồng bộ bằng trigger."""
+    try:
+        cur.execute("CREATE VIRTUAL TABLE temp.fts5_kiem_tra USING fts5(x)")
+        cur.execute("DROP TABLE temp.fts5_kiem_tra")
+    except sqlite3.OperationalError as e:
+        # SQLite build không có FTS5: các hàm search_* tự quay về LIKE
+        print(f"⚠️ SQLite không hỗ trợ FTS5 ({e}); tìm kiếm dùng LIKE")
+        return
+    _create_fts(cur, FTS_UNACCENT)
+
+
+def _m010_sequences(cur):
+    """Bảng day_so cấp số hồ sơ / số phiếu / số chỉ định / STT, khởi tạo từ dữ liệu hiện có."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS day_so (
+            ten TEXT PRIMARY KEY,
+            gia_tri INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Số đã cấp trước đây: cả theo mã (HS012, PK0034...) lẫn theo id (so_phieu/so_chi_dinh cũ = PK{id}, CD{id})
+    seeds = (
+        ("ma_hoso", "SELECT MAX(CAST(SUBSTR(ma_hoso, 3) AS INTEGER)) FROM tiep_don WHERE ma_hoso GLOB 'HS[0-9]*'"),
+        ("so_phieu", "SELECT MAX(CAST(SUBSTR(so_phieu, 3) AS INTEGER)) FROM phieu_kham WHERE so_phieu GLOB 'PK[0-9]*'"),
+        ("so_phieu", "SELECT MAX(id) FROM phieu_kham"),
+        ("so_chi_dinh", "SELECT MAX(CAST(SUBSTR(so_chi_dinh, 3) AS INTEGER)) FROM chi_dinh WHERE so_chi_dinh GLOB 'CD[0-9]*'"),
+        ("so_chi_dinh", "SELECT MAX(id) FROM chi_dinh"),
+    )
+    for ten, sql in seeds:
+        cur.execute(sql)
+        value = cur.fetchone()[0] or 0
+        cur.execute("""
+            INSERT INTO day_so (ten, gia_tri) VALUES (?, ?)
+            ON CONFLICT(ten) DO UPDATE SET gia_tri = MAX(gia_tri, excluded.gia_tri)
+        """, (ten, value))
+
+
+def _m011_drug_catalog_version(cur):
+    """Tăng phiên bản 'danh_muc_thuoc' mỗi khi danh mục thuốc đổi (thêm/sửa/xoá, nhập/xuất kho)."""
+    bump = """
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES ('danh_muc_thuoc', 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1;
+    """
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_danh_muc_thuoc_phien_ban_{event.lower()}
+            AFTER {event} ON danh_muc_thuoc
+            BEGIN
+                {bump}
+            END
+        """)
+
+
+def _m012_stock_ledger(cur):
+    """Sổ kho thuốc chỉ ghi thêm (nhập/xuất/điều chỉnh); ton_kho trở thành số tổng hợp từ sổ."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS so_kho_thuoc (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            thoi_gian TEXT NOT NULL,
+            ma_thuoc TEXT NOT NULL,
+            loai TEXT NOT NULL CHECK (loai IN ('nhap', 'xuat', 'dieu_chinh')),
+            so_luong INTEGER NOT NULL,
+            nguon TEXT,
+            nguon_id INTEGER,
+            nguoi_thuc_hien TEXT,
+            ghi_chu TEXT
+        )
+    """)
+    ensure_indexes(cur.connection)
+    # Sửa/xoá một dòng sổ kho bị chặn: mọi chỉnh sửa là một dòng 'dieu_chinh' mới
+    for event in ("UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_so_kho_thuoc_chi_ghi_them_{event.lower()}
+            BEFORE {event} ON so_kho_thuoc
+            BEGIN
+                SELECT RAISE(ABORT, 'so_kho_thuoc chỉ được ghi thêm');
+            END
+        """)
+    # Số dư đầu kỳ: tồn kho hiện tại của mỗi thuốc, để tổng sổ kho = ton_kho ngay từ đầu
+    cur.execute("""
+        INSERT INTO so_kho_thuoc (thoi_gian, ma_thuoc, loai, so_luong, nguon, ghi_chu)
+        SELECT ?, ma_thuoc, 'dieu_chinh', ton_kho, 'khoi_tao', 'Tồn kho đầu kỳ'
+        FROM danh_muc_thuoc
+        WHERE ma_thuoc IS NOT NULL AND COALESCE(ton_kho, 0) != 0
+    """, (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+
+
+def _m013_dispense_queue_indexes(cur):
+    """Index cho hàng đợi xuất thuốc (các đơn chưa xuất của mọi bệnh nhân)."""
+    ensure_indexes(cur.connection)
+
+
+# Các bảng được ghi vào change_log: (bảng, cột khoá). Thêm bảng mới ở đây rồi chạy
+# `python database.py --rebuild-change-log-triggers`.
+CHANGE_LOG_TABLES = (
+    ("benh_nhan", "id"),
+    ("tiep_don", "id"),
+    ("phieu_kham", "id"),
+    ("chi_tiet_phieu_kham", "id"),
+    ("chi_dinh", "id"),
+    ("don_thuoc", "id"),
+    ("don_thuoc_bo_sung", "id"),
+    ("danh_muc_thuoc", "ma_thuoc"),
+    ("nhap_thuoc", "id"),
+    ("thanh_toan", "id"),
+    ("lich_hen", "id"),
+    ("users", "id"),
+    ("nhan_su", "id"),
+)
+
+
+def _create_change_log_triggers(cur):
+    for table, key in CHANGE_LOG_TABLES:
+        for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            name = f"trg_{table}_change_log_{event.lower()}"
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+            if not _table_exists(cur, table):
+                continue
+            cur.execute(f"""
+                CREATE TRIGGER {name}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO change_log (bang, dong_id, thao_tac) VALUES ('{table}', {row}.{key}, '{event[0]}');
+                END
             """)
-            cursor.execute("DROP TABLE lich_hen")
-            cursor.execute("ALTER TABLE lich_hen_new RENAME TO lich_hen")
-            conn.commit()
-            print("✅ Đã migrate cột phong_kham → loai_kham trong bảng lich_hen")
-        except Exception as e:
-            print(f"⚠️ Lỗi khi migrate lich_hen: {e}")
-        
-    conn.close()
 
 
-    # --- Ensure user_sessions table exists for login/logout tracking ---
+def _m014_change_log(cur):
+    """Nhật ký thay đổi (change_log) để các tiến trình khác dùng chung DB biết bảng/dòng nào vừa đổi."""
+    # dong_id không khai báo kiểu: giữ nguyên id số / mã thuốc dạng chữ
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bang TEXT NOT NULL,
+            dong_id,
+            thao_tac TEXT NOT NULL,
+            thoi_gian TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    _create_change_log_triggers(cur)
+
+
+
+# Trạng thái lịch hẹn không giữ chỗ trong khung giờ
+CANCELLED_STATES = ('Đã hủy', 'đã hủy')
+_CANCELLED_STATES = "(" + ", ".join(f"'{t}'" for t in CANCELLED_STATES) + ")"
+
+
+def _create_slot_triggers(cur):
+    """Trigger giữ khung_gio_kham.da_dat khớp với các lịch hẹn còn hiệu lực.
+
+    Lịch hẹn vượt sức chứa làm CHECK (da_dat <= suc_chua) thất bại ngay trong câu INSERT/UPDATE,
+    nên không ghi nào (web, desktop, tiến trình khác) đặt quá chỗ được.
+    """
+    active_new = f"NEW.khung_gio IS NOT NULL AND COALESCE(NEW.trang_thai, '') NOT IN {_CANCELLED_STATES}"
+    active_old = f"OLD.khung_gio IS NOT NULL AND COALESCE(OLD.trang_thai, '') NOT IN {_CANCELLED_STATES}"
+    take = f"""UPDATE khung_gio_kham SET da_dat = da_dat + 1
+                   WHERE bac_si = NEW.bac_si AND bat_dau = NEW.khung_gio AND {active_new};"""
+    release = f"""UPDATE khung_gio_kham SET da_dat = da_dat - 1
+                   WHERE bac_si = OLD.bac_si AND bat_dau = OLD.khung_gio AND {active_old};"""
+    triggers = (
+        ("trg_lich_hen_khung_gio_insert", "AFTER INSERT ON lich_hen", take),
+        ("trg_lich_hen_khung_gio_delete", "AFTER DELETE ON lich_hen", release),
+        # Đổi giờ/bác sĩ/trạng thái: trả chỗ cũ trước rồi mới giữ chỗ mới (cùng khung thì không đổi)
+        ("trg_lich_hen_khung_gio_update", "AFTER UPDATE OF bac_si, khung_gio, trang_thai ON lich_hen",
+         release + "\n                " + take),
+    )
+    for name, event, body in triggers:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cur.execute(f"""
+            CREATE TRIGGER {name}
+            {event}
+            BEGIN
+                {body}
+            END
+        """)
+
+
+def _m015_appointment_slots(cur):
+    """Khung giờ khám theo bác sĩ có sức chứa; lich_hen.khung_gio trỏ tới khung giờ đã giữ."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS khung_gio_kham (
+            bac_si TEXT NOT NULL,
+            bat_dau TEXT NOT NULL,
+            suc_chua INTEGER NOT NULL,
+            da_dat INTEGER NOT NULL DEFAULT 0,
+            CHECK (da_dat >= 0 AND da_dat <= suc_chua),
+            PRIMARY KEY (bac_si, bat_dau)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS suc_chua_bac_si (
+            bac_si TEXT PRIMARY KEY,
+            suc_chua INTEGER NOT NULL CHECK (suc_chua >= 0)
+        )
+    """)
+    if 'khung_gio' not in _table_columns(cur, 'lich_hen'):
+        cur.execute("ALTER TABLE lich_hen ADD COLUMN khung_gio TEXT")
+    # Lịch hẹn cũ còn hiệu lực: gán khung giờ; khung đã quá tải giữ nguyên số đã đặt (sức chứa nâng lên)
+    cur.execute(f"""
+        SELECT id, ngay_gio FROM lich_hen
+        WHERE COALESCE(bac_si, '') != '' AND COALESCE(trang_thai, '') NOT IN {_CANCELLED_STATES}
+    """)
+    cur.executemany("UPDATE lich_hen SET khung_gio = ? WHERE id = ?",
+                    [(slot_start(ngay_gio), lid) for lid, ngay_gio in cur.fetchall()])
+    cur.execute(f"""
+        INSERT OR IGNORE INTO khung_gio_kham (bac_si, bat_dau, suc_chua, da_dat)
+        SELECT bac_si, khung_gio, MAX(?, COUNT(*)), COUNT(*) FROM lich_hen
+        WHERE khung_gio IS NOT NULL AND COALESCE(trang_thai, '') NOT IN {_CANCELLED_STATES}
+        GROUP BY bac_si, khung_gio
+    """, (SLOT_CAPACITY,))
+    _create_slot_triggers(cur)
+
+
+
+# Bảng -> biểu thức benh_nhan_id của dòng (NEW/OLD thay cho {row}); dùng cho ho_so_phien_ban
+_PATIENT_RECORD_TABLES = (
+    ("benh_nhan", "{row}.id"),
+    ("phieu_kham", "{row}.benh_nhan_id"),
+    ("chi_tiet_phieu_kham", "(SELECT benh_nhan_id FROM phieu_kham WHERE id = {row}.phieu_kham_id)"),
+    ("don_thuoc", "(SELECT benh_nhan_id FROM phieu_kham WHERE id = {row}.phieu_kham_id)"),
+    ("chi_tiet_don_thuoc", "(SELECT pk.benh_nhan_id FROM don_thuoc dt JOIN phieu_kham pk ON pk.id = dt.phieu_kham_id"
+                           " WHERE dt.id = {row}.don_thuoc_id)"),
+)
+
+
+def _m016_record_versions(cur):
+    """Bộ đếm thay đổi hồ sơ theo từng bệnh nhân và phiên bản 'lich_hen' (ETag của API JSON)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ho_so_phien_ban (
+            benh_nhan_id INTEGER PRIMARY KEY,
+            phien_ban INTEGER NOT NULL
+        )
+    """)
+    for table, id_expr in _PATIENT_RECORD_TABLES:
+        for event, rows in (("INSERT", ("NEW",)), ("UPDATE", ("OLD", "NEW")), ("DELETE", ("OLD",))):
+            # UPDATE đổi bệnh nhân (hiếm): tăng cho cả bệnh nhân cũ và mới
+            body = "".join(f"""
+                INSERT INTO ho_so_phien_ban (benh_nhan_id, phien_ban)
+                SELECT {id_expr.format(row=row)}, 1 WHERE {id_expr.format(row=row)} IS NOT NULL
+                ON CONFLICT(benh_nhan_id) DO UPDATE SET phien_ban = phien_ban + 1;""" for row in rows)
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_ho_so_phien_ban_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    {body}
+                END
+            """)
+    bump = """
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES ('lich_hen', 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1;
+    """
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_lich_hen_phien_ban_{event.lower()}
+            AFTER {event} ON lich_hen
+            BEGIN
+                {bump}
+            END
+        """)
+    # ngay_gio từ web cũ dạng 'YYYY-MM-DDTHH:MM': đưa về 'YYYY-MM-DD HH:MM' để sắp xếp/phân trang theo chuỗi
+    cur.execute("UPDATE lich_hen SET ngay_gio = replace(ngay_gio, 'T', ' ') WHERE ngay_gio GLOB '????-??-??T*'")
+
+
+def _m017_staff_version(cur):
+    """Tăng phiên bản 'nhan_su' mỗi khi bảng nhân sự đổi: bộ đệm danh sách bác sĩ của mọi tiến trình
+    (GUI, web) so phiên bản này nên thấy thay đổi ngay, không chờ hết TTL."""
+    bump = """
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES ('nhan_su', 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1;
+    """
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_nhan_su_phien_ban_{event.lower()}
+            AFTER {event} ON nhan_su
+            BEGIN
+                {bump}
+            END
+        """)
+
+
+MIGRATIONS = (
+    (1, "Lược đồ cơ sở", _m001_base_schema),
+    (2, "Chuyển bảng nhân sự cũ (bac_si, tiep_tan)", _m002_legacy_staff_tables),
+    (3, "Dữ liệu khởi tạo (admin, ICD10)", _m003_seed_data),
+    (4, "Cột trạng thái đơn thuốc và bảng thuoc_khac", _m004_prescription_flags),
+    (5, "Index phụ", _m005_indexes),
+    (6, "Tổng hợp doanh thu theo ngày", _m006_revenue_rollup),
+    (7, "Trigger duy trì tổng hợp doanh thu", _m007_revenue_triggers),
+    (8, "Theo dõi thay đổi bệnh nhân cho chỉ mục tìm kiếm", _m008_patient_change_tracking),
+    (9, "Tìm kiếm toàn văn FTS5", _m009_full_text_search),
+    (10, "Bảng cấp số hồ sơ / phiếu / chỉ định / STT", _m010_sequences),
+    (11, "Phiên bản danh mục thuốc", _m011_drug_catalog_version),
+    (12, "Sổ kho thuốc (nhập/xuất/điều chỉnh)", _m012_stock_ledger),
+    (13, "Index hàng đợi xuất thuốc", _m013_dispense_queue_indexes),
+    (14, "Nhật ký thay đổi giữa các tiến trình", _m014_change_log),
+    (15, "Khung giờ khám và sức chứa theo bác sĩ", _m015_appointment_slots),
+    (16, "Phiên bản hồ sơ bệnh nhân và lịch hẹn", _m016_record_versions),
+    (17, "Phiên bản danh sách nhân sự", _m017_staff_version),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Đã kiểm tra phiên bản lược đồ trong tiến trình này chưa (các form gọi initialize_database() nhiều lần)
+_schema_ready = False
+
+
+def get_schema_version(cur):
+    """Phiên bản lược đồ hiện tại của DB (0 nếu chưa có bảng schema_version)."""
     try:
-        conn = get_connection()
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        r = cur.fetchone()
+        return r[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+
+
+def migrate():
+    """Chạy các bước migration còn thiếu trong MỘT transaction. Trả về danh sách phiên bản đã áp dụng."""
+    applied = []
+    with pool.write() as conn:
         cur = conn.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS user_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, login_time TEXT, logout_time TEXT)")
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                ten TEXT,
+                applied_at TEXT
+            )
+        """)
+        # Đọc lại trong transaction (BEGIN IMMEDIATE) để tiến trình khác không migrate song song
+        current = get_schema_version(cur)
+        for version, ten, step in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Migration {version}: {ten}")
+            step(cur)
+            cur.execute(
+                "INSERT INTO schema_version (version, ten, applied_at) VALUES (?, ?, ?)",
+                (version, ten, datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+            )
+            applied.append(version)
+    return applied
+
+
+def initialize_database():
+    """Đảm bảo lược đồ DB ở phiên bản mới nhất.
+
+    Khởi động ấm (DB đã ở SCHEMA_VERSION) chỉ tốn một truy vấn schema_version;
+    các lần gọi tiếp theo trong cùng tiến trình không truy vấn gì.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with pool.read() as conn:
+        current = get_schema_version(conn.cursor())
+    if current < SCHEMA_VERSION:
+        migrate()
+    _schema_ready = True
+
+
+# --- Danh mục index phụ ---
+# Mỗi mục: (tên index, bảng, biểu thức cột). Biểu thức DATE(...) là expression
+# index phục vụ các báo cáo doanh thu lọc/nhóm theo ngày.
+INDEXES = (
+    ("idx_tiep_don_ma_hoso", "tiep_don", "ma_hoso"),
+    ("idx_tiep_don_benh_nhan", "tiep_don", "benh_nhan_id, id"),
+    ("idx_tiep_don_ngay", "tiep_don", "DATE(ngay_tiep_don)"),
+    ("idx_phieu_kham_benh_nhan", "phieu_kham", "benh_nhan_id, ngay_lap"),
+    ("idx_phieu_kham_ngay", "phieu_kham", "DATE(ngay_lap)"),
+    ("idx_chi_tiet_phieu_kham_phieu", "chi_tiet_phieu_kham", "phieu_kham_id"),
+    ("idx_chi_dinh_phieu_kham", "chi_dinh", "phieu_kham_id"),
+    ("idx_don_thuoc_phieu_kham", "don_thuoc", "phieu_kham_id"),
+    ("idx_don_thuoc_ngay_ke", "don_thuoc", "DATE(ngay_ke)"),
+    ("idx_chi_tiet_don_thuoc_don", "chi_tiet_don_thuoc", "don_thuoc_id"),
+    ("idx_don_thuoc_bo_sung_phieu_kham", "don_thuoc_bo_sung", "phieu_kham_id"),
+    ("idx_chi_tiet_don_thuoc_bo_sung_don", "chi_tiet_don_thuoc_bo_sung", "don_thuoc_bo_sung_id"),
+    ("idx_chi_tiet_don_mau_don", "chi_tiet_don_mau", "don_mau_id"),
+    ("idx_lich_hen_ngay_gio", "lich_hen", "ngay_gio"),
+    ("idx_lich_hen_benh_nhan", "lich_hen", "benh_nhan_id"),
+    ("idx_thanh_toan_ngay", "thanh_toan", "DATE(ngay)"),
+    ("idx_doanh_thu_ngay_phien_ban", "doanh_thu_ngay", "phien_ban"),
+    ("idx_benh_nhan_thay_doi_phien_ban", "benh_nhan_thay_doi", "phien_ban"),
+    ("idx_nhap_thuoc_ma_thuoc", "nhap_thuoc", "ma_thuoc, ngay"),
+    ("idx_lich_su_xuat_thuoc_thoi_gian", "lich_su_xuat_thuoc", "thoi_gian_xuat"),
+    ("idx_lich_su_xuat_thuoc_don", "lich_su_xuat_thuoc", "don_thuoc_id"),
+    ("idx_so_kho_thuoc_ma_thuoc", "so_kho_thuoc", "ma_thuoc, id"),
+    ("idx_so_kho_thuoc_nguon", "so_kho_thuoc", "nguon, nguon_id"),
+    ("idx_don_thuoc_chua_xuat", "don_thuoc", "COALESCE(da_xuat, 0), ngay_ke"),
+    ("idx_don_thuoc_bo_sung_chua_xuat", "don_thuoc_bo_sung", "COALESCE(xuat_thuoc, 0), ngay_ke"),
+    ("idx_nhan_su_chuc_vu_ten", "nhan_su", "chuc_vu, ten"),
+    ("idx_benh_nhan_ho_ten", "benh_nhan", "ho_ten"),
+    ("idx_users_role", "users", "role"),
+    ("idx_user_sessions_username", "user_sessions", "username, id"),
+)
+
+
+def _index_sql(name, table, columns):
+    return f"CREATE INDEX {name} ON {table}({columns})"
+
+
+def ensure_indexes(conn=None):
+    """Tạo/kiểm tra các index trong INDEXES. Trả về danh sách index vừa tạo lại.
+
+    Index đã tồn tại nhưng có định nghĩa khác (vd. đổi cột) sẽ được drop và tạo lại.
+    Bảng chưa tồn tại thì bỏ qua.
+    """
+    created = []
+    with (pool.write() if conn is None else nullcontext(conn)) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = {r[0] for r in cur.fetchall()}
+        cur.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")
+        existing = {r[0]: r[1] for r in cur.fetchall()}
+        for name, table, columns in INDEXES:
+            if table not in tables:
+                continue
+            sql = _index_sql(name, table, columns)
+            current = existing.get(name)
+            if current is not None and ' '.join(current.split()).lower() == sql.lower():
+                continue
+            try:
+                if current is not None:
+                    cur.execute(f"DROP INDEX IF EXISTS {name}")
+                cur.execute(sql)
+                created.append(name)
+            except sqlite3.Error as e:
+                print(f"⚠️ Không tạo được index {name}: {e}")
+    return created
+
+
+# Các truy vấn nóng của ứng dụng, dùng để in EXPLAIN QUERY PLAN (python database.py --explain)
+KNOWN_QUERIES = (
+    ("tiep_don theo ma_hoso", "SELECT * FROM tiep_don WHERE ma_hoso = ? LIMIT 1", ('',)),
+    ("tiep_don mới nhất của bệnh nhân", "SELECT * FROM tiep_don WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (0,)),
+    ("thống kê tiếp đón trong ngày", "SELECT phong_kham, COUNT(ma_hoso) FROM tiep_don WHERE date(ngay_tiep_don) = ? GROUP BY phong_kham", ('',)),
+    ("phiếu khám của bệnh nhân", "SELECT id, so_phieu, ngay_lap FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY datetime(ngay_lap) DESC", (0,)),
+    ("phiếu khám trong ngày", "SELECT so_phieu, id FROM phieu_kham WHERE benh_nhan_id = ? AND date(ngay_lap) = ? ORDER BY id DESC LIMIT 1", (0, '')),
+    ("chi tiết phiếu khám", "SELECT * FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (0,)),
+    ("chỉ định của phiếu khám", "SELECT * FROM chi_dinh WHERE phieu_kham_id = ?", (0,)),
+    ("đơn thuốc của bệnh nhân", """
+        SELECT dt.id FROM don_thuoc dt JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
+        WHERE pk.benh_nhan_id = ? ORDER BY dt.ngay_ke DESC""", (0,)),
+    ("chi tiết đơn thuốc", "SELECT * FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (0,)),
+    ("chi tiết đơn thuốc bổ sung", "SELECT * FROM chi_tiet_don_thuoc_bo_sung WHERE don_thuoc_bo_sung_id = ?", (0,)),
+    ("lịch hẹn theo khoảng thời gian", "SELECT * FROM lich_hen WHERE ngay_gio BETWEEN ? AND ? ORDER BY id ASC", ('', '')),
+    ("tổng hợp doanh thu theo ngày", """
+        SELECT DATE(ngay), SUM(so_tien) FROM thanh_toan
+        WHERE DATE(ngay) BETWEEN ? AND ? GROUP BY DATE(ngay)""", ('', '')),
+    ("doanh thu các ngày vừa thay đổi", "SELECT * FROM doanh_thu_ngay WHERE phien_ban > ? ORDER BY ngay DESC", (0,)),
+    ("tìm bệnh nhân toàn văn", "SELECT rowid, rank FROM benh_nhan_fts WHERE benh_nhan_fts MATCH ? ORDER BY rank", ('"a"*',)),
+    ("bệnh nhân vừa thay đổi", "SELECT benh_nhan_id FROM benh_nhan_thay_doi WHERE phien_ban > ?", (0,)),
+    ("chi tiết thanh toán trong ngày", "SELECT * FROM thanh_toan WHERE DATE(ngay) = ? ORDER BY ngay DESC", ('',)),
+    ("lịch sử xuất thuốc", "SELECT * FROM lich_su_xuat_thuoc ORDER BY thoi_gian_xuat DESC LIMIT ?", (100,)),
+    ("đơn thuốc chưa xuất", "SELECT id FROM don_thuoc WHERE COALESCE(da_xuat, 0) = 0 ORDER BY ngay_ke", ()),
+    ("đơn bổ sung chưa xuất", "SELECT id FROM don_thuoc_bo_sung WHERE COALESCE(xuat_thuoc, 0) = 0 ORDER BY ngay_ke", ()),
+    ("sổ kho của thuốc", "SELECT * FROM so_kho_thuoc WHERE ma_thuoc = ? ORDER BY id DESC LIMIT ?", ('', 100)),
+    ("danh sách bác sĩ", "SELECT ten FROM nhan_su WHERE chuc_vu = 'Bác sĩ' ORDER BY ten ASC", ()),
+    ("lần khám của bệnh nhân (keyset)", "SELECT id FROM phieu_kham WHERE benh_nhan_id = ? AND (ngay_lap, id) < (?, ?) ORDER BY ngay_lap DESC, id DESC LIMIT ?", (0, '', 0, 20)),
+    ("khung giờ của bác sĩ", "SELECT bat_dau, suc_chua, da_dat FROM khung_gio_kham WHERE bac_si = ? AND bat_dau >= ? AND bat_dau < ?", ('', '', '')),
+)
+
+
+def explain_known_queries(out=print):
+    """In EXPLAIN QUERY PLAN cho các truy vấn trong KNOWN_QUERIES.
+
+    Trả về danh sách tên truy vấn còn quét toàn bảng (SCAN <bảng> không dùng index)
+    để dễ phát hiện hồi quy.
+    """
+    full_scans = []
+    with pool.read() as conn:
+        cur = conn.cursor()
+        for name, sql, params in KNOWN_QUERIES:
+            out(f"== {name}")
+            try:
+                cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+                plan = cur.fetchall()
+            except sqlite3.Error as e:
+                out(f"   (lỗi: {e})")
+                continue
+            for row in plan:
+                detail = row[-1]
+                out(f"   {detail}")
+                # Bảng ảo FTS5 hiện "SCAN ... VIRTUAL TABLE INDEX" nhưng thực chất tra chỉ mục toàn văn
+                if detail.startswith("SCAN ") and " USING " not in detail and "VIRTUAL TABLE" not in detail:
+                    full_scans.append(name)
+    if full_scans:
+        out(f"⚠️ Truy vấn còn quét toàn bảng: {', '.join(sorted(set(full_scans)))}")
+    return full_scans
 
 
 def add_payment(loai, mo_ta, so_tien, ngay=None):
@@ -766,20 +1317,86 @@ def add_payment(loai, mo_ta, so_tien, ngay=None):
     """
     if ngay is None:
         ngay = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         cur.execute("INSERT INTO thanh_toan (ngay, loai, mo_ta, so_tien) VALUES (?, ?, ?, ?)",
                     (ngay, loai, mo_ta, so_tien))
-        conn.commit()
-    finally:
-        conn.close()
+        # doanh_thu_ngay được trigger trên thanh_toan cập nhật trong cùng transaction
+        return cur.lastrowid
 
+def _bump_data_version(cur, ten):
+    """Tăng bộ đếm phiên bản của nhóm dữ liệu `ten` và trả về giá trị mới."""
+    cur.execute("""
+        INSERT INTO phien_ban_du_lieu (ten, phien_ban) VALUES (?, 1)
+        ON CONFLICT(ten) DO UPDATE SET phien_ban = phien_ban + 1
+    """, (ten,))
+    cur.execute("SELECT phien_ban FROM phien_ban_du_lieu WHERE ten = ?", (ten,))
+    return cur.fetchone()[0]
 
-def sync_users_to_nhan_su():
-    """Ensure users with staff roles in `users` table are present in `nhan_su`.
 
-    This is a best-effort sync: it maps known role codes to display roles
+def rebuild_revenue_rollup():
+    """Tính lại doanh_thu_ngay từ toàn bộ thanh_toan (backfill / sửa lệch). Trả về số ngày."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        _rebuild_doanh_thu_ngay(cur)
+        cur.execute("SELECT COUNT(*) FROM doanh_thu_ngay")
+        return cur.fetchone()[0]
+
+
+def get_patient_record_version(benh_nhan_id):
+    """Bộ đếm thay đổi hồ sơ của một bệnh nhân (thông tin, lần khám, chi tiết khám, đơn thuốc); 0 nếu chưa đổi."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT phien_ban FROM ho_so_phien_ban WHERE benh_nhan_id = ?", (benh_nhan_id,))
+        r = cur.fetchone()
+        return r[0] if r else 0
+
+
+def get_data_version(ten):
+    """Phiên bản hiện tại của nhóm dữ liệu `ten` (0 nếu chưa có thay đổi nào).
+
+    Chỉ là một lần tra khóa chính nên có thể gọi thường xuyên để kiểm tra có dữ liệu mới.
+    """
+    with pool.read() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT phien_ban FROM phien_ban_du_lieu WHERE ten = ?", (ten,))
+        except sqlite3.OperationalError:
+            return 0
+        r = cur.fetchone()
+        return r[0] if r else 0
+
+
+def get_revenue_summary(date_from=None, date_to=None, since_version=None):
+    """Doanh thu theo ngày từ bảng tổng hợp doanh_thu_ngay (mới nhất trước).
+
+    since_version: chỉ trả các ngày thay đổi sau phiên bản này (cập nhật tăng dần); khi đó
+    có thể gồm cả ngày đã hết giao dịch (so_giao_dich = 0) để màn hình xoá dòng tương ứng.
+    Returns list of tuples (ngay, dich_vu, thuoc, tong, so_giao_dich, phien_ban).
+    """
+    sql = "SELECT ngay, dich_vu, thuoc, tong, so_giao_dich, phien_ban FROM doanh_thu_ngay"
+    where, params = [], []
+    if since_version is None:
+        where.append("so_giao_dich > 0")
+    if date_from and date_to:
+        where.append("ngay BETWEEN ? AND ?")
+        params.extend([date_from, date_to])
+    if since_version is not None:
+        where.append("phien_ban > ?")
+        params.append(since_version)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ngay DESC"
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+def sync_users_to_nhan_su():
+    """Ensure users with staff roles in `users` table are present in `nhan_su`.
+
+    This is a best-effort sync: it maps known role codes to display roles
     and inserts a `nhan_su` row if one with same name+role doesn't exist.
     """
     role_map = {
@@ -790,9 +1407,8 @@ def sync_users_to_nhan_su():
         'reception': 'Tiếp tân'
     }
     # normalize role keys (remove non-alphanumeric and lowercase) before lookup
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         try:
             cur.execute("SELECT username, role, full_name FROM users")
             users = cur.fetchall()
@@ -819,90 +1435,1181 @@ def sync_users_to_nhan_su():
             except Exception:
                 # ignore insertion errors and continue
                 continue
-        conn.commit()
-    finally:
-        conn.close()
+    reference_cache.invalidate('nhan_su')
+
+
+# Cấu hình cho bộ tải đơn thuốc theo lô: đơn thường và đơn bổ sung có cấu trúc gần giống nhau
+_PRESCRIPTION_SOURCES = {
+    'don_thuoc': {
+        'header': "dt.id, dt.phieu_kham_id, dt.ngay_ke, dt.so_ngay, dt.tong_tien, dt.bac_si, dt.da_xuat, dt.ngay_xuat",
+        'item_table': 'chi_tiet_don_thuoc',
+        'item_fk': 'don_thuoc_id',
+    },
+    'don_thuoc_bo_sung': {
+        'header': "dt.id, dt.phieu_kham_id, dt.ngay_ke, dt.so_ngay, dt.tong_tien, dt.bac_si, COALESCE(dt.xuat_thuoc, 0)",
+        'item_table': 'chi_tiet_don_thuoc_bo_sung',
+        'item_fk': 'don_thuoc_bo_sung_id',
+    },
+}
+
+# Giới hạn số tham số '?' trong một mệnh đề IN (SQLite cũ chỉ cho phép 999)
+_IN_BATCH = 500
+
+
+def _load_prescriptions(source, benh_nhan_ids):
+    """Tải đơn thuốc (kèm dòng thuốc và tổng tiền) cho nhiều bệnh nhân.
+
+    Mỗi lô bệnh nhân chỉ tốn 2 truy vấn: một cho phần đầu đơn, một cho toàn bộ dòng thuốc
+    (đã JOIN giá và thành tiền từ danh_muc_thuoc); tổng tiền từng đơn được cộng dồn trong Python.
+    Returns dict {benh_nhan_id: [đơn mới nhất trước]}.
+    """
+    spec = _PRESCRIPTION_SOURCES[source]
+    ids = list(dict.fromkeys(benh_nhan_ids))
+    results = {pid: [] for pid in ids}
+    with pool.read() as conn:
+        cur = conn.cursor()
+        for start in range(0, len(ids), _IN_BATCH):
+            batch = ids[start:start + _IN_BATCH]
+            marks = ",".join("?" * len(batch))
+            cur.execute(f"""
+                SELECT pk.benh_nhan_id, {spec['header']}
+                FROM {source} dt
+                JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
+                WHERE pk.benh_nhan_id IN ({marks})
+                ORDER BY dt.ngay_ke DESC
+            """, batch)
+            headers = cur.fetchall()
+
+            cur.execute(f"""
+                SELECT ct.{spec['item_fk']}, ct.ma_thuoc, ct.ten_thuoc, ct.so_luong, ct.don_vi, dmt.gia_thuoc,
+                       ct.so_luong * COALESCE(dmt.gia_thuoc, 0)
+                FROM {spec['item_table']} ct
+                JOIN {source} dt ON ct.{spec['item_fk']} = dt.id
+                JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
+                LEFT JOIN danh_muc_thuoc dmt ON ct.ma_thuoc = dmt.ma_thuoc
+                WHERE pk.benh_nhan_id IN ({marks})
+                ORDER BY ct.id
+            """, batch)
+            items_by_don = {}
+            for don_id, ma_thuoc, ten_thuoc, so_luong, don_vi, gia_thuoc, thanh_tien in cur.fetchall():
+                items_by_don.setdefault(don_id, []).append(dict(
+                    ma_thuoc=ma_thuoc, ten_thuoc=ten_thuoc, so_luong=so_luong,
+                    don_vi=don_vi, gia_thuoc=gia_thuoc, thanh_tien=thanh_tien or 0))
+
+            for r in headers:
+                pid, don_id = r[0], r[1]
+                items = items_by_don.get(don_id, [])
+                pres = {
+                    'id': don_id,
+                    'phieu_kham_id': r[2],
+                    'ngay_ke': r[3],
+                    'so_ngay': r[4],
+                    'tong_tien': r[5],
+                    'bac_si': r[6],
+                    # Tổng theo giá hiện tại trong danh mục: sum(so_luong * gia_thuoc)
+                    'tong_tien_thuoc': sum(i['thanh_tien'] for i in items),
+                    'items': items,
+                }
+                if source == 'don_thuoc':
+                    pres['da_xuat'] = bool(r[7]) if r[7] is not None else False
+                    pres['ngay_xuat'] = r[8]
+                else:
+                    pres['xuat_thuoc'] = bool(r[7]) if r[7] is not None else False
+                results[pid].append(pres)
+    return results
+
+
+def get_prescriptions_for_patients(benh_nhan_ids):
+    """Đơn thuốc thường của nhiều bệnh nhân một lúc: {benh_nhan_id: [đơn]} (xem get_prescriptions_for_patient)."""
+    return _load_prescriptions('don_thuoc', benh_nhan_ids)
 
 
 def get_prescriptions_for_patient(benh_nhan_id: int):
     """Return all prescriptions (don_thuoc) for a given patient id with their items.
 
-    Returns list of dicts: {id, phieu_kham_id, ngay_ke, so_ngay, tong_tien, bac_si, da_xuat, ngay_xuat, items:[{ten_thuoc, ma_thuoc, so_luong, don_vi}]}
+    Returns list of dicts: {id, phieu_kham_id, ngay_ke, so_ngay, tong_tien, tong_tien_thuoc, bac_si, da_xuat, ngay_xuat,
+    items:[{ten_thuoc, ma_thuoc, so_luong, don_vi, gia_thuoc, thanh_tien}]}
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        q = """
-            SELECT dt.id, dt.phieu_kham_id, dt.ngay_ke, dt.so_ngay, dt.tong_tien, dt.bac_si, dt.da_xuat, dt.ngay_xuat
+    return get_prescriptions_for_patients([benh_nhan_id])[benh_nhan_id]
+
+
+# Các cột dòng thuốc dùng chung cho chi_tiet_don_thuoc và chi_tiet_don_thuoc_bo_sung
+_PRESCRIPTION_ITEM_COLUMNS = ('ma_thuoc', 'ten_thuoc', 'so_luong', 'don_vi', 'sang', 'trua',
+                              'chieu', 'toi', 'lieu_dung', 'ghi_chu')
+
+
+def save_prescription_with_items(source, header: dict, items, thuoc_khac=()):
+    """Lưu một đơn thuốc (đầu đơn + mọi dòng thuốc) trong MỘT transaction.
+
+    - source: 'don_thuoc' hoặc 'don_thuoc_bo_sung'
+    - header: {cột: giá trị} của bảng đầu đơn
+    - items: danh sách dict theo _PRESCRIPTION_ITEM_COLUMNS (thiếu khóa -> NULL),
+      được ghi bằng một lệnh executemany
+    - thuoc_khac: danh sách (ten_thuoc, don_vi, ghi_chu) lưu vào bảng gợi ý thuoc_khac
+      nếu tên thuốc chưa có
+
+    Lỗi ở bất kỳ bước nào sẽ rollback toàn bộ (không còn đầu đơn mồ côi).
+    Returns (don_id, [id dòng chi tiết theo đúng thứ tự items]).
+    """
+    spec = _PRESCRIPTION_SOURCES[source]
+    cols = list(header)
+    item_cols = (spec['item_fk'],) + _PRESCRIPTION_ITEM_COLUMNS
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"INSERT INTO {source} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            [header[c] for c in cols])
+        don_id = cur.lastrowid
+
+        cur.executemany(
+            f"INSERT INTO {spec['item_table']} ({', '.join(item_cols)}) VALUES ({', '.join('?' * len(item_cols))})",
+            [(don_id,) + tuple(it.get(c) for c in _PRESCRIPTION_ITEM_COLUMNS) for it in items])
+        cur.execute(f"SELECT id FROM {spec['item_table']} WHERE {spec['item_fk']} = ? ORDER BY id", (don_id,))
+        detail_ids = [r[0] for r in cur.fetchall()]
+
+        if thuoc_khac:
+            cur.executemany("""
+                INSERT INTO thuoc_khac (ten_thuoc, don_vi, ghi_chu, don_thuoc_id)
+                SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM thuoc_khac WHERE ten_thuoc = ?)
+            """, [(ten, don_vi or None, ghi_chu or None, don_id, ten) for ten, don_vi, ghi_chu in thuoc_khac if ten])
+    return don_id, detail_ids
+
+
+def get_patient_ehr(benh_nhan_id: int, before=None, limit=None):
+    """Hồ sơ bệnh án của một bệnh nhân: các lần khám kèm chi tiết khám mới nhất và đơn thuốc.
+
+    Dùng số truy vấn cố định (3) bất kể bệnh nhân có bao nhiêu lần khám / đơn thuốc:
+    lần khám + chi tiết mới nhất (ROW_NUMBER), toàn bộ đơn thuốc, toàn bộ dòng thuốc;
+    sau đó ghép lại thành cấu trúc lồng nhau trong Python.
+
+    Returns list of dicts (mới nhất trước): {id, so_phieu, ngay_lap, bac_si, phong_kham,
+    chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham,
+    don_thuoc:[{id, ngay_ke, so_ngay, ngay_tai_kham, chan_doan, loi_dan,
+    meds:[(ten_thuoc, so_luong, sang, trua, chieu, toi, lieu_dung, ghi_chu)]}]}
+
+    before/limit: một trang theo keyset (ngay_lap, id) — before là (ngay_lap, id) của lần khám cuối
+    trang trước; đơn thuốc chỉ được tải cho các lần khám trong trang.
+    """
+    page_where, page_params, page_limit = "", [], ""
+    if before:
+        page_where = " AND (pk.ngay_lap, pk.id) < (?, ?)"
+        page_params = list(before)
+    if limit:
+        page_limit = " LIMIT ?"
+        page_params.append(int(limit))
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT pk.id, pk.so_phieu, pk.ngay_lap, pk.bac_si, pk.phong_kham,
+                   ct.phieu_kham_id, ct.chan_doan, ct.ket_luan, ct.icd10, ct.di_ung_thuoc, ct.ghi_chu_kham
+            FROM phieu_kham pk
+            LEFT JOIN (
+                SELECT phieu_kham_id, chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham,
+                       ROW_NUMBER() OVER (PARTITION BY phieu_kham_id ORDER BY id DESC) AS rn
+                FROM chi_tiet_phieu_kham
+                WHERE phieu_kham_id IN (SELECT id FROM phieu_kham WHERE benh_nhan_id = ?)
+            ) ct ON ct.phieu_kham_id = pk.id AND ct.rn = 1
+            WHERE pk.benh_nhan_id = ?{page_where}
+            ORDER BY pk.ngay_lap DESC, pk.id DESC{page_limit}
+        """, [benh_nhan_id, benh_nhan_id] + page_params)
+        visit_rows = cur.fetchall()
+
+        # Trang: chỉ đơn thuốc của các lần khám vừa tải
+        visit_filter, visit_params = "pk.benh_nhan_id = ?", [benh_nhan_id]
+        if before or limit:
+            ids = [r[0] for r in visit_rows] or [None]
+            visit_filter = f"pk.id IN ({', '.join('?' * len(ids))})"
+            visit_params = ids
+
+        cur.execute(f"""
+            SELECT dt.id, dt.phieu_kham_id, dt.ngay_ke, dt.so_ngay, dt.ngay_tai_kham, dt.chan_doan, dt.loi_dan
             FROM don_thuoc dt
             JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
-            WHERE pk.benh_nhan_id = ?
+            WHERE {visit_filter}
             ORDER BY dt.ngay_ke DESC
-        """
-        cur.execute(q, (benh_nhan_id,))
-        rows = cur.fetchall()
-        results = []
-        for r in rows:
-            don_id = r[0]
-            cur.execute("SELECT ma_thuoc, ten_thuoc, so_luong, don_vi FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_id,))
-            items = [dict(ma_thuoc=i[0], ten_thuoc=i[1], so_luong=i[2], don_vi=i[3]) for i in cur.fetchall()]
-            results.append({
-                'id': don_id,
-                'phieu_kham_id': r[1],
-                'ngay_ke': r[2],
-                'so_ngay': r[3],
-                'tong_tien': r[4],
-                'bac_si': r[5],
-                'da_xuat': bool(r[6]) if r[6] is not None else False,
-                'ngay_xuat': r[7],
-                'items': items,
-            })
-        return results
-    finally:
-        conn.close()
+        """, visit_params)
+        pres_rows = cur.fetchall()
 
+        cur.execute(f"""
+            SELECT ct.don_thuoc_id, ct.ten_thuoc, ct.so_luong, ct.sang, ct.trua, ct.chieu, ct.toi, ct.lieu_dung, ct.ghi_chu
+            FROM chi_tiet_don_thuoc ct
+            JOIN don_thuoc dt ON ct.don_thuoc_id = dt.id
+            JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
+            WHERE {visit_filter}
+            ORDER BY ct.id
+        """, visit_params)
+        med_rows = cur.fetchall()
+
+    meds_by_don = {}
+    for m in med_rows:
+        meds_by_don.setdefault(m[0], []).append(tuple(m[1:]))
+
+    pres_by_visit = {}
+    for don_id, pkid, ngay_ke, so_ngay, ngay_tai_kham, don_chan_doan, loi_dan in pres_rows:
+        pres_by_visit.setdefault(pkid, []).append({
+            'id': don_id,
+            'ngay_ke': ngay_ke,
+            'so_ngay': so_ngay,
+            'ngay_tai_kham': ngay_tai_kham,
+            'chan_doan': don_chan_doan,
+            'loi_dan': loi_dan,
+            'meds': meds_by_don.get(don_id, []),
+        })
+
+    visits = []
+    for r in visit_rows:
+        pkid, so_phieu, ngay_lap, bac_si, phong_kham, has_detail = r[:6]
+        # Lần khám chưa có chi tiết: các trường chi tiết là chuỗi rỗng
+        chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham = r[6:] if has_detail is not None else ('', '', '', '', '')
+        visits.append({
+            'id': pkid,
+            'so_phieu': so_phieu,
+            'ngay_lap': ngay_lap,
+            'bac_si': bac_si,
+            'phong_kham': phong_kham,
+            'chan_doan': chan_doan,
+            'ket_luan': ket_luan,
+            'icd10': icd10,
+            'di_ung_thuoc': di_ung_thuoc,
+            'ghi_chu_kham': ghi_chu_kham,
+            'don_thuoc': pres_by_visit.get(pkid, []),
+        })
+    return visits
+
+
+_PATIENT_SEARCH_SQL = """
+    SELECT b.id, b.ho_ten, b.dien_thoai, b.ngay_sinh, b.so_cccd, td.ma_hoso,
+           b.gioi_tinh, b.tuoi, b.dia_chi, b.doi_tuong
+    FROM benh_nhan b
+    LEFT JOIN (
+        SELECT benh_nhan_id, ma_hoso,
+               ROW_NUMBER() OVER (PARTITION BY benh_nhan_id ORDER BY id DESC) AS rn
+        FROM tiep_don
+        {tiep_don_where}
+    ) td ON td.benh_nhan_id = b.id AND td.rn = 1
+    {where}
+"""
+
+
+def get_patient_search_rows(benh_nhan_ids=None):
+    """Dữ liệu cho chỉ mục bệnh nhân: (id, ho_ten, dien_thoai, ngay_sinh, so_cccd, ma_hoso,
+    gioi_tinh, tuoi, dia_chi, doi_tuong).
+
+    ma_hoso là mã hồ sơ của lần tiếp đón mới nhất (một lượt quét tiep_don bằng ROW_NUMBER
+    thay cho subquery tương quan theo từng bệnh nhân).
+    benh_nhan_ids=None: toàn bộ bệnh nhân; ngược lại chỉ các id đã cho (đọc theo lô).
+    """
+    with pool.read() as conn:
+        cur = conn.cursor()
+        if benh_nhan_ids is None:
+            cur.execute(_PATIENT_SEARCH_SQL.format(tiep_don_where="", where=""))
+            return cur.fetchall()
+        ids = list(dict.fromkeys(benh_nhan_ids))
+        rows = []
+        for i in range(0, len(ids), _IN_BATCH):
+            batch = ids[i:i + _IN_BATCH]
+            marks = ",".join("?" * len(batch))
+            cur.execute(_PATIENT_SEARCH_SQL.format(
+                tiep_don_where=f"WHERE benh_nhan_id IN ({marks})", where=f"WHERE b.id IN ({marks})"),
+                batch + batch)
+            rows.extend(cur.fetchall())
+        return rows
+
+
+def get_changed_patient_ids(since_version):
+    """Các benh_nhan_id thay đổi sau phiên bản `since_version` (kể cả đã bị xoá)."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT benh_nhan_id FROM benh_nhan_thay_doi WHERE phien_ban > ?", (since_version,))
+        return [r[0] for r in cur.fetchall()]
 
-def mark_prescription_dispensed(don_thuoc_id: int, dispensed_by_username: str = None, dispensed_at: str = None) -> bool:
-    """Mark a prescription as dispensed: set da_xuat=1, xuat_boi_user_id (if username provided), ngay_xuat.
-    Also decrement stock in danh_muc_thuoc according to chi_tiet_don_thuoc quantities.
-    Returns True on success.
+
+def rebuild_search_index(unaccent=None):
+    """Tạo lại các bảng FTS từ dữ liệu hiện có (sửa lệch hoặc đổi chế độ bỏ dấu)."""
+    unaccent = FTS_UNACCENT if unaccent is None else unaccent
+    with pool.write() as conn:
+        _create_fts(conn.cursor(), unaccent)
+
+
+def _fts_mode(cur, fts):
+    """None nếu chưa có bảng FTS `fts` (SQLite không có FTS5), ngược lại True/False: có bỏ dấu không."""
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+    r = cur.fetchone()
+    if not r:
+        return None
+    return 'remove_diacritics 2' in r[0]
+
+
+_FTS_WORD = re.compile(r'\w+')
+
+
+def fts_match_query(text, unaccent=True):
+    """Chuỗi người dùng gõ -> biểu thức MATCH: mọi từ đều phải khớp, từ cuối/giữa khớp theo tiền tố.
+
+    Mỗi từ được đặt trong ngoặc kép nên các ký tự đặc biệt của cú pháp FTS5 (AND, OR, NEAR, *, ^...)
+    trong dữ liệu nhập không có tác dụng. Trả về '' nếu không có từ nào.
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    text = str(text or '')
+    if unaccent:
+        text = text.replace('đ', 'd').replace('Đ', 'D')
+    return ' '.join(f'"{w}"*' for w in _FTS_WORD.findall(text))
+
+
+def _patient_match_sql(cur, text, scope):
+    """(subquery trả về (id, rank) của bệnh nhân khớp, params). scope: 'benh_nhan' | 'kham'."""
+    fts = "benh_nhan_fts" if scope == 'benh_nhan' else "chi_tiet_phieu_kham_fts"
+    mode = _fts_mode(cur, fts)
+    if mode is not None:
+        match = fts_match_query(text, mode)
+        if not match:
+            return "SELECT NULL AS id, 0 AS rank WHERE 0", ()
+        if scope == 'benh_nhan':
+            return f"SELECT rowid AS id, rank FROM {fts} WHERE {fts} MATCH ?", (match,)
+        # Bệnh nhân có lần khám khớp chẩn đoán/kết luận/khám lâm sàng, xếp theo lần khớp tốt nhất
+        return f"""
+            SELECT pk.benh_nhan_id AS id, MIN(f.rank) AS rank
+            FROM {fts} f
+            JOIN chi_tiet_phieu_kham ct ON ct.id = f.rowid
+            JOIN phieu_kham pk ON pk.id = ct.phieu_kham_id
+            WHERE {fts} MATCH ? AND pk.benh_nhan_id IS NOT NULL
+            GROUP BY pk.benh_nhan_id
+        """, (match,)
+    # Không có FTS5: quét LIKE như trước, thứ tự theo họ tên
+    q = f"%{text}%"
+    if scope == 'benh_nhan':
+        return ("SELECT id, 0 AS rank FROM benh_nhan "
+                "WHERE ho_ten LIKE ? OR dien_thoai LIKE ? OR dia_chi LIKE ? OR so_cccd LIKE ?", (q, q, q, q))
+    return """
+        SELECT DISTINCT pk.benh_nhan_id AS id, 0 AS rank
+        FROM chi_tiet_phieu_kham ct JOIN phieu_kham pk ON pk.id = ct.phieu_kham_id
+        WHERE (ct.chan_doan LIKE ? OR ct.ket_luan LIKE ? OR ct.kham_lam_sang LIKE ?) AND pk.benh_nhan_id IS NOT NULL
+    """, (q, q, q)
+
+
+def patient_search_sql(text, columns="b.id, b.ho_ten, b.ngay_sinh, b.dien_thoai, b.so_cccd", scope='benh_nhan'):
+    """Câu truy vấn tìm bệnh nhân theo `text`, xếp theo độ liên quan (bm25) rồi họ tên.
+
+    Trả về (sql, count_sql, params); sql không kèm LIMIT để gọi nơi tự phân trang
+    (LazySqlTableModel, search_patients). `columns` dùng alias b (benh_nhan) và m.rank.
+    scope='kham': tìm trong chẩn đoán / kết luận / khám lâm sàng của các lần khám.
+    """
+    with pool.read() as conn:
+        match_sql, params = _patient_match_sql(conn.cursor(), text, scope)
+    sql = (f"SELECT {columns} FROM ({match_sql}) m JOIN benh_nhan b ON b.id = m.id "
+           f"ORDER BY m.rank, b.ho_ten, b.id")
+    count_sql = f"SELECT COUNT(*) FROM ({match_sql})"
+    return sql, count_sql, params
+
+
+def search_patients(text, page=1, per_page=20, scope='benh_nhan'):
+    """Một trang kết quả tìm bệnh nhân: (rows, total).
+
+    rows: [(id, ho_ten, ngay_sinh, dien_thoai, so_cccd)] theo độ liên quan; page tính từ 1.
+    """
+    if not fts_match_query(text):
+        return [], 0
+    sql, count_sql, params = patient_search_sql(text, scope=scope)
+    page = max(1, int(page))
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute(count_sql, params)
+        total = cur.fetchone()[0]
+        cur.execute(f"{sql} LIMIT ? OFFSET ?", params + (per_page, (page - 1) * per_page))
+        return cur.fetchall(), total
+
+
+def search_appointments(text, so_cccd=None, limit=200, before=None):
+    """Lịch hẹn có họ tên / SĐT / ghi chú khớp `text` (FTS5 nếu có), mới nhất trước.
+
+    so_cccd: chỉ giữ lịch hẹn đã gắn với bệnh nhân có số CCCD này (lich_hen không có cột CCCD).
+    before: (ngay_gio, id) của dòng cuối trang trước — phân trang keyset theo (ngay_gio, id).
+    Returns [(id, ho_ten, ngay_gio, bac_si, loai_kham, trang_thai, nguoi_dat)].
+    """
+    with pool.read() as conn:
+        cur = conn.cursor()
+        mode = _fts_mode(cur, "lich_hen_fts")
+        if mode is not None:
+            match = fts_match_query(text, mode)
+            if not match:
+                return []
+            where, params = "lh.id IN (SELECT rowid FROM lich_hen_fts WHERE lich_hen_fts MATCH ?)", [match]
+        else:
+            where, params = "lh.ho_ten LIKE ?", [f"%{text}%"]
+        if so_cccd:
+            where += " AND lh.benh_nhan_id IN (SELECT id FROM benh_nhan WHERE so_cccd = ?)"
+            params.append(so_cccd)
+        if before:
+            where += " AND (lh.ngay_gio, lh.id) < (?, ?)"
+            params.extend(before)
+        cur.execute(f"""
+            SELECT lh.id, lh.ho_ten, lh.ngay_gio, lh.bac_si, lh.loai_kham, lh.trang_thai, lh.nguoi_dat
+            FROM lich_hen lh WHERE {where}
+            ORDER BY lh.ngay_gio DESC, lh.id DESC LIMIT ?
+        """, params + [limit])
+        return cur.fetchall()
+
+
+# --- Khung giờ khám theo bác sĩ ---
+# Lịch hẹn có bác sĩ được gắn vào khung giờ (lich_hen.khung_gio = giờ bắt đầu khung). Mỗi khung
+# (khung_gio_kham, khóa chính (bac_si, bat_dau)) có sức chứa; trigger của _m015 đếm chỗ đã giữ.
+SLOT_MINUTES = max(5, int(os.environ.get('CLINIC_SLOT_MINUTES', '30') or 30))
+SLOT_CAPACITY = max(1, int(os.environ.get('CLINIC_SLOT_CAPACITY', '2') or 2))
+# Giờ làm việc trong ngày và các thứ nhận khám (0 = thứ Hai ... 6 = Chủ nhật)
+SLOT_HOURS = os.environ.get('CLINIC_SLOT_HOURS', '07:30-11:30,13:30-17:00')
+SLOT_WEEKDAYS = {int(d) for d in os.environ.get('CLINIC_SLOT_WEEKDAYS', '0,1,2,3,4,5').split(',') if d.strip()}
+SLOT_FORMAT = '%Y-%m-%d %H:%M'
+
+
+class SlotFullError(Exception):
+    """Khung giờ của bác sĩ đã đủ chỗ.
+
+    goi_y: [(bat_dau, con_trong)] các khung còn trống gần nhất sau khung đã chọn.
+    """
+
+    def __init__(self, message, bac_si=None, bat_dau=None, goi_y=()):
+        super().__init__(message)
+        self.bac_si = bac_si
+        self.bat_dau = bat_dau
+        self.goi_y = list(goi_y)
+
+
+def _work_periods():
+    periods = []
+    for part in SLOT_HOURS.split(','):
+        try:
+            start, end = part.strip().split('-')
+            h1, m1 = (int(x) for x in start.split(':'))
+            h2, m2 = (int(x) for x in end.split(':'))
+        except ValueError:
+            continue
+        periods.append((h1 * 60 + m1, h2 * 60 + m2))
+    return periods
+
+
+def _parse_ngay_gio(ngay_gio):
+    if isinstance(ngay_gio, datetime):
+        return ngay_gio
+    text = str(ngay_gio or '').strip().replace('T', ' ')
+    for fmt, width in (('%Y-%m-%d %H:%M:%S', 19), (SLOT_FORMAT, 16)):
+        try:
+            return datetime.strptime(text[:width], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_ngay_gio(ngay_gio):
+    """'YYYY-MM-DD HH:MM' cho lich_hen.ngay_gio (web gửi dạng 'T'); giữ nguyên nếu không đọc được."""
+    dt = _parse_ngay_gio(ngay_gio)
+    return dt.strftime(SLOT_FORMAT) if dt is not None else ngay_gio
+
+
+def slot_start(ngay_gio):
+    """Giờ bắt đầu khung chứa `ngay_gio` ('YYYY-MM-DD HH:MM', chấp nhận cả dạng 'T' của web); None nếu sai."""
+    dt = _parse_ngay_gio(ngay_gio)
+    if dt is None:
+        return None
+    minutes = dt.hour * 60 + dt.minute
+    minutes -= minutes % SLOT_MINUTES
+    return dt.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0).strftime(SLOT_FORMAT)
+
+
+def _doctor_capacity(cur, bac_si):
+    cur.execute("SELECT suc_chua FROM suc_chua_bac_si WHERE bac_si = ?", (bac_si,))
+    r = cur.fetchone()
+    return r[0] if r else SLOT_CAPACITY
+
+
+def _ensure_slot(cur, bac_si, bat_dau):
+    cur.execute("INSERT OR IGNORE INTO khung_gio_kham (bac_si, bat_dau, suc_chua) VALUES (?, ?, ?)",
+                (bac_si, bat_dau, _doctor_capacity(cur, bac_si)))
+
+
+def _slot_has_room(cur, bac_si, bat_dau):
+    """Khung còn chỗ cho một lịch hẹn nữa không.
+
+    Gọi sau _ensure_slot() trong cùng pool.write(): câu ghi đó đã lấy khóa ghi của DB nên
+    da_dat không đổi cho tới khi transaction commit (không tiến trình nào chen vào giữa).
+    """
+    cur.execute("SELECT da_dat < suc_chua FROM khung_gio_kham WHERE bac_si = ? AND bat_dau = ?",
+                (bac_si, bat_dau))
+    r = cur.fetchone()
+    return bool(r and r[0])
+
+
+def _holds_seat(trang_thai):
+    return (trang_thai or '') not in CANCELLED_STATES
+
+
+def _check_work_time(ngay_gio):
+    """ValueError nếu giờ hẹn không đọc được, rơi vào ngày nghỉ (SLOT_WEEKDAYS) hoặc khung giờ
+    của nó nằm ngoài giờ làm việc (SLOT_HOURS)."""
+    khung = slot_start(ngay_gio)
+    if khung is None:
+        raise ValueError(f"Giờ hẹn không hợp lệ: {ngay_gio}")
+    dt = _parse_ngay_gio(khung)
+    if dt.weekday() not in SLOT_WEEKDAYS:
+        raise ValueError(f"Phòng khám không nhận lịch hẹn ngày {dt.strftime('%d/%m/%Y')}")
+    minutes = dt.hour * 60 + dt.minute
+    if not any(first <= minutes < last for first, last in _work_periods()):
+        raise ValueError(f"Giờ hẹn {khung} ngoài giờ làm việc ({SLOT_HOURS})")
+
+
+def _slot_full(bac_si, bat_dau):
+    goi_y = get_free_slots(bac_si, start=_parse_ngay_gio(bat_dau), limit=5)
+    return SlotFullError(f"Bác sĩ {bac_si} đã kín lịch lúc {bat_dau}", bac_si, bat_dau, goi_y)
+
+
+def get_free_slots(bac_si, days=14, start=None, limit=None):
+    """Các khung còn trống của bác sĩ từ `start` (mặc định: bây giờ) trong `days` ngày.
+
+    Returns [(bat_dau, con_trong)] theo thời gian. Chỉ một lần quét khoảng trên khóa chính
+    (bac_si, bat_dau); khung chưa ai đặt không có dòng nào và được tính đủ sức chứa.
+    """
+    now = start or datetime.now()
+    end = datetime(now.year, now.month, now.day) + timedelta(days=days)
+    with pool.read() as conn:
+        cur = conn.cursor()
+        capacity = _doctor_capacity(cur, bac_si)
+        cur.execute("""
+            SELECT bat_dau, suc_chua, da_dat FROM khung_gio_kham
+            WHERE bac_si = ? AND bat_dau >= ? AND bat_dau < ?
+        """, (bac_si, now.strftime('%Y-%m-%d 00:00'), end.strftime(SLOT_FORMAT)))
+        booked = {r[0]: r[1] - r[2] for r in cur.fetchall()}
+    free = []
+    periods = _work_periods()
+    day = datetime(now.year, now.month, now.day)
+    while day < end:
+        if day.weekday() in SLOT_WEEKDAYS:
+            for first, last in periods:
+                for minutes in range(first, last, SLOT_MINUTES):
+                    t = day + timedelta(minutes=minutes)
+                    if t < now:
+                        continue
+                    key = t.strftime(SLOT_FORMAT)
+                    con_trong = booked.get(key, capacity)
+                    if con_trong > 0:
+                        free.append((key, con_trong))
+                        if limit and len(free) >= limit:
+                            return free
+        day += timedelta(days=1)
+    return free
+
+
+def book_appointment(ho_ten, ngay_gio, bac_si=None, loai_kham=None, ghi_chu=None, trang_thai="Đã đặt lịch",
+                     nguoi_dat=None, dien_thoai=None, dia_chi=None):
+    """Thêm lịch hẹn và giữ chỗ trong khung giờ của bác sĩ trong cùng một transaction.
+
+    Trả về id lịch hẹn. Raises ValueError nếu giờ hẹn ngoài giờ làm việc / ngày nghỉ,
+    SlotFullError nếu khung đã đủ chỗ (kể cả khi web và desktop cùng đặt một lúc: số chỗ
+    được kiểm tra trong cùng BEGIN IMMEDIATE với INSERT).
+    """
+    ngay_gio = normalize_ngay_gio(ngay_gio)
+    _check_work_time(ngay_gio)
+    khung = slot_start(ngay_gio) if bac_si else None
+    full = False
+    with pool.write() as conn:
+        cur = conn.cursor()
+        if khung:
+            _ensure_slot(cur, bac_si, khung)
+            full = _holds_seat(trang_thai) and not _slot_has_room(cur, bac_si, khung)
+        if not full:
+            cur.execute("""
+                INSERT INTO lich_hen (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, nguoi_dat,
+                                      dien_thoai, dia_chi, khung_gio)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, nguoi_dat, dien_thoai, dia_chi, khung))
+            lid = cur.lastrowid
+    if full:
+        raise _slot_full(bac_si, khung)
+    reference_cache.invalidate('lich_hen')
+    return lid
+
+
+_APPOINTMENT_FIELDS = ('ho_ten', 'bac_si', 'loai_kham', 'ghi_chu')
+
+
+def reschedule_appointment(lid, ngay_gio, **fields):
+    """Đổi giờ (và tùy chọn ho_ten / bac_si / loai_kham / ghi_chu) của lịch hẹn, chuyển chỗ giữ sang khung mới.
+
+    Raises ValueError nếu giờ mới ngoài giờ làm việc / ngày nghỉ, SlotFullError nếu khung mới
+    đã đủ chỗ; khi đó lịch hẹn giữ nguyên.
+    """
+    unknown = set(fields) - set(_APPOINTMENT_FIELDS)
+    if unknown:
+        raise ValueError(f"Không sửa được cột: {', '.join(sorted(unknown))}")
+    ngay_gio = normalize_ngay_gio(ngay_gio)
+    _check_work_time(ngay_gio)
+    full = False
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT bac_si, khung_gio, trang_thai FROM lich_hen WHERE id = ?", (lid,))
+        old_bac_si, old_khung, trang_thai = cur.fetchone() or (None, None, None)
+        bac_si = fields['bac_si'] if 'bac_si' in fields else old_bac_si
+        khung = slot_start(ngay_gio) if bac_si else None
+        if khung:
+            _ensure_slot(cur, bac_si, khung)
+            # Lịch hẹn đã giữ chỗ trong chính khung này thì không cần thêm chỗ
+            moving = (old_bac_si, old_khung) != (bac_si, khung)
+            full = _holds_seat(trang_thai) and moving and not _slot_has_room(cur, bac_si, khung)
+        if not full:
+            cols = [c for c in _APPOINTMENT_FIELDS if c in fields]
+            sets = ''.join(f", {c} = ?" for c in cols)
+            cur.execute(f"UPDATE lich_hen SET ngay_gio = ?, khung_gio = ?{sets} WHERE id = ?",
+                        [ngay_gio, khung] + [fields[c] for c in cols] + [lid])
+    if full:
+        raise _slot_full(bac_si, khung)
+    reference_cache.invalidate('lich_hen')
+
+
+def set_appointment_status(lid, trang_thai):
+    """Đổi trạng thái lịch hẹn (xác nhận, hủy, ...); trigger của _m015 trả/giữ chỗ trong khung giờ.
+
+    Raises SlotFullError nếu lịch hẹn đã hủy được mở lại mà khung của nó đã đủ chỗ.
+    """
+    full = False
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT bac_si, khung_gio, trang_thai FROM lich_hen WHERE id = ?", (lid,))
+        bac_si, khung, old = cur.fetchone() or (None, None, None)
+        if khung and _holds_seat(trang_thai) and not _holds_seat(old):
+            _ensure_slot(cur, bac_si, khung)
+            full = not _slot_has_room(cur, bac_si, khung)
+        if not full:
+            cur.execute("UPDATE lich_hen SET trang_thai = ? WHERE id = ?", (trang_thai, lid))
+    if full:
+        raise _slot_full(bac_si, khung)
+    reference_cache.invalidate('lich_hen')
+
+
+def set_doctor_capacity(bac_si, suc_chua):
+    """Sức chứa mỗi khung của bác sĩ; áp dụng cho các khung từ hôm nay (không thấp hơn số đã đặt)."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO suc_chua_bac_si (bac_si, suc_chua) VALUES (?, ?)
+            ON CONFLICT(bac_si) DO UPDATE SET suc_chua = excluded.suc_chua
+        """, (bac_si, suc_chua))
+        cur.execute("UPDATE khung_gio_kham SET suc_chua = MAX(?, da_dat) WHERE bac_si = ? AND bat_dau >= ?",
+                    (suc_chua, bac_si, datetime.now().strftime('%Y-%m-%d 00:00')))
+
+
+def set_slot_capacity(bac_si, bat_dau, suc_chua):
+    """Sức chứa riêng cho một khung (vd. 0 để khóa khung). ValueError nếu thấp hơn số lịch đã đặt."""
+    khung = slot_start(bat_dau)
+    if khung is None:
+        raise ValueError(f"Giờ không hợp lệ: {bat_dau}")
     try:
-        user_id = None
-        if dispensed_by_username:
-            try:
+        with pool.write() as conn:
+            cur = conn.cursor()
+            _ensure_slot(cur, bac_si, khung)
+            cur.execute("UPDATE khung_gio_kham SET suc_chua = ? WHERE bac_si = ? AND bat_dau = ?",
+                        (suc_chua, bac_si, khung))
+    except sqlite3.IntegrityError:
+        raise ValueError(f"Khung {khung} của {bac_si} đã có nhiều hơn {suc_chua} lịch hẹn")
+
+
+def get_drug_catalog_rows():
+    """Toàn bộ danh mục thuốc: [(ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho)] theo mã thuốc."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho FROM danh_muc_thuoc ORDER BY ma_thuoc")
+        return cur.fetchall()
+
+
+def rebuild_change_log_triggers():
+    """Tạo lại trigger change_log theo CHANGE_LOG_TABLES."""
+    with pool.write() as conn:
+        _create_change_log_triggers(conn.cursor())
+
+
+def get_change_log_head():
+    """id lớn nhất hiện có trong change_log (0 nếu rỗng)."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM change_log")
+        return cur.fetchone()[0]
+
+
+def prune_change_log(max_age_hours=24):
+    """Xoá các dòng change_log cũ hơn `max_age_hours` giờ. Trả về số dòng đã xoá."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM change_log WHERE thoi_gian < datetime('now', ?)", (f"-{int(max_age_hours)} hours",))
+        return cur.rowcount
+
+
+# --- Cấp số hồ sơ / phiếu (bảng day_so) ---
+# Mỗi dãy là một dòng trong day_so; cấp số = UPSERT + đọc lại trong cùng transaction ghi
+# (BEGIN IMMEDIATE), nên hai bàn tiếp đón lưu cùng lúc không bao giờ nhận trùng số và không
+# phải quét bảng nghiệp vụ để tìm số lớn nhất.
+SEQUENCE_FORMATS = {
+    'ma_hoso': 'HS{:03d}',
+    'so_phieu': 'PK{:04d}',
+    'so_chi_dinh': 'CD{:04d}',
+}
+
+# CLINIC_SEQ_BLOCK > 1: mỗi tiến trình giữ trước một lô số, các lần sau lấy từ bộ nhớ (ít lần
+# ghi DB hơn) — đổi lại số giữa các máy không còn tăng dần theo thời gian và phần lô chưa dùng
+# bị bỏ trống khi thoát. Mặc định 1: cấp từng số.
+SEQUENCE_BLOCK = max(1, int(os.environ.get('CLINIC_SEQ_BLOCK', '1') or 1))
+_sequence_lock = threading.Lock()
+_sequence_blocks = {}  # ten -> (số kế tiếp, số cuối của lô đang giữ)
+
+
+def _allocate_numbers(cur, ten, count):
+    cur.execute("""
+        INSERT INTO day_so (ten, gia_tri) VALUES (?, ?)
+        ON CONFLICT(ten) DO UPDATE SET gia_tri = gia_tri + excluded.gia_tri
+    """, (ten, count))
+    cur.execute("SELECT gia_tri FROM day_so WHERE ten = ?", (ten,))
+    return cur.fetchone()[0] - count + 1
+
+
+def reserve_numbers(ten, count=1):
+    """Cấp `count` số liên tiếp của dãy `ten`, trả về số đầu tiên.
+
+    Nếu thread đang ở trong transaction (vd. form đang lưu tiep_don) thì việc cấp số lồng vào
+    transaction đó (SAVEPOINT): rollback lần lưu thì số cũng được trả lại.
+    """
+    with pool.write() as conn:
+        return _allocate_numbers(conn.cursor(), ten, count)
+
+
+def next_number(ten, block=None):
+    """Số kế tiếp của dãy `ten`, không trùng giữa các tiến trình dùng chung DB."""
+    block = SEQUENCE_BLOCK if block is None else max(1, block)
+    # Lô số phải được commit ngay, nên trong transaction của người gọi chỉ cấp từng số
+    if block == 1 or pool.connection().in_transaction:
+        return reserve_numbers(ten)
+    with _sequence_lock:
+        nxt, last = _sequence_blocks.get(ten, (1, 0))
+        if nxt > last:
+            nxt = reserve_numbers(ten, block)
+            last = nxt + block - 1
+        _sequence_blocks[ten] = (nxt + 1, last)
+        return nxt
+
+
+def next_code(ten, block=None):
+    """Mã kế tiếp theo SEQUENCE_FORMATS (vd. next_code('ma_hoso') -> 'HS013')."""
+    return SEQUENCE_FORMATS[ten].format(next_number(ten, block))
+
+
+def peek_code(ten):
+    """Mã dự kiến của lần cấp tiếp theo (chỉ để hiển thị, không giữ chỗ)."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT gia_tri FROM day_so WHERE ten = ?", (ten,))
+        r = cur.fetchone()
+    return SEQUENCE_FORMATS[ten].format((r[0] if r else 0) + 1)
+
+
+def next_daily_stt(ngay=None):
+    """STT xếp hàng trong ngày `ngay` (yyyy-mm-dd, mặc định hôm nay), bắt đầu lại từ 1 mỗi ngày."""
+    ngay = ngay or datetime.now().strftime('%Y-%m-%d')
+    return reserve_numbers(f"stt:{ngay}")
+
+
+# --- Sổ kho thuốc (so_kho_thuoc) ---
+# Mọi thay đổi tồn kho là một dòng trong sổ kho (so_luong có dấu: nhập +, xuất -, điều chỉnh ±);
+# danh_muc_thuoc.ton_kho chỉ là số tổng hợp, được cập nhật trong CÙNG transaction với dòng sổ
+# và có thể tính lại bằng rebuild_stock_from_ledger() (`python database.py --rebuild-ton-kho`).
+
+class StockError(Exception):
+    """Xuất kho không thực hiện được (đơn đã xuất, hoặc thiếu tồn kho).
+
+    shortages: [(ma_thuoc, ten_thuoc, ton_kho, so_luong_can)] các thuốc không đủ tồn.
+    """
+
+    def __init__(self, message, shortages=()):
+        super().__init__(message)
+        self.shortages = list(shortages)
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _append_ledger(cur, ma_thuoc, loai, so_luong, nguon=None, nguon_id=None, nguoi=None, ghi_chu=None, thoi_gian=None):
+    cur.execute("""
+        INSERT INTO so_kho_thuoc (thoi_gian, ma_thuoc, loai, so_luong, nguon, nguon_id, nguoi_thuc_hien, ghi_chu)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (thoi_gian or _now(), ma_thuoc, loai, so_luong, nguon, nguon_id, nguoi, ghi_chu))
+
+
+def _record_movement(cur, ma_thuoc, loai, so_luong, **ledger):
+    """Ghi một biến động kho và cập nhật ton_kho trong transaction hiện tại.
+
+    loai='xuat': so_luong > 0 là số lượng xuất; chỉ trừ khi ton_kho >= so_luong (UPDATE có điều kiện,
+    nên hai người xuất cùng lúc không thể làm tồn kho âm). Trả về False nếu không đủ tồn / không có thuốc.
+    loai='nhap': so_luong > 0; loai='dieu_chinh': so_luong là chênh lệch có dấu.
+    """
+    if loai == 'xuat':
+        cur.execute("""
+            UPDATE danh_muc_thuoc SET ton_kho = COALESCE(ton_kho, 0) - ?
+            WHERE ma_thuoc = ? AND COALESCE(ton_kho, 0) >= ?
+        """, (so_luong, ma_thuoc, so_luong))
+        delta = -so_luong
+    else:
+        cur.execute("UPDATE danh_muc_thuoc SET ton_kho = COALESCE(ton_kho, 0) + ? WHERE ma_thuoc = ?",
+                    (so_luong, ma_thuoc))
+        delta = so_luong
+    if cur.rowcount == 0:
+        return False
+    _append_ledger(cur, ma_thuoc, loai, delta, **ledger)
+    return True
+
+
+def _current_stock(cur, ma_thuoc):
+    cur.execute("SELECT ton_kho FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma_thuoc,))
+    r = cur.fetchone()
+    return None if r is None else (r[0] or 0)
+
+
+def import_stock(ma_thuoc, ten_thuoc, don_vi, so_luong, gia=None, ngay=None, nguoi=None):
+    """Nhập kho: thêm thuốc vào danh mục nếu chưa có, ghi nhap_thuoc và dòng sổ kho 'nhap'.
+
+    gia khác None thì cập nhật giá thuốc. Trả về tồn kho sau khi nhập.
+    """
+    ngay = ngay or _now()
+    with pool.write() as conn:
+        cur = conn.cursor()
+        if _current_stock(cur, ma_thuoc) is None:
+            cur.execute("INSERT INTO danh_muc_thuoc (ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho) VALUES (?, ?, ?, ?, 0)",
+                        (ma_thuoc, ten_thuoc, don_vi, gia or 0))
+        else:
+            cur.execute("""
+                UPDATE danh_muc_thuoc SET ten_thuoc = ?, don_vi = ?, gia_thuoc = COALESCE(?, gia_thuoc)
+                WHERE ma_thuoc = ?
+            """, (ten_thuoc, don_vi, gia, ma_thuoc))
+        if so_luong and so_luong > 0:
+            cur.execute("INSERT INTO nhap_thuoc (ngay, ma_thuoc, ten_thuoc, don_vi, so_luong_nhap) VALUES (?, ?, ?, ?, ?)",
+                        (ngay, ma_thuoc, ten_thuoc, don_vi, so_luong))
+            _record_movement(cur, ma_thuoc, 'nhap', so_luong, nguon='nhap_thuoc', nguon_id=cur.lastrowid,
+                             nguoi=nguoi, thoi_gian=ngay)
+        return _current_stock(cur, ma_thuoc)
+
+
+def update_drug(ma_cu, ma_thuoc, ten_thuoc, don_vi, gia, ton_kho, nguoi=None):
+    """Sửa thông tin thuốc; tồn kho mới được ghi thành dòng 'dieu_chinh' (chênh lệch so với hiện tại).
+
+    Đổi mã thuốc: số dư được chuyển từ mã cũ sang mã mới bằng hai dòng điều chỉnh.
+    """
+    with pool.write() as conn:
+        cur = conn.cursor()
+        ton_cu = _current_stock(cur, ma_cu)
+        if ton_cu is None:
+            return False
+        if ma_thuoc != ma_cu:
+            if ton_cu:
+                _append_ledger(cur, ma_cu, 'dieu_chinh', -ton_cu, nguon='doi_ma', nguoi=nguoi,
+                               ghi_chu=f"Đổi mã sang {ma_thuoc}")
+                _append_ledger(cur, ma_thuoc, 'dieu_chinh', ton_cu, nguon='doi_ma', nguoi=nguoi,
+                               ghi_chu=f"Đổi mã từ {ma_cu}")
+        cur.execute("UPDATE danh_muc_thuoc SET ma_thuoc = ?, ten_thuoc = ?, don_vi = ?, gia_thuoc = ? WHERE ma_thuoc = ?",
+                    (ma_thuoc, ten_thuoc, don_vi, gia, ma_cu))
+        if ton_kho != ton_cu:
+            _record_movement(cur, ma_thuoc, 'dieu_chinh', ton_kho - ton_cu, nguon='sua_danh_muc', nguoi=nguoi,
+                             ghi_chu="Sửa tồn kho trong danh mục")
+        return True
+
+
+def delete_drug(ma_thuoc, nguoi=None):
+    """Xoá thuốc khỏi danh mục; số dư còn lại được đưa về 0 trên sổ kho trước khi xoá."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        ton = _current_stock(cur, ma_thuoc)
+        if ton:
+            _append_ledger(cur, ma_thuoc, 'dieu_chinh', -ton, nguon='xoa_danh_muc', nguoi=nguoi,
+                           ghi_chu="Xoá khỏi danh mục")
+        cur.execute("DELETE FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma_thuoc,))
+        return cur.rowcount > 0
+
+
+def _import_ids(cur, ngay, ma_thuoc):
+    cur.execute("SELECT id FROM nhap_thuoc WHERE ngay = ? AND ma_thuoc = ?", (ngay, ma_thuoc))
+    return [r[0] for r in cur.fetchall()]
+
+
+def correct_import(ngay, ma_cu, so_luong_cu, ma_thuoc, ten_thuoc, don_vi, so_luong, nguoi=None):
+    """Sửa một lần nhập (nhap_thuoc theo ngày + mã); phần chênh lệch được ghi thành dòng 'dieu_chinh'."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        ids = _import_ids(cur, ngay, ma_cu)
+        cur.execute("UPDATE nhap_thuoc SET ma_thuoc = ?, ten_thuoc = ?, don_vi = ?, so_luong_nhap = ? WHERE ngay = ? AND ma_thuoc = ?",
+                    (ma_thuoc, ten_thuoc, don_vi, so_luong, ngay, ma_cu))
+        ref = dict(nguon='nhap_thuoc', nguon_id=ids[0] if ids else None, nguoi=nguoi, ghi_chu=f"Sửa lần nhập {ngay}")
+        if ma_thuoc == ma_cu:
+            if so_luong != so_luong_cu:
+                _record_movement(cur, ma_thuoc, 'dieu_chinh', so_luong - so_luong_cu, **ref)
+        else:
+            _record_movement(cur, ma_cu, 'dieu_chinh', -so_luong_cu, **ref)
+            _record_movement(cur, ma_thuoc, 'dieu_chinh', so_luong, **ref)
+        return True
+
+
+def delete_import(ngay, ma_thuoc, so_luong, nguoi=None):
+    """Xoá một lần nhập; số lượng đã nhập được trừ lại bằng dòng 'dieu_chinh'."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        ids = _import_ids(cur, ngay, ma_thuoc)
+        cur.execute("DELETE FROM nhap_thuoc WHERE ngay = ? AND ma_thuoc = ?", (ngay, ma_thuoc))
+        if so_luong:
+            _record_movement(cur, ma_thuoc, 'dieu_chinh', -so_luong, nguon='nhap_thuoc',
+                             nguon_id=ids[0] if ids else None, nguoi=nguoi, ghi_chu=f"Xoá lần nhập {ngay}")
+        return True
+
+
+# nguồn xuất kho -> (bảng đơn, cột trạng thái đã xuất, bảng chi tiết, cột khoá của chi tiết)
+_DISPENSE_SOURCES = {
+    'don_thuoc': ('don_thuoc', 'da_xuat', 'chi_tiet_don_thuoc', 'don_thuoc_id'),
+    'don_thuoc_bo_sung': ('don_thuoc_bo_sung', 'xuat_thuoc', 'chi_tiet_don_thuoc_bo_sung', 'don_thuoc_bo_sung_id'),
+}
+
+
+def dispense_prescription(source, don_id, dispensed_by_username=None, partial=False, dispensed_at=None):
+    """Xuất kho một đơn thuốc trong MỘT transaction ghi (BEGIN IMMEDIATE).
+
+    - Đánh dấu đã xuất bằng UPDATE ... WHERE <đã xuất> = 0: hai dược sĩ bấm xuất cùng một đơn thì
+      chỉ một người thành công, người kia nhận StockError.
+    - Mỗi thuốc trừ kho bằng UPDATE có điều kiện ton_kho >= số lượng và ghi một dòng sổ kho 'xuat'.
+    - Thiếu tồn: partial=False thì huỷ toàn bộ (StockError.shortages liệt kê thuốc thiếu);
+      partial=True thì xuất các thuốc đủ tồn (không có thuốc nào đủ thì vẫn huỷ).
+    - Đơn thường ('don_thuoc') được ghi vào lich_su_xuat_thuoc trong cùng transaction.
+
+    source: 'don_thuoc' hoặc 'don_thuoc_bo_sung'.
+    Trả về (đã xuất [(ma_thuoc, ten_thuoc, so_luong)], thiếu [(ma_thuoc, ten_thuoc, ton_kho, so_luong)]).
+    Thuốc không có mã (ngoài danh mục) không trừ kho.
+    """
+    table, flag, detail_table, detail_fk = _DISPENSE_SOURCES[source]
+    dispensed_at = dispensed_at or _now()
+    with pool.write() as conn:
+        cur = conn.cursor()
+        if source == 'don_thuoc':
+            user_id = None
+            if dispensed_by_username:
                 cur.execute("SELECT id FROM users WHERE username = ?", (dispensed_by_username,))
                 r = cur.fetchone()
-                if r:
-                    user_id = r[0]
-            except Exception:
-                user_id = None
+                user_id = r[0] if r else None
+            cur.execute(f"""
+                UPDATE {table} SET {flag} = 1, ngay_xuat = ?, xuat_boi_user_id = COALESCE(?, xuat_boi_user_id)
+                WHERE id = ? AND COALESCE({flag}, 0) = 0
+            """, (dispensed_at, user_id, don_id))
+        else:
+            cur.execute(f"UPDATE {table} SET {flag} = 1 WHERE id = ? AND COALESCE({flag}, 0) = 0", (don_id,))
+        if cur.rowcount == 0:
+            raise StockError("Đơn thuốc đã được xuất trước đó hoặc không tồn tại.")
+
+        cur.execute(f"""
+            SELECT ma_thuoc, MAX(ten_thuoc), SUM(so_luong) FROM {detail_table}
+            WHERE {detail_fk} = ? AND ma_thuoc IS NOT NULL AND ma_thuoc != ''
+            GROUP BY ma_thuoc
+        """, (don_id,))
+        dispensed, shortages = [], []
+        for ma_thuoc, ten_thuoc, so_luong in cur.fetchall():
+            so_luong = so_luong or 0
+            if so_luong <= 0:
+                continue
+            if _record_movement(cur, ma_thuoc, 'xuat', so_luong, nguon=source, nguon_id=don_id,
+                                nguoi=dispensed_by_username, thoi_gian=dispensed_at):
+                dispensed.append((ma_thuoc, ten_thuoc, so_luong))
+            else:
+                shortages.append((ma_thuoc, ten_thuoc, _current_stock(cur, ma_thuoc), so_luong))
+        if shortages and (not partial or not dispensed):
+            # Ném lỗi trong khối write(): toàn bộ (cả cờ đã xuất) được rollback
+            raise StockError("Không đủ tồn kho để xuất đơn thuốc.", shortages)
+        if source == 'don_thuoc':
+            # Lịch sử xuất ghi cùng transaction (như dispense_batch): không có đơn đã xuất mà thiếu lịch sử
+            cur.execute("""
+                INSERT INTO lich_su_xuat_thuoc
+                (don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu)
+                SELECT dt.id, dt.bac_si, bn.ho_ten, bn.so_cccd, ?, ?, ''
+                FROM don_thuoc dt
+                LEFT JOIN phieu_kham pk ON pk.id = dt.phieu_kham_id
+                LEFT JOIN benh_nhan bn ON bn.id = pk.benh_nhan_id
+                WHERE dt.id = ?
+            """, (dispensed_by_username or "", dispensed_at, don_id))
+        return dispensed, shortages
 
-        if not dispensed_at:
-            dispensed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # Update prescription
-        if user_id:
-            cur.execute("UPDATE don_thuoc SET da_xuat = 1, xuat_boi_user_id = ?, ngay_xuat = ? WHERE id = ?", (user_id, dispensed_at, don_thuoc_id))
-        else:
-            cur.execute("UPDATE don_thuoc SET da_xuat = 1, ngay_xuat = ? WHERE id = ?", (dispensed_at, don_thuoc_id))
+def mark_prescription_dispensed(don_thuoc_id: int, dispensed_by_username: str = None, dispensed_at: str = None) -> bool:
+    """Mark a prescription as dispensed and decrement stock (see dispense_prescription).
+
+    Raises StockError if the prescription was already dispensed or stock is insufficient.
+    Returns True on success.
+    """
+    dispense_prescription('don_thuoc', don_thuoc_id, dispensed_by_username, dispensed_at=dispensed_at)
+    return True
 
-        # Decrement stock
-        cur.execute("SELECT ma_thuoc, so_luong FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_thuoc_id,))
-        for ma_thuoc, so_luong in cur.fetchall():
-            if not ma_thuoc:
+
+def get_dispense_queue(since=None):
+    """Hàng đợi xuất thuốc: mọi đơn thường và đơn bổ sung chưa xuất của tất cả bệnh nhân, cũ nhất trước.
+
+    since: chỉ lấy đơn kê từ ngày này (yyyy-mm-dd). Trả về
+    [(source, don_id, ngay_ke, benh_nhan_id, ho_ten, so_cccd, bac_si, so_loai_thuoc)].
+    """
+    parts, params = [], []
+    for source, (table, flag, detail_table, detail_fk) in _DISPENSE_SOURCES.items():
+        where = f"COALESCE(dt.{flag}, 0) = 0"
+        if since:
+            where += " AND dt.ngay_ke >= ?"
+            params.append(since)
+        parts.append(f"""
+            SELECT '{source}', dt.id, dt.ngay_ke, bn.id, bn.ho_ten, bn.so_cccd, dt.bac_si,
+                   (SELECT COUNT(*) FROM {detail_table} ct WHERE ct.{detail_fk} = dt.id)
+            FROM {table} dt
+            JOIN phieu_kham pk ON pk.id = dt.phieu_kham_id
+            LEFT JOIN benh_nhan bn ON bn.id = pk.benh_nhan_id
+            WHERE {where}
+        """)
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute(" UNION ALL ".join(parts) + " ORDER BY 3, 2", params)
+        return cur.fetchall()
+
+
+def dispense_batch(orders, dispensed_by_username=None, dispensed_at=None):
+    """Xuất nhiều đơn trong MỘT transaction ghi (BEGIN IMMEDIATE).
+
+    orders: [(source, don_id)] theo thứ tự ưu tiên (đơn đến trước được cấp thuốc trước).
+    Tồn kho được đọc một lần trong transaction rồi phân bổ lần lượt; đơn nào không đủ thuốc
+    (hoặc đã được người khác xuất) bị bỏ qua nguyên đơn và vẫn nằm trong hàng đợi.
+    Cờ đã xuất, trừ kho, sổ kho và lich_su_xuat_thuoc được ghi bằng executemany.
+    Trả về (đã xuất [(source, don_id)], bỏ qua [(source, don_id, lý do)]).
+    """
+    dispensed_at = dispensed_at or _now()
+    orders = list(dict.fromkeys(orders))
+    with pool.write() as conn:
+        cur = conn.cursor()
+        user_id = None
+        if dispensed_by_username:
+            cur.execute("SELECT id FROM users WHERE username = ?", (dispensed_by_username,))
+            r = cur.fetchone()
+            user_id = r[0] if r else None
+
+        # Đầu đơn còn chờ xuất (kèm thông tin cho lịch sử) và dòng thuốc của chúng
+        pending, items = {}, {}
+        for source, (table, flag, detail_table, detail_fk) in _DISPENSE_SOURCES.items():
+            ids = [don_id for src, don_id in orders if src == source]
+            for start in range(0, len(ids), _IN_BATCH):
+                batch = ids[start:start + _IN_BATCH]
+                marks = ",".join("?" * len(batch))
+                cur.execute(f"""
+                    SELECT dt.id, dt.bac_si, bn.ho_ten, bn.so_cccd
+                    FROM {table} dt
+                    JOIN phieu_kham pk ON pk.id = dt.phieu_kham_id
+                    LEFT JOIN benh_nhan bn ON bn.id = pk.benh_nhan_id
+                    WHERE dt.id IN ({marks}) AND COALESCE(dt.{flag}, 0) = 0
+                """, batch)
+                for don_id, bac_si, ho_ten, so_cccd in cur.fetchall():
+                    pending[(source, don_id)] = (bac_si, ho_ten, so_cccd)
+                cur.execute(f"""
+                    SELECT {detail_fk}, ma_thuoc, SUM(so_luong) FROM {detail_table}
+                    WHERE {detail_fk} IN ({marks}) AND ma_thuoc IS NOT NULL AND ma_thuoc != ''
+                    GROUP BY {detail_fk}, ma_thuoc
+                """, batch)
+                for don_id, ma_thuoc, so_luong in cur.fetchall():
+                    if so_luong and so_luong > 0:
+                        items.setdefault((source, don_id), []).append((ma_thuoc, so_luong))
+
+        codes = sorted({ma for lines in items.values() for ma, _ in lines})
+        stock = {}
+        for start in range(0, len(codes), _IN_BATCH):
+            batch = codes[start:start + _IN_BATCH]
+            cur.execute(f"SELECT ma_thuoc, COALESCE(ton_kho, 0) FROM danh_muc_thuoc WHERE ma_thuoc IN ({','.join('?' * len(batch))})", batch)
+            stock.update(cur.fetchall())
+
+        dispensed, skipped = [], []
+        totals, ledger_rows = {}, []
+        for key in orders:
+            if key not in pending:
+                skipped.append(key + ("Đã được xuất trước đó hoặc không tồn tại",))
                 continue
-            try:
-                cur.execute("UPDATE danh_muc_thuoc SET ton_kho = COALESCE(ton_kho,0) - ? WHERE ma_thuoc = ?", (so_luong or 0, ma_thuoc))
-            except Exception:
-                pass
+            lines = items.get(key, [])
+            short = [f"{ma} (tồn {stock.get(ma, 0)}, cần {sl})" for ma, sl in lines if stock.get(ma, 0) < sl]
+            if short:
+                skipped.append(key + ("Không đủ tồn kho: " + ", ".join(short),))
+                continue
+            for ma, sl in lines:
+                stock[ma] -= sl
+                totals[ma] = totals.get(ma, 0) + sl
+                ledger_rows.append((dispensed_at, ma, 'xuat', -sl, key[0], key[1], dispensed_by_username, None))
+            dispensed.append(key)
+
+        if not dispensed:
+            return dispensed, skipped
+        for source, (table, flag, _, _) in _DISPENSE_SOURCES.items():
+            ids = [(don_id,) for src, don_id in dispensed if src == source]
+            if not ids:
+                continue
+            if source == 'don_thuoc':
+                cur.executemany(f"""
+                    UPDATE {table} SET {flag} = 1, ngay_xuat = ?, xuat_boi_user_id = COALESCE(?, xuat_boi_user_id)
+                    WHERE id = ? AND COALESCE({flag}, 0) = 0
+                """, [(dispensed_at, user_id, i) for (i,) in ids])
+            else:
+                cur.executemany(f"UPDATE {table} SET {flag} = 1 WHERE id = ? AND COALESCE({flag}, 0) = 0", ids)
+            if cur.rowcount != len(ids):
+                raise StockError("Có đơn vừa được xuất ở máy khác, vui lòng tải lại hàng đợi.")
+        if totals:
+            # Vẫn là UPDATE có điều kiện: nếu số tồn đã đọc không còn đúng thì huỷ cả lô
+            cur.executemany("""
+                UPDATE danh_muc_thuoc SET ton_kho = COALESCE(ton_kho, 0) - ?
+                WHERE ma_thuoc = ? AND COALESCE(ton_kho, 0) >= ?
+            """, [(sl, ma, sl) for ma, sl in totals.items()])
+            if cur.rowcount != len(totals):
+                raise StockError("Tồn kho vừa thay đổi, vui lòng tải lại hàng đợi.")
+            cur.executemany("""
+                INSERT INTO so_kho_thuoc (thoi_gian, ma_thuoc, loai, so_luong, nguon, nguon_id, nguoi_thuc_hien, ghi_chu)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, ledger_rows)
+        history = [(don_id, *pending[(source, don_id)], dispensed_by_username or "", dispensed_at, "Xuất theo lô")
+                   for source, don_id in dispensed if source == 'don_thuoc']
+        if history:
+            cur.executemany("""
+                INSERT INTO lich_su_xuat_thuoc
+                (don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, history)
+        return dispensed, skipped
+
+
+def get_stock_ledger(ma_thuoc, limit=100):
+    """Các dòng sổ kho gần nhất của một thuốc: [(thoi_gian, loai, so_luong, nguon, nguon_id, nguoi_thuc_hien, ghi_chu)]."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT thoi_gian, loai, so_luong, nguon, nguon_id, nguoi_thuc_hien, ghi_chu
+            FROM so_kho_thuoc WHERE ma_thuoc = ? ORDER BY id DESC LIMIT ?
+        """, (ma_thuoc, limit))
+        return cur.fetchall()
 
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+
+def check_stock_ledger():
+    """Các thuốc có ton_kho lệch với tổng sổ kho: [(ma_thuoc, ton_kho, tong_so_kho)]."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT d.ma_thuoc, COALESCE(d.ton_kho, 0), COALESCE(s.tong, 0)
+            FROM danh_muc_thuoc d
+            LEFT JOIN (SELECT ma_thuoc, SUM(so_luong) AS tong FROM so_kho_thuoc GROUP BY ma_thuoc) s
+                ON s.ma_thuoc = d.ma_thuoc
+            WHERE COALESCE(d.ton_kho, 0) != COALESCE(s.tong, 0)
+        """)
+        return cur.fetchall()
+
+
+def rebuild_stock_from_ledger():
+    """Tính lại danh_muc_thuoc.ton_kho từ sổ kho. Trả về số thuốc đã sửa."""
+    with pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE danh_muc_thuoc
+            SET ton_kho = COALESCE((SELECT SUM(so_luong) FROM so_kho_thuoc s WHERE s.ma_thuoc = danh_muc_thuoc.ma_thuoc), 0)
+            WHERE COALESCE(ton_kho, 0) != COALESCE((SELECT SUM(so_luong) FROM so_kho_thuoc s WHERE s.ma_thuoc = danh_muc_thuoc.ma_thuoc), 0)
+        """)
+        return cur.rowcount
 
 
 # --- User management helpers (password hashing using PBKDF2) ---
@@ -968,6 +2675,8 @@ def create_user(username: str, password: str, role: str = 'user', full_name: str
                     cur.execute("SELECT id FROM nhan_su WHERE ten = ? AND chuc_vu = ?", (display_name, mapped))
                     if not cur.fetchone():
                         cur.execute("INSERT INTO nhan_su (ten, chuc_vu, phong_kham) VALUES (?, ?, ?)", (display_name, mapped, None))
+                    conn.commit()
+                    reference_cache.invalidate('nhan_su')
                 except Exception:
                     # best-effort: ignore failure to insert into nhan_su
                     pass
@@ -984,77 +2693,74 @@ def create_user(username: str, password: str, role: str = 'user', full_name: str
 
 
 def verify_user(username: str, password: str) -> bool:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
         r = cur.fetchone()
         if not r:
             return False
         return _verify_password(r[0], password)
-    finally:
-        conn.close()
 
 
 def get_user_fullname(username: str) -> str:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         try:
             cur.execute("SELECT full_name FROM users WHERE username = ?", (username,))
             r = cur.fetchone()
             return r[0] if r and r[0] else ''
         except Exception:
             return ''
-    finally:
-        conn.close()
 
 
 def update_user_fullname(username: str, full_name: str) -> bool:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        try:
-            cur.execute("ALTER TABLE users ADD COLUMN full_name TEXT")
-        except Exception:
-            pass
+    with pool.write() as conn:
+        cur = conn.cursor()
         cur.execute("UPDATE users SET full_name = ? WHERE username = ?", (full_name, username))
-        conn.commit()
         return True
-    finally:
-        conn.close()
 
 
 def add_bac_si(ten: str, chuyen_khoa: str = None) -> bool:
     """Insert a doctor into `nhan_su` with chuc_vu='Bác sĩ' if not exists (by exact name)."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT id FROM nhan_su WHERE ten = ? AND chuc_vu = 'Bác sĩ'", (ten,))
         if cur.fetchone():
             return False
         cur.execute("INSERT INTO nhan_su (ten, chuc_vu, phong_kham) VALUES (?, 'Bác sĩ', ?)", (ten, chuyen_khoa))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    # Sau commit: lần đọc danh sách bác sĩ kế tiếp lấy dữ liệu mới
+    reference_cache.invalidate('nhan_su')
+    return True
+
+
+def _load_doctor_names():
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT ten FROM nhan_su WHERE chuc_vu = 'Bác sĩ' ORDER BY ten ASC")
+        return tuple(r[0] for r in cur.fetchall())
+
+
+def get_doctor_names():
+    """Tên các bác sĩ theo thứ tự ABC, qua reference_cache.
+
+    Mục đệm gắn với phiên bản 'nhan_su' (trigger của _m017): tiến trình khác sửa nhân sự thì lần gọi
+    sau nạp lại ngay; không đổi thì chỉ tốn một lần tra phien_ban_du_lieu.
+    """
+    return list(reference_cache.get('bac_si', _load_doctor_names, STAFF_TTL, depends=('nhan_su',),
+                                    version=lambda: get_data_version('nhan_su')))
 
 
 def bac_si_exists(ten: str) -> bool:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT id FROM nhan_su WHERE ten = ? AND chuc_vu = 'Bác sĩ'", (ten,))
         return cur.fetchone() is not None
-    finally:
-        conn.close()
 
 
 def add_tiep_tan(ten: str, username: str = None) -> bool:
     """Insert a receptionist into `nhan_su` with chuc_vu='Tiếp tân'. If username provided, use full_name if available."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         display_name = ten
         if username:
             try:
@@ -1068,16 +2774,13 @@ def add_tiep_tan(ten: str, username: str = None) -> bool:
         if cur.fetchone():
             return False
         cur.execute("INSERT INTO nhan_su (ten, chuc_vu, phong_kham) VALUES (?, 'Tiếp tân', NULL)", (display_name,))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    reference_cache.invalidate('nhan_su')
+    return True
 
 
 def tiep_tan_exists(ten: str = None, username: str = None) -> bool:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         if username:
             try:
                 cur.execute("SELECT full_name FROM users WHERE username = ?", (username,))
@@ -1093,64 +2796,47 @@ def tiep_tan_exists(ten: str = None, username: str = None) -> bool:
             cur.execute("SELECT id FROM nhan_su WHERE ten = ? AND chuc_vu = 'Tiếp tân'", (ten,))
             return cur.fetchone() is not None
         return False
-    finally:
-        conn.close()
 
 
 def get_user_role(username: str) -> str:
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT role FROM users WHERE username = ?", (username,))
         r = cur.fetchone()
         return r[0] if r else ''
-    finally:
-        conn.close()
 
 
 def start_user_session(username: str) -> int:
     """Insert a login record and return session id."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         cur.execute("INSERT INTO user_sessions (username, login_time) VALUES (?, ?)", (username, now))
-        conn.commit()
         return cur.lastrowid
-    finally:
-        conn.close()
 
 
 def end_user_session(session_id: int) -> None:
     """Set logout_time for given session id."""
     if not session_id:
         return
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.write() as conn:
+        cur = conn.cursor()
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         cur.execute("UPDATE user_sessions SET logout_time = ? WHERE id = ?", (now, session_id))
-        conn.commit()
-    finally:
-        conn.close()
 
 
 def get_user_sessions(username: str, limit: int = 100):
     """Return list of sessions (login_time, logout_time) for user."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT id, login_time, logout_time FROM user_sessions WHERE username = ? ORDER BY id DESC LIMIT ?", (username, limit))
         return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def get_sessions_by_role(role: str, limit: int = 500):
     """Return sessions for all users with given role."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT username FROM users WHERE role = ?", (role,))
         users = [r[0] for r in cur.fetchall()]
         if not users:
@@ -1159,36 +2845,29 @@ def get_sessions_by_role(role: str, limit: int = 500):
         params = users + [limit]
         cur.execute(q, params)
         return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def save_xuat_thuoc_history(don_thuoc_id: int, bac_si: str, ho_ten_benh_nhan: str, so_cccd: str, xuat_boi: str, ghi_chu: str = ""):
     """Lưu lịch sử xuất thuốc."""
     from datetime import datetime
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        thoi_gian_xuat = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cur.execute("""
-            INSERT INTO lich_su_xuat_thuoc 
-            (don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (don_thuoc_id, bac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu))
-        conn.commit()
+        with pool.write() as conn:
+            thoi_gian_xuat = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            conn.execute("""
+                INSERT INTO lich_su_xuat_thuoc 
+                (don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (don_thuoc_id, bac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu))
         return True
     except Exception as e:
         print(f"Error saving xuat thuoc history: {e}")
         return False
-    finally:
-        conn.close()
 
 
 def get_xuat_thuoc_history(limit: int = 100):
     """Lấy lịch sử xuất thuốc."""
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
+    with pool.read() as conn:
+        cur = conn.cursor()
         cur.execute("""
             SELECT id, don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu
             FROM lich_su_xuat_thuoc
@@ -1196,48 +2875,40 @@ def get_xuat_thuoc_history(limit: int = 100):
             LIMIT ?
         """, (limit,))
         return cur.fetchall()
-    finally:
-        conn.close()
+
+
+def get_supplementary_prescriptions_for_patients(benh_nhan_ids):
+    """Đơn thuốc bổ sung của nhiều bệnh nhân một lúc: {benh_nhan_id: [đơn]}."""
+    return _load_prescriptions('don_thuoc_bo_sung', benh_nhan_ids)
 
 
 def get_supplementary_prescriptions_for_patient(benh_nhan_id: int):
     """Return all supplementary prescriptions (don_thuoc_bo_sung) for a given patient id with their items.
     
-    Returns list of dicts: {id, phieu_kham_id, ngay_ke, so_ngay, tong_tien, bac_si, xuat_thuoc, items:[{ten_thuoc, ma_thuoc, so_luong, don_vi}]}
+    Returns list of dicts: {id, phieu_kham_id, ngay_ke, so_ngay, tong_tien, tong_tien_thuoc, bac_si, xuat_thuoc,
+    items:[{ten_thuoc, ma_thuoc, so_luong, don_vi, gia_thuoc, thanh_tien}]}
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        q = """
-            SELECT dtbs.id, dtbs.phieu_kham_id, dtbs.ngay_ke, dtbs.so_ngay, dtbs.tong_tien, dtbs.bac_si, COALESCE(dtbs.xuat_thuoc, 0) as xuat_thuoc
-            FROM don_thuoc_bo_sung dtbs
-            JOIN phieu_kham pk ON dtbs.phieu_kham_id = pk.id
-            WHERE pk.benh_nhan_id = ?
-            ORDER BY dtbs.ngay_ke DESC
-        """
-        cur.execute(q, (benh_nhan_id,))
-        rows = cur.fetchall()
-        results = []
-        for r in rows:
-            don_id = r[0]
-            cur.execute("SELECT ma_thuoc, ten_thuoc, so_luong, don_vi FROM chi_tiet_don_thuoc_bo_sung WHERE don_thuoc_bo_sung_id = ?", (don_id,))
-            items = [dict(ma_thuoc=i[0], ten_thuoc=i[1], so_luong=i[2], don_vi=i[3]) for i in cur.fetchall()]
-            results.append({
-                'id': don_id,
-                'phieu_kham_id': r[1],
-                'ngay_ke': r[2],
-                'so_ngay': r[3],
-                'tong_tien': r[4],
-                'bac_si': r[5],
-                'xuat_thuoc': bool(r[6]) if r[6] is not None else False,
-                'items': items,
-            })
-        return results
-    finally:
-        conn.close()
+    return get_supplementary_prescriptions_for_patients([benh_nhan_id])[benh_nhan_id]
 
 
 if __name__ == "__main__":
+    import sys
     initialize_database()
     print("✅ Database và các bảng đã được tạo thành công!")
+    if "--explain" in sys.argv[1:]:
+        explain_known_queries()
+    if "--rebuild-doanh-thu" in sys.argv[1:]:
+        n = rebuild_revenue_rollup()
+        print(f"✅ Đã tính lại doanh_thu_ngay ({n} ngày)")
+    if "--rebuild-fts" in sys.argv[1:]:
+        rebuild_search_index()
+        print(f"✅ Đã tạo lại chỉ mục tìm kiếm toàn văn ({'không dấu' if FTS_UNACCENT else 'có dấu'})")
+    if "--rebuild-change-log-triggers" in sys.argv[1:]:
+        rebuild_change_log_triggers()
+        print("✅ Đã tạo lại trigger change_log")
+    if "--rebuild-ton-kho" in sys.argv[1:]:
+        for ma_thuoc, ton_kho, tong in check_stock_ledger():
+            print(f"   {ma_thuoc}: ton_kho={ton_kho}, sổ kho={tong}")
+        n = rebuild_stock_from_ledger()
+        print(f"✅ Đã tính lại tồn kho từ sổ kho ({n} thuốc thay đổi)")
 
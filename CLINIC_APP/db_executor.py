@@ -0,0 +1,156 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from PyQt5.QtCore import QObject, QMetaObject, Qt, Q_ARG, pyqtSignal, pyqtSlot
+
+
+class DbTask(QObject):
+    """Kết quả tương lai của một truy vấn chạy nền.
+
+    - finished(result): truy vấn xong (phát trên GUI thread)
+    - failed(exception): truy vấn lỗi
+    - cancelled(): bị huỷ (bởi cancel() hoặc bị yêu cầu mới cùng key thay thế)
+    """
+
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    cancelled = pyqtSignal()
+
+    def __init__(self, key, fn, args, kwargs):
+        super().__init__()
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.done = False
+        self._cancelled = False
+
+    def same_request(self, fn, args, kwargs):
+        return self.fn == fn and self.args == args and self.kwargs == kwargs
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """Huỷ task: nếu chưa chạy thì bỏ qua hẳn, nếu đang chạy thì bỏ kết quả."""
+        if self.done or self._cancelled:
+            return
+        self._cancelled = True
+        self.cancelled.emit()
+
+    @pyqtSlot(object, object)
+    def _deliver(self, result, error):
+        # Luôn chạy trên GUI thread (gọi qua QueuedConnection từ worker)
+        if self._cancelled:
+            return
+        self.done = True
+        if error is not None:
+            self.failed.emit(error)
+        else:
+            self.finished.emit(result)
+
+
+def _run_task(task):
+    if task.is_cancelled():
+        return
+    result, error = None, None
+    try:
+        result = task.fn(*task.args, **task.kwargs)
+    except Exception as e:
+        error = e
+    QMetaObject.invokeMethod(task, "_deliver", Qt.QueuedConnection,
+                             Q_ARG(object, result), Q_ARG(object, error))
+
+
+class DbExecutor:
+    """Chạy các hàm truy vấn DB trên các thread Python (ThreadPoolExecutor) để GUI thread không bị chặn.
+
+    Mỗi worker thread giữ kết nối riêng của pool (database.pool cấp theo thread) suốt đời thread;
+    kết quả về GUI thread qua slot DbTask._deliver (QueuedConnection).
+    Không dùng QThreadPool: worker của Qt bỏ Python thread state (kèm threading.local) sau mỗi
+    QRunnable.run(), nên mỗi task lại mở kết nối SQLite mới và chạy lại các PRAGMA
+    (50 task trên 1 worker = 50 lần mở kết nối).
+    key: tên nhóm yêu cầu (vd. 'quan_ly_thuoc.drugs'):
+      - yêu cầu giống hệt đang chạy cùng key -> dùng lại task cũ (gộp yêu cầu)
+      - yêu cầu khác cùng key -> huỷ task cũ (kết quả cũ đã lỗi thời)
+    owner: widget nhận kết quả; key được tính riêng cho từng owner và task tự huỷ
+      khi owner bị huỷ (vd. trang bị PageCache dọn) để không gọi vào widget đã xoá.
+    """
+
+    def __init__(self, max_threads=2):
+        self._pool = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='db')
+        self._tasks = {}
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def submit(self, fn, *args, key=None, owner=None, on_result=None, on_error=None, **kwargs):
+        """Đưa fn(*args, **kwargs) vào hàng đợi. Trả về DbTask."""
+        if owner is not None and key is not None:
+            key = (key, id(owner))
+        if key is not None:
+            current = self._tasks.get(key)
+            if current is not None and not current.done and not current.is_cancelled():
+                if current.same_request(fn, args, kwargs):
+                    if on_result:
+                        current.finished.connect(on_result)
+                    if on_error:
+                        current.failed.connect(on_error)
+                    return current
+                current.cancel()
+
+        task = DbTask(key, fn, args, kwargs)
+        if on_result:
+            task.finished.connect(on_result)
+        if on_error:
+            task.failed.connect(on_error)
+        else:
+            task.failed.connect(lambda e, fn=fn: print(f"Lỗi truy vấn nền {getattr(fn, '__name__', fn)}: {e}"))
+        if key is not None:
+            self._tasks[key] = task
+            task.finished.connect(lambda _=None, t=task: self._forget(t))
+            task.failed.connect(lambda _=None, t=task: self._forget(t))
+            task.cancelled.connect(lambda t=task: self._forget(t))
+        if owner is not None:
+            owner.destroyed.connect(task.cancel)
+            release = lambda *_, o=owner, t=task: self._release(o, t)
+            task.finished.connect(release)
+            task.failed.connect(release)
+            task.cancelled.connect(release)
+        future = self._pool.submit(_run_task, task)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._future_done)
+        return task
+
+    def _future_done(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def _forget(self, task):
+        if self._tasks.get(task.key) is task:
+            del self._tasks[task.key]
+
+    @staticmethod
+    def _release(owner, task):
+        # Task đã xong: bỏ kết nối destroyed -> cancel để owner không giữ task cũ
+        try:
+            owner.destroyed.disconnect(task.cancel)
+        except (TypeError, RuntimeError):
+            pass
+
+    def cancel(self, key):
+        """Huỷ task đang chờ/chạy của key (nếu có)."""
+        task = self._tasks.get(key)
+        if task is not None:
+            task.cancel()
+
+    def wait(self, msecs=-1):
+        """Chờ mọi task xong (dùng khi đóng ứng dụng). Trả về False nếu hết msecs mà vẫn còn task."""
+        with self._futures_lock:
+            pending = list(self._futures)
+        _, not_done = wait(pending, timeout=None if msecs < 0 else msecs / 1000.0)
+        return not not_done
+
+
+# Executor dùng chung cho các form
+executor = DbExecutor()
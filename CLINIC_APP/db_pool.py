@@ -0,0 +1,233 @@
+import itertools
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+
+
+# PRAGMA áp dụng một lần cho mỗi kết nối mới (không lặp lại mỗi lần gọi get_connection)
+DEFAULT_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _is_open(conn):
+    try:
+        conn.total_changes
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+class _ThreadToken:
+    """Vật đánh dấu nằm trong threading.local của một thread; bị huỷ khi thread kết thúc."""
+
+    __slots__ = ('__weakref__',)
+
+
+class PooledConnection:
+    """Proxy mỏng quanh kết nối sqlite3 dùng chung của thread hiện tại.
+
+    Giữ nguyên API quen thuộc (cursor/execute/commit/rollback/close) để các form
+    cũ không phải sửa, nhưng close() chỉ trả kết nối về pool thay vì đóng thật.
+    Nếu người gọi cuối cùng trả kết nối khi vẫn còn transaction dở dang
+    (BEGIN mà quên commit), transaction đó sẽ bị rollback.
+    """
+
+    __slots__ = ('_manager', '_conn', '_released', '__weakref__')
+
+    def __init__(self, manager, conn):
+        self._manager = manager
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        if name in PooledConnection.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._manager._release(self._conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """Quản lý kết nối SQLite theo thread.
+
+    - Mỗi thread giữ đúng một kết nối, được tạo lần đầu khi cần và tái sử dụng.
+    - Các PRAGMA (WAL, synchronous...) chỉ chạy một lần khi mở kết nối.
+    - read(): khối đọc, không mở transaction.
+    - write(): khối ghi trong một transaction (BEGIN IMMEDIATE ... COMMIT),
+      tự rollback khi có lỗi; lồng nhau thì dùng SAVEPOINT.
+    """
+
+    def __init__(self, db_path, timeout=20.0, pragmas=DEFAULT_PRAGMAS):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.pragmas = tuple(pragmas)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # khoá (tăng dần) -> kết nối; mỗi thread một khoá riêng, không dùng thread ident
+        # vì ident được hệ điều hành cấp lại cho thread mới
+        self._all = {}
+        self._keys = itertools.count()
+        self._generation = 0
+        self._functions = {}
+
+    # --- quản lý kết nối thô ---
+    def _open(self):
+        conn = sqlite3.connect(self.db_path,
+                               timeout=self.timeout,
+                               isolation_level=None,
+                               check_same_thread=False)
+        for pragma in self.pragmas:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as e:
+                print(f"Không áp dụng được '{pragma}': {e}")
+        for name, (nargs, fn) in self._functions.items():
+            conn.create_function(name, nargs, fn, deterministic=True)
+        return conn
+
+    def create_function(self, name, nargs, fn):
+        """Đăng ký hàm SQL viết bằng Python cho mọi kết nối của pool (kể cả kết nối đã mở)."""
+        self._functions[name] = (nargs, fn)
+        with self._lock:
+            conns = list(self._all.values())
+        for conn in conns:
+            conn.create_function(name, nargs, fn, deterministic=True)
+
+    def _slot(self):
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.conn = None
+            local.token = None
+            local.depth = 0
+            local.generation = self._generation
+        return local
+
+    def connection(self):
+        """Trả về kết nối sqlite3 thật của thread hiện tại (tạo mới nếu chưa có hoặc đã bị đóng)."""
+        local = self._slot()
+        if local.conn is None or not _is_open(local.conn):
+            conn = self._open()
+            key = next(self._keys)
+            token = _ThreadToken()
+            with self._lock:
+                self._all[key] = conn
+            # Kết nối chỉ được đóng bởi chính thread sở hữu: khi thread kết thúc, threading.local
+            # của nó bị xoá, token bị huỷ và finalize đóng kết nối (kể cả thread của QThreadPool,
+            # thread mà threading.enumerate() không liệt kê)
+            # Lúc thoát chương trình thread daemon có thể vẫn đang truy vấn: không đóng hộ
+            weakref.finalize(token, self._discard, key).atexit = False
+            local.conn, local.token, local.depth = conn, token, 0
+        return local.conn
+
+    def _discard(self, key):
+        with self._lock:
+            conn = self._all.pop(key, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """Mượn kết nối dưới dạng PooledConnection (dùng cho get_connection())."""
+        conn = self.connection()
+        self._local.depth += 1
+        return PooledConnection(self, conn)
+
+    def _release(self, conn):
+        local = self._slot()
+        if local.conn is not conn:
+            # Kết nối thuộc thế hệ pool cũ (sau reset) hoặc thread khác: bỏ qua
+            return
+        local.depth = max(0, local.depth - 1)
+        if local.depth == 0:
+            if conn.in_transaction:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            conn.row_factory = None
+
+    # --- đơn vị công việc ---
+    @contextmanager
+    def read(self):
+        """Khối đọc: trả về kết nối của thread, không mở transaction."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def write(self, immediate=True):
+        """Khối ghi nguyên tử: commit khi thành công, rollback khi có exception.
+
+        immediate=True lấy khóa ghi ngay từ đầu (BEGIN IMMEDIATE) để tránh lỗi
+        'database is locked' giữa chừng khi nhiều tiến trình cùng ghi.
+        """
+        conn = self.acquire()
+        raw = conn._conn
+        nested = raw.in_transaction
+        savepoint = f"sp_{id(conn)}"
+        try:
+            if nested:
+                raw.execute(f"SAVEPOINT {savepoint}")
+            else:
+                raw.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                if nested:
+                    raw.execute(f"ROLLBACK TO {savepoint}")
+                    raw.execute(f"RELEASE {savepoint}")
+                elif raw.in_transaction:
+                    raw.rollback()
+                raise
+            if nested:
+                raw.execute(f"RELEASE {savepoint}")
+            elif raw.in_transaction:
+                raw.commit()
+        finally:
+            conn.close()
+
+    def close_all(self):
+        """Đóng mọi kết nối đã mở (gọi khi thoát ứng dụng hoặc đổi DB)."""
+        with self._lock:
+            conns = list(self._all.values())
+            self._all = {}
+            self._generation += 1
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def reset(self, db_path=None):
+        """Đóng các kết nối hiện có và (tuỳ chọn) trỏ pool sang file DB khác."""
+        self.close_all()
+        if db_path:
+            self.db_path = db_path
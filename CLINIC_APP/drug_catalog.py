@@ -0,0 +1,75 @@
+"""
+Bộ nhớ đệm danh mục thuốc dùng chung cho cả tiến trình.
+
+- Dict theo ma_thuoc + danh sách đã sắp xếp, thay cho việc mỗi màn hình (chọn thuốc trong kê đơn,
+  quản lý thuốc, xuất thuốc) tự SELECT danh_muc_thuoc.
+- Trigger trên danh_muc_thuoc tăng phiên bản 'danh_muc_thuoc' (database._m011_drug_catalog_version)
+  khi thêm/sửa/xoá thuốc hoặc nhập/xuất kho, kể cả từ máy khác. refresh() chỉ đọc lại khi phiên bản
+  đổi, nên gọi thường xuyên chỉ tốn một lần tra phien_ban_du_lieu.
+- Model Qt dùng chung và signal báo thay đổi nằm ở forms/drug_catalog_model.py.
+"""
+from collections import namedtuple
+import threading
+
+from database import get_data_version, get_drug_catalog_rows
+
+DrugRecord = namedtuple('DrugRecord', 'ma_thuoc ten_thuoc don_vi gia_thuoc ton_kho')
+
+
+class DrugCatalog:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_code = {}
+        self._records = []      # theo mã thuốc
+        self._by_name = None    # cache danh sách theo tên
+        self.version = None
+
+    def refresh(self):
+        """Đọc lại danh mục nếu phiên bản đã đổi. Trả về True nếu có thay đổi.
+
+        An toàn khi gọi từ worker thread (db_executor).
+        """
+        with self._lock:
+            # Đọc phiên bản trước dữ liệu: thay đổi xen giữa sẽ được lần refresh sau nhận ra
+            current = get_data_version('danh_muc_thuoc')
+            if current == self.version:
+                return False
+            records = [DrugRecord(*r) for r in get_drug_catalog_rows()]
+            self._records = records
+            self._by_code = {r.ma_thuoc: r for r in records}
+            self._by_name = None
+            self.version = current
+            return True
+
+    def get(self, ma_thuoc):
+        """Thuốc theo mã (None nếu không có)."""
+        if ma_thuoc is None:
+            return None
+        return self._by_code.get(str(ma_thuoc).strip())
+
+    def all(self):
+        """Toàn bộ thuốc theo mã thuốc."""
+        return list(self._records)
+
+    def by_name(self):
+        """Toàn bộ thuốc theo tên thuốc."""
+        with self._lock:
+            if self._by_name is None:
+                self._by_name = sorted(self._records, key=lambda r: (r.ten_thuoc or '', r.ma_thuoc or ''))
+            return list(self._by_name)
+
+    def codes(self):
+        return [r.ma_thuoc for r in self._records]
+
+    def __len__(self):
+        return len(self._records)
+
+
+# Danh mục dùng chung trong tiến trình
+drug_catalog = DrugCatalog()
+
+
+def get_drug_catalog():
+    """Danh mục dùng chung, đã đồng bộ với DB."""
+    drug_catalog.refresh()
+    return drug_catalog
@@ -1,14 +1,30 @@
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
-    QLabel, QPushButton, QLineEdit, QTabWidget, QHeaderView, QMessageBox, QSplitter, QComboBox, QFileDialog, QDateTimeEdit
+    QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QTableView, QAbstractItemView,
+    QLabel, QPushButton, QLineEdit, QTabWidget, QHeaderView, QMessageBox, QSplitter, QComboBox, QFileDialog, QDateTimeEdit,
+    QCheckBox
 )
 from forms.dat_lich_kham_form import DatLichKhamForm
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont
-from database import get_connection, get_sessions_by_role
+from database import get_connection, get_sessions_by_role, get_patient_ehr, patient_search_sql
+from forms.lazy_table import LazySqlTableModel
+from db_executor import executor
 import csv, os
 
 
+def _fetch_patient_detail(pid):
+    """Thông tin cơ bản + các lần khám (kèm đơn thuốc) của bệnh nhân; chạy trên worker thread."""
+    conn = get_connection()
+    try:
+        r = conn.execute("SELECT ho_ten, ngay_sinh, dien_thoai, dia_chi, so_cccd FROM benh_nhan WHERE id = ?",
+                         (pid,)).fetchone()
+    finally:
+        conn.close()
+    # Các lần khám kèm chi tiết và đơn thuốc (số truy vấn cố định, dùng chung với web /ehr)
+    visits = get_patient_ehr(pid) if r else []
+    return r, visits
+
+
 class AdminPanel(QWidget):
     def __init__(self):
         super().__init__()
@@ -165,8 +181,12 @@ class AdminPanel(QWidget):
         # Hàng tìm kiếm / các hành động
         search_actions = QHBoxLayout()
         self.patient_search = QLineEdit()
-        self.patient_search.setPlaceholderText("Tìm theo tên hoặc số điện thoại...")
+        self.patient_search.setPlaceholderText("Tìm theo tên, SĐT, CCCD, địa chỉ (không cần dấu)...")
         self.patient_search.setMinimumWidth(300)
+        self.patient_search.returnPressed.connect(self.load_patients)
+        self.chk_search_kham = QCheckBox("Tìm trong chẩn đoán / kết luận")
+        self.chk_search_kham.setToolTip("Tìm bệnh nhân có lần khám mà chẩn đoán, kết luận hoặc khám lâm sàng khớp từ khoá")
+        self.chk_search_kham.toggled.connect(lambda _: self.load_patients())
         self.btn_patient_search = QPushButton("Tìm")
         self.btn_patient_search.clicked.connect(self.load_patients)
         self.btn_patient_clear = QPushButton("Xóa")
@@ -179,6 +199,7 @@ class AdminPanel(QWidget):
         search_actions.addWidget(self.patient_search)
         search_actions.addWidget(self.btn_patient_search)
         search_actions.addWidget(self.btn_patient_clear)
+        search_actions.addWidget(self.chk_search_kham)
         search_actions.addStretch()
         search_actions.addWidget(self.lbl_patient_count)
         search_actions.addWidget(self.btn_export_patients)
@@ -188,14 +209,19 @@ class AdminPanel(QWidget):
         splitter = QSplitter(Qt.Horizontal)
 
         # Bên trái: danh sách bệnh nhân
-        self.table_patients = QTableWidget(0, 5)
-        self.table_patients.setHorizontalHeaderLabels(["ID", "Họ tên", "Ngày sinh", "Điện thoại", "Địa chỉ"])
+        # Danh sách bệnh nhân đọc dần theo trang; tuple: (stt, id, ho_ten, ngay_sinh, dien_thoai, dia_chi)
+        self.model_patients = LazySqlTableModel([
+            ("ID", 0), ("Họ tên", 2), ("Ngày sinh", 3), ("Điện thoại", 4), ("Địa chỉ", 5),
+        ])
+        self.table_patients = QTableView()
+        self.table_patients.setModel(self.model_patients)
         self.table_patients.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.table_patients.verticalHeader().setVisible(False)
-        self.table_patients.setSelectionBehavior(QTableWidget.SelectRows)
+        self.table_patients.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table_patients.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table_patients.setAlternatingRowColors(True)
         self.table_patients.setStyleSheet("""
-            QTableWidget {
+            QTableView {
                 border: 1px solid #ddd;
                 gridline-color: #e0e0e0;
                 font-size: 14px;
@@ -207,13 +233,13 @@ class AdminPanel(QWidget):
                 font-weight: bold;
                 border: none;
             }
-            QTableWidget::item:selected {
+            QTableView::item:selected {
                 background-color: #1976d2;
                 color: white;
             }
         """)
 
-        self.table_patients.cellClicked.connect(self.on_patient_selected)
+        self.table_patients.clicked.connect(lambda idx: self.on_patient_selected(idx.row(), idx.column()))
         splitter.addWidget(self.table_patients)
 
         # Bên phải: chi tiết bệnh nhân + lượt khám
@@ -307,104 +333,55 @@ class AdminPanel(QWidget):
 
     def load_patients(self):
         query = self.patient_search.text().strip()
-        conn = get_connection()
-        cur = conn.cursor()
         try:
+            # Cột 0: STT (số thứ tự) tính trong SQL để các trang sau vẫn đánh số liên tục
             if query:
-                q = f"%{query}%"
-                cur.execute("SELECT id, ho_ten, ngay_sinh, dien_thoai, dia_chi FROM benh_nhan WHERE ho_ten LIKE ? OR dien_thoai LIKE ? ORDER BY ho_ten", (q, q))
+                # Tìm toàn văn (FTS5): kết quả xếp theo độ liên quan, model vẫn đọc dần theo trang
+                scope = 'kham' if self.chk_search_kham.isChecked() else 'benh_nhan'
+                sql, count_sql, params = patient_search_sql(
+                    query, "ROW_NUMBER() OVER (ORDER BY m.rank, b.ho_ten, b.id), b.id, b.ho_ten, b.ngay_sinh, "
+                           "b.dien_thoai, b.dia_chi", scope=scope)
             else:
-                cur.execute("SELECT id, ho_ten, ngay_sinh, dien_thoai, dia_chi FROM benh_nhan ORDER BY ho_ten")
-            rows = cur.fetchall()
-        finally:
-            conn.close()
-
-        self.table_patients.setRowCount(0)
-        for idx, r in enumerate(rows, 1):
-            row = self.table_patients.rowCount()
-            self.table_patients.insertRow(row)
-            # Cột 0: STT (số thứ tự)
-            stt_item = QTableWidgetItem(str(idx))
-            stt_item.setData(Qt.UserRole, r[0])  # Store ID invisibly
-            stt_item.setFlags(stt_item.flags() ^ Qt.ItemIsEditable)
-            self.table_patients.setItem(row, 0, stt_item)
-            # Các cột 1-4: họ tên, ngày sinh, điện thoại, địa chỉ
-            for c, v in enumerate(r[1:], 1):
-                item = QTableWidgetItem(str(v) if v is not None else "")
-                item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-                self.table_patients.setItem(row, c, item)
-        self.lbl_patient_count.setText(f"Tổng: {len(rows)} bệnh nhân")
-
-    def on_patient_selected(self, row, col):
-        try:
-            item = self.table_patients.item(row, 0)
-            if not item:
-                return
-            pid = item.data(Qt.UserRole)
+                sql = ("SELECT ROW_NUMBER() OVER (ORDER BY ho_ten, id), id, ho_ten, ngay_sinh, dien_thoai, dia_chi "
+                       "FROM benh_nhan ORDER BY ho_ten, id")
+                count_sql, params = "SELECT COUNT(*) FROM benh_nhan", ()
+            self.model_patients.set_query(sql, params)
             conn = get_connection()
-            cur = conn.cursor()
             try:
-                # Tải thông tin cơ bản bệnh nhân
-                cur.execute("SELECT ho_ten, ngay_sinh, dien_thoai, dia_chi, so_cccd FROM benh_nhan WHERE id = ?", (pid,))
-                r = cur.fetchone()
-                if r:
-                    ho_ten, ns, dt, dc, cccd = r
-                    # Chuẩn bị phần tiêu đề chi tiết (thông tin cơ bản)
-                    header_html = (
-                        f"<b>ID:</b> {pid}<br>"
-                        f"<b>Họ tên:</b> {ho_ten}<br>"
-                        f"<b>Ngày sinh:</b> {ns or '—'}<br>"
-                        f"<b>Điện thoại:</b> {dt or '—'}<br>"
-                        f"<b>Địa chỉ:</b> {dc or '—'}<br>"
-                        f"<b>CCCD:</b> {cccd or '—'}"
-                    )
-                else:
-                    self.lbl_patient_detail.setText("Không tìm thấy thông tin bệnh nhân")
-                    visits = []
-
-                # Tải các lần khám (phieu_kham) và chi tiết liên quan (chi_tiet_phieu_kham, don_thuoc)
-                cur.execute("SELECT id, so_phieu, ngay_lap, bac_si, phong_kham FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY datetime(ngay_lap) DESC", (pid,))
-                pk_rows = cur.fetchall()
-                visits = []
-                for pk in pk_rows:
-                    pkid, so_phieu, ngay_lap, bac_si, phong_kham = pk
-                    # Chi tiết mới nhất cho lần khám này
-                    cur.execute("SELECT chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (pkid,))
-                    detail_row = cur.fetchone() or ('', '', '', '', '')
-                    chan_doan, ket_luan, icd10, di_ung_thuoc, ghi_chu_kham = detail_row
-
-                    # Đơn thuốc
-                    cur.execute("SELECT id, ngay_ke, so_ngay, ngay_tai_kham, chan_doan, loi_dan FROM don_thuoc WHERE phieu_kham_id = ? ORDER BY ngay_ke DESC", (pkid,))
-                    pres_list = []
-                    for p in cur.fetchall():
-                        don_id, ngay_ke, so_ngay, ngay_tai_kham, don_chan_doan, loi_dan = p
-                        cur.execute("SELECT ten_thuoc, so_luong, sang, trua, chieu, toi, lieu_dung, ghi_chu FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_id,))
-                        meds = cur.fetchall()
-                        pres_list.append({
-                            'id': don_id,
-                            'ngay_ke': ngay_ke,
-                            'so_ngay': so_ngay,
-                            'ngay_tai_kham': ngay_tai_kham,
-                            'chan_doan': don_chan_doan,
-                            'loi_dan': loi_dan,
-                            'meds': meds,
-                        })
-
-                    visits.append({
-                        'id': pkid,
-                        'so_phieu': so_phieu,
-                        'ngay_lap': ngay_lap,
-                        'bac_si': bac_si,
-                        'phong_kham': phong_kham,
-                        'chan_doan': chan_doan,
-                        'ket_luan': ket_luan,
-                        'icd10': icd10,
-                        'di_ung_thuoc': di_ung_thuoc,
-                        'ghi_chu_kham': ghi_chu_kham,
-                        'don_thuoc': pres_list,
-                    })
+                total = conn.execute(count_sql, params).fetchone()[0]
             finally:
                 conn.close()
+        except Exception as e:
+            QMessageBox.critical(self, "Lỗi", f"Không thể tải danh sách bệnh nhân:\n{e}")
+            return
+        self.lbl_patient_count.setText(f"Tổng: {total} bệnh nhân")
+
+    def on_patient_selected(self, row, col):
+        values = self.model_patients.row_values(row)
+        if not values:
+            return
+        pid = values[1]
+        # Đọc chạy nền; bấm sang bệnh nhân khác khi chưa tải xong sẽ huỷ lần tải cũ
+        executor.submit(_fetch_patient_detail, pid, key='admin_panel.patient_detail', owner=self,
+                        on_result=lambda res, pid=pid: self._show_patient_detail(pid, *res),
+                        on_error=lambda e: QMessageBox.critical(self, "Lỗi", f"Không thể tải thông tin bệnh nhân:\n{e}"))
+
+    def _show_patient_detail(self, pid, r, visits):
+        try:
+            if not r:
+                self.lbl_patient_detail.setText("Không tìm thấy thông tin bệnh nhân")
+                self.table_visits.setRowCount(0)
+                return
+            ho_ten, ns, dt, dc, cccd = r
+            # Chuẩn bị phần tiêu đề chi tiết (thông tin cơ bản)
+            header_html = (
+                f"<b>ID:</b> {pid}<br>"
+                f"<b>Họ tên:</b> {ho_ten}<br>"
+                f"<b>Ngày sinh:</b> {ns or '—'}<br>"
+                f"<b>Điện thoại:</b> {dt or '—'}<br>"
+                f"<b>Địa chỉ:</b> {dc or '—'}<br>"
+                f"<b>CCCD:</b> {cccd or '—'}"
+            )
 
             # Điền bảng lượt khám (tóm tắt)
             self.table_visits.setRowCount(0)
@@ -454,13 +431,15 @@ class AdminPanel(QWidget):
             path, _ = QFileDialog.getSaveFileName(self, "Lưu CSV bệnh nhân", os.path.join(os.getcwd(), "output", "patients.csv"), "CSV Files (*.csv)")
             if not path:
                 return
+            model = self.model_patients
+            model.fetch_all()
             rows = []
-            for r in range(self.table_patients.rowCount()):
-                rows.append([self.table_patients.item(r, c).text() if self.table_patients.item(r, c) else "" for c in range(self.table_patients.columnCount())])
+            for r in range(model.rowCount()):
+                rows.append([model.display_text(r, c) for c in range(model.columnCount())])
             os.makedirs(os.path.dirname(path), exist_ok=True)
             with open(path, "w", newline='', encoding='utf-8') as f:
                 w = csv.writer(f)
-                w.writerow([self.table_patients.horizontalHeaderItem(c).text() for c in range(self.table_patients.columnCount())])
+                w.writerow(model.headers())
                 w.writerows(rows)
             QMessageBox.information(self, "Hoàn tất", f"Đã xuất {len(rows)} bệnh nhân ra {path}")
         except Exception as e:
@@ -18,9 +18,11 @@ import os
 font_path = os.path.join(os.path.dirname(__file__), "fonts", "arial.ttf")
 pdfmetrics.registerFont(TTFont("ArialUnicode", font_path))
 
-from PyQt5.QtCore import Qt, QDate, QStringListModel
+from PyQt5.QtCore import Qt, QDate
 from PyQt5.QtGui import QFont
-from database import get_connection, initialize_database
+from database import get_connection, initialize_database, add_payment, next_code, peek_code, pool
+from db_executor import executor
+from forms.patient_search import PatientCompleter, patient_item_index, reset_patient_combo
 initialize_database()
 import logging
 
@@ -34,6 +36,64 @@ if not logger.handlers:
     logger.addHandler(fh)
 logger.setLevel(logging.INFO)
 
+
+# --- Các hàm đọc dữ liệu chạy trên worker thread (qua db_executor), không đụng tới widget ---
+def _fetch_dich_vu_list():
+    with pool.read() as conn:
+        return conn.execute("SELECT id, ten_dich_vu, don_gia FROM dich_vu ORDER BY ten_dich_vu").fetchall()
+
+
+def _fetch_benh_nhan_id_by_ma_hoso(ma):
+    with pool.read() as conn:
+        r = conn.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,)).fetchone()
+        return r[0] if r and r[0] else None
+
+
+def _fetch_chi_dinh_benh_nhan(benh_nhan_id):
+    """(bệnh nhân, phiếu khám mới nhất, chẩn đoán ban đầu, tiếp đón mới nhất, dịch vụ đã chỉ định); None nếu không có bệnh nhân."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        # 🧍 Thông tin bệnh nhân
+        cur.execute("""
+            SELECT ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai,
+                so_cccd, doi_tuong, nghe_nghiep
+            FROM benh_nhan WHERE id = ?
+        """, (benh_nhan_id,))
+        bn = cur.fetchone()
+        if not bn:
+            return None
+        # 🧾 Phiếu khám mới nhất của bệnh nhân (không giới hạn ngày)
+        cur.execute("""
+            SELECT id, so_phieu, ngay_lap, bac_si, phong_kham, tong_tien
+            FROM phieu_kham
+            WHERE benh_nhan_id = ?
+            ORDER BY ngay_lap DESC, id DESC LIMIT 1
+        """, (benh_nhan_id,))
+        pk = cur.fetchone()
+        chan_doan = None
+        if pk:
+            # Chẩn đoán lấy từ chi_dinh (phieu_kham không lưu chẩn đoán)
+            cur.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (pk[0],))
+            cd_row = cur.fetchone()
+            chan_doan = cd_row[0] if cd_row else None
+        # 🏥 Thông tin tiếp đón (phòng khám & tình trạng)
+        cur.execute("""
+            SELECT phong_kham, bac_si_kham, tinh_trang
+            FROM tiep_don
+            WHERE benh_nhan_id = ?
+            ORDER BY id DESC LIMIT 1
+        """, (benh_nhan_id,))
+        td = cur.fetchone()
+        # 🧪 Danh sách dịch vụ đã chỉ định
+        cur.execute("""
+            SELECT cd.id, cd.ten_dich_vu, cd.so_luong, cd.don_gia, cd.thanh_tien
+            FROM chi_dinh cd
+            JOIN phieu_kham pk ON cd.phieu_kham_id = pk.id
+            WHERE pk.benh_nhan_id = ?
+        """, (benh_nhan_id,))
+        return bn, pk, chan_doan, td, cur.fetchall()
+
+
 class TextEditDialog(QDialog):
     def __init__(self, title, initial_text="", parent=None):
         super().__init__(parent)
@@ -199,10 +259,7 @@ class ChiDinhDichVu(QWidget):
         self.hoten = QComboBox()
         self.hoten.setEditable(True)
         try:
-            from PyQt5.QtWidgets import QCompleter
-            self.completer = QCompleter()
-            self.completer.setCaseSensitivity(False)
-            self.hoten.setCompleter(self.completer)
+            self.completer = PatientCompleter(self.hoten)
         except Exception:
             self.completer = None
         self.gioitinh = QLineEdit()
@@ -433,74 +490,19 @@ class ChiDinhDichVu(QWidget):
 
     # ========================== FUNCTION ==========================
     def load_benh_nhan_list(self):
-        """Tải danh sách bệnh nhân vào hoten"""
-        conn = get_connection()
-        cur = conn.cursor()
-
-        cur.execute("""
-            SELECT b.id, b.ho_ten, b.dien_thoai, b.ngay_sinh, b.so_cccd,
-                (
-                    SELECT ma_hoso FROM tiep_don td WHERE td.benh_nhan_id = b.id ORDER BY td.id DESC LIMIT 1
-                ) as ma_hoso
-            FROM benh_nhan b
-            ORDER BY b.ho_ten
-        """)
-        ds = cur.fetchall()
-        conn.close()
-
-        # Đặt placeholder để combobox bắt đầu ở trạng thái trống.
-        # Khi người dùng nhấn mũi tên mới hiện danh sách và khi chọn tên sẽ gọi on_select_benh_nhan
-        self.hoten.clear()
-        self.hoten.addItem("-- Chọn bệnh nhân --", None)
-        display_texts = []
-        for row in ds:
-            pid, name, phone, dob, cccd, ma_hoso = row
-            parts = []
-            if phone:
-                parts.append(str(phone))
-            if cccd:
-                parts.append(str(cccd))
-            if dob:
-                try:
-                    parts.append(str(dob).split('-')[0])
-                except Exception:
-                    pass
-
-            if ma_hoso:
-                disp = f"{name} — Mã:{ma_hoso}"
-            else:
-                disp = f"{name} — ID:{pid}"
-
-            if parts:
-                disp += ' — ' + ' / '.join(parts)
-
-            self.hoten.addItem(disp, pid)
-            display_texts.append(disp)
-
-        # Cập nhật model cho completer
-        try:
-            if self.completer:
-                from PyQt5.QtCore import QStringListModel
-                model = QStringListModel(display_texts)
-                self.completer.setModel(model)
-        except Exception:
-            pass
-        # Giữ placeholder được chọn ban đầu
+        """Đặt lại hoten về placeholder; completer (chỉ mục bệnh nhân dùng chung) thêm bệnh nhân được chọn."""
+        # Combobox bắt đầu ở trạng thái trống; khi chọn tên sẽ gọi on_select_benh_nhan
+        reset_patient_combo(self.hoten, "-- Chọn bệnh nhân --")
         self.hoten.setCurrentIndex(0)
 
     # ========== Quản lý danh sách dịch vụ ===========
     def load_dich_vu_list(self):
-        """Tải danh sách dịch vụ từ DB vào combo_dichvu. Nếu không có bảng, dùng danh sách tạm."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT id, ten_dich_vu, don_gia FROM dich_vu ORDER BY ten_dich_vu")
-            rows = cur.fetchall()
-        except Exception:
-            rows = []
-        finally:
-            conn.close()
+        """Tải danh sách dịch vụ từ DB vào combo_dichvu (chạy nền). Nếu không có bảng, dùng danh sách tạm."""
+        executor.submit(_fetch_dich_vu_list, key='chi_dinh_dich_vu.dich_vu', owner=self,
+                        on_result=self._fill_dich_vu_list,
+                        on_error=lambda e: self._fill_dich_vu_list([]))
 
+    def _fill_dich_vu_list(self, rows):
         # Nếu không có dữ liệu, tạo danh sách mẫu
         if not rows:
             sample = [(-1, 'Khám tổng quát', 50000), (-2, 'Xét nghiệm máu', 120000), (-3, 'Siêu âm', 200000)]
@@ -690,7 +692,7 @@ class ChiDinhDichVu(QWidget):
         # Phát tín hiệu để cập nhật form quản lý
         self.data_saved.emit()
         try:
-            app_signals.data_changed.emit()
+            app_signals.post('chi_dinh', [chi_id] if chi_id else ())
         except Exception:
             pass
 
@@ -754,7 +756,7 @@ class ChiDinhDichVu(QWidget):
         # Phát tín hiệu để cập nhật form quản lý
         self.data_saved.emit()
         try:
-            app_signals.data_changed.emit()
+            app_signals.post('chi_dinh', [chi_id] if chi_id else ())
         except Exception:
             pass
 
@@ -939,6 +941,7 @@ class ChiDinhDichVu(QWidget):
             cur.execute("DELETE FROM chi_dinh WHERE phieu_kham_id = ?", (self.current_phieu_kham_id,))
 
             # Thêm lại tất cả chỉ định từ bảng
+            chi_ids, payment_ids = [], []
             for row in range(self.table.rowCount()):
                 ten = self.table.item(row, 1).text()
                 so_luong = int(self.table.item(row, 2).text())
@@ -962,18 +965,16 @@ class ChiDinhDichVu(QWidget):
                     (self.current_phieu_kham_id, ten, so_luong, don_gia, thanh_tien, kham_lam_sang, chan_doan_ban_dau)
                 ).lastrowid
 
-                so_chi_dinh = f"CD{chi_id:04d}"
+                so_chi_dinh = next_code('so_chi_dinh')
                 cur.execute("UPDATE chi_dinh SET so_chi_dinh = ? WHERE id = ?", 
                           (so_chi_dinh, chi_id))
 
                 # Lưu chi_id vào item trong bảng để tiện cập nhật sau này
                 self.table.item(row, 1).setData(Qt.UserRole + 1, chi_id)
+                chi_ids.append(chi_id)
                 
-                # Cũng insert vào bảng thanh_toan để doanh thu được cập nhật
-                cur.execute("""
-                    INSERT OR REPLACE INTO thanh_toan (ngay, loai, mo_ta, so_tien)
-                    VALUES (?, 'Dịch vụ', ?, ?)
-                """, (self.ngaylap.text(), ten, thanh_tien))
+                # Cũng ghi vào bảng thanh_toan (và bảng tổng hợp doanh thu) trong cùng transaction
+                payment_ids.append(add_payment('Dịch vụ', ten, thanh_tien, ngay=self.ngaylap.text()))
 
             conn.commit()
             try:
@@ -985,10 +986,10 @@ class ChiDinhDichVu(QWidget):
             # Phát tín hiệu để cập nhật form quản lý
             self.data_saved.emit()
             try:
-                # Phát signal múlần để chắc chắn QuanLyThuoc nhận được
-                app_signals.data_changed.emit()
-                # Cũng phát medicine_exported để chắc chắn
-                app_signals.medicine_exported.emit()
+                # Gộp thành một lần phát (kèm id chỉ định / thanh toán vừa ghi)
+                app_signals.post('phieu_kham', [self.current_phieu_kham_id], signals=())
+                app_signals.post('chi_dinh', chi_ids, signals=('data_changed', 'medicine_exported'))
+                app_signals.post('thanh_toan', payment_ids)
             except Exception as e:
                 print(f"Lỗi khi phát signal: {e}")
 
@@ -999,25 +1000,18 @@ class ChiDinhDichVu(QWidget):
             conn.close()
 
     def on_select_benh_nhan(self):
-        """Khi chọn bệnh nhân -> hiển thị đầy đủ thông tin"""
+        """Khi chọn bệnh nhân -> hiển thị đầy đủ thông tin (truy vấn chạy nền)"""
         benh_nhan_id = self.hoten.currentData()
         if not benh_nhan_id:
             return
+        executor.submit(_fetch_chi_dinh_benh_nhan, benh_nhan_id, key='chi_dinh_dich_vu.benh_nhan', owner=self,
+                        on_result=self._fill_benh_nhan_info,
+                        on_error=lambda e: logger.error("on_select_benh_nhan error: %s", e))
 
-        conn = get_connection()
-        cur = conn.cursor()
-
-        # 🧍 Thông tin bệnh nhân
-        cur.execute("""
-            SELECT ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai,
-                so_cccd, doi_tuong, nghe_nghiep
-            FROM benh_nhan WHERE id = ?
-        """, (benh_nhan_id,))
-        bn = cur.fetchone()
-
-        if not bn:
-            conn.close()
+    def _fill_benh_nhan_info(self, data):
+        if not data:
             return
+        bn, pk, chan_doan, td, dich_vu_list = data
 
         # Gán dữ liệu lên form
         self.gioitinh.setText(bn[1] or "")
@@ -1029,15 +1023,7 @@ class ChiDinhDichVu(QWidget):
         self.doituong.setText(bn[7] or "")
         self.nghenghiep.setText(bn[8] or "")
 
-        # 🧾 Lấy phiếu khám mới nhất của bệnh nhân (không giới hạn ngày)
-        cur.execute("""
-            SELECT id, so_phieu, ngay_lap, bac_si, phong_kham, tong_tien
-            FROM phieu_kham
-            WHERE benh_nhan_id = ?
-            ORDER BY ngay_lap DESC, id DESC LIMIT 1
-        """, (benh_nhan_id,))
-        pk = cur.fetchone()
-
+        # 🧾 Phiếu khám mới nhất của bệnh nhân (không giới hạn ngày)
         if pk:
             # Nếu đã có phiếu khám trong ngày, sử dụng lại phiếu khám đó
             self.current_phieu_kham_id = pk[0]
@@ -1047,12 +1033,10 @@ class ChiDinhDichVu(QWidget):
             self.phongkham.setText(pk[4] or "")
             # Load chẩn đoán từ chi_dinh (we do not store diagnosis in phieu_kham)
             try:
-                cur.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (pk[0],))
-                cd_row = cur.fetchone()
-                if cd_row and cd_row[0]:
-                    self.chandoanbandau.setText(cd_row[0])
+                if chan_doan:
+                    self.chandoanbandau.setText(chan_doan)
                     # Update preview label as well
-                    preview = cd_row[0][:50] + "..." if len(cd_row[0]) > 50 else cd_row[0]
+                    preview = chan_doan[:50] + "..." if len(chan_doan) > 50 else chan_doan
                     try:
                         self.lbl_chandoanbandau.setText(preview)
                     except Exception:
@@ -1073,14 +1057,8 @@ class ChiDinhDichVu(QWidget):
             self.sophieukham.clear()
             self.ngaylap.setText(QDate.currentDate().toString("dd/MM/yyyy")) 
             self.chandoanbandau.clear()
-            self.tongtien.setText(self.format_currency(0))        # 🏥 Lấy thông tin tiếp đón (phòng khám & tình trạng)
-        cur.execute("""
-            SELECT phong_kham, bac_si_kham, tinh_trang
-            FROM tiep_don
-            WHERE benh_nhan_id = ?
-            ORDER BY id DESC LIMIT 1
-        """, (benh_nhan_id,))
-        td = cur.fetchone()
+            self.tongtien.setText(self.format_currency(0))
+        # 🏥 Thông tin tiếp đón (phòng khám & tình trạng)
         if td:
             self.phongkham.setText(td[0] or "")
             self.nguoilap.setCurrentText(td[1] or "")
@@ -1088,15 +1066,6 @@ class ChiDinhDichVu(QWidget):
         else:
             self.tinhtrang.clear()
 
-        # 🧪 Lấy danh sách dịch vụ đã chỉ định
-        cur.execute("""
-            SELECT cd.id, cd.ten_dich_vu, cd.so_luong, cd.don_gia, cd.thanh_tien
-            FROM chi_dinh cd
-            JOIN phieu_kham pk ON cd.phieu_kham_id = pk.id
-            WHERE pk.benh_nhan_id = ?
-        """, (benh_nhan_id,))
-        dich_vu_list = cur.fetchall()
-
         # Đổ dữ liệu vào bảng dịch vụ
         self.table.setRowCount(0)
         for idx, row_data in enumerate(dich_vu_list, start=1):
@@ -1132,8 +1101,6 @@ class ChiDinhDichVu(QWidget):
             tt_item.setData(Qt.UserRole, float(thanh_tien))
             self.table.setItem(row, 4, tt_item)
 
-        conn.close()
-
     def _on_completer_activated(self, text):
         try:
             if not text or not text.strip():
@@ -1142,19 +1109,8 @@ class ChiDinhDichVu(QWidget):
             if "Mã:" in text:
                 try:
                     ma = text.split("Mã:")[1].split()[0].strip()
-                    conn = get_connection()
-                    cur = conn.cursor()
-                    cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                    r = cur.fetchone()
-                    conn.close()
-                    if r and r[0]:
-                        # tìm chỉ mục có itemData bằng id này
-                        target_id = r[0]
-                        for i in range(self.hoten.count()):
-                            if self.hoten.itemData(i) == target_id:
-                                self.hoten.setCurrentIndex(i)
-                                self.on_select_benh_nhan()
-                                return
+                    if ma:
+                        return self._select_by_ma_hoso(ma, text.strip())
                 except Exception:
                     pass
 
@@ -1175,18 +1131,8 @@ class ChiDinhDichVu(QWidget):
             if "Mã:" in text:
                 try:
                     ma = text.split("Mã:")[1].split()[0].strip()
-                    conn = get_connection()
-                    cur = conn.cursor()
-                    cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                    r = cur.fetchone()
-                    conn.close()
-                    if r and r[0]:
-                        target_id = r[0]
-                        for i in range(self.hoten.count()):
-                            if self.hoten.itemData(i) == target_id:
-                                self.hoten.setCurrentIndex(i)
-                                self.on_select_benh_nhan()
-                                return
+                    if ma:
+                        return self._select_by_ma_hoso(ma, text)
                 except Exception:
                     pass
 
@@ -1200,60 +1146,31 @@ class ChiDinhDichVu(QWidget):
 
         # (moved) --- the code to load related chi_dinh entries is executed below inside this function
 
+    def _select_by_ma_hoso(self, ma, text):
+        """Chọn bệnh nhân theo mã hồ sơ (tra tiep_don chạy nền); không thấy thì chọn theo chuỗi hiển thị."""
+        def _select(benh_nhan_id):
+            # chỉ mục của bệnh nhân này trong combobox (thêm vào nếu chưa có)
+            i = patient_item_index(self.hoten, benh_nhan_id) if benh_nhan_id else -1
+            if i < 0:
+                i = self.hoten.findText(text, Qt.MatchExactly)
+            if i >= 0:
+                self.hoten.setCurrentIndex(i)
+                self.on_select_benh_nhan()
+
+        executor.submit(_fetch_benh_nhan_id_by_ma_hoso, ma, key='chi_dinh_dich_vu.ma_hoso', owner=self,
+                        on_result=_select)
+
     def tao_so_chi_dinh_moi(self):
-        """Tạo số chỉ định mới dựa trên mã bệnh nhân và số thứ tự chỉ định"""
-        benh_nhan_id = self.hoten.currentData()
-        if not benh_nhan_id:
+        """Số chỉ định dự kiến cho lần lưu tới (chỉ hiển thị; số thật cấp khi insert)."""
+        if not self.hoten.currentData():
             raise Exception("Chưa chọn bệnh nhân")
+        return peek_code('so_chi_dinh')
 
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Lấy số chỉ định lớn nhất của bệnh nhân này
-            cur.execute("""
-                SELECT MAX(CAST(SUBSTR(so_chi_dinh, -4) AS INTEGER))
-                FROM chi_dinh cd
-                JOIN phieu_kham pk ON cd.phieu_kham_id = pk.id
-                WHERE pk.benh_nhan_id = ? AND so_chi_dinh LIKE ?
-            """, (benh_nhan_id, f'CD{benh_nhan_id}%'))
-            max_num = cur.fetchone()[0]
-            
-            if max_num is None:
-                next_num = 1
-            else:
-                next_num = int(max_num) + 1
-                
-            # Format: CD[mã BN][số thứ tự 4 chữ số]
-            return f"CD{benh_nhan_id:03d}{next_num:04d}"
-        finally:
-            conn.close()
-    
     def tao_so_phieu_kham_moi(self):
-        """Tạo số phiếu khám mới dựa trên mã bệnh nhân và số thứ tự khám"""
-        benh_nhan_id = self.hoten.currentData()
-        if not benh_nhan_id:
+        """Số phiếu khám dự kiến cho lần lưu tới (chỉ hiển thị; số thật cấp khi insert)."""
+        if not self.hoten.currentData():
             raise Exception("Chưa chọn bệnh nhân")
-
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Lấy số phiếu khám lớn nhất của bệnh nhân này
-            cur.execute("""
-                SELECT MAX(CAST(SUBSTR(so_phieu, -4) AS INTEGER))
-                FROM phieu_kham 
-                WHERE benh_nhan_id = ? AND so_phieu LIKE ?
-            """, (benh_nhan_id, f'PK{benh_nhan_id}%'))
-            max_num = cur.fetchone()[0]
-            
-            if max_num is None:
-                next_num = 1
-            else:
-                next_num = int(max_num) + 1
-
-            # Format: PK[mã BN][số thứ tự 4 chữ số] 
-            return f"PK{benh_nhan_id:03d}{next_num:04d}"
-        finally:
-            conn.close()
+        return peek_code('so_phieu')
 
     # ======= DB helper methods (tách riêng để dễ bảo trì) =======
     def create_phieu_kham_in_db(self, benh_nhan_id, ngay_lap, bac_si, phong_kham):
@@ -1263,13 +1180,12 @@ class ChiDinhDichVu(QWidget):
         cur = conn.cursor()
         try:
             conn.execute("BEGIN")
+            so_phieu = next_code('so_phieu')
             cur.execute(
-                "INSERT INTO phieu_kham(benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien) VALUES(?,?,?,?,?)",
-                (benh_nhan_id, ngay_lap, bac_si, phong_kham, 0)
+                "INSERT INTO phieu_kham(so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien) VALUES(?,?,?,?,?,?)",
+                (so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, 0)
             )
             phieu_id = cur.lastrowid
-            so_phieu = f"PK{phieu_id:04d}"
-            cur.execute("UPDATE phieu_kham SET so_phieu = ? WHERE id = ?", (so_phieu, phieu_id))
             conn.commit()
             return phieu_id, so_phieu
         except Exception:
@@ -1306,7 +1222,7 @@ class ChiDinhDichVu(QWidget):
                     (phieu_kham_id, ten, so_luong, don_gia, thanh_tien)
                 )
             chi_id = cur.lastrowid
-            so_chi_dinh = f"CD{chi_id:04d}"
+            so_chi_dinh = next_code('so_chi_dinh')
             cur.execute("UPDATE chi_dinh SET so_chi_dinh = ? WHERE id = ?", (so_chi_dinh, chi_id))
             conn.commit()
             return chi_id, so_chi_dinh
@@ -3,7 +3,7 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt, QDateTime
 from PyQt5.QtCore import Qt
-from database import get_connection
+from database import get_connection, get_doctor_names, book_appointment, SlotFullError
 
 class DatLichKhamForm(QWidget):
     def __init__(self, parent=None, role=None):
@@ -158,22 +158,16 @@ class DatLichKhamForm(QWidget):
             self.table_history.setCellWidget(row, 8, btn)
 
     def load_doctors_and_rooms(self):
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT ten FROM nhan_su WHERE chuc_vu = 'Bác sĩ' ORDER BY ten ASC")
-            doctors = [r[0] for r in cur.fetchall()]
-            self.combo_bac_si.clear()
-            self.combo_bac_si.addItem("Nhấn để chọn bác sĩ")
-            self.combo_bac_si.addItems(doctors)
+        doctors = get_doctor_names()
+        self.combo_bac_si.clear()
+        self.combo_bac_si.addItem("Nhấn để chọn bác sĩ")
+        self.combo_bac_si.addItems(doctors)
 
-            # Các loại khám định sẵn
-            loai_kham_list = ["Khám tư vấn", "Tái khám", "Khám theo yêu cầu"]
-            self.combo_loai_kham.clear()
-            self.combo_loai_kham.addItem("Nhấn để chọn loại khám")
-            self.combo_loai_kham.addItems(loai_kham_list)
-        finally:
-            conn.close()
+        # Các loại khám định sẵn
+        loai_kham_list = ["Khám tư vấn", "Tái khám", "Khám theo yêu cầu"]
+        self.combo_loai_kham.clear()
+        self.combo_loai_kham.addItem("Nhấn để chọn loại khám")
+        self.combo_loai_kham.addItems(loai_kham_list)
 
     def load_history_data(self):
         conn = get_connection()
@@ -213,9 +207,6 @@ class DatLichKhamForm(QWidget):
             QMessageBox.warning(self, "Thiếu thông tin", "Vui lòng nhập đầy đủ thông tin và chọn bác sĩ, loại khám!")
             return
         try:
-            conn = get_connection()
-            cur = conn.cursor()
-            
             # Xác định người đặt dựa trên role
             nguoi_dat = "Bệnh nhân"  # Mặc định là bệnh nhân
             if self.role == 'tiep_tan':
@@ -224,11 +215,10 @@ class DatLichKhamForm(QWidget):
                 nguoi_dat = "Bác sĩ"
             elif self.role == 'admin':
                 nguoi_dat = "Admin"
-            
-            cur.execute("INSERT INTO lich_hen (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, trang_thai, nguoi_dat, dien_thoai, dia_chi) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, "Chưa duyệt", nguoi_dat, self.input_dien_thoai.text().strip(), self.input_dia_chi.text().strip()))
-            conn.commit()
-            conn.close()
+
+            # Giữ chỗ trong khung giờ của bác sĩ (báo lỗi nếu khung đã đủ, kể cả do web đặt cùng lúc)
+            book_appointment(ho_ten, ngay_gio, bac_si, loai_kham, ghi_chu, "Chưa duyệt", nguoi_dat,
+                             self.input_dien_thoai.text().strip(), self.input_dia_chi.text().strip())
             QMessageBox.information(self, "Thành công", "Đã lưu lịch hẹn!")
             self.input_ho_ten.clear()
             self.input_ngay_gio.setDateTime(QDateTime.currentDateTime())
@@ -238,6 +228,14 @@ class DatLichKhamForm(QWidget):
             self.input_dien_thoai.clear()
             self.input_dia_chi.clear()
             self.load_history_data()  # Tải lại dữ liệu lịch sử
+        except SlotFullError as e:
+            goi_y = "\n".join(f"  • {b} (còn {n} chỗ)" for b, n in e.goi_y)
+            QMessageBox.warning(self, "Hết chỗ",
+                                f"Bác sĩ {e.bac_si} đã kín lịch khung {e.bat_dau}."
+                                + (f"\n\nKhung còn trống gần nhất:\n{goi_y}" if goi_y else ""))
+        except ValueError as e:
+            # Ngoài giờ làm việc / ngày nghỉ (database.book_appointment)
+            QMessageBox.warning(self, "Giờ hẹn không hợp lệ", str(e))
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể lưu lịch hẹn:\n{e}")
 
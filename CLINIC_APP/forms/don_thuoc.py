@@ -9,7 +9,123 @@ from PyQt5.QtPrintSupport import QPrinter, QPrintDialog, QPrintPreviewDialog
 from PyQt5.QtCore import Qt, QDate, QSortFilterProxyModel, pyqtSignal
 from app_signals import app_signals
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from database import get_connection
+from database import get_connection, save_prescription_with_items, pool
+from db_executor import executor
+from patient_index import patient_index
+from forms.patient_search import MAX_COMBO_PATIENTS
+from forms.drug_catalog_model import shared_drug_model, sync_drug_catalog, COL_GIA, COL_MA, COL_TEN, COL_DON_VI
+
+
+def _patient_display_name(p):
+    # Bệnh nhân kèm mã hồ sơ mới nhất; các mã hồ sơ khác được nạp vào combobox số hồ sơ khi chọn
+    return f"{p.ho_ten} - {p.ma_hoso}" if p.ma_hoso else p.ho_ten
+
+
+def _patient_item_data(p):
+    return {
+        'id': p.id,
+        'ngaysinh': p.ngay_sinh,
+        'gioitinh': p.gioi_tinh,
+        'tuoi': p.tuoi,
+        'dienthoai': p.dien_thoai,
+        'diachi': p.dia_chi,
+        'doituong': p.doi_tuong,
+        'record': p.ma_hoso
+    }
+
+
+# --- Các hàm đọc dữ liệu chạy trên worker thread (qua db_executor), không đụng tới widget ---
+def _fetch_prescription(don_thuoc_id):
+    """(don_thuoc, benh_nhan_id, chẩn đoán chi tiết khám, chi_tiet_don_thuoc) của một đơn thuốc."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT phieu_kham_id, ngay_ke, so_ngay, ngay_tai_kham, tong_tien,
+                   loai_don, chan_doan, di_ung_thuoc, loi_dan, bac_si, quay_thuoc, nguoi_lap_phieu
+            FROM don_thuoc
+            WHERE id = ?
+        """, (don_thuoc_id,))
+        row = cur.fetchone()
+        if not row:
+            raise Exception(f"Không tìm thấy đơn thuốc id={don_thuoc_id}")
+
+        phieu_kham_id = row[0]
+        patient_id = None
+        diag = None
+        if phieu_kham_id:
+            cur.execute("SELECT benh_nhan_id FROM phieu_kham WHERE id = ?", (phieu_kham_id,))
+            t = cur.fetchone()
+            if t:
+                patient_id = t[0]
+            cur.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_kham_id,))
+            t = cur.fetchone()
+            diag = t[0] if t else None
+
+        # include the detail id so we can identify rows for deletion later
+        cur.execute("SELECT id, ma_thuoc, ten_thuoc, so_luong, don_vi, sang, trua, chieu, toi, lieu_dung, ghi_chu FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_thuoc_id,))
+        return row, patient_id, diag, cur.fetchall()
+
+
+def _fetch_patient_prescriptions(patient_id):
+    """(bệnh nhân, các hồ sơ, chẩn đoán chi tiết khám, các đơn thuốc, đơn gần nhất đọc bởi _fetch_prescription)."""
+    with pool.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT b.gioi_tinh, b.ngay_sinh, b.tuoi, b.dia_chi, b.dien_thoai
+            FROM benh_nhan b
+            WHERE b.id = ?
+        """, (patient_id,))
+        patient = cursor.fetchone()
+        if not patient:
+            return None, [], None, [], None
+
+        # Số hồ sơ and other info for this patient
+        cursor.execute("""
+            SELECT DISTINCT 
+                td.ma_hoso,
+                b.doi_tuong,
+                pk.so_phieu,
+                COALESCE(ct.chan_doan, '') AS chan_doan,
+                ct.di_ung_thuoc,
+                pk.id as phieu_kham_id
+            FROM tiep_don td
+            LEFT JOIN benh_nhan b ON td.benh_nhan_id = b.id
+            LEFT JOIN phieu_kham pk ON pk.benh_nhan_id = td.benh_nhan_id
+            LEFT JOIN chi_tiet_phieu_kham ct ON pk.id = ct.phieu_kham_id
+            WHERE td.benh_nhan_id = ? 
+            AND td.ma_hoso IS NOT NULL
+            ORDER BY pk.id DESC
+        """, (patient_id,))
+        records = cursor.fetchall()
+        diag = None
+        if records and records[0][5]:
+            cursor.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (records[0][5],))
+            drow = cursor.fetchone()
+            diag = drow[0] if drow else None
+
+        # Tất cả đơn thuốc của bệnh nhân
+        cursor.execute("""
+            SELECT dt.id, dt.ngay_ke, dt.chan_doan 
+            FROM don_thuoc dt
+            JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
+            WHERE pk.benh_nhan_id = ?
+            ORDER BY dt.ngay_ke DESC, dt.id DESC
+        """, (patient_id,))
+        prescriptions = cursor.fetchall()
+    latest = _fetch_prescription(prescriptions[0][0]) if prescriptions else None
+    return patient, records, diag, prescriptions, latest
+
+
+def _fetch_record(patient_id, record_no):
+    with pool.read() as conn:
+        return conn.execute("""
+            SELECT pk.so_phieu, COALESCE(ct.chan_doan, '') AS chan_doan, ct.di_ung_thuoc
+            FROM tiep_don td
+            LEFT JOIN phieu_kham pk ON pk.benh_nhan_id = td.benh_nhan_id
+            LEFT JOIN chi_tiet_phieu_kham ct ON pk.id = ct.phieu_kham_id
+            WHERE td.benh_nhan_id = ? AND td.ma_hoso = ?
+            ORDER BY pk.id DESC LIMIT 1
+        """, (patient_id, record_no)).fetchone()
 
 
 class NoPopupComboBox(QComboBox):
@@ -154,12 +270,11 @@ class ChonThuocDialog(QDialog):
     def initUI(self):
         layout = QVBoxLayout()
 
-        # Tạo model cho table view
-        self.model = QStandardItemModel()
-        self.model.setHorizontalHeaderLabels(["Mã thuốc", "Tên sản phẩm", "Đơn vị", "Tồn kho"])
+        # Model danh mục thuốc dùng chung (forms/drug_catalog_model.py): mở hộp thoại không phải đọc lại DB
+        self.model = shared_drug_model()
 
         # Tạo proxy model để filter
-        self.proxy_model = QSortFilterProxyModel()
+        self.proxy_model = QSortFilterProxyModel(self)
         self.proxy_model.setSourceModel(self.model)
         self.proxy_model.setFilterKeyColumn(-1)  # Search all columns
         self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
@@ -193,19 +308,9 @@ class ChonThuocDialog(QDialog):
         self.setLayout(layout)
 
     def load_drugs(self):
-        conn = get_connection()
-        cursor = conn.cursor()
-        # Bao gồm cột don_vi để có thể tự động điền đơn vị khi chọn thuốc
-        cursor.execute("SELECT ma_thuoc, ten_thuoc, don_vi, ton_kho FROM danh_muc_thuoc")
-        drugs = cursor.fetchall()
-        conn.close()
-
-        for drug in drugs:
-            ma_thuoc = QStandardItem(str(drug[0]))
-            ten_thuoc = QStandardItem(str(drug[1]))
-            don_vi = QStandardItem(str(drug[2] or ""))
-            ton_kho = QStandardItem(str(drug[3]))
-            self.model.appendRow([ma_thuoc, ten_thuoc, don_vi, ton_kho])
+        # Model dùng chung chỉ được đọc lại khi danh mục thuốc đổi phiên bản
+        sync_drug_catalog()
+        self.table_view.setColumnHidden(COL_GIA, True)
 
     def filter_drugs(self, text):
         self.proxy_model.setFilterFixedString(text)
@@ -215,9 +320,9 @@ class ChonThuocDialog(QDialog):
         if indexes:
             row = indexes[0].row()
             # Đọc ma, ten, don_vi từ proxy model
-            ma = self.proxy_model.data(self.proxy_model.index(row, 0))
-            ten = self.proxy_model.data(self.proxy_model.index(row, 1))
-            don_vi = self.proxy_model.data(self.proxy_model.index(row, 2))
+            ma = self.proxy_model.data(self.proxy_model.index(row, COL_MA))
+            ten = self.proxy_model.data(self.proxy_model.index(row, COL_TEN))
+            don_vi = self.proxy_model.data(self.proxy_model.index(row, COL_DON_VI))
             self.selected_drug = {
                 'ma_thuoc': ma,
                 'ten_thuoc': ten,
@@ -366,11 +471,6 @@ class KeDonThuoc(QWidget):
             self.load_templates()
         except Exception:
             pass
-        # Đảm bảo bảng tùy chỉnh 'thuốc khác' tồn tại để lưu các mục do người dùng nhập
-        try:
-            self.ensure_thuoc_khac_table()
-        except Exception:
-            pass
         self.doncu = QComboBox()
         self.doncu.currentIndexChanged.connect(self.on_doncu_changed)
         
@@ -901,71 +1001,6 @@ class KeDonThuoc(QWidget):
         except Exception:
             pass
 
-    def ensure_thuoc_khac_table(self):
-        """Create `thuoc_khac` table if it does not exist. Used to persist custom 'thuốc khác' entries."""
-        conn = None
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            # Desired schema: id, ten_thuoc, don_vi, ghi_chu, don_thuoc_id
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='thuoc_khac'")
-            exists = cur.fetchone()
-            if not exists:
-                cur.execute(
-                    """
-                    CREATE TABLE thuoc_khac (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        ten_thuoc TEXT NOT NULL,
-                        don_vi TEXT,
-                        ghi_chu TEXT,
-                        don_thuoc_id INTEGER
-                    )
-                    """
-                )
-            else:
-                # Table exists; verify columns and migrate if necessary
-                cur.execute("PRAGMA table_info('thuoc_khac')")
-                cols = [r[1] for r in cur.fetchall()]
-                # If created_by/created_at exist or don_thuoc_id missing, migrate to new schema
-                if ('created_by' in cols) or ('created_at' in cols) or ('don_thuoc_id' not in cols):
-                    # Tạo bảng mới
-                    cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS thuoc_khac_new (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            ten_thuoc TEXT NOT NULL,
-                            don_vi TEXT,
-                            ghi_chu TEXT,
-                            don_thuoc_id INTEGER
-                        )
-                        """
-                    )
-                    # Sao chép dữ liệu: ánh xạ ten_thuoc, don_vi, ghi_chu nếu có thể
-                    copy_cols = []
-                    if 'ten_thuoc' in cols:
-                        copy_cols.append('ten_thuoc')
-                    if 'don_vi' in cols:
-                        copy_cols.append('don_vi')
-                    if 'ghi_chu' in cols:
-                        copy_cols.append('ghi_chu')
-                    if copy_cols:
-                        src_cols = ', '.join(copy_cols)
-                        dst_cols = src_cols
-                        cur.execute(f"INSERT INTO thuoc_khac_new ({dst_cols}) SELECT {src_cols} FROM thuoc_khac")
-                    # Xóa bảng cũ và đổi tên
-                    cur.execute("DROP TABLE thuoc_khac")
-                    cur.execute("ALTER TABLE thuoc_khac_new RENAME TO thuoc_khac")
-            conn.commit()
-        except Exception:
-            try:
-                if conn:
-                    conn.rollback()
-            except Exception:
-                pass
-        finally:
-            if conn:
-                conn.close()
-
     def on_save_template(self):
         """Save current prescription content as a template into don_mau and chi_tiet_don_mau."""
         # Hỏi tên mẫu
@@ -1886,14 +1921,8 @@ class KeDonThuoc(QWidget):
                 conn.close()
                 return
             
-            # Mark the don_thuoc as sent to pharmacy (add column if needed)
+            # Mark the don_thuoc as sent to pharmacy (cột da_gui_cong_duoc có sẵn từ migration)
             try:
-                cur.execute("PRAGMA table_info(don_thuoc)")
-                cols = [c[1] for c in cur.fetchall()]
-                if 'da_gui_cong_duoc' not in cols:
-                    cur.execute("ALTER TABLE don_thuoc ADD COLUMN da_gui_cong_duoc INTEGER DEFAULT 0")
-                    conn.commit()
-                
                 cur.execute("UPDATE don_thuoc SET da_gui_cong_duoc = 1 WHERE id = ?", (self.last_don_thuoc_id,))
                 conn.commit()
                 
@@ -1902,7 +1931,7 @@ class KeDonThuoc(QWidget):
                 # Phát tín hiệu để cập nhật form quản lý
                 self.medicine_exported.emit()
                 try:
-                    app_signals.medicine_exported.emit()
+                    app_signals.post('don_thuoc', [self.last_don_thuoc_id], signals=('medicine_exported',))
                 except Exception:
                     pass
             except Exception as e:
@@ -1945,12 +1974,26 @@ class KeDonThuoc(QWidget):
             pass
 
     def _find_patient_index_by_id(self, patient_id):
-        """Return combobox index for a given patient id, or -1 if not found."""
+        """Return combobox index for a given patient id, or -1 if not found.
+
+        Combobox chỉ chứa các bệnh nhân đã được chọn: bệnh nhân chưa có được lấy từ chỉ mục
+        bệnh nhân dùng chung và thêm vào (tối đa MAX_COMBO_PATIENTS mục).
+        """
         try:
             for i in range(self.hoten.count()):
                 data = self.hoten.itemData(i)
                 if isinstance(data, dict) and data.get('id') == patient_id:
                     return i
+            rec = patient_index.get(patient_id)
+            if rec is None:
+                patient_index.refresh()
+                rec = patient_index.get(patient_id)
+            if rec is None:
+                return -1
+            if self.hoten.count() > MAX_COMBO_PATIENTS and self.hoten.currentIndex() != 1:
+                self.hoten.removeItem(1)
+            self.hoten.addItem(_patient_display_name(rec), userData=_patient_item_data(rec))
+            return self.hoten.count() - 1
         except Exception:
             pass
         return -1
@@ -1975,21 +2018,13 @@ class KeDonThuoc(QWidget):
         - set self.last_don_thuoc_id
         - disable form editing
         """
-        conn = None
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT phieu_kham_id, ngay_ke, so_ngay, ngay_tai_kham, tong_tien,
-                       loai_don, chan_doan, di_ung_thuoc, loi_dan, bac_si, quay_thuoc, nguoi_lap_phieu
-                FROM don_thuoc
-                WHERE id = ?
-            """, (don_thuoc_id,))
-            row = cur.fetchone()
-            if not row:
-                raise Exception(f"Không tìm thấy đơn thuốc id={don_thuoc_id}")
+        executor.submit(_fetch_prescription, don_thuoc_id, key='don_thuoc.prescription', owner=self,
+                        on_result=lambda res: self._fill_prescription(don_thuoc_id, disable_after_load, *res),
+                        on_error=lambda e: QMessageBox.warning(self, "Lỗi tải đơn", f"Không thể tải đơn thuốc: {e}"))
 
-            phieu_kham_id = row[0]
+    def _fill_prescription(self, don_thuoc_id, disable_after_load, row, patient_id, diag, details):
+        """Đổ đơn thuốc đọc bởi _fetch_prescription lên form (GUI thread)."""
+        try:
             # populate top-level fields
             try:
                 if row[1]:
@@ -2023,25 +2058,12 @@ class KeDonThuoc(QWidget):
             except Exception:
                 pass
 
-            patient_id = None
-            if phieu_kham_id:
-                cur.execute("SELECT benh_nhan_id FROM phieu_kham WHERE id = ?", (phieu_kham_id,))
-                t = cur.fetchone()
-                if t:
-                    patient_id = t[0]
-
-            # Ưu tiên lấy chẩn đoán từ thông tin chi tiết khám nếu có
-            try:
-                if phieu_kham_id:
-                    cur.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_kham_id,))
-                    _diag = cur.fetchone()
-                    if _diag and _diag[0]:
-                        try:
-                            self.chandoan.setText(_diag[0])
-                        except Exception:
-                            pass
-            except Exception:
-                pass
+            # Ưu tiên chẩn đoán từ thông tin chi tiết khám nếu có
+            if diag:
+                try:
+                    self.chandoan.setText(diag)
+                except Exception:
+                    pass
 
             # If we have patient_id, select in combobox and populate patient fields
             if patient_id:
@@ -2054,11 +2076,6 @@ class KeDonThuoc(QWidget):
                     finally:
                         self.hoten.blockSignals(False)
 
-            # Load detail rows
-            # include the detail id so we can identify rows for deletion later
-            cur.execute("SELECT id, ma_thuoc, ten_thuoc, so_luong, don_vi, sang, trua, chieu, toi, lieu_dung, ghi_chu FROM chi_tiet_don_thuoc WHERE don_thuoc_id = ?", (don_thuoc_id,))
-            details = cur.fetchall()
-
             # populate main table and 'thuốc khác' table separately
             self._suppress_item_changed = True
             try:
@@ -2188,9 +2205,6 @@ class KeDonThuoc(QWidget):
 
         except Exception as e:
             QMessageBox.warning(self, "Lỗi tải đơn", f"Không thể tải đơn thuốc: {e}")
-        finally:
-            if conn:
-                conn.close()
         
     def on_record_selected(self, index):
         """Handle when user selects a different medical record number"""
@@ -2210,20 +2224,11 @@ class KeDonThuoc(QWidget):
         if not patient_id:
             return
             
-        # Load the specific medical record data
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT pk.so_phieu, COALESCE(ct.chan_doan, '') AS chan_doan, ct.di_ung_thuoc
-            FROM tiep_don td
-            LEFT JOIN phieu_kham pk ON pk.benh_nhan_id = td.benh_nhan_id
-            LEFT JOIN chi_tiet_phieu_kham ct ON pk.id = ct.phieu_kham_id
-            WHERE td.benh_nhan_id = ? AND td.ma_hoso = ?
-            ORDER BY pk.id DESC LIMIT 1
-        """, (patient_id, record_no))
-        
-        record = cursor.fetchone()
+        # Load the specific medical record data (chạy nền)
+        executor.submit(_fetch_record, patient_id, record_no, key='don_thuoc.record', owner=self,
+                        on_result=self._fill_record)
+
+    def _fill_record(self, record):
         if record:
             so_phieu, chan_doan, di_ung = record
             self.sophieukham.setText(so_phieu or "")
@@ -2231,70 +2236,13 @@ class KeDonThuoc(QWidget):
             self.diungthuoc.setText(di_ung or "")
 
     def load_patients(self):
-        """Load all patients into the comboboxes"""
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Get patients with their record numbers and additional info
-        cursor.execute("""
-            SELECT DISTINCT 
-                b.id,
-                b.ho_ten,
-                b.ngay_sinh,
-                b.gioi_tinh,
-                b.tuoi,
-                b.dien_thoai,
-                b.dia_chi,
-                b.doi_tuong,
-                t.ma_hoso
-            FROM benh_nhan b 
-            LEFT JOIN tiep_don t ON b.id = t.benh_nhan_id 
-            ORDER BY b.ho_ten
-        """)
-        patients = cursor.fetchall()
-        conn.close()
+        """Đặt lại combobox bệnh nhân (chỉ mục trống).
 
+        Không nạp cả danh sách bệnh nhân: bệnh nhân được chọn theo id (auto_select_patient,
+        mở từ phiếu khám) được lấy từ chỉ mục bệnh nhân dùng chung khi cần.
+        """
         self.hoten.clear()
         self.hoten.addItem("--- Chọn bệnh nhân ---")  # Empty option
-        
-        # Group patients by name for cases with duplicate names
-        patient_dict = {}
-        for id, name, ngaysinh, gioitinh, tuoi, dienthoai, diachi, doituong, record in patients:
-            if name in patient_dict:
-                patient_dict[name].append((id, ngaysinh, gioitinh, tuoi, dienthoai, diachi, doituong, record))
-            else:
-                patient_dict[name] = [(id, ngaysinh, gioitinh, tuoi, dienthoai, diachi, doituong, record)]
-
-        # Add patients to combobox, marking duplicates with record number
-        for name, patient_records in patient_dict.items():
-            if len(patient_records) == 1:
-                # Single patient with this name
-                patient_data = patient_records[0]
-                display_name = f"{name} - {patient_data[7]}" if patient_data[7] else name
-                self.hoten.addItem(display_name, userData={
-                    'id': patient_data[0],
-                    'ngaysinh': patient_data[1],
-                    'gioitinh': patient_data[2],
-                    'tuoi': patient_data[3],
-                    'dienthoai': patient_data[4],
-                    'diachi': patient_data[5],
-                    'doituong': patient_data[6],
-                    'record': patient_data[7]
-                })
-            else:
-                # Multiple patients with same name
-                for patient_data in patient_records:
-                    display_name = f"{name} - {patient_data[7]}" if patient_data[7] else f"{name} (Chưa có số hồ sơ)"
-                    self.hoten.addItem(display_name, userData={
-                        'id': patient_data[0],
-                        'ngaysinh': patient_data[1],
-                        'gioitinh': patient_data[2],
-                        'tuoi': patient_data[3],
-                        'dienthoai': patient_data[4],
-                        'diachi': patient_data[5],
-                        'doituong': patient_data[6],
-                        'record': patient_data[7]
-                    })
 
     def on_patient_selected(self, index):
         """Handle patient selection"""
@@ -2313,107 +2261,65 @@ class KeDonThuoc(QWidget):
         if not patient_id:
             return
             
-        # Load patient data
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            # Get patient info
-            cursor.execute("""
-                SELECT b.gioi_tinh, b.ngay_sinh, b.tuoi, b.dia_chi, b.dien_thoai
-                FROM benh_nhan b
-                WHERE b.id = ?
-            """, (patient_id,))
-            patient = cursor.fetchone()
-            
-            if patient:
-                gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai = patient
-                
-                # Update UI fields
-                self.gioitinh.setText(gioi_tinh)
-                if ngay_sinh:
-                    try:
-                        self.ngaysinh.setDate(QDate.fromString(ngay_sinh, "yyyy-MM-dd"))
-                    except:
-                        self.ngaysinh.setDate(QDate.currentDate())
-                self.tuoi.setText(str(tuoi) if tuoi else "")
-                self.diachi.setText(dia_chi or "")
-                self.dienthoai.setText(dien_thoai or "")
-                
-                # Load số hồ sơ and other info for this patient
-                cursor.execute("""
-                    SELECT DISTINCT 
-                        td.ma_hoso,
-                        b.doi_tuong,
-                        pk.so_phieu,
-                        COALESCE(ct.chan_doan, '') AS chan_doan,
-                        ct.di_ung_thuoc,
-                        pk.id as phieu_kham_id
-                    FROM tiep_don td
-                    LEFT JOIN benh_nhan b ON td.benh_nhan_id = b.id
-                    LEFT JOIN phieu_kham pk ON pk.benh_nhan_id = td.benh_nhan_id
-                    LEFT JOIN chi_tiet_phieu_kham ct ON pk.id = ct.phieu_kham_id
-                    WHERE td.benh_nhan_id = ? 
-                    AND td.ma_hoso IS NOT NULL
-                    ORDER BY pk.id DESC
-                """, (patient_id,))
-                records = cursor.fetchall()
-                
-                # Update số hồ sơ combobox and set current record
-                self.sohoso.clear()
-                if records:
-                    # Lấy mã hồ sơ mới nhất
-                    first_record = records[0]
-                    ma_hoso, doi_tuong, so_phieu, chan_doan, di_ung_thuoc, phieu_kham_id = first_record
-                    self.sohoso.setText(ma_hoso or "")
-                    # Save phieu_kham_id for later use if needed
-                    self.phieu_kham_id = phieu_kham_id
-                    # Update other fields từ record mới nhất
-                    self.doituong.setText(doi_tuong or "")
-                    self.sophieukham.setText(so_phieu or "")
-                    # Ưu tiên chẩn đoán từ chi tiết phiếu khám (chi_tiet_phieu_kham)
-                    try:
-                        if phieu_kham_id:
-                            cursor.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_kham_id,))
-                            drow = cursor.fetchone()
-                            if drow and drow[0]:
-                                self.chandoan.setText(drow[0])
-                            else:
-                                self.chandoan.setText(chan_doan or "")
-                    except Exception:
-                        self.chandoan.setText(chan_doan or "")
-                    self.diungthuoc.setText(di_ung_thuoc or "")
-
-                # Load tất cả đơn thuốc của bệnh nhân
-                cursor.execute("""
-                    SELECT dt.id, dt.ngay_ke, dt.chan_doan 
-                    FROM don_thuoc dt
-                    JOIN phieu_kham pk ON dt.phieu_kham_id = pk.id
-                    WHERE pk.benh_nhan_id = ?
-                    ORDER BY dt.ngay_ke DESC, dt.id DESC
-                """, (patient_id,))
-                prescriptions = cursor.fetchall()
-                
-                # Cập nhật combobox đơn cũ
-                self.doncu.clear()
-                self.doncu.addItem("---Chọn đơn cũ---", None)
-                self.doncu.addItem("---Tạo đơn mới---", "new")
-                for p in prescriptions:
-                    display_text = f"{p[1]} - {p[2][:50] + '...' if p[2] and len(p[2]) > 50 else p[2] or 'Không có chẩn đoán'}"
-                    self.doncu.addItem(display_text, p[0])
-                
-                if prescriptions:
-                    # Load đơn thuốc gần nhất
-                    # When selecting a patient and auto-loading their most recent
-                    # prescription, keep the form editable so user can immediately
-                    # sửa/nhập đơn mới. Chỉ khóa khi họ nhấn Lưu.
-                    self.load_prescription(prescriptions[0][0], disable_after_load=False)
-                else:
-                    # Reset tables nếu không có đơn thuốc
-                    self.reset_tables()
-                    
-        finally:
-            conn.close()
+        # Load patient data (chạy nền)
+        executor.submit(_fetch_patient_prescriptions, patient_id, key='don_thuoc.patient', owner=self,
+                        on_result=self._fill_patient)
+
+    def _fill_patient(self, data):
+        """Đổ dữ liệu của _fetch_patient_prescriptions lên form (GUI thread)."""
+        patient, records, diag, prescriptions, latest = data
+        if not patient:
+            return
+        gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai = patient
+
+        # Update UI fields
+        self.gioitinh.setText(gioi_tinh)
+        if ngay_sinh:
+            try:
+                self.ngaysinh.setDate(QDate.fromString(ngay_sinh, "yyyy-MM-dd"))
+            except:
+                self.ngaysinh.setDate(QDate.currentDate())
+        self.tuoi.setText(str(tuoi) if tuoi else "")
+        self.diachi.setText(dia_chi or "")
+        self.dienthoai.setText(dien_thoai or "")
+
+        # Update số hồ sơ combobox and set current record
+        self.sohoso.clear()
+        if records:
+            # Lấy mã hồ sơ mới nhất
+            first_record = records[0]
+            ma_hoso, doi_tuong, so_phieu, chan_doan, di_ung_thuoc, phieu_kham_id = first_record
+            self.sohoso.setText(ma_hoso or "")
+            # Save phieu_kham_id for later use if needed
+            self.phieu_kham_id = phieu_kham_id
+            # Update other fields từ record mới nhất
+            self.doituong.setText(doi_tuong or "")
+            self.sophieukham.setText(so_phieu or "")
+            # Ưu tiên chẩn đoán từ chi tiết phiếu khám (chi_tiet_phieu_kham)
+            if phieu_kham_id:
+                self.chandoan.setText(diag or chan_doan or "")
+            self.diungthuoc.setText(di_ung_thuoc or "")
+
+        # Cập nhật combobox đơn cũ
+        self.doncu.clear()
+        self.doncu.addItem("---Chọn đơn cũ---", None)
+        self.doncu.addItem("---Tạo đơn mới---", "new")
+        for p in prescriptions:
+            display_text = f"{p[1]} - {p[2][:50] + '...' if p[2] and len(p[2]) > 50 else p[2] or 'Không có chẩn đoán'}"
+            self.doncu.addItem(display_text, p[0])
+
+        if prescriptions:
+            # Đơn thuốc gần nhất (đã đọc cùng lúc với bệnh nhân)
+            # When selecting a patient and auto-loading their most recent
+            # prescription, keep the form editable so user can immediately
+            # sửa/nhập đơn mới. Chỉ khóa khi họ nhấn Lưu.
+            if latest is not None:
+                self._fill_prescription(prescriptions[0][0], False, *latest)
+            else:
+                self.load_prescription(prescriptions[0][0], disable_after_load=False)
+        else:
+            # Reset tables nếu không có đơn thuốc
+            self.reset_tables()
 
     def save_prescription(self):
         """Save the prescription and its details to database"""
@@ -2424,43 +2330,29 @@ class KeDonThuoc(QWidget):
         # Get patient ID
         patient_id = self.hoten.currentData()
 
-        conn = None
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            # Insert don_thuoc record
-            cursor.execute("""
-                INSERT INTO don_thuoc (
-                    phieu_kham_id,
-                    ngay_ke,
-                    so_ngay,
-                    ngay_tai_kham,
-                    tong_tien,
-                    loai_don,
-                    chan_doan,
-                    di_ung_thuoc,
-                    loi_dan,
-                    bac_si,
-                    quay_thuoc,
-                    nguoi_lap_phieu
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                self.phieu_kham_id,
-                self.ngaykedon.date().toString("yyyy-MM-dd"),
-                self.songay.value(),
-                self.taikham.date().toString("yyyy-MM-dd"),
-                float(self.tongtien.text() or 0),
-                self.loaithuoc.currentText(),
-                self.chandoan.text(),
-                self.diungthuoc.text(),
-                self.loidan.toPlainText(),
-                self.bacsi.currentText(),
-                self.quaythuoc.currentText(),
-                self.nguoilapphieu.text()
-            ))
+            header = {
+                'phieu_kham_id': self.phieu_kham_id,
+                'ngay_ke': self.ngaykedon.date().toString("yyyy-MM-dd"),
+                'so_ngay': self.songay.value(),
+                'ngay_tai_kham': self.taikham.date().toString("yyyy-MM-dd"),
+                'tong_tien': float(self.tongtien.text() or 0),
+                'loai_don': self.loaithuoc.currentText(),
+                'chan_doan': self.chandoan.text(),
+                'di_ung_thuoc': self.diungthuoc.text(),
+                'loi_dan': self.loidan.toPlainText(),
+                'bac_si': self.bacsi.currentText(),
+                'quay_thuoc': self.quaythuoc.currentText(),
+                'nguoi_lap_phieu': self.nguoilapphieu.text(),
+                # Đánh dấu bản ghi này là đã lưu (cột da_luu có sẵn từ migration)
+                'da_luu': 1,
+            }
 
-            don_thuoc_id = cursor.lastrowid
+            # Gom toàn bộ dòng thuốc trước, ghi một lần trong cùng transaction.
+            # row_items giữ ô bảng tương ứng để gắn id chi tiết sau khi lưu.
+            items = []
+            row_items = []
+            thuoc_khac = []
 
             # Save main medicines
             for row in range(self.table_thuoc.rowCount()):
@@ -2490,43 +2382,19 @@ class KeDonThuoc(QWidget):
                 ghi_chu_item = self.table_thuoc.item(row, 9)
                 ghi_chu = ghi_chu_item.text() if ghi_chu_item and ghi_chu_item.text() != "Nhấn để chọn" else ""
 
-                cursor.execute("""
-                    INSERT INTO chi_tiet_don_thuoc (
-                        don_thuoc_id,
-                        ma_thuoc,
-                        ten_thuoc,
-                        so_luong,
-                        don_vi,
-                        sang,
-                        trua,
-                        chieu,
-                        toi,
-                        lieu_dung,
-                        ghi_chu
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    don_thuoc_id,
-                    ma_thuoc_item.text(),
-                    ten_thuoc,
-                    so_luong,
-                    don_vi,
-                    sang,
-                    trua,
-                    chieu,
-                    toi,
-                    lieu_dung,
-                    ghi_chu
-                ))
-                # record the inserted detail id on the row item for later per-row deletion
-                try:
-                    detail_id = cursor.lastrowid
-                    if ma_thuoc_item:
-                        try:
-                            ma_thuoc_item.setData(Qt.UserRole, int(detail_id))
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
+                items.append({
+                    'ma_thuoc': ma_thuoc_item.text(),
+                    'ten_thuoc': ten_thuoc,
+                    'so_luong': so_luong,
+                    'don_vi': don_vi,
+                    'sang': sang,
+                    'trua': trua,
+                    'chieu': chieu,
+                    'toi': toi,
+                    'lieu_dung': lieu_dung,
+                    'ghi_chu': ghi_chu,
+                })
+                row_items.append(ma_thuoc_item)
 
             # Save additional medicines
             for row in range(self.table_thuoc_khac.rowCount()):
@@ -2541,90 +2409,37 @@ class KeDonThuoc(QWidget):
                 lieu_dung_item = self.table_thuoc_khac.item(row, 3)
                 lieu_dung = lieu_dung_item.text() if lieu_dung_item and lieu_dung_item.text() != "Nhấn để chọn" else ""
                 # Persist this 'thuốc khác' into thuoc_khac table for future autocomplete/suggestions
-                try:
-                    name_val = ten_thuoc_item.text().strip()
-                    if name_val:
-                        cursor.execute("SELECT id FROM thuoc_khac WHERE ten_thuoc = ? LIMIT 1", (name_val,))
-                        found = cursor.fetchone()
-                        if not found:
-                            try:
-                                cursor.execute("INSERT INTO thuoc_khac (ten_thuoc, don_vi, ghi_chu, don_thuoc_id) VALUES (?, ?, ?, ?)", (
-                                    name_val,
-                                    don_vi or None,
-                                    lieu_dung or None,
-                                    don_thuoc_id
-                                ))
-                            except Exception:
-                                # ignore insertion errors for now
-                                pass
-                except Exception:
-                    pass
+                thuoc_khac.append((ten_thuoc_item.text().strip(), don_vi, lieu_dung))
+
+                items.append({
+                    'ma_thuoc': None,
+                    'ten_thuoc': ten_thuoc_item.text(),
+                    'so_luong': so_luong,
+                    'don_vi': don_vi,
+                    'lieu_dung': lieu_dung,
+                })
+                row_items.append(ten_thuoc_item)
 
-                cursor.execute("""
-                    INSERT INTO chi_tiet_don_thuoc (
-                        don_thuoc_id,
-                        ma_thuoc,
-                        ten_thuoc,
-                        so_luong,
-                        don_vi,
-                        lieu_dung
-                    ) VALUES (?, NULL, ?, ?, ?, ?)
-                """, (
-                    don_thuoc_id,
-                    ten_thuoc_item.text(),
-                    so_luong,
-                    don_vi,
-                    lieu_dung
-                ))
-                # attach the newly inserted detail id to the thuốc_khac table row for later deletion
+            # Một transaction duy nhất: đầu đơn + chi tiết + thuoc_khac (rollback nếu lỗi)
+            don_thuoc_id, detail_ids = save_prescription_with_items('don_thuoc', header, items, thuoc_khac)
+
+            # record the inserted detail id on the row item for later per-row deletion
+            for item, detail_id in zip(row_items, detail_ids):
                 try:
-                    detail_id = cursor.lastrowid
-                    try:
-                        item0 = self.table_thuoc_khac.item(row, 0)
-                        if item0:
-                            item0.setData(Qt.UserRole, int(detail_id))
-                    except Exception:
-                        pass
+                    item.setData(Qt.UserRole, int(detail_id))
                 except Exception:
                     pass
 
-            # Commit once everything saved
-            conn.commit()
             # keep reference to the last saved id
             try:
                 self.last_don_thuoc_id = don_thuoc_id
             except Exception:
                 pass
 
-            # Đảm bảo bảng don_thuoc có cột 'da_luu' và đánh dấu bản ghi này là đã lưu
-            try:
-                cursor.execute("PRAGMA table_info('don_thuoc')")
-                cols = [r[1] for r in cursor.fetchall()]
-                if 'da_luu' not in cols:
-                    try:
-                        cursor.execute("ALTER TABLE don_thuoc ADD COLUMN da_luu INTEGER DEFAULT 0")
-                    except Exception:
-                        pass
-                try:
-                    cursor.execute("UPDATE don_thuoc SET da_luu = 1 WHERE id = ?", (don_thuoc_id,))
-                    conn.commit()
-                except Exception:
-                    pass
-            except Exception:
-                pass
-
             return True, "Lưu đơn thuốc thành công"
 
         except Exception as e:
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception:
-                    pass
             return False, f"Lỗi khi lưu đơn thuốc: {str(e)}"
-        finally:
-            if conn:
-                conn.close()
 
 # ======== MAIN ========
 if __name__ == "__main__":
@@ -6,8 +6,10 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt, QDate, QSortFilterProxyModel, pyqtSignal, QTimer
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from database import get_connection
+from database import get_connection, save_prescription_with_items
 from signals import app_signals
+from forms.page_cache import connect_global
+from forms.drug_catalog_model import shared_drug_model, sync_drug_catalog, COL_GIA, COL_MA, COL_TEN, COL_DON_VI
 from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtPrintSupport import QPrinter, QPrintDialog, QPrintPreviewDialog
 
@@ -23,9 +25,9 @@ class ChonThuocDialog(QDialog):
 
     def initUI(self):
         layout = QVBoxLayout()
-        self.model = QStandardItemModel()
-        self.model.setHorizontalHeaderLabels(["Mã thuốc", "Tên sản phẩm", "Tồn kho", "Đơn vị"])
-        self.proxy_model = QSortFilterProxyModel()
+        # Model danh mục thuốc dùng chung (forms/drug_catalog_model.py)
+        self.model = shared_drug_model()
+        self.proxy_model = QSortFilterProxyModel(self)
         self.proxy_model.setSourceModel(self.model)
         self.proxy_model.setFilterKeyColumn(-1)
         self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
@@ -51,17 +53,9 @@ class ChonThuocDialog(QDialog):
         self.setLayout(layout)
 
     def load_drugs(self):
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT ma_thuoc, ten_thuoc, ton_kho, don_vi FROM danh_muc_thuoc")
-        drugs = cursor.fetchall()
-        conn.close()
-        for drug in drugs:
-            ma_thuoc = QStandardItem(str(drug[0]))
-            ten_thuoc = QStandardItem(str(drug[1]))
-            ton_kho = QStandardItem(str(drug[2]))
-            don_vi = QStandardItem(str(drug[3]) if len(drug) > 3 and drug[3] is not None else "")
-            self.model.appendRow([ma_thuoc, ten_thuoc, ton_kho, don_vi])
+        # Model dùng chung chỉ được đọc lại khi danh mục thuốc đổi phiên bản
+        sync_drug_catalog()
+        self.table_view.setColumnHidden(COL_GIA, True)
 
     def filter_drugs(self, text):
         self.proxy_model.setFilterFixedString(text)
@@ -71,9 +65,9 @@ class ChonThuocDialog(QDialog):
         if indexes:
             row = indexes[0].row()
             self.selected_drug = {
-                'ma_thuoc': self.proxy_model.data(self.proxy_model.index(row, 0)),
-                'ten_thuoc': self.proxy_model.data(self.proxy_model.index(row, 1)),
-                'don_vi': self.proxy_model.data(self.proxy_model.index(row, 3))
+                'ma_thuoc': self.proxy_model.data(self.proxy_model.index(row, COL_MA)),
+                'ten_thuoc': self.proxy_model.data(self.proxy_model.index(row, COL_TEN)),
+                'don_vi': self.proxy_model.data(self.proxy_model.index(row, COL_DON_VI))
             }
             self.accept()
 
@@ -298,7 +292,7 @@ class DonThuocKhac(QWidget):
         self.load_nguoilap_list()
         # Đăng ký nhận sự kiện chọn bệnh nhân toàn ứng dụng để các form khác có thể cập nhật
         try:
-            app_signals.patient_selected.connect(self.auto_select_patient)
+            connect_global(self, app_signals.patient_selected, self.auto_select_patient)
         except Exception:
             pass
         if self.benh_nhan_id:
@@ -1234,16 +1228,7 @@ class DonThuocKhac(QWidget):
 
     def on_luu_bo_sung(self):
         """Save supplementary prescription to DB and lock editing."""
-        conn = None
         try:
-            conn = get_connection()
-            cur = conn.cursor()
-            # ensure header table
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='don_thuoc_bo_sung'")
-            if not cur.fetchone():
-                cur.execute(
-                    "CREATE TABLE don_thuoc_bo_sung (id INTEGER PRIMARY KEY, phieu_kham_id INTEGER, ngay_ke TEXT, nguoi_lap_phieu TEXT, chan_doan TEXT, loi_dan TEXT, tong_tien REAL)"
-                )
             phieu_kham_id = getattr(self, 'phieu_kham_id', None)
             ngay = self.ngaykedon.date().toString("yyyy-MM-dd") if hasattr(self, 'ngaykedon') else QDate.currentDate().toString("yyyy-MM-dd")
             nguoi = self.nguoilap.currentText() if hasattr(self, 'nguoilap') else ''
@@ -1253,35 +1238,18 @@ class DonThuocKhac(QWidget):
                 tong = float(self.tongtien.text()) if hasattr(self, 'tongtien') and self.tongtien.text() else 0
             except Exception:
                 tong = 0
-            cur.execute("INSERT INTO don_thuoc_bo_sung (phieu_kham_id, ngay_ke, nguoi_lap_phieu, chan_doan, loi_dan, tong_tien) VALUES (?, ?, ?, ?, ?, ?)", (
-                phieu_kham_id, ngay, nguoi, chan, loi, tong
-            ))
-            don_id = cur.lastrowid
-            # ensure detail table exists and choose the correct FK column name
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chi_tiet_don_thuoc_bo_sung'")
-            if not cur.fetchone():
-                cur.execute(
-                    "CREATE TABLE chi_tiet_don_thuoc_bo_sung (id INTEGER PRIMARY KEY, don_thuoc_id INTEGER, ma_thuoc TEXT, ten_thuoc TEXT, so_luong INTEGER, don_vi TEXT, sang TEXT, trua TEXT, chieu TEXT, toi TEXT, lieu_dung TEXT, ghi_chu TEXT)"
-                )
-
-            # Determine which FK column the table uses (some schemas use don_thuoc_bo_sung_id)
-            cur.execute("PRAGMA table_info(chi_tiet_don_thuoc_bo_sung)")
-            detail_cols = [c[1] for c in cur.fetchall()]
-            if 'don_thuoc_id' in detail_cols:
-                fk_col = 'don_thuoc_id'
-            elif 'don_thuoc_bo_sung_id' in detail_cols:
-                fk_col = 'don_thuoc_bo_sung_id'
-            else:
-                # If neither column exists (very old schema), try to add don_thuoc_id
-                try:
-                    cur.execute("ALTER TABLE chi_tiet_don_thuoc_bo_sung ADD COLUMN don_thuoc_id INTEGER DEFAULT 0")
-                    fk_col = 'don_thuoc_id'
-                except Exception:
-                    # fallback to don_thuoc_id if add failed
-                    fk_col = 'don_thuoc_id'
-
-            insert_sql = f"INSERT INTO chi_tiet_don_thuoc_bo_sung ({fk_col}, ma_thuoc, ten_thuoc, so_luong, don_vi, sang, trua, chieu, toi, lieu_dung, ghi_chu) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            header = {
+                'phieu_kham_id': phieu_kham_id,
+                'ngay_ke': ngay,
+                'nguoi_lap_phieu': nguoi,
+                'chan_doan': chan,
+                'loi_dan': loi,
+                'tong_tien': tong,
+                # đánh dấu đã lưu (cột da_luu có sẵn từ migration)
+                'da_luu': 1,
+            }
 
+            items = []
             for r in range(self.table_thuoc.rowCount()):
                 ma = self.table_thuoc.item(r, 0)
                 if not ma or not ma.text() or ma.text() == 'Nhấn để chọn':
@@ -1296,19 +1264,14 @@ class DonThuocKhac(QWidget):
                 toi = self.table_thuoc.item(r, 7).text() if self.table_thuoc.item(r, 7) else ''
                 lieu = self.table_thuoc.item(r, 8).text() if self.table_thuoc.item(r, 8) else ''
                 ghi = self.table_thuoc.item(r, 9).text() if self.table_thuoc.item(r, 9) else ''
-                cur.execute(insert_sql, (
-                    don_id, ma.text(), ten, qty, unit, sang, trua, chieu, toi, lieu, ghi
-                ))
-            # try add da_luu flag
-            try:
-                cur.execute("PRAGMA table_info(don_thuoc_bo_sung)")
-                cols = [c[1] for c in cur.fetchall()]
-                if 'da_luu' not in cols:
-                    cur.execute("ALTER TABLE don_thuoc_bo_sung ADD COLUMN da_luu INTEGER DEFAULT 0")
-                cur.execute("UPDATE don_thuoc_bo_sung SET da_luu = 1 WHERE id = ?", (don_id,))
-            except Exception:
-                pass
-            conn.commit()
+                items.append({
+                    'ma_thuoc': ma.text(), 'ten_thuoc': ten, 'so_luong': qty, 'don_vi': unit,
+                    'sang': sang, 'trua': trua, 'chieu': chieu, 'toi': toi,
+                    'lieu_dung': lieu, 'ghi_chu': ghi,
+                })
+
+            # Đầu đơn + toàn bộ dòng thuốc trong một transaction (rollback nếu lỗi)
+            save_prescription_with_items('don_thuoc_bo_sung', header, items)
             QMessageBox.information(self, "Thành công", "Đã lưu đơn thuốc bổ sung.")
             # lock editing
             try:
@@ -1321,12 +1284,7 @@ class DonThuocKhac(QWidget):
             except Exception:
                 pass
         except Exception as e:
-            if conn:
-                conn.rollback()
             QMessageBox.critical(self, "Lỗi", f"Không thể lưu: {e}")
-        finally:
-            if conn:
-                conn.close()
 
     def on_in_bo_sung(self):
         """Print / preview supplementary prescription."""
@@ -1474,11 +1432,6 @@ class DonThuocKhac(QWidget):
             # 3. Nếu không có chi tiết → chỉ đánh dấu gửi
             if not medicines:
                 try:
-                    cur.execute("PRAGMA table_info(don_thuoc_bo_sung)")
-                    cols = [c[1] for c in cur.fetchall()]
-                    if 'da_gui_cong_duoc' not in cols:
-                        cur.execute("ALTER TABLE don_thuoc_bo_sung ADD COLUMN da_gui_cong_duoc INTEGER DEFAULT 0")
-
                     cur.execute("UPDATE don_thuoc_bo_sung SET da_gui_cong_duoc = 1 WHERE id = ?", (don_id,))
                     conn.commit()
                     QMessageBox.information(self, "Hoàn tất", "Đã gửi đơn bổ sung tới cổng dược.")
@@ -1493,13 +1446,6 @@ class DonThuocKhac(QWidget):
 
             # 4. Đánh dấu đơn đã gửi tới cổng dược
             try:
-                cur.execute("PRAGMA table_info(don_thuoc_bo_sung)")
-                cols = [c[1] for c in cur.fetchall()]
-
-                if 'da_gui_cong_duoc' not in cols:
-                    cur.execute("ALTER TABLE don_thuoc_bo_sung ADD COLUMN da_gui_cong_duoc INTEGER DEFAULT 0")
-                    conn.commit()
-
                 cur.execute("UPDATE don_thuoc_bo_sung SET da_gui_cong_duoc = 1 WHERE id = ?", (don_id,))
                 conn.commit()
                 
@@ -0,0 +1,127 @@
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+
+from app_signals import app_signals
+from db_executor import executor
+from drug_catalog import drug_catalog
+
+# Cột của model danh mục thuốc dùng chung
+COL_MA, COL_TEN, COL_DON_VI, COL_TON_KHO, COL_GIA = range(5)
+HEADERS = ["Mã thuốc", "Tên sản phẩm", "Đơn vị", "Tồn kho", "Giá"]
+
+_model = None            # QStandardItemModel dùng chung (tạo khi màn hình đầu tiên cần)
+_synced_version = None   # phiên bản danh mục đã đưa vào model / đã thông báo
+_listening = False       # đã kết nối app_signals.changes -> _on_changes chưa
+
+
+def format_price(gia):
+    """Giá hiển thị: dấu chấm phân tách hàng nghìn."""
+    return f"{gia:,.0f}".replace(',', '.') if gia else "0"
+
+
+def _row_texts(rec):
+    return [str(rec.ma_thuoc or ''), str(rec.ten_thuoc or ''), str(rec.don_vi or ''),
+            str(rec.ton_kho or 0), format_price(rec.gia_thuoc or 0)]
+
+
+def _make_row(rec):
+    items = []
+    for col, text in enumerate(_row_texts(rec)):
+        it = QStandardItem(text)
+        it.setEditable(False)
+        if col in (COL_TON_KHO, COL_GIA):
+            it.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        items.append(it)
+    return items
+
+
+def _fill_model(records):
+    codes = [str(r.ma_thuoc or '') for r in records]
+    if _model.rowCount() == len(records) and all(
+            _model.item(i, COL_MA).text() == code for i, code in enumerate(codes)):
+        # Cùng danh sách thuốc (thường gặp: chỉ đổi tồn kho/giá): chỉ sửa ô thay đổi,
+        # view/proxy đang mở giữ nguyên lựa chọn và vị trí cuộn
+        for i, rec in enumerate(records):
+            for col, text in enumerate(_row_texts(rec)):
+                it = _model.item(i, col)
+                if it.text() != text:
+                    it.setText(text)
+        return
+    _model.setRowCount(0)
+    for rec in records:
+        _model.appendRow(_make_row(rec))
+
+
+def _apply():
+    """Đưa danh mục đã refresh vào model dùng chung; phát drug_catalog_changed nếu có thay đổi."""
+    global _synced_version
+    if drug_catalog.version is None or drug_catalog.version == _synced_version:
+        return False
+    if _model is not None:
+        _fill_model(drug_catalog.all())
+    _synced_version = drug_catalog.version
+    app_signals.drug_catalog_changed.emit()
+    return True
+
+
+def shared_drug_model():
+    """Model Qt dùng chung của danh mục thuốc (HEADERS), đã đồng bộ với DB.
+
+    Các hộp thoại chọn thuốc đặt QSortFilterProxyModel lên model này thay vì tự SELECT và tạo
+    QStandardItemModel mới mỗi lần mở.
+    """
+    global _model
+    _listen_for_changes()
+    drug_catalog.refresh()
+    if _model is None:
+        _model = QStandardItemModel()
+        _model.setHorizontalHeaderLabels(HEADERS)
+        _fill_model(drug_catalog.all())
+    _apply()
+    return _model
+
+
+def sync_drug_catalog(*_):
+    """Đồng bộ danh mục ngay trên GUI thread. Trả về True nếu danh mục vừa thay đổi."""
+    _listen_for_changes()
+    try:
+        drug_catalog.refresh()
+    except Exception as e:
+        print(f"Lỗi đọc danh mục thuốc: {e}")
+        return False
+    return _apply()
+
+
+def sync_drug_catalog_async(on_done=None, owner=None):
+    """Đọc lại danh mục trên worker thread (db_executor).
+
+    on_done(changed) chạy ở GUI thread sau khi model dùng chung đã cập nhật; changed=False nghĩa là
+    danh mục không đổi (màn hình tự điền từ drug_catalog nếu cần) và drug_catalog_changed không được phát.
+    """
+    _listen_for_changes()
+
+    def done(_):
+        changed = _apply()
+        if on_done:
+            on_done(changed)
+
+    return executor.submit(drug_catalog.refresh, key='drug_catalog.refresh', owner=owner,
+                           on_result=done,
+                           on_error=lambda e: print(f"Lỗi đọc danh mục thuốc: {e}"))
+
+
+def _on_changes(changes):
+    if changes.touches('danh_muc_thuoc'):
+        sync_drug_catalog()
+
+
+def _listen_for_changes():
+    """Sau khi xuất/nhập thuốc (tồn kho đổi) thì đồng bộ để các màn hình đang mở thấy số mới.
+
+    Kết nối ở lần dùng đầu tiên (luôn trên GUI thread) thay vì lúc import: PyQt gắn slot là hàm
+    thường với thread đang kết nối, mà module này có thể được import trên thread khác.
+    """
+    global _listening
+    if not _listening:
+        _listening = True
+        app_signals.changes.connect(_on_changes)
@@ -0,0 +1,116 @@
+import importlib
+import logging
+import sys
+import threading
+import time
+
+from PyQt5.QtCore import QTimer
+
+# Tên class -> module chứa class. Module chỉ được import khi trang được mở lần đầu
+# (hoặc khi pre-warm), để màn hình đăng nhập / MainApp hiện ra mà không phải chờ
+# reportlab, requests/dotenv, PyMuPDF... của từng form.
+PAGE_MODULES = {
+    'TiepDonKham': 'forms.tiep_don_kham',
+    'ChiDinhDichVu': 'forms.chi_dinh_dich_vu',
+    'TaoPhieuKham': 'forms.tao_phieu_kham',
+    'QuanLyThuoc': 'forms.quan_ly_thuoc',
+    'DonThuocKhac': 'forms.don_thuoc_bo_sung',
+    'KeDonThuoc': 'forms.don_thuoc',
+    'DatLichKhamForm': 'forms.dat_lich_kham_form',
+    'AIChatDialog': 'forms.ai_chat',
+    'QuanLyNhanSu': 'forms.quan_ly_nhan_su',
+    'QuanLyLichHen': 'forms.quan_ly_lich_hen',
+    'QuanLyXuatThuoc': 'forms.quan_ly_xuat_thuoc',
+    'XemLichSuXuatThuoc': 'forms.xem_lich_su_xuat_thuoc',
+    'QuanLyTaiKhoan': 'forms.quan_ly_tai_khoan',
+    'AdminPanel': 'forms.admin_panel',
+}
+
+# Thư viện bên thứ ba nặng mà form kéo theo lúc import. Các package này không kết nối signal
+# hay tạo QObject khi import nên được pre-warm trên thread nền.
+PAGE_PACKAGES = {
+    'TiepDonKham': ('reportlab.pdfgen.canvas', 'reportlab.pdfbase.ttfonts', 'reportlab.pdfbase.cidfonts'),
+    'ChiDinhDichVu': ('reportlab.pdfgen.canvas', 'reportlab.pdfbase.ttfonts'),
+    'AIChatDialog': ('requests', 'dotenv'),
+}
+
+# Khoảng chờ (ms) giữa hai lượt pre-warm trên GUI thread
+PREWARM_TICK_MS = 50
+
+# module -> (số giây import, nguồn: 'click' | 'prewarm')
+IMPORT_TIMES = {}
+
+
+def _import(module_name, source):
+    # Luôn đi qua importlib (không nhận module đang khởi tạo dở từ sys.modules)
+    if module_name in sys.modules:
+        return importlib.import_module(module_name)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    IMPORT_TIMES.setdefault(module_name, (time.perf_counter() - start, source))
+    return module
+
+
+def page_class(name):
+    """Trả về class form `name`, import module của nó nếu chưa import."""
+    module = _import(PAGE_MODULES[name], 'click')
+    return getattr(module, name)
+
+
+def prewarm(names, delay=0.0, warmups=()):
+    """Import trước các form `names` sau khi cửa sổ đã hiện (gọi trên GUI thread).
+
+    - Thư viện bên thứ ba (PAGE_PACKAGES) và warmups (hàm không đụng tới Qt, vd. nạp chỉ mục
+      bệnh nhân) chạy trên một thread nền.
+    - Module forms.* được import trên GUI thread qua QTimer, mỗi lượt một module, sau khi thread
+      nền đã nạp xong thư viện: các module này kết nối signal lúc import và PyQt gắn slot với
+      thread đang import.
+    Lỗi import (thiếu thư viện...) chỉ được ghi log; lần mở trang sẽ báo lỗi như cũ.
+    """
+    modules = [PAGE_MODULES[n] for n in names if n in PAGE_MODULES]
+    packages = []
+    for n in names:
+        packages.extend(p for p in PAGE_PACKAGES.get(n, ()) if p not in packages)
+
+    def run():
+        if delay:
+            time.sleep(delay)
+        for package in packages:
+            try:
+                importlib.import_module(package)
+            except Exception as e:
+                logging.warning("Pre-warm %s thất bại: %s", package, e)
+        for fn in warmups:
+            try:
+                fn()
+            except Exception as e:
+                logging.warning("Pre-warm %s thất bại: %s", getattr(fn, '__name__', fn), e)
+
+    t = threading.Thread(target=run, name='prewarm-packages', daemon=True)
+    t.start()
+
+    def import_next():
+        if t.is_alive():
+            # Chưa nạp xong thư viện: import form lúc này sẽ chặn GUI thread chờ thread nền
+            QTimer.singleShot(PREWARM_TICK_MS, import_next)
+            return
+        if not modules:
+            return
+        module_name = modules.pop(0)
+        try:
+            _import(module_name, 'prewarm')
+        except Exception as e:
+            logging.warning("Pre-warm %s thất bại: %s", module_name, e)
+        if modules:
+            QTimer.singleShot(PREWARM_TICK_MS, import_next)
+
+    QTimer.singleShot(PREWARM_TICK_MS, import_next)
+    return t
+
+
+def startup_report():
+    """Các dòng báo cáo thời gian import form (chậm nhất trước)."""
+    lines = []
+    for module_name, (secs, source) in sorted(IMPORT_TIMES.items(), key=lambda kv: -kv[1][0]):
+        lines.append(f"{secs * 1000:8.1f} ms  {module_name} ({source})")
+    return lines
@@ -0,0 +1,173 @@
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyleOptionButton, QStyle, QApplication
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, pyqtSignal
+from database import pool
+
+
+class LazySqlTableModel(QAbstractTableModel):
+    """Model bảng đọc dữ liệu SQLite theo từng trang (fetchMore).
+
+    View (QTableView) chỉ gọi fetchMore() khi cuộn gần cuối, nên bảng 100k dòng vẫn
+    hiển thị ngay trang đầu và bộ nhớ chỉ giữ các tuple đã đọc (không có QTableWidgetItem
+    hay widget cho từng ô).
+
+    columns: danh sách (tiêu đề, chỉ số cột trong tuple kết quả, hàm định dạng, căn lề).
+      - chỉ số None: cột không có dữ liệu (vd. cột nút bấm vẽ bởi ButtonDelegate)
+      - hàm định dạng / căn lề có thể bỏ trống
+    style: hàm tuỳ chọn (row_tuple, col, role) -> giá trị cho Foreground/Background... của ô.
+    Câu truy vấn phải có ORDER BY xác định thứ tự duy nhất (thêm id cuối cùng): các trang đọc bằng
+    LIMIT/OFFSET, thứ tự không cố định thì dòng cùng khoá sắp xếp có thể lặp hoặc bị sót giữa hai trang.
+    """
+
+    def __init__(self, columns, page_size=500, style=None, parent=None):
+        super().__init__(parent)
+        self._columns = [tuple(c) + (None,) * (4 - len(c)) for c in columns]
+        self._page_size = page_size
+        self._style = style
+        self._sql = None
+        self._params = ()
+        self._rows = []
+        self._exhausted = True
+
+    # --- nguồn dữ liệu ---
+    def set_query(self, sql, params=()):
+        """Đặt câu truy vấn (không kèm LIMIT) và nạp lại từ đầu; trang đầu được đọc ngay."""
+        self.beginResetModel()
+        self._sql = sql
+        self._params = tuple(params)
+        self._rows = []
+        self._exhausted = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def refresh(self):
+        """Đọc lại câu truy vấn hiện tại (sau khi dữ liệu thay đổi)."""
+        if self._sql is not None:
+            self.set_query(self._sql, self._params)
+
+    def refresh_loaded(self):
+        """Đọc lại các dòng đã nạp và chỉ báo dataChanged cho dòng khác đi.
+
+        Giữ nguyên vị trí cuộn / lựa chọn của view. Nếu số dòng thay đổi (thêm/xoá) thì nạp lại như refresh().
+        """
+        if self._sql is None:
+            return
+        count = max(len(self._rows), self._page_size)
+        with pool.read() as conn:
+            cur = conn.cursor()
+            cur.execute(f"{self._sql} LIMIT ? OFFSET 0", self._params + (count,))
+            rows = cur.fetchall()
+        if len(rows) != len(self._rows):
+            self.beginResetModel()
+            self._rows = rows
+            self._exhausted = len(rows) < count
+            self.endResetModel()
+            return
+        last = self.columnCount() - 1
+        for i, row in enumerate(rows):
+            if row != self._rows[i]:
+                self._rows[i] = row
+                self.dataChanged.emit(self.index(i, 0), self.index(i, last))
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted or self._sql is None:
+            return
+        with pool.read() as conn:
+            cur = conn.cursor()
+            cur.execute(f"{self._sql} LIMIT ? OFFSET ?",
+                        self._params + (self._page_size, len(self._rows)))
+            page = cur.fetchall()
+        if len(page) < self._page_size:
+            self._exhausted = True
+        if not page:
+            return
+        start = len(self._rows)
+        self.beginInsertRows(QModelIndex(), start, start + len(page) - 1)
+        self._rows.extend(page)
+        self.endInsertRows()
+
+    def fetch_all(self):
+        """Đọc hết các trang còn lại (dùng khi xuất file)."""
+        while self.canFetchMore():
+            self.fetchMore()
+
+    # --- truy cập dữ liệu ---
+    def row_values(self, row):
+        """Tuple kết quả SQL của dòng `row` (None nếu ngoài phạm vi)."""
+        if 0 <= row < len(self._rows):
+            return self._rows[row]
+        return None
+
+    def display_text(self, row, col):
+        """Chuỗi đang hiển thị ở ô (row, col)."""
+        return self.data(self.index(row, col)) or ""
+
+    def headers(self):
+        return [c[0] for c in self._columns]
+
+    # --- QAbstractTableModel ---
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and section < len(self._columns):
+            return self._columns[section][0]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        _, field, fmt, align = self._columns[index.column()]
+        if role == Qt.DisplayRole:
+            if field is None:
+                return None
+            value = row[field]
+            if fmt:
+                return fmt(value)
+            return "" if value is None else str(value)
+        if role == Qt.TextAlignmentRole and align is not None:
+            return align
+        if role == Qt.UserRole:
+            return row
+        if self._style:
+            return self._style(row, index.column(), role)
+        return None
+
+
+class ButtonDelegate(QStyledItemDelegate):
+    """Vẽ một nút bấm trong ô thay cho QPushButton thật ở từng dòng.
+
+    Phát clicked(row) khi người dùng bấm vào ô.
+    """
+
+    clicked = pyqtSignal(int)
+
+    def __init__(self, text, parent=None):
+        super().__init__(parent)
+        self._text = text
+        self._pressed = None
+
+    def paint(self, painter, option, index):
+        opt = QStyleOptionButton()
+        opt.rect = option.rect.adjusted(4, 2, -4, -2)
+        opt.text = self._text
+        opt.state = QStyle.State_Enabled | (
+            QStyle.State_Sunken if self._pressed == (index.row(), index.column()) else QStyle.State_Raised)
+        QApplication.style().drawControl(QStyle.CE_PushButton, opt, painter)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonPress and option.rect.contains(event.pos()):
+            self._pressed = (index.row(), index.column())
+            return True
+        if event.type() == QEvent.MouseButtonRelease:
+            pressed, self._pressed = self._pressed, None
+            if pressed == (index.row(), index.column()) and option.rect.contains(event.pos()):
+                self.clicked.emit(index.row())
+            return True
+        return False
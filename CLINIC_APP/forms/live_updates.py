@@ -0,0 +1,47 @@
+import os
+
+from PyQt5.QtCore import QTimer
+
+from app_signals import app_signals
+from change_feed import ChangeFeed
+from db_executor import executor
+from ref_cache import reference_cache
+
+# Chu kỳ hỏi PRAGMA data_version (ms); mỗi lần chỉ là một lệnh PRAGMA trên kết nối riêng
+FEED_INTERVAL_MS = max(100, int(os.environ.get('CLINIC_FEED_INTERVAL_MS', '300') or 300))
+
+_feed = None
+_timer = None
+
+
+def _poll():
+    try:
+        changes = _feed.poll()
+    except Exception as e:
+        print(f"Lỗi đọc change_log: {e}")
+        return
+    if changes:
+        # Dữ liệu tham chiếu (danh sách bác sĩ...) do tiến trình khác sửa: không chờ hết TTL
+        reference_cache.invalidate(*changes)
+    for table, ids in changes.items():
+        # Chỉ phát app_signals.changes (payload bảng/dòng), không phát lại các signal cũ
+        app_signals.post(table, ids, signals=())
+
+
+def _submit_prune(prune):
+    executor.submit(prune, key='change_feed.prune')
+
+
+def start_live_updates(parent=None):
+    """Bắt đầu nhận thay đổi từ các tiến trình khác dùng chung clinic.db (gọi một lần trên GUI thread)."""
+    global _feed, _timer
+    if _timer is not None:
+        return _timer
+    # Dọn change_log (transaction ghi) trên worker thread của db_executor, không chặn GUI thread
+    _feed = ChangeFeed(submit=_submit_prune)
+    _submit_prune(_feed.prune)
+    _feed.start()
+    _timer = QTimer(parent)
+    _timer.timeout.connect(_poll)
+    _timer.start(FEED_INTERVAL_MS)
+    return _timer
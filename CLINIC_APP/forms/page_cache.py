@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import logging
+
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+
+
+def connect_global(owner, signal, slot):
+    """Nối signal toàn cục (app_signals.py / signals.py) tới slot và ghi lại kết nối trên `owner`.
+
+    teardown_page() chỉ ngắt đúng các kết nối đã ghi của trang và các widget con của nó.
+    """
+    signal.connect(slot)
+    owner.__dict__.setdefault('_global_connections', []).append((signal, slot))
+
+
+def _disconnect_global_signals(page):
+    """Ngắt các kết nối connect_global() của page và các widget con."""
+    for obj in [page] + page.findChildren(QObject):
+        for signal, slot in obj.__dict__.pop('_global_connections', ()):
+            try:
+                signal.disconnect(slot)
+            except (TypeError, RuntimeError):
+                pass
+
+
+def teardown_page(page):
+    """Dọn dẹp page trước khi huỷ: hook riêng của form, timer, signal toàn cục."""
+    try:
+        hook = getattr(page, 'teardown', None)
+        if callable(hook):
+            hook()
+    except Exception as e:
+        print(f"Lỗi khi dọn dẹp trang {type(page).__name__}: {e}")
+    # Timer có thể là con của page hoặc chỉ được giữ bằng thuộc tính (QTimer() không parent)
+    timers = set(page.findChildren(QTimer))
+    timers.update(v for v in vars(page).values() if isinstance(v, QTimer))
+    for t in timers:
+        try:
+            t.stop()
+        except RuntimeError:
+            pass
+    _disconnect_global_signals(page)
+
+
+class PageCache:
+    """Quản lý các trang trong QStackedWidget của MainApp.
+
+    - Mỗi trang có một key; mở lại cùng key thì dùng lại trang cũ (reuse=True)
+      hoặc huỷ trang cũ rồi tạo trang mới (reuse=False, cho các form nhập liệu cần trắng).
+    - Chỉ giữ tối đa max_pages trang; trang lâu không dùng nhất bị huỷ (LRU).
+    - Các trang trong `pinned` (vd. trang chào mừng) không bao giờ bị huỷ.
+    """
+
+    def __init__(self, stack, max_pages=6, on_change=None):
+        self.stack = stack
+        self.max_pages = max_pages
+        self.on_change = on_change
+        self._pages = OrderedDict()   # key -> page, cuối = dùng gần nhất
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, key):
+        return self._pages.get(key)
+
+    def keys(self):
+        return list(self._pages.keys())
+
+    def __len__(self):
+        return len(self._pages)
+
+    def show(self, key, factory, reuse=True):
+        """Hiển thị trang `key`, tạo bằng factory() nếu chưa có. Trả về page."""
+        page = self._pages.get(key)
+        if page is not None and not reuse:
+            self.remove(key)
+            page = None
+        if page is None:
+            page = factory()
+            self.stack.addWidget(page)
+            self.created += 1
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        self.stack.setCurrentWidget(page)
+        self._evict()
+        self._changed()
+        return page
+
+    def ensure(self, key, factory):
+        """Tạo (nếu chưa có) mà không chuyển trang hiện tại."""
+        page = self._pages.get(key)
+        if page is None:
+            page = factory()
+            self.stack.addWidget(page)
+            self.created += 1
+            self._pages[key] = page
+            self._evict()
+            self._changed()
+        return page
+
+    def remove(self, key):
+        page = self._pages.pop(key, None)
+        if page is None:
+            return
+        teardown_page(page)
+        self.stack.removeWidget(page)
+        page.deleteLater()
+        self.evicted += 1
+        self._changed()
+
+    def clear(self):
+        for key in list(self._pages.keys()):
+            self.remove(key)
+
+    def _evict(self):
+        current = self.stack.currentWidget()
+        for key in list(self._pages.keys()):
+            if len(self._pages) <= self.max_pages:
+                break
+            if self._pages[key] is current:
+                continue
+            logging.info("Huỷ trang ít dùng: %s", key)
+            self.remove(key)
+
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception:
+                pass
+
+
+def memory_usage_text(cache=None):
+    """Chuỗi trạng thái bộ nhớ cho status bar: RSS (nếu có psutil), số widget, số trang."""
+    parts = []
+    try:
+        import psutil
+        rss = psutil.Process().memory_info().rss
+        parts.append(f"RAM: {rss / (1024 * 1024):.0f} MB")
+    except Exception:
+        # psutil là tuỳ chọn: không có thì chỉ hiện số widget
+        pass
+    try:
+        parts.append(f"Widget: {len(QApplication.allWidgets())}")
+    except Exception:
+        pass
+    if cache is not None:
+        parts.append(f"Trang: {len(cache)}/{cache.max_pages}")
+    return " · ".join(parts)
@@ -0,0 +1,106 @@
+from PyQt5.QtCore import Qt, QModelIndex, QStringListModel
+from PyQt5.QtWidgets import QCompleter
+
+from db_executor import executor
+from patient_index import patient_index, patient_display_text
+
+# Số bệnh nhân tối đa giữ trong combobox (các bệnh nhân vừa chọn); phần còn lại chỉ có trong chỉ mục
+MAX_COMBO_PATIENTS = 50
+
+
+def add_patient_item(combo, rec, formatter=patient_display_text):
+    """Vị trí của bệnh nhân `rec` trong combobox; thêm vào (itemData = id) nếu chưa có.
+
+    Combobox chỉ giữ MAX_COMBO_PATIENTS bệnh nhân gần nhất: mục cũ nhất (không phải placeholder
+    itemData=None, không phải mục đang chọn) bị bỏ khi đầy.
+    """
+    idx = combo.findData(rec.id, Qt.UserRole)
+    if idx >= 0:
+        return idx
+    patients = [i for i in range(combo.count()) if combo.itemData(i, Qt.UserRole) is not None]
+    while len(patients) >= MAX_COMBO_PATIENTS:
+        oldest = next((i for i in patients if i != combo.currentIndex()), None)
+        if oldest is None:
+            break
+        combo.blockSignals(True)
+        combo.removeItem(oldest)
+        combo.blockSignals(False)
+        patients = [i for i in range(combo.count()) if combo.itemData(i, Qt.UserRole) is not None]
+    combo.addItem(formatter(rec), rec.id)
+    return combo.count() - 1
+
+
+def patient_item_index(combo, pid, formatter=patient_display_text):
+    """Vị trí của bệnh nhân id `pid` trong combobox (lấy từ chỉ mục và thêm vào nếu chưa có); -1 nếu không có."""
+    if not pid:
+        return -1
+    idx = combo.findData(pid, Qt.UserRole)
+    if idx >= 0:
+        return idx
+    rec = patient_index.get(pid)
+    if rec is None:
+        # Bệnh nhân vừa được thêm: đồng bộ chỉ mục (chỉ đọc các dòng thay đổi)
+        patient_index.refresh()
+        rec = patient_index.get(pid)
+    if rec is None:
+        return -1
+    return add_patient_item(combo, rec, formatter)
+
+
+def reset_patient_combo(combo, placeholder=None):
+    """Xoá danh sách bệnh nhân của combobox (chỉ để lại placeholder nếu có).
+
+    Combobox không nạp toàn bộ bệnh nhân: PatientCompleter thêm bệnh nhân khi được chọn,
+    patient_item_index() thêm khi form chọn theo id. Chỉ mục được đồng bộ với DB trên worker thread.
+    """
+    combo.clear()
+    if placeholder is not None:
+        combo.addItem(placeholder, None)
+    executor.submit(patient_index.refresh, key='patient_index.refresh')
+
+
+class PatientCompleter(QCompleter):
+    """QCompleter gợi ý bệnh nhân từ chỉ mục dùng chung (patient_index).
+
+    Mỗi lần gõ chỉ lấy top-`limit` kết quả (không dấu, SĐT, CCCD, mã hồ sơ) thay vì
+    nạp cả danh sách bệnh nhân vào model rồi để QCompleter tự lọc.
+    Khi chọn một gợi ý, bệnh nhân đó được thêm vào combobox (itemData = id) trước khi
+    combobox và các handler của form xử lý, nên findText(...)/currentData() vẫn dùng được.
+    formatter(record) là chuỗi hiển thị của bệnh nhân trong gợi ý và trong combobox.
+    """
+
+    def __init__(self, combo, formatter=patient_display_text, limit=20):
+        super().__init__(combo)
+        self.formatter = formatter
+        self._combo = combo
+        self._limit = limit
+        self._results = {}
+        self._model = QStringListModel(self)
+        self.setModel(self._model)
+        self.setCaseSensitivity(Qt.CaseInsensitive)
+        # Kết quả đã được lọc sẵn: popup hiển thị nguyên model
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setMaxVisibleItems(min(limit, 15))
+        # Kết nối trước combo.setCompleter(): handler này phải chạy trước handler của QComboBox
+        # (tìm mục theo chữ rồi setCurrentIndex)
+        self.activated[QModelIndex].connect(self._on_activated)
+        combo.setCompleter(self)
+        combo.lineEdit().textEdited.connect(self._on_text_edited)
+
+    def _on_text_edited(self, text):
+        try:
+            results = patient_index.search(text, self._limit)
+        except Exception as e:
+            print(f"Lỗi tìm bệnh nhân: {e}")
+            results = []
+        self._results = {self.formatter(r): r for r in results}
+        self._model.setStringList(list(self._results))
+        if results:
+            self.complete()
+        else:
+            self.popup().hide()
+
+    def _on_activated(self, index):
+        rec = self._results.get(index.data())
+        if rec is not None:
+            add_patient_item(self._combo, rec, self.formatter)
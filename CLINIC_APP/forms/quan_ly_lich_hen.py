@@ -1,10 +1,13 @@
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton,
-    QTableWidget, QTableWidgetItem, QMessageBox, QDialog, QFormLayout,
+    QTableView, QAbstractItemView, QMessageBox, QDialog, QFormLayout,
     QHeaderView, QSizePolicy, QComboBox, QDateTimeEdit, QTextEdit
 )
 from PyQt5.QtCore import Qt, QDateTime, pyqtSignal
-from database import get_connection
+from database import get_connection, reschedule_appointment, set_appointment_status, SlotFullError
+from app_signals import app_signals
+from forms.page_cache import connect_global
+from forms.lazy_table import LazySqlTableModel
 
 
 class QuanLyLichHen(QWidget):
@@ -17,6 +20,12 @@ class QuanLyLichHen(QWidget):
         self.setWindowTitle("Quản Lý Lịch Hẹn")
         self.init_ui()
         self.load_appointments()
+        # Lịch hẹn đặt qua web / máy khác (change_log) hoặc form khác: đọc lại các dòng đang hiển thị
+        connect_global(self, app_signals.changes, self.on_data_changes)
+
+    def on_data_changes(self, changes):
+        if changes.touches('lich_hen'):
+            self.model.refresh_loaded()
         
     def init_ui(self):
         layout = QVBoxLayout(self)
@@ -76,14 +85,17 @@ class QuanLyLichHen(QWidget):
         
         # Bảng (hiển thị cột SĐT và địa chỉ)
         # Các cột: Bệnh Nhân, SĐT, Địa chỉ, Ngày Giờ, Bác Sĩ, Loại Khám, Trạng Thái, Ghi Chú, BN_ID
-        self.table = QTableWidget(0, 9)
-        self.table.setHorizontalHeaderLabels([
-            "Bệnh Nhân", "SĐT", "Địa chỉ", "Ngày Giờ", "Bác Sĩ", 
-            "Loại Khám", "Trạng Thái", "Ghi Chú", "BN_ID"
-        ])
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.table.setSelectionMode(QTableWidget.SingleSelection)
+        # Dữ liệu đọc dần theo trang (LazySqlTableModel); chỉ số cột trỏ vào tuple SELECT trong load_appointments
+        self.model = LazySqlTableModel([
+            ("Bệnh Nhân", 1), ("SĐT", 2), ("Địa chỉ", 3), ("Ngày Giờ", 4), ("Bác Sĩ", 5),
+            ("Loại Khám", 6), ("Trạng Thái", 7), ("Ghi Chú", 8), ("BN_ID", 9),
+        ], style=self._status_style)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
         self.table.setMinimumHeight(400)
         self.table.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         
@@ -111,66 +123,49 @@ class QuanLyLichHen(QWidget):
         
         layout.addWidget(self.table)
     
+    def _status_style(self, row, col, role):
+        # Cột trạng thái với mã màu (chỉ số 6)
+        if col == 6 and row[7] == "đã hủy":
+            if role == Qt.ForegroundRole:
+                return self.table.palette().color(self.table.palette().Foreground)
+            if role == Qt.BackgroundRole:
+                return self.table.palette().color(self.table.palette().HighlightedText)
+        return None
+
     def load_appointments(self):
-        """Tải danh sách lịch hẹn từ database."""
-        self.table.setRowCount(0)
+        """Tải danh sách lịch hẹn từ database (theo bộ lọc hiện tại, đọc dần theo trang)."""
+        sql = """
+            SELECT lh.id, lh.ho_ten, lh.dien_thoai, lh.dia_chi, lh.ngay_gio, lh.bac_si, lh.loai_kham,
+                   lh.trang_thai, lh.ghi_chu, lh.benh_nhan_id, lh.nguoi_dat
+            FROM lich_hen lh
+        """
+        where, params = [], []
+        search_text = self.search_input.text().strip().lower()
+        if search_text:
+            # Tìm kiếm cả trong cột bác sĩ
+            where.append("(instr(lower_unicode(lh.ho_ten), ?) > 0 OR instr(lower_unicode(lh.bac_si), ?) > 0)")
+            params.extend([search_text, search_text])
+        status_filter = self.status_filter.currentText()
+        if status_filter != "Tất cả":
+            where.append("lh.trang_thai = ?")
+            params.append(status_filter)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # id phân định các lịch cùng giờ: trang LIMIT/OFFSET của LazySqlTableModel không lặp/sót dòng
+        sql += " ORDER BY lh.ngay_gio DESC, lh.id DESC"
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT lh.id, lh.ho_ten, lh.dien_thoai, lh.dia_chi, lh.ngay_gio, lh.bac_si, lh.loai_kham,
-                       lh.trang_thai, lh.ghi_chu, lh.benh_nhan_id, lh.nguoi_dat
-                FROM lich_hen lh
-                ORDER BY lh.ngay_gio DESC
-            """)
-            rows = cursor.fetchall()
-            conn.close()
-            
-            for row in rows:
-                row_pos = self.table.rowCount()
-                self.table.insertRow(row_pos)
-                # Lưu LH id vào Qt.UserRole của cột đầu tiên
-                ho_ten_item = QTableWidgetItem(row[1] or "")
-                ho_ten_item.setData(Qt.UserRole, row[0])  # Store LH id invisibly
-                self.table.setItem(row_pos, 0, ho_ten_item)
-
-                # Số điện thoại và địa chỉ
-                self.table.setItem(row_pos, 1, QTableWidgetItem(row[2] or ""))
-                self.table.setItem(row_pos, 2, QTableWidgetItem(row[3] or ""))
-
-                self.table.setItem(row_pos, 3, QTableWidgetItem(row[4] or ""))
-                self.table.setItem(row_pos, 4, QTableWidgetItem(row[5] or ""))
-                self.table.setItem(row_pos, 5, QTableWidgetItem(row[6] or ""))
-
-                # Cột trạng thái với mã màu (chỉ số 6)
-                status_item = QTableWidgetItem(row[7] or "")
-                if row[7] == "đã hủy":
-                    status_item.setForeground(self.table.palette().color(self.table.palette().Foreground))
-                    status_item.setBackground(self.table.palette().color(self.table.palette().HighlightedText))
-                self.table.setItem(row_pos, 6, status_item)
-
-                self.table.setItem(row_pos, 7, QTableWidgetItem(row[8] or ""))
-                # BN_ID ẩn (tham chiếu nội bộ)
-                self.table.setItem(row_pos, 8, QTableWidgetItem(str(row[9] or "")))
+            self.model.set_query(sql, params)
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể tải lịch hẹn: {e}")
     
     def filter_appointments(self):
-        """Lọc lịch hẹn theo tìm kiếm và trạng thái."""
-        search_text = self.search_input.text().lower()
-        status_filter = self.status_filter.currentText()
-        
-        for row in range(self.table.rowCount()):
-            ho_ten = self.table.item(row, 0).text().lower()
-            trang_thai = self.table.item(row, 6).text()
-            
-            # Tìm kiếm cả trong cột bác sĩ (chỉ số 4)
-            show_search = search_text in ho_ten or search_text in self.table.item(row, 4).text().lower()
-            show_status = status_filter == "Tất cả" or trang_thai == status_filter
-            
-            show = show_search and show_status
-            self.table.setRowHidden(row, not show)
+        """Lọc lịch hẹn theo tìm kiếm và trạng thái (lọc ngay trong SQL)."""
+        self.load_appointments()
     
+    def _cell(self, row, col):
+        """Nội dung đang hiển thị ở ô (row, col) của bảng lịch hẹn."""
+        return self.model.display_text(row, col)
+
     def get_selected_appointment(self):
         """Lấy lịch hẹn được chọn."""
         selected_rows = self.table.selectionModel().selectedRows()
@@ -185,20 +180,21 @@ class QuanLyLichHen(QWidget):
         if row is None:
             return
         
-        lh_id = self.table.item(row, 0).data(Qt.UserRole)
-        ho_ten = self.table.item(row, 0).text()
+        lh_id = self.model.row_values(row)[0]
+        ho_ten = self._cell(row, 0)
         
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE lich_hen SET trang_thai = ? WHERE id = ?",
-                          ("xác nhận", lh_id))
-            conn.commit()
-            conn.close()
-            
+            # Xác nhận lịch đã hủy sẽ giữ lại chỗ trong khung giờ: SlotFullError nếu khung đã kín
+            set_appointment_status(lh_id, "xác nhận")
+
             QMessageBox.information(self, "Thành công", f"Đã xác nhận lịch hẹn cho {ho_ten}")
             self.load_appointments()
             self.data_saved.emit()
+        except SlotFullError as e:
+            goi_y = ", ".join(b for b, _ in e.goi_y[:3])
+            QMessageBox.warning(self, "Hết chỗ",
+                                f"Bác sĩ {e.bac_si} đã kín lịch khung {e.bat_dau}."
+                                + (f"\nCòn trống: {goi_y}" if goi_y else ""))
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể xác nhận: {e}")
     
@@ -208,30 +204,31 @@ class QuanLyLichHen(QWidget):
         if row is None:
             return
         
-        lh_id = self.table.item(row, 0).data(Qt.UserRole)
-        ho_ten = self.table.item(row, 0).text()
-        ngay_gio_cu = self.table.item(row, 3).text()
-        bac_si = self.table.item(row, 4).text()
-        loai_kham = self.table.item(row, 5).text()
-        ghi_chu = self.table.item(row, 7).text()
+        lh_id = self.model.row_values(row)[0]
+        ho_ten = self._cell(row, 0)
+        ngay_gio_cu = self._cell(row, 3)
+        bac_si = self._cell(row, 4)
+        loai_kham = self._cell(row, 5)
+        ghi_chu = self._cell(row, 7)
         
         dialog = RescheduleDialog(self, ho_ten, ngay_gio_cu, bac_si, loai_kham, ghi_chu)
         if dialog.exec_():
             new_ngay_gio, new_bac_si, new_loai_kham, new_ghi_chu = dialog.get_data()
             try:
-                conn = get_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE lich_hen 
-                    SET ngay_gio = ?, bac_si = ?, loai_kham = ?, ghi_chu = ?
-                    WHERE id = ?
-                """, (new_ngay_gio, new_bac_si, new_loai_kham, new_ghi_chu, lh_id))
-                conn.commit()
-                conn.close()
-                
+                # Chuyển chỗ giữ sang khung giờ mới của bác sĩ (xem database.reschedule_appointment)
+                reschedule_appointment(lh_id, new_ngay_gio, bac_si=new_bac_si, loai_kham=new_loai_kham,
+                                       ghi_chu=new_ghi_chu)
+
                 QMessageBox.information(self, "Thành công", f"Đã rescheduling lịch hẹn cho {ho_ten}")
                 self.load_appointments()
                 self.data_saved.emit()
+            except SlotFullError as e:
+                goi_y = ", ".join(b for b, _ in e.goi_y[:3])
+                QMessageBox.warning(self, "Hết chỗ",
+                                    f"Bác sĩ {e.bac_si} đã kín lịch khung {e.bat_dau}."
+                                    + (f"\nCòn trống: {goi_y}" if goi_y else ""))
+            except ValueError as e:
+                QMessageBox.warning(self, "Giờ hẹn không hợp lệ", str(e))
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Không thể reschedule: {e}")
     
@@ -241,9 +238,9 @@ class QuanLyLichHen(QWidget):
         if row is None:
             return
         
-        lh_id = self.table.item(row, 0).data(Qt.UserRole)
-        ho_ten = self.table.item(row, 0).text()
-        trang_thai = self.table.item(row, 6).text()
+        lh_id = self.model.row_values(row)[0]
+        ho_ten = self._cell(row, 0)
+        trang_thai = self._cell(row, 6)
         
         if trang_thai == "đã hủy":
             QMessageBox.warning(self, "Thông báo", "Lịch hẹn này đã bị hủy rồi")
@@ -254,13 +251,8 @@ class QuanLyLichHen(QWidget):
                                      QMessageBox.Yes | QMessageBox.No)
         if reply == QMessageBox.Yes:
             try:
-                conn = get_connection()
-                cursor = conn.cursor()
-                cursor.execute("UPDATE lich_hen SET trang_thai = ? WHERE id = ?",
-                              ("đã hủy", lh_id))
-                conn.commit()
-                conn.close()
-                
+                set_appointment_status(lh_id, "đã hủy")
+
                 QMessageBox.information(self, "Thành công", f"Đã hủy lịch hẹn cho {ho_ten}")
                 self.load_appointments()
                 self.data_saved.emit()
@@ -273,13 +265,13 @@ class QuanLyLichHen(QWidget):
         if row is None:
             return
         
-        lh_id = self.table.item(row, 0).data(Qt.UserRole)
-        ho_ten = self.table.item(row, 0).text()
-        ngay_gio = self.table.item(row, 3).text()
-        bac_si = self.table.item(row, 4).text()
-        loai_kham = self.table.item(row, 5).text()
-        trang_thai = self.table.item(row, 6).text()
-        ghi_chu = self.table.item(row, 7).text()
+        lh_id = self.model.row_values(row)[0]
+        ho_ten = self._cell(row, 0)
+        ngay_gio = self._cell(row, 3)
+        bac_si = self._cell(row, 4)
+        loai_kham = self._cell(row, 5)
+        trang_thai = self._cell(row, 6)
+        ghi_chu = self._cell(row, 7)
         
         # Lấy thông tin người đặt từ database
         try:
@@ -5,7 +5,9 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt, pyqtSignal
 from database import get_connection
+from ref_cache import reference_cache
 from app_signals import app_signals
+from forms.page_cache import connect_global
 
 
 class QuanLyNhanSu(QWidget):
@@ -80,12 +82,20 @@ class QuanLyNhanSu(QWidget):
         layout.addWidget(self.table)
         # Lắng nghe signal toàn cục `user_created` để làm mới danh sách khi tài khoản được tạo
         try:
-            app_signals.user_created.connect(lambda u, r, f: self.load_staff())
-            # Ngoài ra lắng nghe các thay đổi dữ liệu chung (xóa/sửa tài khoản)
-            app_signals.data_changed.connect(self.load_staff)
+            # Ghi lại kết nối để PageCache ngắt khi huỷ trang
+            connect_global(self, app_signals.user_created, self.on_user_created)
+            # Ngoài ra lắng nghe thay đổi tài khoản / nhân sự (xóa/sửa tài khoản), đã gộp theo đợt
+            connect_global(self, app_signals.changes, self.on_data_changes)
         except Exception:
             pass
     
+    def on_data_changes(self, changes):
+        if changes.touches('users', 'nhan_su'):
+            self.load_staff()
+
+    def on_user_created(self, username, role, full_name):
+        self.load_staff()
+
     def load_staff(self):
         """Tải danh sách nhân sự từ bảng users trong database."""
         self.table.setRowCount(0)
@@ -162,6 +172,7 @@ class QuanLyNhanSu(QWidget):
                           (ten, chuc_vu, phong_kham))
             conn.commit()
             conn.close()
+            reference_cache.invalidate('nhan_su')
 
             QMessageBox.information(self, "Thành công", f"Đã thêm nhân viên {ten}")
             self.load_staff()
@@ -178,6 +189,7 @@ class QuanLyNhanSu(QWidget):
                           (ten, chuc_vu, phong_kham, ns_id))
             conn.commit()
             conn.close()
+            reference_cache.invalidate('nhan_su')
 
             QMessageBox.information(self, "Thành công", f"Đã cập nhật nhân viên {ten}")
             self.load_staff()
@@ -206,6 +218,7 @@ class QuanLyNhanSu(QWidget):
                 cursor.execute("DELETE FROM nhan_su WHERE id = ?", (ns_id,))
                 conn.commit()
                 conn.close()
+                reference_cache.invalidate('nhan_su')
 
                 QMessageBox.information(self, "Thành công", f"Đã xóa nhân viên {ten}")
                 self.load_staff()
@@ -226,7 +226,7 @@ class QuanLyTaiKhoan(QWidget):
             self.load_accounts()
             self.account_created.emit()
             try:
-                app_signals.data_changed.emit()
+                app_signals.post('users')
             except Exception:
                 pass
             
@@ -477,7 +477,7 @@ class QuanLyTaiKhoan(QWidget):
                 dialog.accept()
                 self.load_accounts()
                 try:
-                    app_signals.data_changed.emit()
+                    app_signals.post('users')
                 except Exception:
                     pass
             except Exception as e:
@@ -549,7 +549,7 @@ class QuanLyTaiKhoan(QWidget):
 
             self.load_accounts()
             try:
-                app_signals.data_changed.emit()
+                app_signals.post('users')
             except Exception:
                 pass
         
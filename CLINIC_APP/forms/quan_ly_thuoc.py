@@ -1,11 +1,36 @@
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton,
     QTableWidget, QTableWidgetItem, QMessageBox, QComboBox, QDialog, QFormLayout,
-    QHeaderView, QSizePolicy, QTabWidget, QTextEdit, QCompleter, QDateEdit
+    QHeaderView, QSizePolicy, QTabWidget, QTextEdit, QCompleter, QDateEdit,
+    QTableView, QAbstractItemView
 )
-from PyQt5.QtCore import Qt, QDateTime, QTimer, QDate, pyqtSignal
+from PyQt5.QtCore import Qt, QDateTime, QDate, pyqtSignal
 from app_signals import app_signals
-from database import get_connection
+from forms.page_cache import connect_global
+from database import get_connection, get_data_version, get_revenue_summary, pool
+from database import import_stock, update_drug, delete_drug, correct_import, delete_import
+from db_executor import executor
+from forms.lazy_table import LazySqlTableModel, ButtonDelegate
+from forms.drug_catalog_model import shared_drug_model, sync_drug_catalog_async, format_price, COL_MA
+from drug_catalog import drug_catalog
+
+
+# --- Các hàm đọc dữ liệu chạy trên worker thread (qua db_executor), không đụng tới widget ---
+def _fetch_import_history():
+    with pool.read() as conn:
+        # Lấy giá từ danh_muc_thuoc nếu có
+        return conn.execute("""
+            SELECT n.ngay, n.ma_thuoc, n.ten_thuoc, n.don_vi, COALESCE(d.gia_thuoc, 0) as gia_thuoc, n.so_luong_nhap
+            FROM nhap_thuoc n
+            LEFT JOIN danh_muc_thuoc d ON n.ma_thuoc = d.ma_thuoc
+            ORDER BY n.ngay DESC LIMIT 500
+        """).fetchall()
+
+
+def _fetch_summary(date_from, date_to):
+    # Đọc phiên bản trước dữ liệu: thay đổi xen giữa sẽ được lần kiểm tra sau nhận ra
+    version = get_data_version('doanh_thu')
+    return version, get_revenue_summary(date_from, date_to)
 
 
 class QuanLyThuoc(QWidget):
@@ -23,24 +48,12 @@ class QuanLyThuoc(QWidget):
         self.load_summary()
         self.load_detail_services()
         
-        # Timer tự động cập nhật mỗi 5 giây để cập nhật doanh thu ngay khi có dữ liệu mới
-        self.auto_update_timer = QTimer()
-        self.auto_update_timer.timeout.connect(self.auto_refresh_summary)
-        self.auto_update_timer.start(5000)  # 5 giây = 5000ms
-
-        # Kết nối global app signals để cập nhật khi có thay đổi từ các form khác
-        try:
-            # Lắng nghe data_changed để cập nhật doanh thu dịch vụ
-            app_signals.data_changed.connect(self.on_data_updated_service)
-            print("✓ QuanLyThuoc kết nối data_changed signal (dịch vụ)")
-        except Exception as e:
-            print(f"✗ Lỗi kết nối data_changed: {e}")
-        try:
-            # Lắng nghe medication_dispensed để cập nhật doanh thu thuốc
-            app_signals.medication_dispensed.connect(self.on_medication_dispensed)
-            print("✓ QuanLyThuoc kết nối medication_dispensed signal (thuốc)")
-        except Exception as e:
-            print(f"✗ Lỗi kết nối medication_dispensed: {e}")
+        # Thay đổi từ các form khác và từ tiến trình khác (change_log, forms/live_updates.py),
+        # đã gộp theo đợt, kèm bảng/id dòng: chỉ cập nhật phần bị ảnh hưởng
+        self._detail_dirty = False
+        connect_global(self, app_signals.changes, self.on_data_changes)
+        # Danh mục thuốc đổi ở màn hình khác (kê đơn, xuất thuốc, máy khác) -> điền lại bảng thuốc
+        connect_global(self, app_signals.drug_catalog_changed, self.on_drug_catalog_changed)
 
     def init_db(self):
         conn = get_connection()
@@ -335,10 +348,22 @@ class QuanLyThuoc(QWidget):
         filter_controls.addStretch()
 
         tab3_layout.addLayout(filter_controls)
-        self.table_detail = QTableWidget(0, 7)
-        self.table_detail.setHorizontalHeaderLabels(["Ngày", "Bệnh nhân", "Loại", "Nội dung", "Số lượng", "Tổng tiền", "Xem chi tiết"])
-        self.table_detail.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.table_detail.setSelectionBehavior(QTableWidget.SelectRows)
+        # row: (ngay, ho_ten, loai, noi_dung, so_luong, thanh_tien, ids) — xem load_detail_services
+        self.model_detail = LazySqlTableModel([
+            ("Ngày", 0), ("Bệnh nhân", 1), ("Loại", 2), ("Nội dung", 3),
+            ("Số lượng", 4, lambda v: str(v or 0), Qt.AlignCenter),
+            ("Tổng tiền", 5, lambda v: f"{(v or 0):,.0f}".replace(',', '.'), Qt.AlignRight | Qt.AlignVCenter),
+            ("Xem chi tiết", None),
+        ])
+        self.table_detail = QTableView()
+        self.table_detail.setModel(self.model_detail)
+        self.table_detail.verticalHeader().setVisible(False)
+        self.table_detail.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table_detail.setSelectionBehavior(QAbstractItemView.SelectRows)
+        # Nút xem chi tiết vẽ bởi delegate — truyền ids (có thể nhiều id, phân tách bởi dấu phẩy) và tổng tiền
+        self.detail_button = ButtonDelegate("Xem chi tiết", self.table_detail)
+        self.detail_button.clicked.connect(self._on_detail_button)
+        self.table_detail.setItemDelegateForColumn(6, self.detail_button)
         self.table_detail.setMinimumHeight(400)
         self.table_detail.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         
@@ -407,17 +432,26 @@ class QuanLyThuoc(QWidget):
 
     # --- Drugs CRUD ---
     def load_drugs(self):
-        """Tải danh mục thuốc từ cơ sở dữ liệu."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho FROM danh_muc_thuoc ORDER BY ma_thuoc")
-            rows = cur.fetchall()
-        except Exception:
-            rows = []
-        finally:
-            conn.close()
-
+        """Tải danh mục thuốc qua bộ đệm dùng chung (đọc lại DB trên worker thread chỉ khi phiên bản đổi)."""
+        # Danh mục đổi -> drug_catalog_changed đã điền bảng; không đổi -> tự điền từ bộ đệm
+        sync_drug_catalog_async(owner=self,
+                                on_done=lambda changed: changed or self._fill_drugs(drug_catalog.all()))
+
+    def on_drug_catalog_changed(self):
+        self._fill_drugs(drug_catalog.all())
+
+    def _fill_drugs(self, rows):
+        if self.table_drugs.rowCount() == len(rows) and all(
+                (self.table_drugs.item(i, 0) and self.table_drugs.item(i, 0).text()) == (r[0] or "")
+                for i, r in enumerate(rows)):
+            # Cùng danh sách thuốc (thường chỉ đổi tồn kho/giá sau khi xuất/nhập): chỉ sửa ô khác đi
+            for i, r in enumerate(rows):
+                for col, text in ((1, r[1] or ""), (2, r[2] or ""), (3, format_price(r[3] or 0)), (4, str(r[4] or 0))):
+                    it = self.table_drugs.item(i, col)
+                    if it is not None and it.text() != text:
+                        it.setText(text)
+            self.calculate_total_inventory_value()
+            return
         self.table_drugs.setRowCount(0)
         for r in rows:
             row = self.table_drugs.rowCount()
@@ -426,9 +460,7 @@ class QuanLyThuoc(QWidget):
             self.table_drugs.setItem(row, 1, QTableWidgetItem(r[1] or ""))
             self.table_drugs.setItem(row, 2, QTableWidgetItem(r[2] or ""))
             # Hiển thị giá với định dạng tiền tệ (dấu chấm là phân tách hàng nghìn)
-            gia = r[3] or 0
-            gia_str = f"{gia:,.0f}".replace(',', '.') if gia else "0"
-            gia_item = QTableWidgetItem(gia_str)
+            gia_item = QTableWidgetItem(format_price(r[3] or 0))
             gia_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             self.table_drugs.setItem(row, 3, gia_item)
             self.table_drugs.setItem(row, 4, QTableWidgetItem(str(r[4] or 0)))
@@ -439,23 +471,12 @@ class QuanLyThuoc(QWidget):
         self.calculate_total_inventory_value()
 
     def load_import_drugs_history(self):
-        """Tải lịch sử nhập thuốc từ bảng nhap_thuoc."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Try to get the price from danh_muc_thuoc if available
-            cur.execute("""
-                SELECT n.ngay, n.ma_thuoc, n.ten_thuoc, n.don_vi, COALESCE(d.gia_thuoc, 0) as gia_thuoc, n.so_luong_nhap
-                FROM nhap_thuoc n
-                LEFT JOIN danh_muc_thuoc d ON n.ma_thuoc = d.ma_thuoc
-                ORDER BY n.ngay DESC LIMIT 500
-            """)
-            rows = cur.fetchall()
-        except Exception:
-            rows = []
-        finally:
-            conn.close()
+        """Tải lịch sử nhập thuốc từ bảng nhap_thuoc (truy vấn chạy nền)."""
+        executor.submit(_fetch_import_history, key='quan_ly_thuoc.import_history', owner=self,
+                        on_result=self._fill_import_drugs_history,
+                        on_error=lambda e: self._fill_import_drugs_history([]))
 
+    def _fill_import_drugs_history(self, rows):
         self.table_import_drugs.setRowCount(0)
         for r in rows:
             row = self.table_import_drugs.rowCount()
@@ -497,12 +518,12 @@ class QuanLyThuoc(QWidget):
 
         if dlg.exec_():
             ma, ten, don_vi, gia, ton_kho = dlg.values()
-            conn = get_connection()
-            cur = conn.cursor()
             try:
                 # Kiểm tra mã thuốc đã tồn tại chưa
-                cur.execute("SELECT COUNT(*) FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma,))
-                exists = cur.fetchone()[0] > 0
+                with pool.read() as conn:
+                    cur = conn.cursor()
+                    cur.execute("SELECT COUNT(*) FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma,))
+                    exists = cur.fetchone()[0] > 0
 
                 if exists:
                     # Hỏi người dùng có muốn cập nhật bản ghi hiện có hay không
@@ -511,56 +532,22 @@ class QuanLyThuoc(QWidget):
                                                  QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
                     if reply == QMessageBox.Yes:
                         try:
-                            # Lấy tồn kho hiện tại
-                            cur.execute("SELECT ton_kho FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma,))
-                            row = cur.fetchone()
-                            ton_hien_tai = int(row[0] or 0) if row else 0
-
-                            # Số lượng trong dialog được hiểu là số lượng nhập mới (không phải tổng)
-                            so_nhap = int(ton_kho or 0)
-                            ton_moi = ton_hien_tai + so_nhap
-
-                            # Cập nhật thông tin (cập nhật giá nếu khác, và cộng tồn kho)
-                            cur.execute("UPDATE danh_muc_thuoc SET ten_thuoc = ?, don_vi = ?, gia_thuoc = ?, ton_kho = ? WHERE ma_thuoc = ?",
-                                        (ten, don_vi, gia, ton_moi, ma))
-                            conn.commit()
-
-                            # Nếu có nhập số lượng >0, ghi vào lịch sử nhập
-                            try:
-                                if so_nhap and so_nhap > 0:
-                                    ngay = QDateTime.currentDateTime().toString("yyyy-MM-dd HH:mm:ss")
-                                    cur.execute("INSERT INTO nhap_thuoc (ngay, ma_thuoc, ten_thuoc, don_vi, so_luong_nhap) VALUES (?, ?, ?, ?, ?)",
-                                                (ngay, ma, ten, don_vi, so_nhap))
-                                    conn.commit()
-                            except Exception:
-                                pass
-
+                            # Số lượng trong dialog được hiểu là số lượng nhập mới (không phải tổng);
+                            # cập nhật thông tin + ghi lần nhập vào nhap_thuoc và sổ kho trong một transaction
+                            so_nhap = max(int(ton_kho or 0), 0)
+                            ton_moi = import_stock(ma, ten, don_vi, so_nhap, gia=gia)
+                            ton_hien_tai = ton_moi - so_nhap
                             QMessageBox.information(self, "Thành công", f"Đã cập nhật thuốc. Tồn kho: {ton_hien_tai} + {so_nhap} = {ton_moi}.")
                         except Exception as e:
                             QMessageBox.critical(self, "Lỗi", f"Không thể cập nhật thuốc: {e}")
                     else:
                         QMessageBox.information(self, "Bỏ qua", "Không thêm hoặc cập nhật thuốc.")
                 else:
-                    # Thêm mới
-                    cur.execute("INSERT INTO danh_muc_thuoc (ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho) VALUES (?, ?, ?, ?, ?)",
-                                (ma, ten, don_vi, gia, ton_kho))
-                    conn.commit()
-                    # Nếu có tồn kho ban đầu, ghi lại vào lịch sử nhập thuốc để hiển thị ngay
-                    try:
-                        if ton_kho and ton_kho > 0:
-                            ngay = QDateTime.currentDateTime().toString("yyyy-MM-dd HH:mm:ss")
-                            cur.execute("INSERT INTO nhap_thuoc (ngay, ma_thuoc, ten_thuoc, don_vi, so_luong_nhap) VALUES (?, ?, ?, ?, ?)",
-                                        (ngay, ma, ten, don_vi, ton_kho))
-                            conn.commit()
-                    except Exception:
-                        # Nếu bảng nhap_thuoc chưa tồn tại hoặc lỗi, không làm crash
-                        pass
-
+                    # Thêm mới; tồn kho ban đầu được ghi thành một lần nhập (lịch sử nhập + sổ kho)
+                    import_stock(ma, ten, don_vi, ton_kho, gia=gia)
                     QMessageBox.information(self, "Thành công", "Đã thêm thuốc vào danh mục.")
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Không thể thêm thuốc: {e}")
-            finally:
-                conn.close()
             # Reload both danh mục và lịch sử nhập để hiển thị ngay
             self.load_drugs()
             self.load_import_drugs_history()
@@ -598,33 +585,9 @@ class QuanLyThuoc(QWidget):
             return
         
         ngay = QDateTime.currentDateTime().toString("yyyy-MM-dd HH:mm:ss")
-        conn = get_connection()
-        cur = conn.cursor()
         try:
-            # Kiểm tra xem mã thuốc đã tồn tại hay chưa
-            cur.execute("SELECT ton_kho FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma,))
-            result = cur.fetchone()
-            
-            if result:
-                # Nếu tồn tại, lấy tồn kho hiện tại
-                ton_kho_hien_tai = result[0] or 0
-            else:
-                # Nếu không tồn tại, thêm vào danh mục
-                cur.execute("INSERT INTO danh_muc_thuoc (ma_thuoc, ten_thuoc, don_vi, gia_thuoc, ton_kho) VALUES (?, ?, ?, ?, ?)",
-                            (ma, ten, don_vi, gia, so_luong))
-                ton_kho_hien_tai = 0
-            
-            # Lưu lịch sử nhập vào bảng nhap_thuoc
-            cur.execute("INSERT INTO nhap_thuoc (ngay, ma_thuoc, ten_thuoc, don_vi, so_luong_nhap) VALUES (?, ?, ?, ?, ?)",
-                        (ngay, ma, ten, don_vi, so_luong))
-            
-            # Cập nhật tồn kho và giá trong danh_muc_thuoc
-            if result:  # Chỉ cập nhật nếu đã tồn tại
-                ton_kho_moi = ton_kho_hien_tai + so_luong
-                cur.execute("UPDATE danh_muc_thuoc SET ton_kho = ?, gia_thuoc = ? WHERE ma_thuoc = ?", 
-                            (ton_kho_moi, gia, ma))
-            
-            conn.commit()
+            # Thêm vào danh mục nếu chưa có, lưu lịch sử nhập, cộng tồn kho qua sổ kho
+            import_stock(ma, ten, don_vi, so_luong, gia=gia, ngay=ngay)
             # Hiển thị giá trong thông báo với dấu chấm
             try:
                 gia_msg = f"{gia:,.0f}".replace(',', '.')
@@ -646,8 +609,6 @@ class QuanLyThuoc(QWidget):
 
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể ghi nhận nhập: {e}")
-        finally:
-            conn.close()
 
     def on_edit_drug(self):
         sel = self.table_drugs.currentRow()
@@ -687,17 +648,12 @@ class QuanLyThuoc(QWidget):
         dlg = DrugDialog(parent=self, ma=ma, ten=ten, don_vi=don_vi, ton_kho=ton_kho, gia=gia, editing=True)
         if dlg.exec_():
             new_ma, new_ten, new_don_vi, new_gia, new_ton = dlg.values()
-            conn = get_connection()
-            cur = conn.cursor()
             try:
-                cur.execute("UPDATE danh_muc_thuoc SET ma_thuoc=?, ten_thuoc=?, don_vi=?, gia_thuoc=?, ton_kho=? WHERE ma_thuoc=?",
-                            (new_ma, new_ten, new_don_vi, new_gia, new_ton, ma))
-                conn.commit()
+                # Tồn kho sửa tay được ghi thành dòng điều chỉnh trên sổ kho
+                update_drug(ma, new_ma, new_ten, new_don_vi, new_gia, new_ton)
                 QMessageBox.information(self, "Thành công", "Đã cập nhật thuốc.")
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Không thể cập nhật thuốc: {e}")
-            finally:
-                conn.close()
             self.load_drugs()
 
     def on_delete_drug(self):
@@ -709,16 +665,11 @@ class QuanLyThuoc(QWidget):
         ma = it.text() if it else ""
         reply = QMessageBox.question(self, "Xác nhận", f"Bạn có chắc muốn xóa thuốc {ma}?", QMessageBox.Yes | QMessageBox.No)
         if reply == QMessageBox.Yes:
-            conn = get_connection()
-            cur = conn.cursor()
             try:
-                cur.execute("DELETE FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma,))
-                conn.commit()
+                delete_drug(ma)
                 QMessageBox.information(self, "Thành công", "Đã xóa thuốc.")
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Không thể xóa thuốc: {e}")
-            finally:
-                conn.close()
             self.load_drugs()
 
     def on_edit_import(self):
@@ -774,28 +725,16 @@ class QuanLyThuoc(QWidget):
                 QMessageBox.warning(dialog, "Lỗi", "Số lượng phải lớn hơn 0.")
                 return
             
-            conn = get_connection()
-            cur = conn.cursor()
             try:
-                # Cập nhật lịch sử nhập
-                cur.execute("UPDATE nhap_thuoc SET ma_thuoc = ?, ten_thuoc = ?, don_vi = ?, so_luong_nhap = ? WHERE ngay = ? AND ma_thuoc = ?",
-                            (edit_ma.text().strip(), edit_ten.text().strip(), edit_don_vi.text().strip(), so_luong_moi, ngay, ma))
-                
-                # Cập nhật lại tồn kho nếu số lượng thay đổi
-                if so_luong_moi != so_luong_cu:
-                    so_luong_khac = so_luong_moi - so_luong_cu
-                    cur.execute("UPDATE danh_muc_thuoc SET ton_kho = ton_kho + ? WHERE ma_thuoc = ?",
-                                (so_luong_khac, edit_ma.text().strip()))
-                
-                conn.commit()
+                # Cập nhật lịch sử nhập; chênh lệch số lượng được ghi thành dòng điều chỉnh trên sổ kho
+                correct_import(ngay, ma, so_luong_cu, edit_ma.text().strip(), edit_ten.text().strip(),
+                               edit_don_vi.text().strip(), so_luong_moi)
                 QMessageBox.information(dialog, "Thành công", "Đã cập nhật lịch sử nhập.")
                 dialog.accept()
                 self.load_import_drugs_history()
                 self.load_drugs()
             except Exception as e:
                 QMessageBox.critical(dialog, "Lỗi", f"Không thể cập nhật: {e}")
-            finally:
-                conn.close()
         
         btn_ok.clicked.connect(on_save)
         btn_cancel.clicked.connect(dialog.reject)
@@ -825,24 +764,14 @@ class QuanLyThuoc(QWidget):
         if reply == QMessageBox.No:
             return
         
-        conn = get_connection()
-        cur = conn.cursor()
         try:
-            # Xóa lịch sử nhập
-            cur.execute("DELETE FROM nhap_thuoc WHERE ngay = ? AND ma_thuoc = ?", (ngay, ma))
-            
-            # Cập nhật lại tồn kho (trừ đi số lượng đã nhập)
-            cur.execute("UPDATE danh_muc_thuoc SET ton_kho = ton_kho - ? WHERE ma_thuoc = ?", 
-                        (so_luong, ma))
-            
-            conn.commit()
+            # Xóa lịch sử nhập và trừ lại số lượng đã nhập (dòng điều chỉnh trên sổ kho)
+            delete_import(ngay, ma, so_luong)
             QMessageBox.information(self, "Thành công", "Đã xóa lịch sử nhập.")
             self.load_import_drugs_history()
             self.load_drugs()
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể xóa: {e}")
-        finally:
-            conn.close()
 
     def open_import_detail(self, record):
         """Open a dialog that shows detailed information for a given import record.
@@ -900,90 +829,149 @@ class QuanLyThuoc(QWidget):
         dlg.exec_()
 
     # --- Tổng hợp doanh thu ---
-    def load_summary(self):
-        """Tải và hiển thị tổng hợp doanh thu theo ngày."""
-        conn = get_connection()
-        cur = conn.cursor()
+    def _summary_range(self):
+        """Khoảng ngày đang lọc trên tab tổng hợp (None, None nếu chưa có bộ lọc)."""
         try:
-            # Build query optionally with date filter
-            base_sql = """
-                SELECT 
-                    DATE(ngay) as ngay,
-                    SUM(CASE WHEN loai = 'Dịch vụ' THEN so_tien ELSE 0 END) as doanh_thu_dv,
-                    SUM(CASE WHEN loai = 'Thuốc' THEN so_tien ELSE 0 END) as doanh_thu_thuoc,
-                    SUM(so_tien) as tong_tien
-                FROM thanh_toan
-            """
-            params = []
-            # If summary_date_from/summary_date_to controls exist, use them
-            try:
-                date_from = self.summary_date_from.date().toString("yyyy-MM-dd")
-                date_to = self.summary_date_to.date().toString("yyyy-MM-dd")
-                if date_from and date_to:
-                    base_sql += " WHERE DATE(ngay) BETWEEN ? AND ?"
-                    params.extend([date_from, date_to])
-            except Exception:
-                pass
+            date_from = self.summary_date_from.date().toString("yyyy-MM-dd")
+            date_to = self.summary_date_to.date().toString("yyyy-MM-dd")
+            if date_from and date_to:
+                return date_from, date_to
+        except Exception:
+            pass
+        return None, None
 
-            base_sql += " GROUP BY DATE(ngay) ORDER BY ngay DESC"
-            cur.execute(base_sql, params)
-            rows = cur.fetchall()
-        except Exception as e:
-            QMessageBox.warning(self, "Lỗi", f"Không thể tải tổng hợp: {e}")
-            rows = []
-        finally:
-            conn.close()
+    def load_summary(self):
+        """Tải và hiển thị tổng hợp doanh thu theo ngày (đọc từ bảng tổng hợp doanh_thu_ngay).
 
+        Truy vấn chạy nền; đổi khoảng ngày khi lần tải trước chưa xong sẽ huỷ lần tải cũ.
+        """
+        executor.submit(_fetch_summary, *self._summary_range(), key='quan_ly_thuoc.summary', owner=self,
+                        on_result=lambda res: self._fill_summary(*res),
+                        on_error=self._on_summary_error)
+
+    def _on_summary_error(self, e):
+        QMessageBox.warning(self, "Lỗi", f"Không thể tải tổng hợp: {e}")
+        self._fill_summary(getattr(self, '_revenue_version', None), [])
+
+    def _fill_summary(self, version, rows):
+        self._revenue_version = version
         # Cập nhật bảng tổng hợp
+        sorting = self.table_summary.isSortingEnabled()
+        self.table_summary.setSortingEnabled(False)
         self.table_summary.setRowCount(0)
-        total_all = 0
+        self._summary_totals = {}
         for r in rows:
-            ngay = r[0] or ""
-            doanh_thu_dv = r[1] or 0
-            doanh_thu_thuoc = r[2] or 0
-            tong_tien = r[3] or 0
-            
-            total_all += tong_tien
-            
-            row = self.table_summary.rowCount()
+            self._set_summary_row(self.table_summary.rowCount(), r, insert=True)
+        self.table_summary.setSortingEnabled(sorting)
+        self._update_summary_total()
+
+    def _set_summary_row(self, row, r, insert=False):
+        """Ghi một dòng (ngay, dich_vu, thuoc, tong, ...) vào bảng tổng hợp."""
+        ngay = r[0] or ""
+        doanh_thu_dv = r[1] or 0
+        doanh_thu_thuoc = r[2] or 0
+        self._summary_totals[ngay] = r[3] or 0
+        if insert:
             self.table_summary.insertRow(row)
-            self.table_summary.setItem(row, 0, QTableWidgetItem(ngay))
-            # Format with dot as thousands separator
-            dv_str = f"{doanh_thu_dv:,.0f}".replace(',', '.')
-            th_str = f"{doanh_thu_thuoc:,.0f}".replace(',', '.')
-            self.table_summary.setItem(row, 1, QTableWidgetItem(dv_str))
-            item_thuoc = QTableWidgetItem(th_str)
-            item_thuoc.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-            self.table_summary.setItem(row, 2, item_thuoc)
-        
-        # Cập nhật tổng tiền
+        self.table_summary.setItem(row, 0, QTableWidgetItem(ngay))
+        # Format with dot as thousands separator
+        dv_str = f"{doanh_thu_dv:,.0f}".replace(',', '.')
+        th_str = f"{doanh_thu_thuoc:,.0f}".replace(',', '.')
+        self.table_summary.setItem(row, 1, QTableWidgetItem(dv_str))
+        item_thuoc = QTableWidgetItem(th_str)
+        item_thuoc.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        self.table_summary.setItem(row, 2, item_thuoc)
+
+    def _update_summary_total(self):
+        total_all = sum(self._summary_totals.values())
         total_str = f"Tổng doanh thu: {total_all:,.0f} VNĐ".replace(',', '.')
         self.lbl_total.setText(total_str)
-    
-    def auto_refresh_summary(self):
-        """Hàm được gọi bởi timer để tự động cập nhật tổng hợp."""
-        self.load_summary()
-    
-    def on_data_updated_service(self):
-        """Cập nhật khi dữ liệu dịch vụ thay đổi (từ data_changed signal)."""
-        print("📊 on_data_updated_service được gọi - đang tải lại dữ liệu dịch vụ...")
-        try:
+
+    def refresh_summary_changes(self):
+        """Chỉ cập nhật các ngày có doanh thu thay đổi kể từ lần tải trước.
+
+        Trả về True nếu có thay đổi. Khi không có gì mới, chỉ tốn một lần đọc bộ đếm phiên bản.
+        """
+        last = getattr(self, '_revenue_version', None)
+        if last is None:
             self.load_summary()
-            self.load_detail_services()
-            self.calculate_total_inventory_value()
-            print("✓ Dữ liệu dịch vụ đã được cập nhật")
+            return True
+        try:
+            current = get_data_version('doanh_thu')
+            if current == last:
+                return False
+            changed = get_revenue_summary(*self._summary_range(), since_version=last)
         except Exception as e:
-            print(f"✗ Lỗi khi cập nhật dữ liệu dịch vụ: {e}")
+            print(f"✗ Lỗi khi kiểm tra thay đổi doanh thu: {e}")
+            return False
+        self._revenue_version = current
+        if not changed:
+            return False
+
+        # Vị trí hiện tại của từng ngày trong bảng (người dùng có thể đã sắp xếp lại)
+        positions = {}
+        for row in range(self.table_summary.rowCount()):
+            it = self.table_summary.item(row, 0)
+            if it:
+                positions[it.text()] = row
+        sorting = self.table_summary.isSortingEnabled()
+        self.table_summary.setSortingEnabled(False)
+        for r in changed:
+            ngay = r[0] or ""
+            if not r[4]:
+                # Ngày không còn giao dịch nào (bản ghi thanh toán đã bị xoá)
+                if ngay in positions:
+                    row = positions.pop(ngay)
+                    self.table_summary.removeRow(row)
+                    positions = {k: (v - 1 if v > row else v) for k, v in positions.items()}
+                self._summary_totals.pop(ngay, None)
+                continue
+            if ngay in positions:
+                self._set_summary_row(positions[ngay], r)
+            else:
+                # Ngày mới: chèn đúng vị trí theo thứ tự ngày giảm dần
+                row = 0
+                while row < self.table_summary.rowCount():
+                    it = self.table_summary.item(row, 0)
+                    if it and it.text() < ngay:
+                        break
+                    row += 1
+                self._set_summary_row(row, r, insert=True)
+                positions = {k: (v + 1 if v >= row else v) for k, v in positions.items()}
+                positions[ngay] = row
+        self.table_summary.setSortingEnabled(sorting)
+        self._update_summary_total()
+        return True
+
+    def showEvent(self, event):
+        # Bắt kịp các thay đổi đã bỏ qua trong lúc màn hình bị ẩn
+        super().showEvent(event)
+        try:
+            self.refresh_summary_changes()
+            if self._detail_dirty:
+                self._detail_dirty = False
+                self.model_detail.refresh_loaded()
+        except Exception:
+            pass
 
-    def on_medication_dispensed(self):
-        """Cập nhật doanh thu thuốc khi xuất thuốc thành công (từ medication_dispensed signal)."""
-        print("💊 on_medication_dispensed được gọi - đang tải lại tổng hợp doanh thu và danh mục thuốc...")
+    def on_data_changes(self, changes):
+        """Cập nhật theo app_signals.changes thay vì tải lại toàn bộ sau mỗi lần lưu.
+
+        - Doanh thu: chỉ các ngày có thay đổi (refresh_summary_changes)
+        - Chi tiết dịch vụ/thuốc: đọc lại các dòng đang hiển thị, chỉ vẽ lại dòng khác đi
+        - Bảng thuốc: drug_catalog_model phát drug_catalog_changed khi danh mục/tồn kho đổi
+        Màn hình đang ẩn chỉ ghi nhận; showEvent bắt kịp khi hiện lại.
+        """
+        if not changes.touches('thanh_toan', 'chi_dinh', 'don_thuoc', 'don_thuoc_bo_sung'):
+            return
+        if not self.isVisible():
+            self._detail_dirty = True
+            return
         try:
-            self.load_summary()
-            self.load_drugs()
-            print("✓ Doanh thu thuốc và danh mục thuốc đã được cập nhật")
+            self.refresh_summary_changes()
+            self.model_detail.refresh_loaded()
         except Exception as e:
-            print(f"✗ Lỗi khi cập nhật doanh thu thuốc: {e}")
+            print(f"✗ Lỗi khi cập nhật doanh thu / chi tiết: {e}")
 
     # --- Summary filters / helpers ---
     def filter_summary_apply(self):
@@ -1070,12 +1058,26 @@ class QuanLyThuoc(QWidget):
     
     # --- Chi tiết dịch vụ và thuốc ---
     def load_detail_services(self):
-        """Tải chi tiết dịch vụ và thuốc từ các bệnh nhân."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Lấy và gộp dữ liệu dịch vụ: nhóm theo ngày, bệnh nhân, tên dịch vụ
-            cur.execute("""
+        """Tải chi tiết dịch vụ và thuốc từ các bệnh nhân (chưa áp bộ lọc)."""
+        self._query_detail_services()
+
+    def _query_detail_services(self, search_text="", sel_type="Tất cả", date_from=None, date_to=None):
+        """Đặt truy vấn cho bảng chi tiết; lọc thực hiện trong SQL và dữ liệu được đọc dần theo trang."""
+        if getattr(self, '_don_thuoc_has_xuat_thuoc', None) is None:
+            # Kiểm tra một lần xem bảng don_thuoc có cột xuat_thuoc không
+            conn = get_connection()
+            try:
+                cols = [c[1] for c in conn.execute("PRAGMA table_info('don_thuoc')").fetchall()]
+            finally:
+                conn.close()
+            self._don_thuoc_has_xuat_thuoc = 'xuat_thuoc' in cols
+        # Chỉ lấy thuốc đã xuất nếu cột xuat_thuoc tồn tại
+        where_clause = "WHERE dt.xuat_thuoc = 1" if self._don_thuoc_has_xuat_thuoc else ""
+
+        # Dịch vụ: nhóm theo ngày, bệnh nhân, tên dịch vụ.
+        # Thuốc: nhóm theo ngày, bệnh nhân; tổng tiền tính từ danh_muc_thuoc.gia_thuoc * so_luong
+        sql = f"""
+            SELECT * FROM (
                 SELECT
                     DATE(pk.ngay_lap) as ngay,
                     bn.ho_ten,
@@ -1088,21 +1090,7 @@ class QuanLyThuoc(QWidget):
                 JOIN phieu_kham pk ON cd.phieu_kham_id = pk.id
                 JOIN benh_nhan bn ON pk.benh_nhan_id = bn.id
                 GROUP BY DATE(pk.ngay_lap), bn.ho_ten, cd.ten_dich_vu
-                ORDER BY DATE(pk.ngay_lap) DESC
-            """)
-            dich_vu_rows = cur.fetchall()
-
-            # Kiểm tra xem bảng don_thuoc có cột xuat_thuoc không
-            cur.execute("PRAGMA table_info('don_thuoc')")
-            cols_info = cur.fetchall()
-            cols = [c[1] for c in cols_info]
-            has_xuat_thuoc = 'xuat_thuoc' in cols
-            
-            # Lấy và gộp dữ liệu thuốc: nhóm theo ngày, bệnh nhân, tổng danh sách thuốc và tổng tiền (tính từ danh_muc_thuoc.gia_thuoc * so_luong)
-            # Chỉ lấy thuốc đã xuất nếu cột xuat_thuoc tồn tại
-            where_clause = "WHERE dt.xuat_thuoc = 1" if has_xuat_thuoc else ""
-            
-            cur.execute(f"""
+                UNION ALL
                 SELECT
                     DATE(dt.ngay_ke) as ngay,
                     bn.ho_ten,
@@ -1118,61 +1106,39 @@ class QuanLyThuoc(QWidget):
                 LEFT JOIN danh_muc_thuoc dmh ON cdt.ma_thuoc = dmh.ma_thuoc
                 {where_clause}
                 GROUP BY DATE(dt.ngay_ke), bn.ho_ten
-                ORDER BY DATE(dt.ngay_ke) DESC
-            """)
-            thuoc_rows = cur.fetchall()
+            )
+        """
+        where, params = [], []
+        if date_from:
+            where.append("ngay >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("ngay <= ?")
+            params.append(date_to)
+        if sel_type and sel_type != "Tất cả":
+            where.append("loai = ?")
+            params.append(sel_type)
+        if search_text:
+            # Tìm trong bệnh nhân / loại / nội dung / tổng tiền (dạng hiển thị 1.234.000)
+            where.append("""(
+                instr(lower_unicode(ho_ten), ?) > 0 OR instr(lower_unicode(loai), ?) > 0
+                OR instr(lower_unicode(noi_dung), ?) > 0
+                OR instr(replace(printf('%,d', CAST(ROUND(COALESCE(thanh_tien, 0)) AS INTEGER)), ',', '.'), ?) > 0
+            )""")
+            params.extend([search_text] * 4)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Sắp xếp theo ngày giảm dần; các cột sau (ids là duy nhất mỗi dòng) để thứ tự giữa các trang cố định
+        sql += " ORDER BY ngay DESC, loai, ho_ten, ids"
+        try:
+            self.model_detail.set_query(sql, params)
         except Exception as e:
             QMessageBox.warning(self, "Lỗi", f"Không thể tải chi tiết: {e}")
-            dich_vu_rows = []
-            thuoc_rows = []
-        finally:
-            conn.close()
-        # Gộp tất cả vào 1 danh sách để hiển thị (dich_vu_rows và thuoc_rows đã là các hàng gộp)
-        all_rows = []
-        for r in dich_vu_rows:
-            # r: (ngay, ho_ten, loai, noi_dung, so_luong, thanh_tien, ids)
-            all_rows.append(r)
-        for r in thuoc_rows:
-            all_rows.append(r)
-
-        # Sắp xếp theo ngày giảm dần
-        all_rows.sort(key=lambda x: x[0] if x[0] else "", reverse=True)
-
-        # Cập nhật bảng
-        self.table_detail.setRowCount(0)
-        for row in all_rows:
-            ngay = row[0] or ""
-            benh_nhan = row[1] or ""
-            loai = row[2] or ""
-            noi_dung = row[3] or ""
-            so_luong = row[4] or 0
-            thanh_tien = row[5] or 0
-            ids = row[6] or ""
-
-            row_pos = self.table_detail.rowCount()
-            self.table_detail.insertRow(row_pos)
-
-            self.table_detail.setItem(row_pos, 0, QTableWidgetItem(ngay))
-            self.table_detail.setItem(row_pos, 1, QTableWidgetItem(benh_nhan))
-            self.table_detail.setItem(row_pos, 2, QTableWidgetItem(loai))
-            self.table_detail.setItem(row_pos, 3, QTableWidgetItem(noi_dung))
-            qty_item = QTableWidgetItem(str(so_luong))
-            qty_item.setTextAlignment(Qt.AlignCenter)
-            self.table_detail.setItem(row_pos, 4, qty_item)
-            total_item = QTableWidgetItem(f"{thanh_tien:,.0f}".replace(',', '.'))
-            total_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-            self.table_detail.setItem(row_pos, 5, total_item)
-
-            # Nút xem chi tiết — truyền ids (có thể là nhiều id, phân tách bởi dấu phẩy) và tổng tiền
-            btn_detail = QPushButton("Xem chi tiết")
-            btn_detail.setMaximumWidth(100)
-            # Safely capture the handler now to avoid AttributeError during connect/runtime
-            _show_fn = getattr(self, "show_detail_info", None)
-            if not callable(_show_fn):
-                def _show_fn(ids_str, lt, tt):
-                    QMessageBox.warning(self, "Lỗi", "Hàm xem chi tiết chưa khả dụng.")
-            btn_detail.clicked.connect(lambda checked, ids_str=ids, lt=loai, tt=thanh_tien, fn=_show_fn: fn(ids_str, lt, tt))
-            self.table_detail.setCellWidget(row_pos, 6, btn_detail)
+
+    def _on_detail_button(self, row):
+        values = self.model_detail.row_values(row)
+        if values:
+            self.show_detail_info(values[6] or "", values[2] or "", values[5] or 0)
     
     def show_detail_info(self, ids_str, loai, total_amount=0):
         """Hiển thị chi tiết của dịch vụ hoặc thuốc trong dialog.
@@ -1251,19 +1217,10 @@ class QuanLyThuoc(QWidget):
         if not hasattr(self, 'input_drug_code'):
             return
 
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT ma_thuoc FROM danh_muc_thuoc ORDER BY ma_thuoc")
-            drug_codes = [row[0] for row in cur.fetchall()]
-        except Exception:
-            drug_codes = []
-        finally:
-            conn.close()
-        
-        # Tạo completer cho input_drug_code
-        if drug_codes:
-            completer = QCompleter(drug_codes)
+        # Completer trên cột mã của model danh mục dùng chung: tạo một lần, tự cập nhật theo model
+        if self.input_drug_code.completer() is None:
+            completer = QCompleter(shared_drug_model(), self.input_drug_code)
+            completer.setCompletionColumn(COL_MA)
             completer.setCaseSensitivity(Qt.CaseInsensitive)
             self.input_drug_code.setCompleter(completer)
 
@@ -1276,22 +1233,14 @@ class QuanLyThuoc(QWidget):
         if not text.strip():
             return
         
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT ten_thuoc, don_vi, gia_thuoc FROM danh_muc_thuoc WHERE ma_thuoc = ?", (text.strip(),))
-            result = cur.fetchone()
-            if result:
-                self.input_drug_name.setText(result[0] or "")
-                self.input_drug_unit.setText(result[1] or "")
-                try:
-                    self.input_drug_price.setText(f"{result[2]:,.0f}".replace(',', '.'))
-                except Exception:
-                    self.input_drug_price.setText(str(result[2] or 0))
-        except Exception:
-            pass
-        finally:
-            conn.close()
+        drug = drug_catalog.get(text)
+        if drug:
+            self.input_drug_name.setText(drug.ten_thuoc or "")
+            self.input_drug_unit.setText(drug.don_vi or "")
+            try:
+                self.input_drug_price.setText(f"{drug.gia_thuoc:,.0f}".replace(',', '.'))
+            except Exception:
+                self.input_drug_price.setText(str(drug.gia_thuoc or 0))
 
     def filter_drugs_table(self, text):
         """Lọc bảng danh mục thuốc theo text tìm kiếm."""
@@ -1317,14 +1266,7 @@ class QuanLyThuoc(QWidget):
 
     def filter_detail_table(self, text):
         """Lọc bảng chi tiết (tab Chi tiết dịch vụ/thuốc)."""
-        search_text = text.lower()
-        for row in range(self.table_detail.rowCount()):
-            benh_nhan = self.table_detail.item(row, 1).text().lower() if self.table_detail.item(row, 1) else ""
-            loai = self.table_detail.item(row, 2).text().lower() if self.table_detail.item(row, 2) else ""
-            noi_dung = self.table_detail.item(row, 3).text().lower() if self.table_detail.item(row, 3) else ""
-            total = self.table_detail.item(row, 5).text().lower() if self.table_detail.item(row, 5) else ""
-            should_show = (search_text in benh_nhan) or (search_text in loai) or (search_text in noi_dung) or (search_text in total)
-            self.table_detail.setRowHidden(row, not should_show)
+        self._query_detail_services(search_text=(text or "").lower())
 
     def filter_detail_apply(self, _=None):
         """Áp dụng bộ lọc tổng hợp: search text + loại + khoảng ngày."""
@@ -1336,32 +1278,7 @@ class QuanLyThuoc(QWidget):
             date_to = self.filter_date_to.date().toString("yyyy-MM-dd")
         except Exception:
             date_from = date_to = None
-
-        for row in range(self.table_detail.rowCount()):
-            # date in column 0
-            date_text = self.table_detail.item(row, 0).text() if self.table_detail.item(row, 0) else ""
-            try:
-                in_range = True
-                if date_from:
-                    in_range = in_range and (date_text >= date_from)
-                if date_to:
-                    in_range = in_range and (date_text <= date_to)
-            except Exception:
-                in_range = True
-
-            benh_nhan = self.table_detail.item(row, 1).text().lower() if self.table_detail.item(row, 1) else ""
-            loai = self.table_detail.item(row, 2).text() if self.table_detail.item(row, 2) else ""
-            noi_dung = self.table_detail.item(row, 3).text().lower() if self.table_detail.item(row, 3) else ""
-            total = self.table_detail.item(row, 5).text().lower() if self.table_detail.item(row, 5) else ""
-
-            # type filter
-            type_match = (sel_type == "Tất cả") or (loai == sel_type)
-
-            # search text
-            search_match = (search_text in benh_nhan) or (search_text in loai.lower()) or (search_text in noi_dung) or (search_text in total)
-
-            should_show = in_range and type_match and (search_match if search_text else True)
-            self.table_detail.setRowHidden(row, not should_show)
+        self._query_detail_services(search_text, sel_type, date_from, date_to)
 
     def clear_detail_filters(self):
         try:
@@ -1375,8 +1292,7 @@ class QuanLyThuoc(QWidget):
         except Exception:
             pass
         # show all rows
-        for row in range(self.table_detail.rowCount()):
-            self.table_detail.setRowHidden(row, False)
+        self.load_detail_services()
 
     def calculate_total_inventory_value(self):
         """Tính tổng giá trị tồn kho: SUM(giá × tồn kho)."""
@@ -4,10 +4,39 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor, QFont
-from database import get_connection, get_prescriptions_for_patient, mark_prescription_dispensed
-from database import get_user_role, save_xuat_thuoc_history, get_supplementary_prescriptions_for_patient
+from database import get_connection, get_prescriptions_for_patient, dispense_prescription, StockError
+from database import get_dispense_queue, dispense_batch
+from database import get_user_role, get_supplementary_prescriptions_for_patient
 from app_signals import app_signals
 from signals import app_signals as signal_app_signals
+from forms.page_cache import connect_global
+from db_executor import executor
+from forms.patient_search import PatientCompleter, reset_patient_combo
+from forms.drug_catalog_model import sync_drug_catalog
+from drug_catalog import drug_catalog
+
+
+def _patient_label(rec):
+    return f"{rec.ho_ten} ({rec.so_cccd})"
+
+
+def _fetch_prescriptions(patient_id, username):
+    """Đọc đơn thường + đơn bổ sung của bệnh nhân và tên bác sĩ đang đăng nhập (chạy trên worker thread)."""
+    # Hiển thị tên bác sĩ là người đang đăng nhập nếu có (tra một lần cho cả hai bảng)
+    login_full_name = None
+    if username:
+        conn = get_connection()
+        try:
+            rown = conn.execute("SELECT full_name FROM users WHERE username = ?", (username,)).fetchone()
+            if rown and rown[0]:
+                login_full_name = rown[0]
+        except Exception:
+            pass
+        finally:
+            conn.close()
+    pres = get_prescriptions_for_patient(patient_id)
+    pres_bo_sung = get_supplementary_prescriptions_for_patient(patient_id)
+    return pres, pres_bo_sung, login_full_name
 
 class QuanLyXuatThuoc(QWidget):
     """Form cho dược sĩ để xuất thuốc dựa trên đơn bác sĩ kê."""
@@ -31,6 +60,8 @@ class QuanLyXuatThuoc(QWidget):
         self.combo_patient = QComboBox()
         self.combo_patient.setEditable(True)
         self.combo_patient.setMinimumWidth(300)
+        # Gõ tên không dấu / CCCD / SĐT để tìm nhanh trong chỉ mục bệnh nhân
+        self.patient_completer = PatientCompleter(self.combo_patient, formatter=_patient_label)
         btn_load = QPushButton("Tải đơn")
         btn_load.clicked.connect(self.load_prescriptions_for_selected)
         controls.addWidget(lbl)
@@ -69,6 +100,34 @@ class QuanLyXuatThuoc(QWidget):
         tab_supplement_layout.addWidget(self.table_bo_sung)
         
         self.tabs.addTab(tab_supplement, "Đơn Thuốc Bổ Sung")
+
+        # Tab 3: Hàng đợi xuất thuốc (mọi đơn chưa xuất của tất cả bệnh nhân, chọn nhiều đơn để xuất một lần)
+        tab_queue = QWidget()
+        tab_queue_layout = QVBoxLayout(tab_queue)
+
+        # (source, don_id) lưu trong Qt.UserRole của ô 'Loại'
+        self.table_queue = QTableWidget(0, 6)
+        self.table_queue.setHorizontalHeaderLabels(["Loại", "Ngày kê", "Bệnh nhân", "CCCD", "Bác sĩ", "Số thuốc"])
+        self.table_queue.setSelectionBehavior(QTableWidget.SelectRows)
+        self.table_queue.setSelectionMode(QTableWidget.ExtendedSelection)
+        self.table_queue.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table_queue.setMaximumHeight(220)
+        tab_queue_layout.addWidget(self.table_queue)
+
+        queue_actions = QHBoxLayout()
+        btn_reload_queue = QPushButton("Tải lại hàng đợi")
+        btn_reload_queue.clicked.connect(self.load_dispense_queue)
+        btn_select_all = QPushButton("Chọn tất cả")
+        btn_select_all.clicked.connect(self.table_queue.selectAll)
+        self.lbl_queue = QLabel("")
+        queue_actions.addWidget(btn_reload_queue)
+        queue_actions.addWidget(btn_select_all)
+        queue_actions.addWidget(self.lbl_queue)
+        queue_actions.addStretch()
+        tab_queue_layout.addLayout(queue_actions)
+
+        self.tabs.addTab(tab_queue, "Hàng Đợi Xuất Thuốc")
+        self.tabs.currentChanged.connect(self._on_tab_changed)
         
         layout.addWidget(self.tabs)
 
@@ -108,23 +167,17 @@ class QuanLyXuatThuoc(QWidget):
         
         # Kết nối signal cho đơn thuốc bổ sung
         try:
-            app_signals.don_bo_sung_printed.connect(self.on_don_bo_sung_printed)
+            connect_global(self, signal_app_signals.don_bo_sung_printed, self.on_don_bo_sung_printed)
         except Exception:
             pass
+        # Tồn kho đổi ở màn hình/máy khác: cập nhật bảng thuốc đang hiển thị
+        connect_global(self, app_signals.drug_catalog_changed, self.on_drug_catalog_changed)
+        # Đơn mới / đơn vừa xuất ở máy khác: cập nhật hàng đợi đang mở
+        connect_global(self, app_signals.changes, self.on_data_changes)
 
     def load_patients(self):
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT id, ho_ten, so_cccd FROM benh_nhan ORDER BY ho_ten")
-            rows = cur.fetchall()
-            self.patients = rows
-            self.combo_patient.clear()
-            self.combo_patient.addItem("")
-            for r in rows:
-                self.combo_patient.addItem(f"{r[1]} ({r[2]})", userData=r[0])
-        finally:
-            conn.close()
+        # Chỉ giữ mục trống: completer tìm trong chỉ mục bệnh nhân dùng chung và thêm bệnh nhân được chọn
+        reset_patient_combo(self.combo_patient, "")
 
     def load_prescriptions_for_selected(self):
         idx = self.combo_patient.currentIndex()
@@ -132,9 +185,15 @@ class QuanLyXuatThuoc(QWidget):
             QMessageBox.warning(self, "Chọn bệnh nhân", "Vui lòng chọn bệnh nhân trước khi tải đơn.")
             return
         patient_id = self.combo_patient.currentData()
-        
-        # Tải các đơn thuốc thường
-        pres = get_prescriptions_for_patient(patient_id)
+
+        # Đọc đơn chạy nền; chọn bệnh nhân khác khi lần tải trước chưa xong sẽ huỷ lần tải cũ
+        executor.submit(_fetch_prescriptions, patient_id, getattr(self, 'username', None),
+                        key='quan_ly_xuat_thuoc.prescriptions', owner=self,
+                        on_result=lambda res: self._fill_prescription_tables(*res),
+                        on_error=lambda e: QMessageBox.critical(self, "Lỗi", f"Không thể tải đơn thuốc:\n{e}"))
+
+    def _fill_prescription_tables(self, pres, pres_bo_sung, login_full_name):
+        # Các đơn thuốc thường
         self.table.setRowCount(0)
         self.current_pres = pres
         for p in pres:
@@ -146,36 +205,12 @@ class QuanLyXuatThuoc(QWidget):
             self.table.setItem(r, 0, date_item)
 
             # Hiển thị tên bác sĩ là người đang đăng nhập nếu có, nếu không thì dùng giá trị trong record
-            display_doctor = p.get('bac_si') or ''
-            try:
-                if getattr(self, 'username', None):
-                    conn_d = get_connection()
-                    cur_d = conn_d.cursor()
-                    cur_d.execute("SELECT full_name FROM users WHERE username = ?", (self.username,))
-                    rown = cur_d.fetchone()
-                    conn_d.close()
-                    if rown and rown[0]:
-                        display_doctor = rown[0]
-            except Exception:
-                pass
+            display_doctor = login_full_name or p.get('bac_si') or ''
 
             self.table.setItem(r, 1, QTableWidgetItem(str(display_doctor)))
 
-            # Tính tổng tiền cho đơn hiện tại: sum(so_luong * gia_thuoc) từ chi_tiet_don_thuoc
-            try:
-                conn2 = get_connection()
-                cur2 = conn2.cursor()
-                cur2.execute("""
-                    SELECT SUM(ct.so_luong * COALESCE(dmt.gia_thuoc, 0))
-                    FROM chi_tiet_don_thuoc ct
-                    LEFT JOIN danh_muc_thuoc dmt ON ct.ma_thuoc = dmt.ma_thuoc
-                    WHERE ct.don_thuoc_id = ?
-                """, (p['id'],))
-                total_row = cur2.fetchone()
-                total_amount = total_row[0] or 0
-                conn2.close()
-            except Exception:
-                total_amount = p.get('tong_tien', 0) or 0
+            # Tổng tiền sum(so_luong * gia_thuoc) đã được tính sẵn khi tải đơn theo lô
+            total_amount = p.get('tong_tien_thuoc', 0)
 
             try:
                 total_text = f"{float(total_amount):,.0f}"
@@ -186,8 +221,7 @@ class QuanLyXuatThuoc(QWidget):
             status_text = "Đã xuất" if p.get('da_xuat') else "Chưa xuất"
             self.table.setItem(r, 3, QTableWidgetItem(status_text))
         
-        # Tải các đơn thuốc bổ sung
-        pres_bo_sung = get_supplementary_prescriptions_for_patient(patient_id)
+        # Các đơn thuốc bổ sung
         self.table_bo_sung.setRowCount(0)
         self.current_pres_bo_sung = pres_bo_sung
         for p in pres_bo_sung:
@@ -199,35 +233,11 @@ class QuanLyXuatThuoc(QWidget):
             self.table_bo_sung.setItem(r, 0, date_item_b)
 
             # Hiển thị tên bác sĩ là người đang đăng nhập nếu có, nếu không thì dùng giá trị trong record
-            display_doctor = p.get('bac_si') or ''
-            try:
-                if getattr(self, 'username', None):
-                    conn_d = get_connection()
-                    cur_d = conn_d.cursor()
-                    cur_d.execute("SELECT full_name FROM users WHERE username = ?", (self.username,))
-                    rown = cur_d.fetchone()
-                    conn_d.close()
-                    if rown and rown[0]:
-                        display_doctor = rown[0]
-            except Exception:
-                pass
+            display_doctor = login_full_name or p.get('bac_si') or ''
 
             self.table_bo_sung.setItem(r, 1, QTableWidgetItem(str(display_doctor)))
-            # Tính tổng tiền cho đơn bổ sung
-            try:
-                conn3 = get_connection()
-                cur3 = conn3.cursor()
-                cur3.execute("""
-                    SELECT SUM(ct.so_luong * COALESCE(dmt.gia_thuoc, 0))
-                    FROM chi_tiet_don_thuoc_bo_sung ct
-                    LEFT JOIN danh_muc_thuoc dmt ON ct.ma_thuoc = dmt.ma_thuoc
-                    WHERE ct.don_thuoc_bo_sung_id = ?
-                """, (p['id'],))
-                total_row = cur3.fetchone()
-                total_amount = total_row[0] or 0
-                conn3.close()
-            except Exception:
-                total_amount = p.get('tong_tien', 0) or 0
+            # Tổng tiền cho đơn bổ sung (tính sẵn khi tải đơn theo lô)
+            total_amount = p.get('tong_tien_thuoc', 0)
 
             try:
                 total_text = f"{float(total_amount):,.0f}"
@@ -282,32 +292,8 @@ class QuanLyXuatThuoc(QWidget):
         # Tải tất cả thuốc từ bảng `danh_muc_thuoc`
         self.load_all_drugs()
         
-        # Tính tổng tiền từ giá thuốc trong danh mục nhân với số lượng
-        total_amount = 0
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            if active_tab == 0:
-                cur.execute("""
-                    SELECT ct.so_luong, dmt.gia_thuoc 
-                    FROM chi_tiet_don_thuoc ct 
-                    LEFT JOIN danh_muc_thuoc dmt ON ct.ma_thuoc = dmt.ma_thuoc 
-                    WHERE ct.don_thuoc_id = ?
-                """, (don_id,))
-            else:
-                cur.execute("""
-                    SELECT ct.so_luong, dmt.gia_thuoc 
-                    FROM chi_tiet_don_thuoc_bo_sung ct 
-                    LEFT JOIN danh_muc_thuoc dmt ON ct.ma_thuoc = dmt.ma_thuoc 
-                    WHERE ct.don_thuoc_bo_sung_id = ?
-                """, (don_id,))
-            
-            price_details = cur.fetchall()
-            for so_luong, gia_thuoc in price_details:
-                if gia_thuoc and so_luong:
-                    total_amount += float(gia_thuoc) * int(so_luong)
-        finally:
-            conn.close()
+        # Tổng tiền theo giá danh mục đã có sẵn trong đơn (tính khi tải theo lô)
+        total_amount = float(pres.get('tong_tien_thuoc') or 0)
 
         # Cập nhật văn bản chi tiết
         lines = [f"Đơn ID: {pres['id']}", f"Ngày kê: {pres['ngay_ke']}", f"Bác sĩ kê đơn: {pres['bac_si']}", f"Tổng tiền: {total_amount:,.0f} VND"]
@@ -369,50 +355,46 @@ class QuanLyXuatThuoc(QWidget):
         self.detail.setPlainText('\n'.join(lines))
 
     def load_all_drugs(self):
-        """Load all drugs from danh_muc_thuoc table."""
+        """Hiển thị toàn bộ danh mục thuốc (từ bộ đệm danh mục dùng chung, theo tên thuốc)."""
         self.table_drugs.setRowCount(0)
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        try:
-            cur.execute("SELECT ma_thuoc, ten_thuoc, don_vi, ton_kho FROM danh_muc_thuoc ORDER BY ten_thuoc")
-            drugs = cur.fetchall()
-            
-            # Xây dựng dict tên thuốc trong đơn hiện tại để tra nhanh
-            drug_in_pres = {}
-            if hasattr(self, 'current_prescription'):
-                for item in self.current_prescription.get('items', []):
-                    ma = item.get('ma_thuoc')
-                    if ma:
-                        drug_in_pres[ma] = f"{item.get('ten_thuoc', '')} - {item.get('so_luong', 0)} {item.get('don_vi', '')}"
-            
-            for drug in drugs:
-                ma_thuoc = drug[0]
-                ten_thuoc = drug[1]
-                don_vi = drug[2]
-                ton_kho = drug[3] or 0
-                
-                r = self.table_drugs.rowCount()
-                self.table_drugs.insertRow(r)
-                self.table_drugs.setItem(r, 0, QTableWidgetItem(ten_thuoc))
-                self.table_drugs.setItem(r, 1, QTableWidgetItem(str(ma_thuoc or '')))
-                self.table_drugs.setItem(r, 2, QTableWidgetItem(str(don_vi or '')))
-                
-                # Tồn kho item - để dễ cập nhật
-                ton_kho_item = QTableWidgetItem(str(ton_kho))
-                ton_kho_item.setData(Qt.UserRole, ma_thuoc)  # Store ma_thuoc for later reference
-                self.table_drugs.setItem(r, 3, ton_kho_item)
-                
-                # Ghi chú: show drug details if it's in the current prescription
-                ghi_chu = ""
-                if ma_thuoc in drug_in_pres:
-                    ghi_chu = drug_in_pres[ma_thuoc]
-                self.table_drugs.setItem(r, 4, QTableWidgetItem(ghi_chu))
-        finally:
-            conn.close()
-        
+        # Chỉ đọc lại DB khi phiên bản danh mục đổi (vd. vừa xuất thuốc ở máy khác)
+        sync_drug_catalog()
+
+        # Xây dựng dict tên thuốc trong đơn hiện tại để tra nhanh
+        drug_in_pres = {}
+        if hasattr(self, 'current_prescription'):
+            for item in self.current_prescription.get('items', []):
+                ma = item.get('ma_thuoc')
+                if ma:
+                    drug_in_pres[ma] = f"{item.get('ten_thuoc', '')} - {item.get('so_luong', 0)} {item.get('don_vi', '')}"
+
+        for drug in drug_catalog.by_name():
+            ma_thuoc = drug.ma_thuoc
+            ton_kho = drug.ton_kho or 0
+
+            r = self.table_drugs.rowCount()
+            self.table_drugs.insertRow(r)
+            self.table_drugs.setItem(r, 0, QTableWidgetItem(drug.ten_thuoc))
+            self.table_drugs.setItem(r, 1, QTableWidgetItem(str(ma_thuoc or '')))
+            self.table_drugs.setItem(r, 2, QTableWidgetItem(str(drug.don_vi or '')))
+
+            # Tồn kho item - để dễ cập nhật
+            ton_kho_item = QTableWidgetItem(str(ton_kho))
+            ton_kho_item.setData(Qt.UserRole, ma_thuoc)  # Store ma_thuoc for later reference
+            self.table_drugs.setItem(r, 3, ton_kho_item)
+
+            # Ghi chú: show drug details if it's in the current prescription
+            ghi_chu = ""
+            if ma_thuoc in drug_in_pres:
+                ghi_chu = drug_in_pres[ma_thuoc]
+            self.table_drugs.setItem(r, 4, QTableWidgetItem(ghi_chu))
+
         self.table_drugs.resizeColumnsToContents()
 
+    def on_drug_catalog_changed(self):
+        if self.table_drugs.rowCount():
+            self.load_all_drugs()
+
     def dispense_selected(self):
         # Check which tab is active
         active_tab = self.tabs.currentIndex()
@@ -442,48 +424,25 @@ class QuanLyXuatThuoc(QWidget):
                 return
             
             try:
-                # Get current patient info
-                patient_id = self.combo_patient.currentData()
-                conn = get_connection()
-                cur = conn.cursor()
-                cur.execute("SELECT ho_ten, so_cccd FROM benh_nhan WHERE id = ?", (patient_id,))
-                patient_info = cur.fetchone()
-                
-                # Get prescription info
-                cur.execute("SELECT bac_si FROM don_thuoc WHERE id = ?", (don_id,))
-                pres_info = cur.fetchone()
-                conn.close()
-                
-                ho_ten = patient_info[0] if patient_info else "Unknown"
-                so_cccd = patient_info[1] if patient_info else ""
-                bac_si = pres_info[0] if pres_info else "Unknown"
-                
-                success = mark_prescription_dispensed(don_id, dispensed_by_username=self.username)
-                if success:
-                    # Save history
-                    save_xuat_thuoc_history(
-                        don_thuoc_id=don_id,
-                        bac_si=bac_si,
-                        ho_ten_benh_nhan=ho_ten,
-                        so_cccd=so_cccd,
-                        xuat_boi=self.username,
-                        ghi_chu=""
-                    )
-                    
+                # Trừ kho, đánh dấu đã xuất và ghi lich_su_xuat_thuoc trong một transaction
+                result = self._dispense('don_thuoc', don_id)
+                if result:
                     # Update stock in the drug table immediately
                     self.update_drug_table_after_dispense(don_id)
                     
-                    QMessageBox.information(self, "Hoàn thành", "Đã xuất thuốc và cập nhật tồn kho.")
+                    msg = "Đã xuất thuốc và cập nhật tồn kho."
+                    if result[1]:
+                        msg += f"\n(Không thể xuất {len(result[1])} loại do tồn kho không đủ)"
+                    QMessageBox.information(self, "Hoàn thành", msg)
                     
-                    # Emit signal để cập nhật doanh thu
+                    # Báo thay đổi (đơn + tồn kho các thuốc vừa xuất) để cập nhật doanh thu, danh mục thuốc
                     try:
-                        app_signals.medication_dispensed.emit()
+                        app_signals.post('don_thuoc', [don_id], signals=('medication_dispensed',))
+                        app_signals.post('danh_muc_thuoc', [ma for ma, _, _ in result[0]], signals=())
                     except Exception:
                         pass
                     
                     self.load_prescriptions_for_selected()
-                else:
-                    QMessageBox.critical(self, "Lỗi", "Không thể xuất thuốc. Vui lòng thử lại.")
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Lỗi khi xuất thuốc: {e}")
         
@@ -516,106 +475,132 @@ class QuanLyXuatThuoc(QWidget):
             except Exception as e:
                 QMessageBox.critical(self, "Lỗi", f"Lỗi khi xuất thuốc: {e}")
 
-    def dispense_supplementary_prescription(self, don_bo_sung_id):
-        """Mark supplementary prescription as exported and update stock."""
-        conn = None
+        elif active_tab == 2:
+            self.dispense_queue_selected()
+
+    def on_data_changes(self, changes):
+        if self.tabs.currentIndex() == 2 and self.isVisible() and changes.touches('don_thuoc', 'don_thuoc_bo_sung'):
+            self.load_dispense_queue()
+
+    def _on_tab_changed(self, index):
+        if index == 2:
+            self.load_dispense_queue()
+
+    def load_dispense_queue(self):
+        """Tải hàng đợi xuất thuốc (truy vấn chạy nền)."""
+        executor.submit(get_dispense_queue, key='quan_ly_xuat_thuoc.queue', owner=self,
+                        on_result=self._fill_dispense_queue,
+                        on_error=lambda e: QMessageBox.critical(self, "Lỗi", f"Không thể tải hàng đợi xuất thuốc:\n{e}"))
+
+    def _fill_dispense_queue(self, rows):
+        self.table_queue.setRowCount(0)
+        for r, (source, don_id, ngay_ke, _, ho_ten, so_cccd, bac_si, so_thuoc) in enumerate(rows):
+            self.table_queue.insertRow(r)
+            loai_item = QTableWidgetItem("Thường" if source == 'don_thuoc' else "Bổ sung")
+            loai_item.setData(Qt.UserRole, (source, don_id))
+            self.table_queue.setItem(r, 0, loai_item)
+            self.table_queue.setItem(r, 1, QTableWidgetItem(str(ngay_ke or '')))
+            self.table_queue.setItem(r, 2, QTableWidgetItem(str(ho_ten or '')))
+            self.table_queue.setItem(r, 3, QTableWidgetItem(str(so_cccd or '')))
+            self.table_queue.setItem(r, 4, QTableWidgetItem(str(bac_si or '')))
+            self.table_queue.setItem(r, 5, QTableWidgetItem(str(so_thuoc or 0)))
+        self.lbl_queue.setText(f"{len(rows)} đơn chờ xuất")
+
+    def dispense_queue_selected(self):
+        """Xuất các đơn đang chọn trong hàng đợi: một transaction, một lần báo thay đổi (medication_dispensed)."""
+        rows = sorted({idx.row() for idx in self.table_queue.selectionModel().selectedRows()})
+        orders = [self.table_queue.item(r, 0).data(Qt.UserRole) for r in rows]
+        orders = [tuple(o) for o in orders if o]
+        if not orders:
+            QMessageBox.warning(self, "Chọn đơn", "Vui lòng chọn ít nhất một đơn trong hàng đợi.")
+            return
+        ok = QMessageBox.question(self, "Xác nhận", f"Xuất thuốc cho {len(orders)} đơn đã chọn?", QMessageBox.Yes | QMessageBox.No)
+        if ok != QMessageBox.Yes:
+            return
         try:
-            conn = get_connection()
-            cur = conn.cursor()
-            
-            # Get patient info
-            patient_id = self.combo_patient.currentData()
-            cur.execute("SELECT ho_ten, so_cccd FROM benh_nhan WHERE id = ?", (patient_id,))
-            patient_info = cur.fetchone()
-            ho_ten = patient_info[0] if patient_info else "Unknown"
-            so_cccd = patient_info[1] if patient_info else ""
-            
-            # Get supplementary prescription info
-            cur.execute("SELECT bac_si FROM don_thuoc_bo_sung WHERE id = ?", (don_bo_sung_id,))
-            pres_info = cur.fetchone()
-            bac_si = pres_info[0] if pres_info else "Unknown"
-            
-            # Get medicine details
-            cur.execute("SELECT ma_thuoc, ten_thuoc, so_luong FROM chi_tiet_don_thuoc_bo_sung WHERE don_thuoc_bo_sung_id = ?", (don_bo_sung_id,))
-            medicines = cur.fetchall()
-            
-            # Check stock availability
-            insufficient = []
-            updates = []
-            
-            for ma_thuoc, ten_thuoc, so_luong in medicines:
-                if not ma_thuoc:
-                    continue
-                
-                cur.execute("SELECT ton_kho FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma_thuoc,))
-                result = cur.fetchone()
-                if not result:
-                    insufficient.append(f"{ten_thuoc} - Không tìm thấy trong danh mục")
-                    continue
-                
-                ton_kho = result[0] or 0
-                if ton_kho < so_luong:
-                    insufficient.append(f"{ten_thuoc} - Tồn kho: {ton_kho}, cần: {so_luong}")
-                else:
-                    updates.append((ton_kho - so_luong, ma_thuoc))
-            
-            # If insufficient and no valid updates, abort
-            if insufficient and not updates:
-                QMessageBox.warning(self, "Lỗi", "Các thuốc không đủ tồn kho:\n" + "\n".join(insufficient))
-                return
-            
-            # Ask user if there are partial shortages
-            if insufficient and updates:
-                reply = QMessageBox.warning(
-                    self,
-                    "Cảnh báo",
-                    "Các thuốc không đủ tồn kho:\n" + "\n".join(insufficient) + "\n\nBạn có muốn tiếp tục xuất những thuốc đủ tồn kho không?",
-                    QMessageBox.Yes | QMessageBox.No
-                )
-                if reply != QMessageBox.Yes:
-                    return
-            
-            # Update stock
+            dispensed, skipped = dispense_batch(orders, self.username)
+        except Exception as e:
+            QMessageBox.critical(self, "Lỗi", f"Lỗi khi xuất thuốc: {e}")
+            self.load_dispense_queue()
+            return
+
+        msg = f"Đã xuất {len(dispensed)}/{len(orders)} đơn."
+        if skipped:
+            msg += "\n\nKhông xuất được:\n" + "\n".join(
+                f"- {'Đơn thường' if source == 'don_thuoc' else 'Đơn bổ sung'} #{don_id}: {ly_do}"
+                for source, don_id, ly_do in skipped)
+        if dispensed:
+            QMessageBox.information(self, "Hoàn tất", msg)
+            # Một lần cho cả lô: doanh thu, danh mục thuốc (tồn kho) cập nhật một lần
             try:
-                conn.execute("BEGIN")
-                for new_ton_kho, ma_thuoc in updates:
-                    cur.execute("""
-                        UPDATE danh_muc_thuoc 
-                        SET ton_kho = ? 
-                        WHERE ma_thuoc = ?
-                    """, (new_ton_kho, ma_thuoc))
-                
-                # Mark as exported
-                cur.execute("UPDATE don_thuoc_bo_sung SET xuat_thuoc = 1 WHERE id = ?", (don_bo_sung_id,))
-                
-                conn.commit()
-                
-                msg = f"Đã xuất thành công {len(updates)} loại thuốc"
-                if insufficient:
-                    msg += f"\n(Không thể xuất {len(insufficient)} loại do tồn kho không đủ)"
-                
-                QMessageBox.information(self, "Hoàn tất", msg)
-                
-                # Emit signal để cập nhật doanh thu
-                try:
-                    app_signals.medication_dispensed.emit()
-                except Exception:
-                    pass
-                
-                # Update drug table
-                self.update_drug_table_after_dispense(don_bo_sung_id, is_supplementary=True)
-                
-                # Reload prescriptions
+                for source in ('don_thuoc', 'don_thuoc_bo_sung'):
+                    ids = [don_id for src, don_id in dispensed if src == source]
+                    if ids:
+                        app_signals.post(source, ids, signals=('medication_dispensed',))
+                app_signals.post('danh_muc_thuoc', signals=())
+            except Exception:
+                pass
+            if self.combo_patient.currentIndex() > 0:
                 self.load_prescriptions_for_selected()
-                
-            except Exception as e:
-                conn.rollback()
-                QMessageBox.critical(self, "Lỗi", f"Không thể cập nhật tồn kho: {e}")
-                return
-        
-        finally:
-            if conn:
-                conn.close()
+        else:
+            QMessageBox.warning(self, "Không xuất được", msg)
+        self.load_dispense_queue()
+
+    def _dispense(self, source, don_id):
+        """Xuất kho đơn `don_id` (database.dispense_prescription, một transaction).
+
+        Thiếu tồn kho: hỏi người dùng có xuất các thuốc còn đủ không. Trả về (đã xuất, thiếu) hoặc None.
+        """
+        try:
+            return dispense_prescription(source, don_id, self.username)
+        except StockError as e:
+            if not e.shortages:
+                # Người khác vừa xuất đơn này
+                QMessageBox.information(self, "Đã xuất", str(e))
+                self.load_prescriptions_for_selected()
+                return None
+            insufficient = [f"{ten_thuoc} - Tồn kho: {ton_kho or 0}, cần: {so_luong}"
+                            for _, ten_thuoc, ton_kho, so_luong in e.shortages]
+        reply = QMessageBox.warning(
+            self,
+            "Cảnh báo",
+            "Các thuốc không đủ tồn kho:\n" + "\n".join(insufficient) + "\n\nBạn có muốn tiếp tục xuất những thuốc đủ tồn kho không?",
+            QMessageBox.Yes | QMessageBox.No
+        )
+        if reply != QMessageBox.Yes:
+            return None
+        try:
+            return dispense_prescription(source, don_id, self.username, partial=True)
+        except StockError as e:
+            detail = "\n".join(f"{ten_thuoc} - Tồn kho: {ton_kho or 0}, cần: {so_luong}"
+                               for _, ten_thuoc, ton_kho, so_luong in e.shortages)
+            QMessageBox.warning(self, "Lỗi", f"{e}\n{detail}".strip())
+            return None
+
+    def dispense_supplementary_prescription(self, don_bo_sung_id):
+        """Mark supplementary prescription as exported and update stock."""
+        result = self._dispense('don_thuoc_bo_sung', don_bo_sung_id)
+        if not result:
+            return
+        dispensed, shortages = result
+
+        msg = f"Đã xuất thành công {len(dispensed)} loại thuốc"
+        if shortages:
+            msg += f"\n(Không thể xuất {len(shortages)} loại do tồn kho không đủ)"
+        QMessageBox.information(self, "Hoàn tất", msg)
+
+        # Báo thay đổi để cập nhật doanh thu, danh mục thuốc
+        try:
+            app_signals.post('don_thuoc_bo_sung', [don_bo_sung_id], signals=('medication_dispensed',))
+            app_signals.post('danh_muc_thuoc', [ma for ma, _, _ in dispensed], signals=())
+        except Exception:
+            pass
+
+        # Update drug table
+        self.update_drug_table_after_dispense(don_bo_sung_id, is_supplementary=True)
+
+        # Reload prescriptions
+        self.load_prescriptions_for_selected()
 
     def update_drug_table_after_dispense(self, don_id, is_supplementary=False):
         """Update drug table with new stock values after dispensing."""
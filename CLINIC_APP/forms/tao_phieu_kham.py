@@ -4,10 +4,12 @@ from PyQt5.QtWidgets import (
     QTabWidget, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QDialog,
     QListWidget, QListWidgetItem, QSizePolicy
 )
-from PyQt5.QtCore import QDate, Qt, QStringListModel
+from PyQt5.QtCore import QDate, Qt
 from PyQt5.QtGui import QFont
 import sys
-from database import get_connection
+from database import get_connection, pool
+from db_executor import executor
+from forms.patient_search import PatientCompleter, patient_item_index, reset_patient_combo
 from functools import partial
 import logging
 
@@ -15,6 +17,108 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# --- Các hàm đọc dữ liệu chạy trên worker thread (qua db_executor), không đụng tới widget ---
+def _fetch_benh_nhan_id_by_ma_hoso(ma):
+    with pool.read() as conn:
+        r = conn.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,)).fetchone()
+        return r[0] if r and r[0] else None
+
+
+def _fetch_kham_benh_nhan(benh_nhan_id=None, ma_hoso=None):
+    """Toàn bộ dữ liệu form cần khi chọn bệnh nhân (thông tin, sinh hiệu, phiếu khám gần nhất, lịch sử KCB).
+
+    Nếu chỉ có ma_hoso thì tìm benh_nhan_id qua tiep_don; trả về None nếu không tìm thấy bệnh nhân.
+    """
+    if not benh_nhan_id and ma_hoso:
+        benh_nhan_id = _fetch_benh_nhan_id_by_ma_hoso(ma_hoso)
+    if not benh_nhan_id:
+        return None
+    data = {"id": benh_nhan_id, "last": None, "chi_tiet": None, "chi_dinh": None, "history": []}
+    with pool.read() as conn:
+        cur = conn.cursor()
+        # include loai_kham when loading patient record
+        cur.execute("SELECT ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai, doi_tuong, so_cccd, loai_kham FROM benh_nhan WHERE id = ?", (benh_nhan_id,))
+        data["bn"] = cur.fetchone()
+        # Sinh hiệu từ lần tiếp đón mới nhất
+        cur.execute("""
+            SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao
+            FROM tiep_don
+            WHERE benh_nhan_id = ?
+            ORDER BY id DESC LIMIT 1
+        """, (benh_nhan_id,))
+        data["vitals"] = cur.fetchone()
+        # Phiếu khám gần nhất + chi tiết khám + khám lâm sàng từ chi_dinh của phiếu đó
+        cur.execute("SELECT so_phieu, id FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (benh_nhan_id,))
+        last = cur.fetchone()
+        if last:
+            data["last"] = last
+            cur.execute("""
+                SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho,
+                       can_nang, chieu_cao, di_ung_thuoc, tien_su_ban_than,
+                       tien_su_gia_dinh, benh_kem_theo, icd10, chidinh_cls,
+                       kham_lam_sang, chan_doan, ket_luan, ghi_chu_kham
+                FROM chi_tiet_phieu_kham
+                WHERE phieu_kham_id = ?
+            """, (last[1],))
+            data["chi_tiet"] = cur.fetchone()
+            cur.execute("""
+                SELECT kham_lam_sang, id
+                FROM chi_dinh
+                WHERE phieu_kham_id = ?
+                ORDER BY id DESC LIMIT 1
+            """, (last[1],))
+            data["chi_dinh"] = cur.fetchone()
+        # Lịch sử KCB: chẩn đoán (ưu tiên chi_tiet_phieu_kham, rồi chi_dinh) và thuốc của từng phiếu
+        cur.execute("""
+            SELECT pk.id, pk.ngay_lap, pk.bac_si
+            FROM phieu_kham pk
+            WHERE pk.benh_nhan_id = ?
+            ORDER BY pk.id DESC
+            LIMIT 50
+        """, (benh_nhan_id,))
+        for phieu_id, ngay_lap, bac_si in cur.fetchall():
+            drow = conn.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,)).fetchone()
+            if not (drow and drow[0]):
+                drow = conn.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,)).fetchone()
+            medicines = conn.execute("""
+                SELECT ctdt.ten_thuoc, ctdt.so_luong, ctdt.don_vi, ctdt.lieu_dung
+                FROM chi_tiet_don_thuoc ctdt
+                JOIN don_thuoc dt ON ctdt.don_thuoc_id = dt.id
+                WHERE dt.phieu_kham_id = ?
+                ORDER BY ctdt.id
+            """, (phieu_id,)).fetchall()
+            data["history"].append((phieu_id, ngay_lap, bac_si, (drow[0] if drow else None) or "", medicines))
+        # Thông tin tiếp đón gần nhất (ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham)
+        cur.execute("SELECT ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham FROM tiep_don WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (benh_nhan_id,))
+        data["tiep_don"] = cur.fetchone()
+    return data
+
+
+def _fetch_phieu_kham_details(phieu_id):
+    """(phiếu khám, chi tiết khám, chẩn đoán ban đầu của chi_dinh, dịch vụ, thuốc) của một phiếu."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien FROM phieu_kham WHERE id = ?", (phieu_id,))
+        pk = cur.fetchone()
+        cur.execute("SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao, di_ung_thuoc, tien_su_ban_than, tien_su_gia_dinh, benh_kem_theo, icd10, chidinh_cls, kham_lam_sang, chan_doan, ket_luan, ghi_chu_kham FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ?", (phieu_id,))
+        detail = cur.fetchone()
+        cur.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,))
+        cdv = cur.fetchone()
+        # Also collect chi_dinh (danh sách dịch vụ)
+        cur.execute("SELECT ten_dich_vu, so_luong, don_gia FROM chi_dinh WHERE phieu_kham_id = ?", (phieu_id,))
+        services = cur.fetchall()
+        # Lấy thông tin thuốc từ đơn thuốc
+        cur.execute("""
+            SELECT ctdt.ten_thuoc, ctdt.so_luong, ctdt.don_vi, ctdt.lieu_dung, ctdt.sang, ctdt.trua, ctdt.chieu, ctdt.toi
+            FROM chi_tiet_don_thuoc ctdt
+            JOIN don_thuoc dt ON ctdt.don_thuoc_id = dt.id
+            WHERE dt.phieu_kham_id = ?
+            ORDER BY ctdt.id
+        """, (phieu_id,))
+        medicines = cur.fetchall()
+    return pk, detail, (cdv[0] if cdv else None), services, medicines
+
+
 class TaoPhieuKham(QWidget):
     """Form Lập phiếu khám (trang, không phải dialog)."""
     def __init__(self, parent=None):
@@ -272,10 +376,7 @@ class TaoPhieuKham(QWidget):
         self.hoten = QComboBox()  # Rename combo_bn to hoten to match tiep_don_kham.py
         self.hoten.setEditable(True)
         try:
-            from PyQt5.QtWidgets import QCompleter
-            self.completer = QCompleter()
-            self.completer.setCaseSensitivity(False)
-            self.hoten.setCompleter(self.completer)
+            self.completer = PatientCompleter(self.hoten)
         except Exception:
             self.completer = None
         grid.addWidget(self.hoten, 0, 1)
@@ -681,12 +782,13 @@ class TaoPhieuKham(QWidget):
             pass
 
     def on_select_benh_nhan(self, idx: int):
-        """Khi chọn bệnh nhân: nạp thông tin cơ bản và lịch sử KCB."""
+        """Khi chọn bệnh nhân: nạp thông tin cơ bản và lịch sử KCB (truy vấn chạy nền)."""
         # Use currentData() which is more robust than itemData(idx)
         # (signals may emit -1 or stale index in some Qt versions)
         # Handler for selecting patient
 
         benh_nhan_id = self.hoten.currentData()
+        ma_hoso = None
         # Fallback: nếu currentData() là None (ví dụ người dùng gõ tên thay vì chọn)
         # Chỉ tự chọn khi:
         #  - user nhập full display item (ví dụ 'Họ Tên — Mã:HS005 ...') - exact match
@@ -696,19 +798,12 @@ class TaoPhieuKham(QWidget):
             name = self.hoten.currentText().strip()
             if name:
                 try:
-                    # If name contains Mã:HSxxx try to lookup benh_nhan_id via tiep_don
+                    # If name contains Mã:HSxxx, benh_nhan_id is looked up via tiep_don on the worker
                     if "Mã:" in name:
                         try:
-                            ma = name.split("Mã:")[1].split()[0].strip()
-                            tmp_conn = get_connection()
-                            tmp_cur = tmp_conn.cursor()
-                            tmp_cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                            rr = tmp_cur.fetchone()
-                            tmp_conn.close()
-                            if rr and rr[0]:
-                                benh_nhan_id = rr[0]
+                            ma_hoso = name.split("Mã:")[1].split()[0].strip()
                         except Exception:
-                            benh_nhan_id = None
+                            ma_hoso = None
                     elif "ID:" in name:
                         try:
                             pid = int(name.split("ID:")[1].split()[0].strip())
@@ -724,258 +819,179 @@ class TaoPhieuKham(QWidget):
                             benh_nhan_id = None
                 except Exception:
                     benh_nhan_id = None
-        if not benh_nhan_id:
-            # clear
-            self.dienthoai.clear()
-            self.ngaysinh.clear()
-            self.gioitinh.clear()
-            self.diachi.clear()
-            self.sophieukham.clear()
-            self.table_history.setRowCount(0)
-            # Clear vital fields
+        if not benh_nhan_id and not ma_hoso:
+            # Bỏ kết quả của lần chọn trước (nếu còn đang tải)
+            executor.cancel(('tao_phieu_kham.benh_nhan', id(self)))
+            self._clear_benh_nhan_info()
+            return
+
+        executor.submit(_fetch_kham_benh_nhan, benh_nhan_id, ma_hoso, key='tao_phieu_kham.benh_nhan', owner=self,
+                        on_result=self._fill_benh_nhan_info,
+                        on_error=lambda e: logger.error("Error loading patient data: %s", e))
+
+    def _clear_benh_nhan_info(self):
+        self.dienthoai.clear()
+        self.ngaysinh.clear()
+        self.gioitinh.clear()
+        self.diachi.clear()
+        self.sophieukham.clear()
+        self.table_history.setRowCount(0)
+        # Clear vital fields
+        self.nhietdo.clear()
+        self.nhiptim.clear()
+        self.huyetap.clear()
+        self.nhiptho.clear()
+        self.cannang.clear()
+        self.chieucao.clear()
+
+    def _fill_benh_nhan_info(self, data):
+        """Đổ dữ liệu của _fetch_kham_benh_nhan lên form (GUI thread)."""
+        if not data:
+            self._clear_benh_nhan_info()
+            return
+        benh_nhan_id = data["id"]
+        bn = data["bn"]
+        if bn:
+            # bn: ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai, doi_tuong, so_cccd, loai_kham
+            self.dienthoai.setText(bn[5] or "")
+            self.ngaysinh.setText(bn[2] or "")
+            self.gioitinh.setText(bn[1] or "")
+            self.diachi.setText(bn[4] or "")
+            self.tuoi.setText(str(bn[3]) + " tuổi" if bn[3] else "")
+            self.doituong.setText(bn[6] or "")
+            # so_cccd stored in bn[7] — keep as mã hồ sơ display if present
+            self.mahoso.setText(bn[7] or "")
+            # loai_kham may be in benh_nhan — populate top Loại khám field
+            try:
+                self.loaikham.setText(bn[8] or "")
+            except Exception:
+                pass
+
+        # Sinh hiệu từ tiep_don mới nhất
+        # Helper function to safely convert number to string
+        # Chỉ hiển thị giá trị nếu nó là số hợp lệ
+        def safe_str(val):
+            if val is None:
+                return ""
+            try:
+                # Nếu là số (int hoặc float) thì hiển thị
+                if isinstance(val, (int, float)):
+                    # If it's a whole number, display without decimal
+                    if float(val) == int(val):
+                        return str(int(val))
+                    return str(val)
+                # Nếu là chuỗi, cố gắng chuyển thành số để kiểm tra hợp lệ
+                str_val = str(val).strip()
+                if not str_val:
+                    return ""
+                # Kiểm tra xem chuỗi có thể chuyển thành số không
+                try:
+                    num_val = float(str_val)
+                    # Nếu là số nguyên, hiển thị không có phần thập phân
+                    if num_val == int(num_val):
+                        return str(int(num_val))
+                    return str(num_val)
+                except ValueError:
+                    # Nếu không phải số hợp lệ, trả về chuỗi rỗng
+                    return ""
+            except:
+                return ""
+
+        td = data["vitals"]
+        if td:
+            # td: nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao
+            self.nhietdo.setText(safe_str(td[0]))
+            self.nhiptim.setText(safe_str(td[1]))
+            self.huyetap.setText(safe_str(td[2]))
+            self.nhiptho.setText(safe_str(td[3]))
+            self.cannang.setText(safe_str(td[4]))
+            self.chieucao.setText(safe_str(td[5]))
+        else:
+            # Clear vital fields if no tiep_don data
             self.nhietdo.clear()
             self.nhiptim.clear()
             self.huyetap.clear()
             self.nhiptho.clear()
             self.cannang.clear()
             self.chieucao.clear()
-            return
 
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # include loai_kham when loading patient record
-            cur.execute("SELECT ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai, doi_tuong, so_cccd, loai_kham FROM benh_nhan WHERE id = ?", (benh_nhan_id,))
-            bn = cur.fetchone()
-            if bn:
-                # bn: ho_ten, gioi_tinh, ngay_sinh, tuoi, dia_chi, dien_thoai, doi_tuong, so_cccd, loai_kham
-                self.dienthoai.setText(bn[5] or "")
-                self.ngaysinh.setText(bn[2] or "")
-                self.gioitinh.setText(bn[1] or "")
-                self.diachi.setText(bn[4] or "")
-                self.tuoi.setText(str(bn[3]) + " tuổi" if bn[3] else "")
-                self.doituong.setText(bn[6] or "")
-                # so_cccd stored in bn[7] — keep as mã hồ sơ display if present
-                self.mahoso.setText(bn[7] or "")
-                # loai_kham may be in benh_nhan — populate top Loại khám field
-                try:
-                    self.loaikham.setText(bn[8] or "")
-                except Exception:
-                    pass
-
-            # Load latest tiep_don (reception data) to populate vital fields
+        # latest phieu_kham -> display so_phieu and load detail
+        last = data["last"]
+        if last:
+            self.sophieukham.setText(last[0] or "")
+            # Chi tiết phiếu khám gần nhất
             try:
-                cur.execute("""
-                    SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao
-                    FROM tiep_don
-                    WHERE benh_nhan_id = ?
-                    ORDER BY id DESC LIMIT 1
-                """, (benh_nhan_id,))
-                td = cur.fetchone()
-                
-                # Helper function to safely convert number to string
-                # Chỉ hiển thị giá trị nếu nó là số hợp lệ
-                def safe_str(val):
-                    if val is None:
-                        return ""
-                    try:
-                        # Nếu là số (int hoặc float) thì hiển thị
-                        if isinstance(val, (int, float)):
-                            # If it's a whole number, display without decimal
-                            if float(val) == int(val):
-                                return str(int(val))
-                            return str(val)
-                        # Nếu là chuỗi, cố gắng chuyển thành số để kiểm tra hợp lệ
-                        str_val = str(val).strip()
-                        if not str_val:
-                            return ""
-                        # Kiểm tra xem chuỗi có thể chuyển thành số không
-                        try:
-                            num_val = float(str_val)
-                            # Nếu là số nguyên, hiển thị không có phần thập phân
-                            if num_val == int(num_val):
-                                return str(int(num_val))
-                            return str(num_val)
-                        except ValueError:
-                            # Nếu không phải số hợp lệ, trả về chuỗi rỗng
-                            return ""
-                    except:
-                        return ""
-                
-                if td:
-                    # td: nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao
-                    self.nhietdo.setText(safe_str(td[0]))
-                    self.nhiptim.setText(safe_str(td[1]))
-                    self.huyetap.setText(safe_str(td[2]))
-                    self.nhiptho.setText(safe_str(td[3]))
-                    self.cannang.setText(safe_str(td[4]))
-                    self.chieucao.setText(safe_str(td[5]))
+                self.load_chi_tiet_kham(data["chi_tiet"], data["chi_dinh"])
+                # Cũng load thêm khám lâm sàng từ chi_dinh để đảm bảo cập nhật mới nhất
+                self.load_kham_lam_sang_from_chi_dinh(data["chi_dinh"])
+                self.current_phieu_kham_id = last[1]
+                self.current_so_phieu = last[0]
+                # Chỉ khóa form khi phiếu đã có dữ liệu chi tiết (ghi chú, exam info, ...);
+                # nếu chưa có thì mở form để nhập
+                if data["chi_tiet"] is not None:
+                    self.lock_form()
                 else:
-                    # Clear vital fields if no tiep_don data
-                    self.nhietdo.clear()
-                    self.nhiptim.clear()
-                    self.huyetap.clear()
-                    self.nhiptho.clear()
-                    self.cannang.clear()
-                    self.chieucao.clear()
+                    self.unlock_form()
+            except Exception:
+                logger.exception("Error loading chi tiết khám")
+        else:
+            # Nếu chưa có phiếu khám -> không tạo số phiếu mới, chờ tạo từ form chỉ định
+            # Giữ lại các giá trị vitals đã load từ `tiep_don` (nếu có)
+            self.sophieukham.clear()
+            # Clear các trường khác trong tab THÔNG TIN KHÁM
+            self.clear_chi_tiet_kham()
+            # Đảm bảo form mở để nhập dữ liệu mới
+            self.unlock_form()
+
+        # recent tiep_don info (ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham)
+        td = data["tiep_don"]
+        if td:
+            try:
+                self.mahoso.setText(td[0] or "")
             except Exception:
-                # Ignore errors when loading tiep_don
                 pass
-
-            # load latest phieu_kham -> display so_phieu and load detail
-            cur.execute("SELECT so_phieu, id FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (benh_nhan_id,))
-            last = cur.fetchone()
-            if last:
-                self.sophieukham.setText(last[0] or "")
-                # Load chi tiết phiếu khám gần nhất
-                try:
-                    self.load_chi_tiet_kham(last[1])
-                    # Cũng load thêm khám lâm sàng từ chi_dinh để đảm bảo cập nhật mới nhất
-                    self.load_kham_lam_sang_from_chi_dinh(benh_nhan_id)
-                    self.current_phieu_kham_id = last[1]
-                    self.current_so_phieu = last[0]
-                    # Kiểm tra xem phiếu khám này có dữ liệu chi tiết không
-                    # Nếu chưa có dữ liệu chi tiết (ghi chú, exam info, ...) thì mở form để nhập
-                    # Chỉ khóa form khi phiếu đã đầy đủ thông tin
-                    conn_check = get_connection()
-                    cur_check = conn_check.cursor()
-                    try:
-                        cur_check.execute("""
-                            SELECT COUNT(*) FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ?
-                        """, (last[1],))
-                        has_detail = cur_check.fetchone()[0] > 0
-                        
-                        if has_detail:
-                            # Phiếu có dữ liệu chi tiết → khóa form
-                            self.lock_form()
-                        else:
-                            # Phiếu chưa có chi tiết → mở form để nhập
-                            self.unlock_form()
-
-                    
-                    finally:
-                        conn_check.close()
-                except Exception:
-                    logger.exception("Error loading chi tiết khám")
-            else:
-                # Nếu chưa có phiếu khám -> không tạo số phiếu mới, chờ tạo từ form chỉ định
-                # Giữ lại các giá trị vitals đã load từ `tiep_don` (nếu có)
-                self.sophieukham.clear()
-                # Clear các trường khác trong tab THÔNG TIN KHÁM
-                self.clear_chi_tiet_kham()
-                # Load khám lâm sàng từ form chỉ định dịch vụ (nếu có)
-                self.load_kham_lam_sang_from_chi_dinh(benh_nhan_id)
-                # Đảm bảo form mở để nhập dữ liệu mới
-                self.unlock_form()
-
-            # load history (phieu_kham)
-            cur.execute("""
-                SELECT pk.id, pk.ngay_lap, pk.bac_si
-                FROM phieu_kham pk
-                WHERE pk.benh_nhan_id = ?
-                ORDER BY pk.id DESC
-                LIMIT 50
-            """, (benh_nhan_id,))
-            rows = cur.fetchall()
-
-            # load recent tiep_don info (ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham)
             try:
-                cur.execute("SELECT ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham FROM tiep_don WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (benh_nhan_id,))
-                td = cur.fetchone()
-                if td:
-                    # td: ma_hoso, phong_kham, bac_si_kham, tinh_trang, ngay_tiep_don, tien_kham
-                    try:
-                        self.mahoso.setText(td[0] or "")
-                    except Exception:
-                        pass
-                    try:
-                        self.phongkham.setText(td[1] or "")
-                        # also sync bottom editable room field
-                        self.phong.setText(td[1] or "")
-                    except Exception:
-                        pass
-                    try:
-                        self.bacsikham.setText(td[2] or "")
-                        # also sync bottom editable doctor field
-                        self.bacsi.setText(td[2] or "")
-                    except Exception:
-                        pass
-                    try:
-                        self.tinhtrang.setText(td[3] or "")
-                    except Exception:
-                        pass
-                    try:
-                        # display date of reception in top panel
-                        self.ngaytiepdon.setText(td[4] or "")
-                        # and set bottom editable date (QDateEdit) if possible
-                        if td[4]:
-                            qd = QDate.fromString(td[4], "yyyy-MM-dd")
-                            if qd.isValid():
-                                try:
-                                    self.ngaylap.setDate(qd)
-                                    try:
-                                        self.display_ngaylap_top.setText(qd.toString("dd/MM/yyyy"))
-                                    except Exception:
-                                        pass
-                                except Exception:
-                                    pass
-                    except Exception:
-                        pass
-                    try:
-                        # tiền khám từ tiep_don
-                        self.tienkham.setText(str(td[5] or "0"))
-                    except Exception:
-                        pass
+                self.phongkham.setText(td[1] or "")
+                # also sync bottom editable room field
+                self.phong.setText(td[1] or "")
             except Exception:
                 pass
-        except Exception:
-            rows = []
-        finally:
-            conn.close()
-
-        # populate history table
-        self.table_history.setRowCount(0)
-        for r in rows:
-            # r: id, ngay_lap, bac_si
-            phieu_id = r[0]
-            # determine diagnosis for history: prefer chi_tiet_phieu_kham.chan_doan then chi_dinh.chan_doan_ban_dau
-            diagnosis_text = ""
             try:
-                conn_diag = get_connection()
-                cur_diag = conn_diag.cursor()
-                cur_diag.execute("SELECT chan_doan FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,))
-                drow = cur_diag.fetchone()
-                if drow and drow[0]:
-                    diagnosis_text = drow[0]
-                else:
-                    cur_diag.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,))
-                    cdrow = cur_diag.fetchone()
-                    if cdrow and cdrow[0]:
-                        diagnosis_text = cdrow[0]
+                self.bacsikham.setText(td[2] or "")
+                # also sync bottom editable doctor field
+                self.bacsi.setText(td[2] or "")
             except Exception:
-                diagnosis_text = ""
-            finally:
-                try:
-                    conn_diag.close()
-                except Exception:
-                    pass
-            # Lấy thông tin thuốc cho phiếu khám này
-            conn_drugs = get_connection()
-            cur_drugs = conn_drugs.cursor()
+                pass
             try:
-                cur_drugs.execute("""
-                    SELECT ctdt.ten_thuoc, ctdt.so_luong, ctdt.don_vi, ctdt.lieu_dung
-                    FROM chi_tiet_don_thuoc ctdt
-                    JOIN don_thuoc dt ON ctdt.don_thuoc_id = dt.id
-                    WHERE dt.phieu_kham_id = ?
-                    ORDER BY ctdt.id
-                """, (phieu_id,))
-                medicines = cur_drugs.fetchall()
+                self.tinhtrang.setText(td[3] or "")
             except Exception:
-                medicines = []
-            finally:
-                conn_drugs.close()
-            
+                pass
+            try:
+                # display date of reception in top panel
+                self.ngaytiepdon.setText(td[4] or "")
+                # and set bottom editable date (QDateEdit) if possible
+                if td[4]:
+                    qd = QDate.fromString(td[4], "yyyy-MM-dd")
+                    if qd.isValid():
+                        try:
+                            self.ngaylap.setDate(qd)
+                            try:
+                                self.display_ngaylap_top.setText(qd.toString("dd/MM/yyyy"))
+                            except Exception:
+                                pass
+                        except Exception:
+                            pass
+            except Exception:
+                pass
+            try:
+                # tiền khám từ tiep_don
+                self.tienkham.setText(str(td[5] or "0"))
+            except Exception:
+                pass
+
+        # populate history table
+        self.table_history.setRowCount(0)
+        for phieu_id, ngay_lap, bac_si, diagnosis_text, medicines in data["history"]:
             # Tạo chuỗi thuốc
             medicine_text = ""
             if medicines:
@@ -990,11 +1006,11 @@ class TaoPhieuKham(QWidget):
                         med_str += f" ({lieu_dung})"
                     medicine_lines.append(med_str)
                 medicine_text = "\n".join(medicine_lines)
-            
+
             row = self.table_history.rowCount()
             self.table_history.insertRow(row)
-            self.table_history.setItem(row, 0, QTableWidgetItem(str(r[1] or "")))
-            self.table_history.setItem(row, 1, QTableWidgetItem(str(r[2] or "")))
+            self.table_history.setItem(row, 0, QTableWidgetItem(str(ngay_lap or "")))
+            self.table_history.setItem(row, 1, QTableWidgetItem(str(bac_si or "")))
             self.table_history.setItem(row, 2, QTableWidgetItem(str(diagnosis_text or "")))
             # Cột thuốc: hiển thị danh sách thuốc
             med_item = QTableWidgetItem(medicine_text)
@@ -1203,108 +1219,54 @@ class TaoPhieuKham(QWidget):
         self.cannang.setText(vital_backup["cannang"])
         self.chieucao.setText(vital_backup["chieucao"])
 
-    def load_kham_lam_sang_from_chi_dinh(self, benh_nhan_id):
-        """Load khám lâm sàng từ chi_dinh."""
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            logger.debug("load_kham_lam_sang_from_chi_dinh: benh_nhan_id=%s", benh_nhan_id)
+    def load_kham_lam_sang_from_chi_dinh(self, cd_result):
+        """Điền khám lâm sàng từ chi_dinh mới nhất của phiếu khám gần nhất (cd_result = (kham_lam_sang, id))."""
+        logger.debug("chi_dinh query result: %s", cd_result)
+        if cd_result and cd_result[0]:
+            kham_lam_sang = cd_result[0]
+            chi_dinh_id = cd_result[1]
 
-            # Bước 1: Lấy phiếu khám mới nhất của bệnh nhân
-            cur.execute("SELECT id FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY id DESC LIMIT 1", (benh_nhan_id,))
-            pk_result = cur.fetchone()
-            logger.debug("Latest phieu_kham: %s", pk_result)
-
-            if not pk_result:
-                logger.debug("No phieu_kham found for benh_nhan_id=%s", benh_nhan_id)
-                conn.close()
-                return
-
-            phieu_kham_id = pk_result[0]
-
-            # Bước 2: Lấy chi_dinh mới nhất của phiếu khám đó
-            cur.execute("""
-                SELECT kham_lam_sang, id
-                FROM chi_dinh
-                WHERE phieu_kham_id = ?
-                ORDER BY id DESC LIMIT 1
-            """, (phieu_kham_id,))
-            cd_result = cur.fetchone()
-            logger.debug("chi_dinh query result: %s", cd_result)
-
-            if cd_result and cd_result[0]:
-                kham_lam_sang = cd_result[0]
-                chi_dinh_id = cd_result[1]
-
-                self.khamlamsang.setPlainText(kham_lam_sang)
-                try:
-                    self._kham_load_source.setText(f"Loaded from: chi_dinh (id={chi_dinh_id})")
-                except Exception:
-                    pass
-                logger.debug("Loaded kham_lam_sang from chi_dinh: %s...", (kham_lam_sang[:50] if len(kham_lam_sang) > 50 else kham_lam_sang))
-            else:
-                logger.debug("No kham_lam_sang in chi_dinh for phieu_kham_id=%s", phieu_kham_id)
+            self.khamlamsang.setPlainText(kham_lam_sang)
+            try:
+                self._kham_load_source.setText(f"Loaded from: chi_dinh (id={chi_dinh_id})")
+            except Exception:
+                pass
+            logger.debug("Loaded kham_lam_sang from chi_dinh: %s...", (kham_lam_sang[:50] if len(kham_lam_sang) > 50 else kham_lam_sang))
+
+    def load_chi_tiet_kham(self, row, cd_result=None):
+        """Điền thông tin chi tiết khám (dòng chi_tiet_phieu_kham) lên form."""
+        if row:
+            self.nhietdo.setText(str(row[0]) if row[0] is not None else "")
+            self.nhiptim.setText(str(row[1]) if row[1] is not None else "")
+            self.huyetap.setText(row[2] or "")
+            self.nhiptho.setText(str(row[3]) if row[3] is not None else "")
+            self.cannang.setText(str(row[4]) if row[4] is not None else "")
+            self.chieucao.setText(str(row[5]) if row[5] is not None else "")
+            self.diungthuoc.setText(row[6] or "")
+            self.tiensubanthan.setText(row[7] or "")
+            self.tiensugiadinh.setText(row[8] or "")
+            self.benhkemtheo.setText(row[9] or "")
+            # Load ICD10 codes (stored as comma-separated string)
+            icd10_codes_str = row[10] or ""
+            self.selected_icd10_codes = [code.strip() for code in icd10_codes_str.split(",") if code.strip()]
+            self.update_icd10_display()
+            # row[11] = chidinh_cls, row[12] = kham_lam_sang, row[13] = chan_doan, row[14] = ket_luan, row[15] = ghi_chu_kham
+            try:
+                self.chidinh_cls.setPlainText(row[11] or "")
+            except Exception:
+                pass
 
-            conn.close()
-        except Exception:
-            logger.exception("Exception in load_kham_lam_sang_from_chi_dinh")
+            # Priority: kham_lam_sang từ chi_dinh
+            kham_from_chi_dinh = cd_result[0] if cd_result and cd_result[0] else None
+            # Use chi_dinh data if available, otherwise fall back to chi_tiet_phieu_kham
+            self.khamlamsang.setPlainText(kham_from_chi_dinh or row[12] or "")
+            # chan_doan giữ nguyên từ chi_tiet_phieu_kham (load từ ICD10, không từ chi_dinh)
+            self.chandoan.setPlainText(row[13] or "")
+            self.ketluan.setPlainText(row[14] or "")
+            self.ghichu.setPlainText(row[15] or "")
+        else:
+            self.clear_chi_tiet_kham()
 
-    def load_chi_tiet_kham(self, phieu_kham_id):
-        """Load thông tin chi tiết khám từ CSDL."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("""
-                SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho,
-                       can_nang, chieu_cao, di_ung_thuoc, tien_su_ban_than,
-                       tien_su_gia_dinh, benh_kem_theo, icd10, chidinh_cls,
-                       kham_lam_sang, chan_doan, ket_luan, ghi_chu_kham
-                FROM chi_tiet_phieu_kham
-                WHERE phieu_kham_id = ?
-            """, (phieu_kham_id,))
-            row = cur.fetchone()
-            if row:
-                self.nhietdo.setText(str(row[0]) if row[0] is not None else "")
-                self.nhiptim.setText(str(row[1]) if row[1] is not None else "")
-                self.huyetap.setText(row[2] or "")
-                self.nhiptho.setText(str(row[3]) if row[3] is not None else "")
-                self.cannang.setText(str(row[4]) if row[4] is not None else "")
-                self.chieucao.setText(str(row[5]) if row[5] is not None else "")
-                self.diungthuoc.setText(row[6] or "")
-                self.tiensubanthan.setText(row[7] or "")
-                self.tiensugiadinh.setText(row[8] or "")
-                self.benhkemtheo.setText(row[9] or "")
-                # Load ICD10 codes (stored as comma-separated string)
-                icd10_codes_str = row[10] or ""
-                self.selected_icd10_codes = [code.strip() for code in icd10_codes_str.split(",") if code.strip()]
-                self.update_icd10_display()
-                # row[11] = chidinh_cls, row[12] = kham_lam_sang, row[13] = chan_doan, row[14] = ket_luan, row[15] = ghi_chu_kham
-                try:
-                    self.chidinh_cls.setPlainText(row[11] or "")
-                except Exception:
-                    pass
-                
-                # Priority: Load kham_lam_sang từ chi_dinh
-                kham_from_chi_dinh = None
-                try:
-                    cur.execute("SELECT kham_lam_sang FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_kham_id,))
-                    cd = cur.fetchone()
-                    if cd and cd[0]:
-                        kham_from_chi_dinh = cd[0]
-                except Exception as e:
-                    logger.exception("Error loading kham_lam_sang from chi_dinh in load_chi_tiet_kham")
-                
-                # Use chi_dinh data if available, otherwise fall back to chi_tiet_phieu_kham
-                self.khamlamsang.setPlainText(kham_from_chi_dinh or row[12] or "")
-                # chan_doan giữ nguyên từ chi_tiet_phieu_kham (load từ ICD10, không từ chi_dinh)
-                self.chandoan.setPlainText(row[13] or "")
-                self.ketluan.setPlainText(row[14] or "")
-                self.ghichu.setPlainText(row[15] or "")
-            else:
-                self.clear_chi_tiet_kham()
-        finally:
-            conn.close()
-            
     def on_reset(self):
         self.hoten.setCurrentIndex(-1)  # Updated from combo_bn to hoten
         self.ngaylap.setDate(QDate.currentDate())
@@ -1328,29 +1290,11 @@ class TaoPhieuKham(QWidget):
         self.clear_chi_tiet_kham()
 
     def show_phieu_kham_details(self, phieu_id):
-        """Hiển thị dialog chi tiết cho một phiếu khám."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT so_phieu, benh_nhan_id, ngay_lap, bac_si, phong_kham, tong_tien FROM phieu_kham WHERE id = ?", (phieu_id,))
-            pk = cur.fetchone()
-            cur.execute("SELECT nhiet_do, nhip_tim, huyet_ap, nhip_tho, can_nang, chieu_cao, di_ung_thuoc, tien_su_ban_than, tien_su_gia_dinh, benh_kem_theo, icd10, chidinh_cls, kham_lam_sang, chan_doan, ket_luan, ghi_chu_kham FROM chi_tiet_phieu_kham WHERE phieu_kham_id = ?", (phieu_id,))
-            detail = cur.fetchone()
-            # Also collect chi_dinh (danh sách dịch vụ)
-            cur.execute("SELECT ten_dich_vu, so_luong, don_gia FROM chi_dinh WHERE phieu_kham_id = ?", (phieu_id,))
-            services = cur.fetchall()
-            # Lấy thông tin thuốc từ đơn thuốc
-            cur.execute("""
-                SELECT ctdt.ten_thuoc, ctdt.so_luong, ctdt.don_vi, ctdt.lieu_dung, ctdt.sang, ctdt.trua, ctdt.chieu, ctdt.toi
-                FROM chi_tiet_don_thuoc ctdt
-                JOIN don_thuoc dt ON ctdt.don_thuoc_id = dt.id
-                WHERE dt.phieu_kham_id = ?
-                ORDER BY ctdt.id
-            """, (phieu_id,))
-            medicines = cur.fetchall()
-        finally:
-            conn.close()
+        """Hiển thị dialog chi tiết cho một phiếu khám (dữ liệu đọc chạy nền)."""
+        executor.submit(_fetch_phieu_kham_details, phieu_id, key='tao_phieu_kham.details', owner=self,
+                        on_result=lambda res: self._show_phieu_kham_dialog(phieu_id, *res))
 
+    def _show_phieu_kham_dialog(self, phieu_id, pk, detail, chan_doan_ban_dau, services, medicines):
         dlg = QDialog(self)
         dlg.setWindowTitle(f"Chi tiết phiếu {pk[0] if pk else phieu_id}")
         layout = QVBoxLayout(dlg)
@@ -1365,14 +1309,7 @@ class TaoPhieuKham(QWidget):
             if detail and len(detail) > 13 and detail[13]:
                 diagnosis_text = detail[13]
             else:
-                try:
-                    cur2 = get_connection().cursor()
-                    cur2.execute("SELECT chan_doan_ban_dau FROM chi_dinh WHERE phieu_kham_id = ? ORDER BY id DESC LIMIT 1", (phieu_id,))
-                    cdv = cur2.fetchone()
-                    if cdv and cdv[0]:
-                        diagnosis_text = cdv[0]
-                except Exception:
-                    diagnosis_text = ""
+                diagnosis_text = chan_doan_ban_dau or ""
             text.append(f"Chẩn đoán (phiếu): {diagnosis_text}")
             text.append(f"Tổng tiền: {pk[5]}")
             if detail:
@@ -1658,18 +1595,8 @@ class TaoPhieuKham(QWidget):
                 if "Mã:" in text:
                     try:
                         ma = text.split("Mã:")[1].split()[0].strip()
-                        conn = get_connection()
-                        cur = conn.cursor()
-                        cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                        r = cur.fetchone()
-                        conn.close()
-                        if r and r[0]:
-                            target_id = r[0]
-                            for i in range(self.hoten.count()):
-                                if self.hoten.itemData(i, Qt.UserRole) == target_id:
-                                    self.hoten.setCurrentIndex(i)
-                                    self.on_select_benh_nhan(i)
-                                    return
+                        if ma:
+                            return self._select_by_ma_hoso(ma, text.strip())
                     except Exception:
                         pass
                 idx = self.hoten.findText(text.strip(), Qt.MatchExactly)
@@ -1687,18 +1614,8 @@ class TaoPhieuKham(QWidget):
                 if "Mã:" in text:
                     try:
                         ma = text.split("Mã:")[1].split()[0].strip()
-                        conn = get_connection()
-                        cur = conn.cursor()
-                        cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                        r = cur.fetchone()
-                        conn.close()
-                        if r and r[0]:
-                            target_id = r[0]
-                            for i in range(self.hoten.count()):
-                                if self.hoten.itemData(i, Qt.UserRole) == target_id:
-                                    self.hoten.setCurrentIndex(i)
-                                    self.on_select_benh_nhan(i)
-                                    return
+                        if ma:
+                            return self._select_by_ma_hoso(ma, text.strip())
                     except Exception:
                         pass
                 idx = self.hoten.findText(text, Qt.MatchExactly)
@@ -1718,59 +1635,12 @@ class TaoPhieuKham(QWidget):
                 self._on_hoten_editing_finished = _on_hoten_editing_finished_local
         except Exception:
             pass
-        """Load danh sách bệnh nhân vào combobox."""
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-                cur.execute("""
-                    SELECT b.id, b.ho_ten, b.dien_thoai, b.ngay_sinh, b.so_cccd,
-                        (
-                            SELECT ma_hoso FROM tiep_don td WHERE td.benh_nhan_id = b.id ORDER BY td.id DESC LIMIT 1
-                        ) as ma_hoso
-                    FROM benh_nhan b
-                    ORDER BY b.ho_ten
-                """)
-                rows = cur.fetchall()
-        except Exception:
-            rows = []
-        finally:
-            conn.close()
-
-        self.hoten.clear()
-        # Thêm placeholder
-        self.hoten.addItem("-- Chọn bệnh nhân --", None)
-        display_texts = []
-        for r in rows:
-            pid, name, phone, dob, cccd, ma_hoso = r
-            parts = []
-            if phone:
-                parts.append(str(phone))
-            if cccd:
-                parts.append(str(cccd))
-            if dob:
-                try:
-                    parts.append(str(dob).split('-')[0])
-                except Exception:
-                    pass
-            if ma_hoso:
-                disp = f"{name} — Mã:{ma_hoso}"
-            else:
-                disp = f"{name} — ID:{pid}"
-
-            if parts:
-                disp += ' — ' + ' / '.join(parts)
-
-            # add item and store benh_nhan id in itemData (UserRole)
-            self.hoten.addItem(disp)
-            idx = self.hoten.count() - 1
-            self.hoten.setItemData(idx, pid, Qt.UserRole)
-            display_texts.append(disp)
+        """Đặt lại combobox bệnh nhân: chỉ placeholder; completer (chỉ mục dùng chung) thêm bệnh nhân được chọn."""
+        reset_patient_combo(self.hoten, "-- Chọn bệnh nhân --")
 
         try:
             if self.completer:
-                model = QStringListModel(display_texts)
-                self.completer.setModel(model)
-                # Connect completer to instance handler (created above)
+                # Completer tự lấy gợi ý từ chỉ mục khi gõ. Connect completer to instance handler (created above)
                 try:
                     # Disconnect existing to avoid duplicate connections
                     self.completer.activated.disconnect()
@@ -1802,6 +1672,19 @@ class TaoPhieuKham(QWidget):
         except Exception:
             pass
 
+    def _select_by_ma_hoso(self, ma, text):
+        """Chọn bệnh nhân theo mã hồ sơ (tra tiep_don chạy nền); không thấy thì chọn theo chuỗi hiển thị."""
+        def _select(benh_nhan_id):
+            i = patient_item_index(self.hoten, benh_nhan_id) if benh_nhan_id else -1
+            if i < 0:
+                i = self.hoten.findText(text, Qt.MatchExactly)
+            if i >= 0:
+                self.hoten.setCurrentIndex(i)
+                self.on_select_benh_nhan(i)
+
+        executor.submit(_fetch_benh_nhan_id_by_ma_hoso, ma, key='tao_phieu_kham.ma_hoso', owner=self,
+                        on_result=_select)
+
     def load_icd10_list(self):
         """Load danh sách mã ICD10 từ database (dùng khi khởi tạo)."""
         conn = get_connection()
@@ -1823,14 +1706,8 @@ class TaoPhieuKham(QWidget):
         self.load_benh_nhan_list()
         if benh_nhan_id:
             try:
-                idx = self.hoten.findData(benh_nhan_id)
-                if idx is None or idx < 0:
-                    # Try linear search as fallback
-                    for i in range(self.hoten.count()):
-                        if self.hoten.itemData(i) == benh_nhan_id:
-                            idx = i
-                            break
-                if idx is not None and idx >= 0:
+                idx = patient_item_index(self.hoten, benh_nhan_id)
+                if idx >= 0:
                     self.hoten.setCurrentIndex(idx)
                     # explicitly call handler to load full data
                     try:
@@ -2141,7 +2018,7 @@ class TaoPhieuKham(QWidget):
         """Tải lại form (reinit UI) khi code thay đổi."""
         try:
             # Lưu lại các giá trị quan trọng
-            current_bn_idx = self.hoten.currentIndex()  # Updated from combo_bn to hoten
+            current_bn_id = self.hoten.currentData()
             current_date = self.ngaylap.date()
             
             # Tải lại UI
@@ -2149,8 +2026,9 @@ class TaoPhieuKham(QWidget):
             self.__init__(parent=self.parent())  # Reinit với parent cũ
             
             # Khôi phục lại các giá trị
+            current_bn_idx = patient_item_index(self.hoten, current_bn_id)
             if current_bn_idx >= 0:
-                self.hoten.setCurrentIndex(current_bn_idx)  # Updated from combo_bn to hoten
+                self.hoten.setCurrentIndex(current_bn_idx)
             self.ngaylap.setDate(current_date)
         except Exception as e:
             QMessageBox.warning(self, "Lỗi", f"Không thể tải lại form: {e}")
@@ -2174,7 +2052,7 @@ class TaoPhieuKham(QWidget):
             form_chidinh.setWindowTitle("Chỉ định dịch vụ")
             # Chọn bệnh nhân tương ứng trong form chỉ định
             try:
-                idx = form_chidinh.hoten.findData(benh_nhan_id)
+                idx = patient_item_index(form_chidinh.hoten, benh_nhan_id)
             except Exception:
                 idx = -1
             if idx is not None and idx >= 0:
@@ -1,7 +1,7 @@
 from PyQt5.QtWidgets import (
     QWidget, QLabel, QLineEdit, QComboBox, QCheckBox, QDateEdit,
     QTableWidget, QPushButton, QVBoxLayout, QHBoxLayout,
-    QGridLayout, QGroupBox, QSplitter, QHeaderView, QCompleter,
+    QGridLayout, QGroupBox, QSplitter, QHeaderView,
     QTableWidgetItem, QMessageBox, QAbstractItemView
 )
 # Sinh file PDF
@@ -24,9 +24,11 @@ except Exception as _e:
     # Nếu có lỗi khi đăng ký font thì log và tiếp tục — không nên làm crash toàn app
     print(f"⚠️ Lỗi khi đăng ký font ArialUnicode: {_e}")
 
-from PyQt5.QtCore import Qt, QDate, QStringListModel
+from PyQt5.QtCore import Qt, QDate
 from PyQt5.QtGui import QFont
-from database import get_connection, initialize_database
+from database import get_connection, initialize_database, next_code, next_daily_stt, peek_code, pool
+from db_executor import executor
+from forms.patient_search import PatientCompleter, reset_patient_combo
 import logging
 from signals import app_signals
 
@@ -38,6 +40,93 @@ logging.basicConfig(
 )
 initialize_database()
 
+
+# --- Các hàm đọc dữ liệu chạy trên worker thread (qua db_executor), không đụng tới widget ---
+def _fetch_danh_sach_tiep_don(limit):
+    with pool.read() as conn:
+        cur = conn.cursor()
+        # Lấy tổng số bản ghi để tính số trang
+        cur.execute("SELECT COUNT(*) FROM tiep_don")
+        total_records = cur.fetchone()[0]
+        # Chỉ lấy số lượng bản ghi theo limit, sắp xếp theo ngày mới nhất
+        cur.execute("""
+            SELECT td.ma_hoso, td.ngay_tiep_don, td.phong_kham, bn.ho_ten, td.bac_si_kham, td.tinh_trang
+            FROM tiep_don td
+            JOIN benh_nhan bn ON td.benh_nhan_id = bn.id
+            ORDER BY td.ngay_tiep_don DESC
+            LIMIT ?
+        """, (limit,))
+        return total_records, cur.fetchall()
+
+
+def _fetch_thongke_luot_tiepdon(today):
+    with pool.read() as conn:
+        # Chỉ lấy thống kê của ngày hiện tại
+        return conn.execute("""
+            SELECT 
+                t.phong_kham, 
+                COUNT(t.ma_hoso) as total_tiepdon,
+                SUM(CASE WHEN t.tinh_trang LIKE '%đã khám%' OR t.tinh_trang LIKE '%hoàn thành%' 
+                    THEN 1 ELSE 0 END) as total_dakham
+            FROM tiep_don t
+            WHERE date(t.ngay_tiep_don) = ?
+            GROUP BY t.phong_kham
+        """, (today,)).fetchall()
+
+
+def _fetch_patient(pid):
+    """(bệnh nhân, lần tiếp đón mới nhất) dạng dict; (None, None) nếu không có bệnh nhân."""
+    with pool.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM benh_nhan WHERE id = ? LIMIT 1", (pid,))
+        row = cur.fetchone()
+        if not row:
+            return None, None
+        data = dict(zip([desc[0] for desc in cur.description], row))
+        cur.execute("SELECT * FROM tiep_don WHERE benh_nhan_id = ? ORDER BY ngay_tiep_don DESC LIMIT 1", (pid,))
+        tiepdon = cur.fetchone()
+        td_data = dict(zip([desc[0] for desc in cur.description], tiepdon)) if tiepdon else None
+        return data, td_data
+
+
+def _fetch_patient_by_name(ho_ten):
+    """(bệnh nhân, lần tiếp đón mới nhất, tìm theo mã hồ sơ?) cho chuỗi chọn từ combobox.
+
+    Nếu chuỗi chứa Mã hồ sơ (ví dụ 'Họ Tên — Mã:HS005') thì tìm benh_nhan_id theo ma_hoso,
+    nếu không (hoặc không thấy) thì tìm theo tên.
+    """
+    by_ma_hoso = False
+    with pool.read() as conn:
+        r = None
+        if isinstance(ho_ten, str) and "Mã:" in ho_ten:
+            ma = ho_ten.split("Mã:")[1].split()
+            ma = ma[0].strip().strip('—').strip() if ma else ""
+            if ma:
+                r = conn.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,)).fetchone()
+                by_ma_hoso = bool(r and r[0])
+        if not by_ma_hoso:
+            r = conn.execute("SELECT id FROM benh_nhan WHERE ho_ten = ? LIMIT 1", (ho_ten,)).fetchone()
+    if not r:
+        return None, None, False
+    return _fetch_patient(r[0]) + (by_ma_hoso,)
+
+
+def _fetch_hoso(ma_hoso):
+    with pool.read() as conn:
+        return conn.execute("""
+            SELECT 
+                t.ma_hoso, t.ngay_tiep_don, t.phong_kham, t.bac_si_kham, 
+                t.tinh_trang, t.tien_kham, t.nv_tiepdon, t.huyet_ap, 
+                t.nhiet_do, t.chieu_cao, t.can_nang, t.nhip_tho, t.nhip_tim,
+                b.ho_ten, b.gioi_tinh, b.ngay_sinh, b.tuoi, b.dia_chi,
+                b.dien_thoai, b.so_cccd, b.doi_tuong, b.nghe_nghiep,
+                b.nguoi_gioi_thieu, b.loai_kham, t.benh_nhan_id
+            FROM tiep_don t
+            JOIN benh_nhan b ON t.benh_nhan_id = b.id
+            WHERE t.ma_hoso = ?
+        """, (ma_hoso,)).fetchone()
+
+
 class TiepDonKham(QWidget):
     def __init__(self, role=None):
         self.is_resetting = False # Tránh gọi đệ quy khi reset form
@@ -72,60 +161,9 @@ class TiepDonKham(QWidget):
 
         # Khi khởi tạo, load danh sách bệnh nhân vào combobox
     def load_benh_nhan_list(self):
-        conn = get_connection()
-        cur = conn.cursor()
-        # Lấy thêm id và một số trường để phân biệt các bản ghi có cùng tên
-        # Lấy kèm mã hồ sơ gần nhất cho mỗi bệnh nhân (nếu có)
-        cur.execute("""
-            SELECT b.id, b.ho_ten, b.dien_thoai, b.ngay_sinh, b.so_cccd,
-                (
-                    SELECT ma_hoso FROM tiep_don td WHERE td.benh_nhan_id = b.id ORDER BY td.id DESC LIMIT 1
-                ) as ma_hoso
-            FROM benh_nhan b
-            ORDER BY b.ho_ten
-        """)
-        rows = cur.fetchall()
-        # Tạo display text chứa thông tin phân biệt (tên — ID — SDT/CCCD/NGS)
-        names = []
-        items = []  # list of tuples (display, id)
-        for r in rows:
-            pid, name, phone, dob, cccd, ma_hoso = r
-            extra = []
-            if phone:
-                extra.append(str(phone))
-            if cccd:
-                extra.append(str(cccd))
-            # Nếu có ngày sinh, show năm sinh ngắn để dễ đọc
-            if dob:
-                try:
-                    yyyy = str(dob).split("-")[0]
-                    extra.append(yyyy)
-                except Exception:
-                    pass
-            display = name
-            # ưu tiên hiển thị mã hồ sơ để dễ phân biệt (mã HSxxx). Nếu chưa có ma_hoso, hiển thị id nội bộ
-            if ma_hoso:
-                # ma_hoso có thể là None — sử dụng khi có giá trị
-                display += f" — Mã:{ma_hoso}"
-            else:
-                display += f" — ID:{pid}"
-            if extra:
-                display += f" — {' / '.join(extra)}"
-            items.append((display, pid))
-        conn.close()
-    
-        # Gắn danh sách vào combobox và completer
-        self.hoten.clear()
-        display_texts = []
-        for display, pid in items:
-            # lưu id trong itemData để khi người dùng chọn có thể lấy pid
-            self.hoten.addItem(display)
-            idx = self.hoten.count() - 1
-            self.hoten.setItemData(idx, pid, Qt.UserRole)
-            display_texts.append(display)
-
-        model = QStringListModel(display_texts)
-        self.completer.setModel(model)
+        # Không nạp cả danh sách bệnh nhân vào combobox: completer tìm top-K trong chỉ mục
+        # bệnh nhân dùng chung khi gõ và thêm bệnh nhân được chọn vào combobox (itemData = id)
+        reset_patient_combo(self.hoten)
     
     def update_age(self):
         today = QDate.currentDate()
@@ -159,10 +197,8 @@ class TiepDonKham(QWidget):
         self.hoten = QComboBox()
         self.hoten.setEditable(True)
 
-        # Completer gợi ý
-        self.completer = QCompleter()
-        self.completer.setCaseSensitivity(False)
-        self.hoten.setCompleter(self.completer)
+        # Completer gợi ý (tìm không dấu / SĐT / CCCD / mã hồ sơ trong chỉ mục bệnh nhân)
+        self.completer = PatientCompleter(self.hoten)
         form_bn.addWidget(self.hoten, 0, 1)
 
         # Giới tính
@@ -532,20 +568,11 @@ class TiepDonKham(QWidget):
 
 
     # ---------------------------
-    # Sinh số hồ sơ (TD + yyyymmdd + seq)
+    # Sinh số hồ sơ (HS001, HS002, ...)
     # ---------------------------
     def generate_mahoso(self, conn):
-        cur = conn.cursor()
-        cur.execute("SELECT ma_hoso FROM tiep_don ORDER BY id DESC LIMIT 1")
-        result = cur.fetchone()
-
-        if result and result[0] and isinstance(result[0], str) and result[0].startswith("HS"):
-            last_num = int(result[0][2:])  # bỏ "HS"
-        else:
-            last_num = 0
-
-        new_num = last_num + 1
-        return f"HS{new_num:03d}"  # HS001, HS002, ...
+        # Cấp từ dãy 'ma_hoso' (bảng day_so): hai bàn tiếp đón lưu cùng lúc không bị trùng số
+        return next_code('ma_hoso')
 
 
 
@@ -921,14 +948,9 @@ class TiepDonKham(QWidget):
             self.nhiptim.clear()
             self.ngaylap.setDate(QDate.currentDate())
 
-            # Sinh số hồ sơ mới
+            # Số hồ sơ dự kiến (số thật được cấp khi lưu)
             try:
-                conn = get_connection()
-                cur = conn.cursor()
-                cur.execute("SELECT COUNT(*) FROM tiep_don")
-                count = cur.fetchone()[0] or 0
-                self.mahoso.setText(f"HS{count + 1:03d}")
-                conn.close()
+                self.mahoso.setText(peek_code('ma_hoso'))
             except Exception as e:
                 print("⚠️ Không thể sinh số hồ sơ mới:", e)
                 self.mahoso.setText("HS001")
@@ -975,25 +997,11 @@ class TiepDonKham(QWidget):
             
         # Khóa form trước khi load dữ liệu
         self.set_form_editable(False)
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("""
-                SELECT 
-                    t.ma_hoso, t.ngay_tiep_don, t.phong_kham, t.bac_si_kham, 
-                    t.tinh_trang, t.tien_kham, t.nv_tiepdon, t.huyet_ap, 
-                    t.nhiet_do, t.chieu_cao, t.can_nang, t.nhip_tho, t.nhip_tim,
-                    b.ho_ten, b.gioi_tinh, b.ngay_sinh, b.tuoi, b.dia_chi,
-                    b.dien_thoai, b.so_cccd, b.doi_tuong, b.nghe_nghiep,
-                    b.nguoi_gioi_thieu, b.loai_kham
-                FROM tiep_don t
-                JOIN benh_nhan b ON t.benh_nhan_id = b.id
-                WHERE t.ma_hoso = ?
-            """, (ma_hoso,))
-            record = cur.fetchone()
-        finally:
-            conn.close()
+        executor.submit(_fetch_hoso, ma_hoso, key='tiep_don_kham.hoso', owner=self,
+                        on_result=self._fill_hoso,
+                        on_error=lambda e: print("❌ Lỗi khi load hồ sơ:", e))
 
+    def _fill_hoso(self, record):
         if not record:
             return
 
@@ -1135,31 +1143,14 @@ class TiepDonKham(QWidget):
             pass
 
         # Emit patient_selected signal with benh_nhan id when known
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            # Lấy benh_nhan_id từ bảng tiep_don theo ma_hoso để đảm bảo đúng bản ghi
+        rid = record[24]
+        if rid:
             try:
-                mid = data_td.get("ma_hoso")
+                import signals as sig_module
+                sig_module.current_patient_id = int(rid)
+                app_signals.patient_selected.emit(int(rid))
             except Exception:
-                mid = None
-
-            if mid:
-                cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (mid,))
-                rid = cur.fetchone()
-            else:
-                rid = None
-
-            conn.close()
-            if rid and rid[0]:
-                try:
-                    import signals as sig_module
-                    sig_module.current_patient_id = int(rid[0])
-                    app_signals.patient_selected.emit(int(rid[0]))
-                except Exception:
-                    pass
-        except Exception:
-            pass
+                pass
 
     def luu_du_lieu(self):
         """Lưu các thay đổi khi đang ở chế độ sửa (được gọi bởi nút 'Lưu')."""
@@ -1380,7 +1371,7 @@ class TiepDonKham(QWidget):
         from reportlab.pdfbase import pdfmetrics
         from reportlab.pdfbase.ttfonts import TTFont
         from datetime import datetime
-        import os, json
+        import os
 
         # 🟢 Đăng ký font Unicode tiếng Việt
         font_path = os.path.join(os.getcwd(), "forms", "fonts", "arial.ttf")
@@ -1394,23 +1385,11 @@ class TiepDonKham(QWidget):
         namsinh = self.tuoi.text().strip()
         ngay = datetime.now().strftime("%d tháng %m năm %Y")
 
-        # 🟢 Tạo thư mục output và file lưu số thứ tự
+        # 🟢 Tạo thư mục output
         os.makedirs("output", exist_ok=True)
-        counter_file = os.path.join("output", "stt_counter.json")
-
-        today = datetime.now().strftime("%Y-%m-%d")
-        stt = 1
 
-        # 🟢 Đọc số thứ tự cũ (nếu có)
-        if os.path.exists(counter_file):
-            with open(counter_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if data.get("date") == today:
-                    stt = data.get("stt", 0) + 1
-
-        # 🟢 Ghi lại STT mới và ngày hiện tại
-        with open(counter_file, "w", encoding="utf-8") as f:
-            json.dump({"date": today, "stt": stt}, f, ensure_ascii=False, indent=2)
+        # 🟢 Cấp STT trong ngày từ DB (dùng chung giữa các bàn tiếp đón, tự về 1 khi sang ngày mới)
+        stt = next_daily_stt()
 
         # 🟢 Tạo file PDF
         file_path = os.path.join("output", f"STT_{self.selected_ma_hoso}.pdf")
@@ -1545,140 +1524,32 @@ class TiepDonKham(QWidget):
     # Load dữ liệu bệnh nhân vào form (khi chọn từ combobox)
     # ---------------------------
     def load_patient_into_form(self, ho_ten):
-        try:
-            # Nếu người dùng truyền chuỗi chứa Mã hồ sơ (ví dụ 'Họ Tên — Mã:HS005'),
-            # tìm benh_nhan_id từ bảng tiep_don theo ma_hoso và load theo id đó.
-            if isinstance(ho_ten, str) and "Mã:" in ho_ten:
-                try:
-                    ma = ho_ten.split("Mã:")[1].split()[0].strip().strip('—').strip()
-                    if ma:
-                        cur = get_connection().cursor()
-                        cur.execute("SELECT benh_nhan_id FROM tiep_don WHERE ma_hoso = ? LIMIT 1", (ma,))
-                        r = cur.fetchone()
-                        try:
-                            cur.connection.close()
-                        except Exception:
-                            pass
-                        if r and r[0]:
-                            return self.load_patient_by_id(r[0])
-                except Exception:
-                    # nếu parse hoặc lookup thất bại, fallback sang tìm theo tên
-                    pass
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM benh_nhan WHERE ho_ten = ? LIMIT 1", (ho_ten,))
-            columns = [desc[0] for desc in cur.description]
-            row = cur.fetchone()
-            conn.close()
-
-            if not row:
-                return
-
-            data = dict(zip(columns, row))
+        # Tìm bệnh nhân (theo Mã hồ sơ trong chuỗi hoặc theo tên) và đọc dữ liệu chạy nền
+        executor.submit(_fetch_patient_by_name, ho_ten, key='tiep_don_kham.patient', owner=self,
+                        on_result=lambda res: self._fill_patient_by_name(ho_ten, *res),
+                        on_error=lambda e: print("❌ Lỗi khi load bệnh nhân:", e))
 
-            # Điền dữ liệu vào form
-            self.hoten.setCurrentText(data.get("ho_ten", ""))
-            self.gioitinh.setCurrentText(data.get("gioi_tinh", "Nam"))
-            if data.get("ngay_sinh"):
-                self.ngaysinh.setDate(QDate.fromString(data.get("ngay_sinh"), "yyyy-MM-dd"))
-            self.update_age()
-            self.diachi.setText(data.get("dia_chi", ""))
-            self.dienthoai.setText(data.get("dien_thoai", ""))
-            self.socccd.setText(data.get("so_cccd", ""))
-            self.doituong.setCurrentText(data.get("doi_tuong", "BHYT"))
-            self.nghenghiep.setText(data.get("nghe_nghiep", ""))
-            self.nguoigioithieu.setCurrentText(data.get("nguoi_gioi_thieu", "Bác sĩ"))
-            self.loaikham.setCurrentText(data.get("loai_kham", "Khám và tư vấn"))
-            self.hoten.setFocus()
+    def _fill_patient_by_name(self, ho_ten, data, td_data, by_ma_hoso):
+        if not data:
+            return
+        self._fill_patient(data.get('id'), data, td_data)
+        if not by_ma_hoso:
             self.hoten.setEditText(ho_ten)
 
-            # --- Load thêm thông tin tiếp đón ---
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT * FROM tiep_don 
-                WHERE benh_nhan_id = (
-                    SELECT id FROM benh_nhan WHERE ho_ten = ? LIMIT 1
-                )
-                ORDER BY ngay_tiep_don DESC LIMIT 1
-            """, (ho_ten,))
-            tiepdon = cur.fetchone()
-            columns = [desc[0] for desc in cur.description] if tiepdon else []
-            conn.close()
-
-            try:
-                if tiepdon:
-                    td_data = dict(zip(columns, tiepdon))
-
-                    # Hàm nhỏ để định dạng số
-                    def format_number(value):
-                        if value is None:
-                            return ""
-                        if isinstance(value, (int, float)):
-                            if float(value).is_integer():
-                                return str(int(value))
-                            return f"{value:.1f}".rstrip('0').rstrip('.')
-                        return str(value)
-
-                    # Hàm định dạng tiền
-                    def format_money(value):
-                        if value is None:
-                            return "0"
-                        try:
-                            num = float(value)
-                            return "{:,.0f}".format(num).replace(",", ".")
-                        except:
-                            return str(value)
-
-                    self.mahoso.setText(str(td_data.get("ma_hoso") or ""))
-                    self.phongkham.setCurrentText(str(td_data.get("phong_kham") or ""))
-                    self.bacsi.setCurrentText(str(td_data.get("bac_si_kham") or ""))
-                    self.ngaylap.setDate(QDate.fromString(str(td_data.get("ngay_tiep_don") or ""), "yyyy-MM-dd"))
-                    self.tinhtrang.setCurrentText(str(td_data.get("tinh_trang") or ""))
-                    self.nhiptho.setText(str(td_data.get("nhip_tho") or ""))
-                    self.nhiptim.setText(str(td_data.get("nhip_tim") or ""))
-                    self.nhanvientiepdon.setCurrentText(str(td_data.get("nv_tiepdon") or ""))
-                    self.huyetap.setText(str(td_data.get("huyet_ap") or ""))
-                    self.nhietdo.setText(format_number(td_data.get("nhiet_do")))
-                    self.chieucao.setText(format_number(td_data.get("chieu_cao")))
-                    self.cannang.setText(format_number(td_data.get("can_nang")))
-            except Exception as e:
-                print("❌ Lỗi khi load tiếp đón:", e)
-
-            # Phát tín hiệu patient_selected để các form khác phản ứng
-            try:
-                pid = data.get('id') or data.get('ID') or None
-                if pid:
-                    import signals as sig_module
-                    sig_module.current_patient_id = int(pid)
-                    app_signals.patient_selected.emit(int(pid))
-            except Exception:
-                pass
-
-
-
-        except Exception as e:
-            import traceback
-            print("❌ Lỗi khi load bệnh nhân:", e)
-            traceback.print_exc()
-
     # ---------------------------
     # Load bệnh nhân theo id (an toàn khi có nhiều người cùng tên)
     # ---------------------------
     def load_patient_by_id(self, pid):
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM benh_nhan WHERE id = ? LIMIT 1", (pid,))
-            columns = [desc[0] for desc in cur.description]
-            row = cur.fetchone()
-            conn.close()
+        # Đọc bệnh nhân + lần tiếp đón mới nhất chạy nền; chọn bệnh nhân khác trước khi xong sẽ huỷ lần cũ
+        executor.submit(_fetch_patient, pid, key='tiep_don_kham.patient', owner=self,
+                        on_result=lambda res: self._fill_patient(pid, *res),
+                        on_error=lambda e: print("❌ Lỗi khi load bệnh nhân theo id:", e))
 
-            if not row:
+    def _fill_patient(self, pid, data, td_data):
+        try:
+            if not data:
                 return
 
-            data = dict(zip(columns, row))
-
             # Điền dữ liệu vào form giống như load_patient_into_form
             self.hoten.setCurrentText(data.get("ho_ten", ""))
             self.gioitinh.setCurrentText(data.get("gioi_tinh", "Nam"))
@@ -1694,16 +1565,8 @@ class TiepDonKham(QWidget):
             self.loaikham.setCurrentText(data.get("loai_kham", "Khám và tư vấn"))
             self.hoten.setFocus()
 
-            # Tải bản ghi `tiep_don` mới nhất cho bệnh nhân này
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM tiep_don WHERE benh_nhan_id = ? ORDER BY ngay_tiep_don DESC LIMIT 1", (pid,))
-            tiepdon = cur.fetchone()
-            td_columns = [desc[0] for desc in cur.description] if tiepdon else []
-            conn.close()
-
-            if tiepdon:
-                td_data = dict(zip(td_columns, tiepdon))
+            # Bản ghi `tiep_don` mới nhất cho bệnh nhân này
+            if td_data:
                 # copy existing formatting logic
                 def format_number(value):
                     if value is None:
@@ -1777,14 +1640,6 @@ class TiepDonKham(QWidget):
             if not text:
                 return
 
-            model = self.completer.model()
-            # Ưu tiên dùng QStringListModel.stringList() khi có
-            try:
-                names = model.stringList()
-            except Exception:
-                # Dự phòng: lấy dữ liệu qua model index
-                names = [model.data(model.index(i, 0)) for i in range(model.rowCount())]
-
             # Chỉ tự động tải khi văn bản nhập khớp chính xác một mục hiển thị đầy đủ
             # (ví dụ: mục bao gồm ID và ta có thể lấy itemData).
             # Điều này tránh vô tình tải bệnh nhân đã có khi người dùng
@@ -1832,25 +1687,11 @@ class TiepDonKham(QWidget):
     # Load danh sách tiếp đón khám chữa bệnh
     # ---------------------------
     def load_danh_sach_tiep_don(self, limit=50):
-        """Load danh sách tiếp đón với giới hạn số lượng bản ghi"""
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        # Lấy tổng số bản ghi để tính số trang
-        cur.execute("SELECT COUNT(*) FROM tiep_don")
-        total_records = cur.fetchone()[0]
-        
-        # Chỉ lấy số lượng bản ghi theo limit, sắp xếp theo ngày mới nhất
-        cur.execute("""
-            SELECT td.ma_hoso, td.ngay_tiep_don, td.phong_kham, bn.ho_ten, td.bac_si_kham, td.tinh_trang
-            FROM tiep_don td
-            JOIN benh_nhan bn ON td.benh_nhan_id = bn.id
-            ORDER BY td.ngay_tiep_don DESC
-            LIMIT ?
-        """, (limit,))
-        records = cur.fetchall()
-        conn.close()
+        """Load danh sách tiếp đón với giới hạn số lượng bản ghi (truy vấn chạy nền)"""
+        executor.submit(_fetch_danh_sach_tiep_don, limit, key='tiep_don_kham.danh_sach', owner=self,
+                        on_result=lambda res: self._fill_danh_sach_tiep_don(*res, limit))
 
+    def _fill_danh_sach_tiep_don(self, total_records, records, limit):
         # Xóa dữ liệu cũ
         self.tableTiepDon.setRowCount(0)
 
@@ -1917,28 +1758,14 @@ class TiepDonKham(QWidget):
         self.table_thongke.setCellWidget(row, 2, checkbox)
 
     def load_thongke_luot_tiepdon(self):
-        """Load thống kê lượt tiếp đón từ DB, chỉ lấy thống kê của ngày hiện tại"""
-        from database import get_connection
+        """Load thống kê lượt tiếp đón từ DB, chỉ lấy thống kê của ngày hiện tại (truy vấn chạy nền)"""
         import datetime
-        
-        today = datetime.date.today().strftime("%Y-%m-%d")
-        conn = get_connection()
-        cur = conn.cursor()
 
-        # Chỉ lấy thống kê của ngày hiện tại
-        cur.execute("""
-            SELECT 
-                t.phong_kham, 
-                COUNT(t.ma_hoso) as total_tiepdon,
-                SUM(CASE WHEN t.tinh_trang LIKE '%đã khám%' OR t.tinh_trang LIKE '%hoàn thành%' 
-                    THEN 1 ELSE 0 END) as total_dakham
-            FROM tiep_don t
-            WHERE date(t.ngay_tiep_don) = ?
-            GROUP BY t.phong_kham
-        """, (today,))
-        rows = cur.fetchall()
-        conn.close()
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        executor.submit(_fetch_thongke_luot_tiepdon, today, key='tiep_don_kham.thongke', owner=self,
+                        on_result=self._fill_thongke_luot_tiepdon)
 
+    def _fill_thongke_luot_tiepdon(self, rows):
         # Xóa toàn bộ hàng cũ
         self.table_thongke.setRowCount(0)
 
@@ -1,9 +1,10 @@
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
-    QTableWidget, QTableWidgetItem, QMessageBox, QDateEdit, QDialog, QSizePolicy
+    QTableWidget, QTableWidgetItem, QTableView, QAbstractItemView, QMessageBox, QDateEdit, QDialog, QSizePolicy
 )
 from PyQt5.QtCore import Qt, QDate
-from database import get_xuat_thuoc_history, get_connection, get_prescriptions_for_patient
+from database import get_connection, get_prescriptions_for_patient
+from forms.lazy_table import LazySqlTableModel, ButtonDelegate
 
 
 class XemLichSuXuatThuoc(QWidget):
@@ -49,14 +50,22 @@ class XemLichSuXuatThuoc(QWidget):
         layout.addLayout(controls)
 
         # Bảng lịch sử
-        self.table = QTableWidget(0, 8)
-        self.table.setHorizontalHeaderLabels([
-            "Đơn ID", "Bác sĩ kê", "Bệnh nhân", "Số CCCD", 
-            "Xuất bởi", "Thời gian xuất", "Ghi chú", "Xem"
+        # row: id, don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu
+        # Bỏ qua ID (row[0]) và bắt đầu từ don_thuoc_id; cột "Xem" là nút vẽ bởi delegate
+        self.model = LazySqlTableModel([
+            ("Đơn ID", 1), ("Bác sĩ kê", 2), ("Bệnh nhân", 3), ("Số CCCD", 4),
+            ("Xuất bởi", 5), ("Thời gian xuất", 6), ("Ghi chú", 7), ("Xem", None),
         ])
-        self.table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table.setAlternatingRowColors(True)
+        # Nút "Xem chi tiết" ở cột 7
+        self.btn_delegate = ButtonDelegate("Xem", self.table)
+        self.btn_delegate.clicked.connect(lambda row: self.open_detail(self.model.row_values(row)[1]))
+        self.table.setItemDelegateForColumn(7, self.btn_delegate)
         self.table.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.table.setMinimumHeight(400)
         self.table.resizeColumnsToContents()
@@ -71,45 +80,18 @@ class XemLichSuXuatThuoc(QWidget):
         layout.addLayout(actions)
 
     def load_history(self):
-        """Load history from database."""
+        """Load history from database (lọc theo khoảng ngày trong SQL, đọc dần theo trang)."""
         try:
-            history = get_xuat_thuoc_history(limit=500)
-            self.table.setRowCount(0)
-            
             date_from = self.date_from.date().toString('yyyy-MM-dd')
             date_to = self.date_to.date().toString('yyyy-MM-dd')
-            
-            for row_data in history:
-                # Lọc theo khoảng ngày
-                thoi_gian = row_data[6]  # thoi_gian_xuat
-                if thoi_gian:
-                    date_part = thoi_gian.split(' ')[0]  # Extract date from datetime
-                    if not (date_from <= date_part <= date_to):
-                        continue
-                
-                r = self.table.rowCount()
-                self.table.insertRow(r)
-                
-                # row_data: id, don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu (dữ liệu hàng)
-                # Bỏ qua ID (row_data[0]) và bắt đầu từ don_thuoc_id
-                self.table.setItem(r, 0, QTableWidgetItem(str(row_data[1])))  # đơn ID
-                self.table.setItem(r, 1, QTableWidgetItem(str(row_data[2] or '')))  # bác sĩ
-                self.table.setItem(r, 2, QTableWidgetItem(str(row_data[3] or '')))  # bệnh nhân
-                self.table.setItem(r, 3, QTableWidgetItem(str(row_data[4] or '')))  # CCCD
-                self.table.setItem(r, 4, QTableWidgetItem(str(row_data[5] or '')))  # xuất bởi
-                self.table.setItem(r, 5, QTableWidgetItem(str(row_data[6] or '')))  # thời gian
-                self.table.setItem(r, 6, QTableWidgetItem(str(row_data[7] or '')))  # ghi chú
-                
-                # Thêm nút "Xem chi tiết" ở cột 7
-                try:
-                    btn = QPushButton("Xem")
-                    btn.setToolTip("Xem chi tiết đơn xuất thuốc")
-                    # Lưu don_thuoc_id (row_data[1]) để dùng trong callback
-                    btn.clicked.connect(lambda _, don_id=row_data[1]: self.open_detail(don_id))
-                    self.table.setCellWidget(r, 7, btn)
-                except Exception:
-                    pass
-            
+            # Bản ghi không có thời gian xuất vẫn được hiển thị như trước
+            self.model.set_query("""
+                SELECT id, don_thuoc_id, dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi, thoi_gian_xuat, ghi_chu
+                FROM lich_su_xuat_thuoc
+                WHERE (thoi_gian_xuat >= ? AND thoi_gian_xuat < date(?, '+1 day'))
+                   OR COALESCE(thoi_gian_xuat, '') = ''
+                ORDER BY thoi_gian_xuat DESC, id DESC
+            """, (date_from, date_to))
             self.table.resizeColumnsToContents()
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Lỗi khi tải lịch sử: {e}")
@@ -217,15 +199,12 @@ class XemLichSuXuatThuoc(QWidget):
                 cell.alignment = Alignment(horizontal="center", vertical="center")
             
             # Dữ liệu
-            for row in range(self.table.rowCount()):
-                row_data = []
-                for col in range(self.table.columnCount()):
-                    item = self.table.item(row, col)
-                    row_data.append(item.text() if item else "")
-                ws.append(row_data)
+            self.model.fetch_all()
+            for row in range(self.model.rowCount()):
+                ws.append([self.model.display_text(row, col) for col in range(self.model.columnCount())])
             
             # Điều chỉnh độ rộng cột
-            for col in range(1, self.table.columnCount() + 1):
+            for col in range(1, self.model.columnCount() + 1):
                 ws.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 15
             
             # Lưu
@@ -1,9 +1,12 @@
+import os
 import sys
+import time
+_IMPORT_START = time.perf_counter()
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QFrame, QStackedWidget, QAction, QAbstractItemView, QMessageBox
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QFont
 from database import initialize_database
 initialize_database()
@@ -11,19 +14,27 @@ initialize_database()
 from database import get_user_role, end_user_session
 import logging
 
-# 🟢 THÊM DÒNG NÀY: import form tiếp đón khám
-from forms.tiep_don_kham import TiepDonKham
-from forms.chi_dinh_dich_vu import ChiDinhDichVu
-from forms.tao_phieu_kham import TaoPhieuKham
-from forms.quan_ly_thuoc import QuanLyThuoc
-from forms.don_thuoc_bo_sung import DonThuocKhac
-from forms.dat_lich_kham_form import DatLichKhamForm
-from forms.ai_chat import AIChatDialog
-from forms.quan_ly_nhan_su import QuanLyNhanSu
-from forms.quan_ly_lich_hen import QuanLyLichHen
-from forms.quan_ly_xuat_thuoc import QuanLyXuatThuoc
-from forms.xem_lich_su_xuat_thuoc import XemLichSuXuatThuoc
-from forms.quan_ly_tai_khoan import QuanLyTaiKhoan
+# Các form được import khi mở lần đầu (forms/lazy_pages.py), không import sẵn ở đây
+from forms.lazy_pages import page_class, prewarm, startup_report
+from forms.page_cache import PageCache, memory_usage_text
+# Tạo executor dùng chung trước khi các form dùng nó được import
+import db_executor  # noqa: F401
+
+# Số trang chức năng tối đa giữ trong QStackedWidget (ngoài trang chào mừng)
+MAX_CACHED_PAGES = 6
+
+# Form được pre-warm (sau khi MainApp hiện lên, xem forms/lazy_pages.prewarm) theo vai trò.
+# Đặt biến môi trường CLINIC_PREWARM=0 để tắt.
+PREWARM_PAGES = {
+    'tiep_tan': ['TiepDonKham', 'DatLichKhamForm'],
+    'bac_si': ['TiepDonKham', 'DatLichKhamForm', 'ChiDinhDichVu', 'TaoPhieuKham', 'KeDonThuoc'],
+    'duoc_si': ['DatLichKhamForm', 'QuanLyXuatThuoc'],
+    'admin': ['TiepDonKham', 'DatLichKhamForm', 'ChiDinhDichVu', 'TaoPhieuKham', 'KeDonThuoc',
+              'QuanLyThuoc', 'QuanLyXuatThuoc', 'AdminPanel'],
+}
+
+# Thời gian import main_app (database + khởi tạo DB + Qt), dùng cho báo cáo khởi động
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_START
 
 
 class MainApp(QMainWindow):
@@ -44,7 +55,29 @@ class MainApp(QMainWindow):
         self.setGeometry(100, 100, 1280, 720)
         self.setMinimumSize(900, 600)
 
+        init_start = time.perf_counter()
         self.initUI()
+        self._init_seconds = time.perf_counter() - init_start
+        # Chạy khi vòng lặp sự kiện rảnh lần đầu, tức là sau khi cửa sổ đã được vẽ
+        QTimer.singleShot(0, self._after_first_paint)
+
+    def _after_first_paint(self):
+        """Ghi báo cáo thời gian khởi động và pre-warm các form hay dùng của vai trò này."""
+        logging.info("Khởi động: import main_app %.0f ms, dựng MainApp %.0f ms",
+                     IMPORT_SECONDS * 1000, self._init_seconds * 1000)
+        # Nhận thay đổi từ các phiên bản ứng dụng khác dùng chung clinic.db (change_log)
+        from forms.live_updates import start_live_updates
+        start_live_updates(self)
+        if os.environ.get('CLINIC_PREWARM', '1') != '0':
+            # Nạp sẵn chỉ mục bệnh nhân để form đầu tiên mở ra không phải đọc cả bảng benh_nhan
+            from patient_index import get_patient_index
+            prewarm(PREWARM_PAGES.get(self.role, []), warmups=(get_patient_index,))
+
+    def import_report(self):
+        """Các dòng báo cáo thời gian khởi động + import form (để xem log / debug)."""
+        lines = [f"{IMPORT_SECONDS * 1000:8.1f} ms  import main_app",
+                 f"{self._init_seconds * 1000:8.1f} ms  MainApp.initUI"]
+        return lines + startup_report()
 
     def initUI(self):
         # ----- MENU BAR TRÊN CÙNG -----
@@ -221,6 +254,16 @@ class MainApp(QMainWindow):
         # keep reference to default page to detect 'exit' back to home
         self.default_page = default_page
 
+        # Các trang chức năng được quản lý bởi PageCache (dùng lại / huỷ trang ít dùng)
+        self.pages = PageCache(self.content, max_pages=MAX_CACHED_PAGES, on_change=self._update_memory_status)
+        self.memory_label = QLabel()
+        self.memory_label.setStyleSheet("color: #666; padding-right: 8px;")
+        self.statusBar().addPermanentWidget(self.memory_label)
+        self._memory_timer = QTimer(self)
+        self._memory_timer.timeout.connect(self._update_memory_status)
+        self._memory_timer.start(10000)
+        self._update_memory_status()
+
         # 🟢 THÊM SỰ KIỆN NHẤN NÚT "TIẾP ĐÓN KHÁM"
         self.btn_tiepdon.clicked.connect(self.show_tiepdon_form)
 
@@ -306,6 +349,13 @@ class MainApp(QMainWindow):
         # Update active state when content changes (e.g., child form closes and returns to default)
         self.content.currentChanged.connect(self._on_content_changed) 
 
+    def _update_memory_status(self):
+        """Hiển thị RAM / số widget / số trang đang giữ ở status bar."""
+        try:
+            self.memory_label.setText(memory_usage_text(self.pages))
+        except Exception:
+            pass
+
     def _set_sidebar_inactive(self, btn):
         """Set button to inactive (white background)."""
         try:
@@ -354,9 +404,8 @@ class MainApp(QMainWindow):
         """Hiển thị form tiếp đón trong vùng nội dung chính"""
         # TiepDonKham currently accepts role; avoid passing session_id to prevent signature mismatch
         try:
-            tiepdon_page = TiepDonKham(role=self.role)  # gọi class trong tiep_don_kham.py, truyền role
-            self.content.addWidget(tiepdon_page)
-            self.content.setCurrentWidget(tiepdon_page)
+            # Form nhập liệu: mỗi lần mở là form trắng, trang cũ được huỷ (không tích luỹ widget)
+            self.pages.show('tiep_don', lambda: page_class('TiepDonKham')(role=self.role), reuse=False)  # gọi class trong tiep_don_kham.py, truyền role
             try:
                 self._activate_only(self.btn_tiepdon)
             except Exception:
@@ -376,20 +425,21 @@ class MainApp(QMainWindow):
         if self.role not in ['bac_si', 'admin']:
             QMessageBox.warning(self, "Phân quyền", "Bạn không có quyền mở trang 'Chỉ định dịch vụ'.")
             return
-        chidinh_page = ChiDinhDichVu() # gọi class trong chi_dinh_dich_vu.py
-        self.content.addWidget(chidinh_page)
-        self.content.setCurrentWidget(chidinh_page)
+        self.pages.show('chi_dinh', self._create_chidinh_page, reuse=False)
         
-        # Kết nối signal để cập nhật form quản lý khi lưu
         try:
-            chidinh_page.data_saved.connect(lambda: self.refresh_quan_ly_form())
+            self._activate_only(self.btn_chidinh)
         except Exception:
             pass
-        
+
+    def _create_chidinh_page(self):
+        page = page_class('ChiDinhDichVu')()  # gọi class trong chi_dinh_dich_vu.py
+        # Kết nối signal để cập nhật form quản lý khi lưu
         try:
-            self._activate_only(self.btn_chidinh)
+            page.data_saved.connect(self.refresh_quan_ly_form)
         except Exception:
             pass
+        return page
 
     def show_lapphieu_form(self):
         """Hiển thị trang Lập phiếu khám trong vùng nội dung chính."""
@@ -398,9 +448,7 @@ class MainApp(QMainWindow):
             if self.role not in ['bac_si', 'admin']:
                 QMessageBox.warning(self, "Phân quyền", "Bạn không có quyền mở trang 'Lập phiếu khám'.")
                 return
-            page = TaoPhieuKham()
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('lap_phieu', page_class('TaoPhieuKham'), reuse=False)
             try:
                 self._activate_only(self.btn_lapphieu)
             except Exception:
@@ -416,14 +464,13 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Chỉ admin mới có quyền mở 'Quản lý thuốc'.")
                 return
-            page = self._get_or_create_quan_ly_thuoc()
+            page = self._show_quan_ly_thuoc()
             if page:
                 # Hiển thị chỉ tab Ghi nhận thanh toán khi mở từ mục Quản lý thuốc
                 try:
                     page.set_mode('quanly')
                 except Exception:
                     pass
-                self.content.setCurrentWidget(page)
             try:
                 self._activate_only(self.btn_quanly_thuoc)
             except Exception:
@@ -438,9 +485,7 @@ class MainApp(QMainWindow):
             if self.role not in ['duoc_si', 'admin']:
                 QMessageBox.warning(self, "Phân quyền", "Bạn không có quyền mở trang 'Xuất thuốc'.")
                 return
-            page = QuanLyXuatThuoc(username=self.username)
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('xuat_thuoc', lambda: page_class('QuanLyXuatThuoc')(username=self.username), reuse=False)
             try:
                 self._activate_only(self.btn_xuat_thuoc)
             except Exception:
@@ -455,9 +500,7 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Bạn không có quyền mở trang 'Lịch sử xuất thuốc'.")
                 return
-            page = XemLichSuXuatThuoc(username=self.username)
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('lich_su_xuat_thuoc', lambda: page_class('XemLichSuXuatThuoc')(username=self.username), reuse=False)
             try:
                 self._activate_only(self.btn_lich_su_xuat_thuoc)
             except Exception:
@@ -466,15 +509,10 @@ class MainApp(QMainWindow):
             logging.exception("Không thể mở form Lịch sử xuất thuốc:")
             QMessageBox.critical(self, "Lỗi", f"Không thể mở trang Lịch sử xuất thuốc:\n{e}")
 
-    def _get_or_create_quan_ly_thuoc(self):
-        """Create QuanLyThuoc page if not exists and return it (doesn't change sidebar active state)."""
+    def _show_quan_ly_thuoc(self):
+        """Show the shared QuanLyThuoc page, creating it if needed (doesn't change sidebar active state)."""
         try:
-            if hasattr(self, 'quan_ly_thuoc_page') and self.quan_ly_thuoc_page:
-                return self.quan_ly_thuoc_page
-            page = QuanLyThuoc()
-            self.content.addWidget(page)
-            self.quan_ly_thuoc_page = page
-            return page
+            return self.pages.show('quan_ly_thuoc', page_class('QuanLyThuoc'))
         except Exception as e:
             from PyQt5.QtWidgets import QMessageBox
             QMessageBox.critical(self, "Lỗi", f"Không thể tạo trang Quản lý thuốc:\n{e}")
@@ -483,14 +521,13 @@ class MainApp(QMainWindow):
     def show_doanhthu_tab(self):
         """Open QuanLyThuoc and switch to the 'Tổng hợp doanh thu' tab."""
         try:
-            page = self._get_or_create_quan_ly_thuoc()
+            page = self._show_quan_ly_thuoc()
             if page:
                 # Hiển thị chỉ tab Tổng hợp doanh thu cho mục Doanh thu tổng hợp
                 try:
                     page.set_mode('doanhthu')
                 except Exception:
                     pass
-                self.content.setCurrentWidget(page)
             try:
                 self._activate_only(self.btn_doanhthu)
             except Exception:
@@ -501,14 +538,13 @@ class MainApp(QMainWindow):
     def show_thutien_tab(self):
         """Open QuanLyThuoc and switch to the 'Chi tiết dịch vụ/thuốc' tab (used by Thu tiền dịch vụ)."""
         try:
-            page = self._get_or_create_quan_ly_thuoc()
+            page = self._show_quan_ly_thuoc()
             if page:
                 # Hiển thị chỉ tab Chi tiết dịch vụ/thuốc cho mục Thu tiền dịch vụ
                 try:
                     page.set_mode('thutien')
                 except Exception:
                     pass
-                self.content.setCurrentWidget(page)
             try:
                 self._activate_only(self.btn_thutien)
             except Exception:
@@ -519,8 +555,9 @@ class MainApp(QMainWindow):
     def refresh_quan_ly_form(self):
         """Cập nhật dữ liệu trong form quản lý thuốc khi nhân liệu thay đổi."""
         try:
-            if hasattr(self, 'quan_ly_thuoc_page') and self.quan_ly_thuoc_page:
-                self.quan_ly_thuoc_page.on_data_updated()
+            page = self.pages.get('quan_ly_thuoc')
+            if page:
+                page.on_data_updated()
         except Exception:
             pass
     
@@ -528,15 +565,14 @@ class MainApp(QMainWindow):
         """Tạo form đơn thuốc (hoặc đơn bổ sung) và kết nối signal."""
         try:
             if is_bo_sung:
-                page = DonThuocKhac()
+                page = page_class('DonThuocKhac')()
                 # Kết nối signal từ form đơn bổ sung
                 try:
                     page.medicine_exported.connect(lambda: self.refresh_quan_ly_form())
                 except Exception:
                     pass
             else:
-                from forms.don_thuoc import KeDonThuoc
-                page = KeDonThuoc()
+                page = page_class('KeDonThuoc')()
                 # Kết nối signal từ form đơn thuốc
                 try:
                     page.medicine_exported.connect(lambda: self.refresh_quan_ly_form())
@@ -554,6 +590,11 @@ class MainApp(QMainWindow):
                 end_user_session(self.session_id)
         except Exception:
             pass
+        # Huỷ các trang đang giữ: dừng timer và ngắt signal toàn cục của chúng
+        try:
+            self.pages.clear()
+        except Exception:
+            pass
         from login import LoginWindow
         self.login_window = LoginWindow()
         self.login_window.show()
@@ -565,10 +606,7 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Bạn không có quyền truy cập Admin Panel.")
                 return
-            from forms.admin_panel import AdminPanel
-            page = AdminPanel()
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('admin_panel', page_class('AdminPanel'), reuse=False)
             try:
                 self._activate_only(self.btn_admin_panel)
             except Exception:
@@ -580,9 +618,7 @@ class MainApp(QMainWindow):
         """Mở form quản lý đặt lịch khám (DatLichKhamForm)."""
         try:
             # Tạo form quản lý đặt lịch
-            page = DatLichKhamForm(role=self.role)
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('dat_lich', lambda: page_class('DatLichKhamForm')(role=self.role), reuse=False)
             try:
                 self._activate_only(self.btn_quanly_dat_lich)
             except Exception:
@@ -593,7 +629,7 @@ class MainApp(QMainWindow):
     def show_ai_dialog(self):
         """Mở dialog AI Chat (modal)."""
         try:
-            dlg = AIChatDialog(self)
+            dlg = page_class('AIChatDialog')(self)
             dlg.exec_()
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể mở AI Chat:\n{e}")
@@ -604,9 +640,8 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Chỉ admin mới có quyền truy cập Quản lý Nhân Sự.")
                 return
-            page = QuanLyNhanSu()
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            # Danh sách nhân sự tự cập nhật qua app_signals nên dùng lại trang cũ
+            self.pages.show('quan_ly_nhan_su', page_class('QuanLyNhanSu'))
             try:
                 self._activate_only(self.btn_quanly_nhan_su)
             except Exception:
@@ -620,9 +655,7 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Chỉ admin mới có quyền truy cập Quản lý Lịch Hẹn.")
                 return
-            page = QuanLyLichHen()
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('quan_ly_lich_hen', page_class('QuanLyLichHen'), reuse=False)
             try:
                 self._activate_only(self.btn_quanly_lich_hen)
             except Exception:
@@ -636,9 +669,7 @@ class MainApp(QMainWindow):
             if self.role != 'admin':
                 QMessageBox.warning(self, "Phân quyền", "Chỉ admin mới có quyền truy cập Quản lý Tài Khoản.")
                 return
-            page = QuanLyTaiKhoan(current_username=self.username)
-            self.content.addWidget(page)
-            self.content.setCurrentWidget(page)
+            self.pages.show('quan_ly_tai_khoan', lambda: page_class('QuanLyTaiKhoan')(current_username=self.username), reuse=False)
             try:
                 self._activate_only(self.btn_quanly_tai_khoan)
             except Exception:
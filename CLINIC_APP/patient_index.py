@@ -0,0 +1,241 @@
+"""
+Chỉ mục tìm kiếm bệnh nhân trong bộ nhớ, dùng chung cho các form.
+
+- Tìm theo tiền tố của từng từ trong họ tên (bỏ dấu tiếng Việt: "nguyen v" khớp "Nguyễn Văn"),
+  số điện thoại, số CCCD và mã hồ sơ.
+- Mỗi loại khoá là một danh sách đã sắp xếp; tìm tiền tố bằng bisect nên với 200k bệnh nhân
+  một lần tìm top-K vẫn dưới vài ms.
+- Nạp toàn bộ một lần; sau đó refresh() chỉ đọc các bệnh nhân thay đổi (bảng benh_nhan_thay_doi
+  do trigger ghi, xem database._m008_patient_change_tracking). Khi không có gì mới, refresh()
+  chỉ tốn một lần tra phien_ban_du_lieu.
+"""
+from bisect import bisect_left, insort
+from collections import namedtuple
+import re
+import threading
+import unicodedata
+
+from database import get_changed_patient_ids, get_data_version, get_patient_search_rows
+
+PatientRecord = namedtuple('PatientRecord',
+                           'id ho_ten dien_thoai ngay_sinh so_cccd ma_hoso gioi_tinh tuoi dia_chi doi_tuong')
+
+# Ký tự cao nhất dùng để chặn trên khoảng tiền tố trong bisect
+_MAX_CHAR = '\U0010ffff'
+
+
+def _build_fold_table():
+    # Bảng dịch cho str.translate (chạy ở tầng C): chữ có dấu -> chữ thường không dấu,
+    # dấu rời (văn bản dạng NFD) -> bỏ
+    table = {ord('đ'): 'd', ord('Đ'): 'd'}
+    for code in range(0xC0, 0x1F00):
+        c = chr(code)
+        base = ''.join(ch for ch in unicodedata.normalize('NFD', c) if not unicodedata.combining(ch))
+        if unicodedata.combining(c):
+            table[code] = None
+        elif base != c and base.isascii():
+            table[code] = base.lower()
+    return table
+
+
+_FOLD_TABLE = _build_fold_table()
+_NON_DIGITS = re.compile(r'\D+')
+
+
+def fold_text(text):
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả đ -> d)."""
+    if not text:
+        return ''
+    return str(text).translate(_FOLD_TABLE).lower()
+
+
+def _digits(text):
+    return _NON_DIGITS.sub('', str(text)) if text else ''
+
+
+def patient_display_text(rec):
+    """Chuỗi hiển thị chuẩn: 'Tên — Mã:HS.. — SĐT / CCCD / năm sinh' (ID nếu chưa có mã hồ sơ)."""
+    parts = []
+    if rec.dien_thoai:
+        parts.append(str(rec.dien_thoai))
+    if rec.so_cccd:
+        parts.append(str(rec.so_cccd))
+    if rec.ngay_sinh:
+        parts.append(str(rec.ngay_sinh).split('-')[0])
+    if rec.ma_hoso:
+        disp = f"{rec.ho_ten} — Mã:{rec.ma_hoso}"
+    else:
+        disp = f"{rec.ho_ten} — ID:{rec.id}"
+    if parts:
+        disp += ' — ' + ' / '.join(parts)
+    return disp
+
+
+class PatientIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records = {}      # id -> PatientRecord
+        self._folded = {}       # id -> họ tên đã bỏ dấu
+        self._keys = {}         # id -> [(tên danh sách, khoá)] để gỡ khi cập nhật
+        # Mỗi danh sách gồm (khoá, họ tên bỏ dấu, id), sắp xếp tăng dần
+        # 'fullname': cả họ tên (gõ từ đầu tên, trường hợp thường gặp nhất); 'name': từng từ
+        self._lists = {'fullname': [], 'name': [], 'phone': [], 'cccd': [], 'ma_hoso': []}
+        self._words = {}        # id -> các từ của họ tên bỏ dấu
+        self._sorted_ids = None  # cache danh sách id theo tên (cho all_records)
+        self.version = None
+
+    # --- nạp / cập nhật ---
+    def refresh(self):
+        """Đồng bộ với DB: nạp toàn bộ lần đầu, sau đó chỉ các bệnh nhân thay đổi. Trả về số bản ghi cập nhật."""
+        with self._lock:
+            # Đọc phiên bản trước dữ liệu: thay đổi xen giữa sẽ được lần refresh sau nhận ra
+            current = get_data_version('benh_nhan')
+            if self.version is None:
+                self._load_all(get_patient_search_rows())
+                self.version = current
+                return len(self._records)
+            if current == self.version:
+                return 0
+            ids = get_changed_patient_ids(self.version)
+            rows = {r[0]: r for r in get_patient_search_rows(ids)} if ids else {}
+            for pid in ids:
+                self._remove(pid)
+                if pid in rows:
+                    self._add(PatientRecord(*rows[pid]))
+            self._sorted_ids = None
+            self.version = current
+            return len(ids)
+
+    def _load_all(self, rows):
+        self._records.clear()
+        self._folded.clear()
+        self._words.clear()
+        self._keys.clear()
+        entries = {name: [] for name in self._lists}
+        for r in rows:
+            rec = PatientRecord(*r)
+            for list_name, key in self._index_keys(rec):
+                entries[list_name].append((key, self._folded[rec.id], rec.id))
+        for name, lst in entries.items():
+            lst.sort()
+            self._lists[name] = lst
+        self._sorted_ids = None
+
+    def _index_keys(self, rec):
+        folded = fold_text(rec.ho_ten)
+        self._records[rec.id] = rec
+        self._folded[rec.id] = folded
+        words = tuple(folded.split())
+        self._words[rec.id] = words
+        keys = [('fullname', ' '.join(words))]
+        keys.extend(('name', tok) for tok in set(words))
+        phone = _digits(rec.dien_thoai)
+        if phone:
+            keys.append(('phone', phone))
+        cccd = _digits(rec.so_cccd)
+        if cccd:
+            keys.append(('cccd', cccd))
+        if rec.ma_hoso:
+            keys.append(('ma_hoso', fold_text(rec.ma_hoso)))
+        self._keys[rec.id] = keys
+        return keys
+
+    def _add(self, rec):
+        for list_name, key in self._index_keys(rec):
+            insort(self._lists[list_name], (key, self._folded[rec.id], rec.id))
+
+    def _remove(self, pid):
+        folded = self._folded.pop(pid, None)
+        self._words.pop(pid, None)
+        for list_name, key in self._keys.pop(pid, []):
+            lst = self._lists[list_name]
+            i = bisect_left(lst, (key, folded, pid))
+            if i < len(lst) and lst[i] == (key, folded, pid):
+                del lst[i]
+        self._records.pop(pid, None)
+
+    # --- truy vấn ---
+    def get(self, pid):
+        return self._records.get(pid)
+
+    def __len__(self):
+        return len(self._records)
+
+    def all_records(self):
+        """Toàn bộ bệnh nhân theo họ tên (thay cho SELECT * FROM benh_nhan ORDER BY ho_ten)."""
+        with self._lock:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(self._records, key=lambda pid: (self._records[pid].ho_ten or '', pid))
+            return [self._records[pid] for pid in self._sorted_ids]
+
+    def _prefix_range(self, list_name, prefix):
+        lst = self._lists[list_name]
+        lo = bisect_left(lst, (prefix,))
+        hi = bisect_left(lst, (prefix + _MAX_CHAR,))
+        return lst, lo, hi
+
+    def search(self, text, limit=20):
+        """Top-`limit` bệnh nhân khớp `text` (theo thứ tự khoá khớp, rồi họ tên).
+
+        - Chuỗi chữ: mọi từ của truy vấn phải là tiền tố của một từ trong họ tên (bỏ dấu)
+        - Chuỗi số: tiền tố SĐT hoặc CCCD
+        - Mã hồ sơ (vd. 'HS00012'): tiền tố mã hồ sơ
+        """
+        query = fold_text(text).strip()
+        if not query:
+            return []
+        with self._lock:
+            found = []
+            seen = set()
+
+            def take(lst, lo, hi, accept=None):
+                for i in range(lo, hi):
+                    pid = lst[i][2]
+                    if pid in seen or (accept and not accept(pid)):
+                        continue
+                    seen.add(pid)
+                    found.append(pid)
+                    if len(found) >= limit:
+                        return True
+                return False
+
+            compact = query.replace(' ', '')
+            digits = _digits(compact)
+            if digits and len(digits) == len(compact):
+                for list_name in ('phone', 'cccd'):
+                    if take(*self._prefix_range(list_name, digits)):
+                        break
+                return [self._records[pid] for pid in found]
+            if digits and ' ' not in query:
+                # Chữ + số liền nhau (vd. 'hs00'): mã hồ sơ
+                take(*self._prefix_range('ma_hoso', compact))
+                return [self._records[pid] for pid in found]
+            tokens = query.split()
+            # 1) Gõ từ đầu họ tên ('nguyen van d'): một khoảng liên tục, đã theo thứ tự tên
+            if take(*self._prefix_range('fullname', ' '.join(tokens))):
+                return [self._records[pid] for pid in found]
+            if len(tokens) == 1:
+                # 2) Một từ: tiền tố của bất kỳ từ nào trong tên ('van', 'duc')
+                take(*self._prefix_range('name', tokens[0]))
+                return [self._records[pid] for pid in found]
+            # 3) Nhiều từ không theo thứ tự ('duc nguyen'): duyệt khoảng của từ hiếm nhất,
+            #    lọc theo tất cả các từ của truy vấn
+            lst, lo, hi = min((self._prefix_range('name', tok) for tok in set(tokens)),
+                              key=lambda r: r[2] - r[1])
+            words = self._words
+
+            def accept(pid):
+                ws = words[pid]
+                return all(any(w.startswith(tok) for w in ws) for tok in tokens)
+            take(lst, lo, hi, accept)
+            return [self._records[pid] for pid in found]
+
+
+# Chỉ mục dùng chung trong tiến trình (nạp khi form đầu tiên cần)
+patient_index = PatientIndex()
+
+
+def get_patient_index():
+    """Chỉ mục dùng chung, đã đồng bộ với DB."""
+    patient_index.refresh()
+    return patient_index
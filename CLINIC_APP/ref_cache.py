@@ -0,0 +1,67 @@
+"""
+Bộ nhớ đệm dữ liệu tham chiếu ít thay đổi (danh sách bác sĩ, lịch hẹn gần đây trên web đặt lịch...).
+
+- Mỗi mục có thời hạn (TTL) và danh sách bảng phụ thuộc; get() chỉ gọi loader khi mục chưa có
+  hoặc đã hết hạn, nên nhiều request liên tiếp dùng chung một lần đọc SQLite.
+- Ghi vào bảng phụ thuộc trong tiến trình này thì gọi invalidate(<bảng>) ngay sau khi ghi
+  (database.add_bac_si, QuanLyNhanSu.add_staff/update_staff...). Thay đổi từ tiến trình khác
+  được thấy chậm nhất sau TTL, hoặc ngay lập tức nếu mục có `version` (bộ đếm do trigger tăng,
+  vd. phien_ban_du_lieu 'nhan_su'): mỗi get() so phiên bản (một lần tra khóa chính) thay vì nạp lại.
+- Không import database: database.py gọi invalidate() trong các hàm ghi.
+"""
+import os
+import threading
+import time
+
+# TTL mặc định (giây) cho danh sách bác sĩ / nhân sự; có thể chỉnh bằng biến môi trường
+STAFF_TTL = float(os.environ.get('CLINIC_STAFF_CACHE_TTL', '300') or 300)
+
+
+class ReferenceCache:
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (giá trị, hết hạn lúc, các bảng phụ thuộc, phiên bản dữ liệu lúc nạp)
+        self._entries = {}
+        # key -> khóa riêng để chỉ một thread gọi loader khi mục hết hạn
+        self._loading = {}
+        # Tăng mỗi lần invalidate: kết quả loader đọc trước lần invalidate không được lưu lại
+        self._generation = 0
+
+    def get(self, key, loader, ttl, depends=(), version=None):
+        """Giá trị của `key`; gọi loader() khi chưa có/hết hạn và giữ kết quả trong `ttl` giây.
+
+        version: hàm trả phiên bản hiện tại của dữ liệu nguồn; khác phiên bản lúc nạp thì nạp lại.
+        """
+        current = version() if version is not None else None
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > self._clock() and entry[3] == current:
+            return entry[0]
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            # Thread khác có thể vừa nạp xong trong lúc chờ khóa
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self._clock() and entry[3] == current:
+                return entry[0]
+            generation = self._generation
+            # `current` đọc TRƯỚC loader: có ghi xen giữa thì lần get sau thấy phiên bản mới và nạp lại
+            value = loader()
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = (value, self._clock() + ttl, frozenset(depends), current)
+            return value
+
+    def invalidate(self, *tables):
+        """Bỏ các mục phụ thuộc vào một trong `tables` (không truyền gì = bỏ tất cả)."""
+        with self._lock:
+            self._generation += 1
+            if not tables:
+                self._entries.clear()
+                return
+            for key in [k for k, e in self._entries.items() if e[2].intersection(tables)]:
+                del self._entries[key]
+
+
+# Bộ đệm dùng chung trong tiến trình (GUI hoặc web)
+reference_cache = ReferenceCache()
@@ -0,0 +1,71 @@
+"""
+Đo số request/giây của web đặt lịch (dat_lich_web.py) trên các route '/' và '/ehr'.
+
+So sánh hai chế độ trong cùng một tiến trình, dùng Flask test client (không qua mạng):
+- truoc: như bản cũ — render_template_string biên dịch lại template ở mỗi request
+- sau:   template đã biên dịch sẵn trong app.jinja_env
+Cả hai chế độ dùng chung một kết nối pool cho mỗi request (dat_lich_web.get_db).
+
+Chạy từ thư mục CLINIC_APP:
+    python scripts/bench_dat_lich_web.py --requests 500
+"""
+import argparse
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from flask import render_template_string  # noqa: E402
+
+import dat_lich_web  # noqa: E402
+
+ROUTES = ('/', '/ehr')
+
+
+def _legacy_render(name, **context):
+    return render_template_string(dat_lich_web.TEMPLATES[name], **context)
+
+
+_ORIGINAL_RENDER = dat_lich_web.render_template
+
+
+def _set_mode(mode):
+    """Chuyển app giữa cách render cũ ('truoc') và mới ('sau')."""
+    dat_lich_web.render_template = _legacy_render if mode == 'truoc' else _ORIGINAL_RENDER
+
+
+def bench(client, path, n, warmup=20):
+    for _ in range(warmup):
+        client.get(path)
+    start = time.perf_counter()
+    for _ in range(n):
+        resp = client.get(path)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{path}: HTTP {resp.status_code}")
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Request/giây của dat_lich_web trước và sau khi biên dịch sẵn template")
+    parser.add_argument('--requests', type=int, default=500, help="số request mỗi route mỗi chế độ")
+    args = parser.parse_args()
+
+    client = dat_lich_web.app.test_client()
+    results = {}
+    for mode in ('truoc', 'sau'):
+        _set_mode(mode)
+        for path in ROUTES:
+            results[(mode, path)] = bench(client, path, args.requests)
+    _set_mode('sau')
+
+    print(f"{'route':<8} {'trước (req/s)':>14} {'sau (req/s)':>12} {'tăng':>8}")
+    for path in ROUTES:
+        before, after = results[('truoc', path)], results[('sau', path)]
+        print(f"{path:<8} {before:14.0f} {after:12.0f} {after / before:7.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
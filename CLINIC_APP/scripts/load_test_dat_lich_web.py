@@ -0,0 +1,218 @@
+"""
+Thử tải web đặt lịch: N bệnh nhân đồng thời mở trang, đặt lịch và tra hồ sơ (EHR).
+
+- Sao chép clinic.db sang thư mục tạm (sqlite3 backup API, nhất quán kể cả khi app đang chạy)
+  rồi khởi động `python wsgi.py` trên bản sao đó; dữ liệu thật không bị ghi vào.
+- Mỗi bệnh nhân ảo là một luồng lặp: GET / -> GET /slots (khung trống của một bác sĩ) -> POST / (đặt lịch)
+  -> POST /ehr -> GET /ehr?q=...
+- In số request, lỗi, request/giây và độ trễ p50/p95/p99 theo từng thao tác.
+
+Chỉ dùng thư viện chuẩn. Chạy từ thư mục CLINIC_APP:
+    python scripts/load_test_dat_lich_web.py --patients 20 --duration 30
+    python scripts/load_test_dat_lich_web.py --patients 50 --workers 4 --threads 8
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB = os.path.join(APP_DIR, 'data', 'clinic.db')
+
+
+def copy_database(src, dst_dir):
+    dst = os.path.join(dst_dir, 'clinic.db')
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return dst
+
+
+def sample_names(db_path, limit=200):
+    """Tên bệnh nhân có sẵn trong DB để tra EHR (luôn có vài tên giả nếu DB trống)."""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT ho_ten FROM benh_nhan WHERE ho_ten IS NOT NULL ORDER BY RANDOM() LIMIT ?",
+                            (limit,)).fetchall()
+    except sqlite3.Error:
+        rows = []
+    finally:
+        conn.close()
+    names = [r[0] for r in rows if r[0] and r[0].strip()]
+    return names or ["Nguyễn Văn A", "Trần Thị B", "Lê Văn C"]
+
+
+def sample_doctors(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [r[0] for r in conn.execute("SELECT ten FROM nhan_su WHERE chuc_vu = 'Bác sĩ'").fetchall()]
+    except sqlite3.Error:
+        return []
+    finally:
+        conn.close()
+
+
+def start_server(db_path, port, workers, threads):
+    env = dict(os.environ)
+    env.update({
+        'CLINIC_DB_PATH': db_path,
+        'CLINIC_WEB_PORT': str(port),
+        'CLINIC_WEB_WORKERS': str(workers),
+        'CLINIC_WEB_THREADS': str(threads),
+    })
+    proc = subprocess.Popen([sys.executable, 'wsgi.py'], cwd=APP_DIR, env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"wsgi.py dừng ngay khi khởi động (exit code {proc.returncode})")
+        try:
+            urllib.request.urlopen(base + '/', timeout=2).read()
+            return proc, base
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("Server không phản hồi sau 30 giây")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank: phần tử thứ ceil(p% * n)
+    k = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[min(k, len(sorted_values)) - 1]
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, action, seconds, ok):
+        with self._lock:
+            self.latencies[action].append(seconds)
+            if not ok:
+                self.errors[action] += 1
+
+
+def timed(stats, action, url, data=None):
+    body = urllib.parse.urlencode(data).encode('utf-8') if data is not None else None
+    start = time.perf_counter()
+    content = None
+    try:
+        with urllib.request.urlopen(url, data=body, timeout=60) as resp:
+            content = resp.read()
+            ok = resp.status == 200
+    except Exception:
+        ok = False
+    stats.record(action, time.perf_counter() - start, ok)
+    return content
+
+
+def patient(base, names, doctors, stop_at, stats, seed):
+    rnd = random.Random(seed)
+    while time.time() < stop_at:
+        timed(stats, 'GET /', base + '/')
+        doctor = rnd.choice(doctors) if doctors else ''
+        ngay_gio = (datetime.now() + timedelta(days=rnd.randint(1, 14))).strftime('%Y-%m-%dT09:00')
+        if doctor:
+            # Nhiều bệnh nhân tranh cùng vài khung đầu tiên: thử khả năng chống đặt quá chỗ
+            content = timed(stats, 'GET /slots', base + '/slots?' + urllib.parse.urlencode({'bac_si': doctor}))
+            try:
+                slots = json.loads(content or b'{}').get('slots', [])
+            except ValueError:
+                slots = []
+            if slots:
+                ngay_gio = rnd.choice(slots[:5])['bat_dau']
+        timed(stats, 'POST / (đặt lịch)', base + '/', {
+            'ho_ten': f"Tải thử {seed}-{rnd.randint(1, 10 ** 6)}",
+            'ngay_gio': ngay_gio,
+            'dien_thoai': f"09{rnd.randint(10 ** 7, 10 ** 8 - 1)}",
+            'dia_chi': 'Tải thử',
+            'bac_si': doctor,
+            'loai_kham': 'Khám tư vấn',
+            'ghi_chu': '',
+        })
+        name = rnd.choice(names)
+        timed(stats, 'POST /ehr', base + '/ehr', {'ho_ten': name, 'so_cccd': ''})
+        word = name.split()[-1]
+        timed(stats, 'GET /ehr?q=', base + '/ehr?' + urllib.parse.urlencode({'q': word, 'page': 1}))
+
+
+def report(stats, elapsed):
+    total = sum(len(v) for v in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print(f"\n{total} request trong {elapsed:.1f}s: {total / elapsed:.1f} req/s, {errors} lỗi")
+    print(f"{'thao tác':<20} {'số':>7} {'lỗi':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for action, values in stats.latencies.items():
+        values = sorted(values)
+        print(f"{action:<20} {len(values):7d} {stats.errors[action]:5d} "
+              f"{percentile(values, 50) * 1000:9.1f} {percentile(values, 95) * 1000:9.1f} "
+              f"{percentile(values, 99) * 1000:9.1f} {values[-1] * 1000:9.1f}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thử tải web đặt lịch trên bản sao clinic.db")
+    parser.add_argument('--patients', type=int, default=20, help="số bệnh nhân ảo đồng thời")
+    parser.add_argument('--duration', type=float, default=30.0, help="thời gian chạy (giây)")
+    parser.add_argument('--db', default=DEFAULT_DB, help="DB nguồn để sao chép")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--workers', type=int, default=1, help="CLINIC_WEB_WORKERS của server")
+    parser.add_argument('--threads', type=int, default=8, help="CLINIC_WEB_THREADS của server")
+    parser.add_argument('--url', help="dùng server đang chạy sẵn thay vì tự khởi động (không sao chép DB)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='clinic_load_')
+    proc = None
+    try:
+        if args.url:
+            base = args.url.rstrip('/')
+            names, doctors = sample_names(args.db), sample_doctors(args.db)
+        else:
+            db_path = copy_database(args.db, tmp_dir)
+            names, doctors = sample_names(db_path), sample_doctors(db_path)
+            proc, base = start_server(db_path, args.port, args.workers, args.threads)
+
+        stats = Stats()
+        print(f"{args.patients} bệnh nhân ảo trong {args.duration:.0f}s -> {base}")
+        stop_at = time.time() + args.duration
+        threads = [threading.Thread(target=patient, args=(base, names, doctors, stop_at, stats, i), daemon=True)
+                   for i in range(args.patients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        errors = report(stats, time.perf_counter() - start)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
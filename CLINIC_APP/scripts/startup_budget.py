@@ -0,0 +1,84 @@
+"""
+Đo thời gian import main_app bằng `python -X importtime` và kiểm tra ngân sách khởi động.
+
+- In các module import chậm nhất (cột cumulative, giống báo cáo -X importtime)
+- Thất bại (exit code 1) nếu (cũng được kiểm tra bởi tests/test_startup_budget.py):
+  * import main_app vượt quá ngân sách --budget-ms
+  * main_app kéo theo các thư viện nặng lẽ ra chỉ nạp khi mở form (reportlab, requests...)
+
+Chạy từ thư mục CLINIC_APP:
+    python scripts/startup_budget.py --budget-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Ngân sách mặc định (ms) cho `import main_app`
+DEFAULT_BUDGET_MS = 1500.0
+
+# Các package chỉ được import khi mở form tương ứng (forms/lazy_pages.py)
+LAZY_ONLY = ('reportlab', 'requests', 'dotenv', 'fitz', 'forms.tiep_don_kham', 'forms.don_thuoc',
+             'forms.quan_ly_thuoc', 'forms.ai_chat', 'forms.chi_dinh_dich_vu')
+
+
+def run_importtime(module='main_app'):
+    """Chạy `python -X importtime -c 'import <module>'`, trả về [(self_us, cumulative_us, name)]."""
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['CLINIC_PREWARM'] = '0'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=APP_DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Không import được {module}:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        # "import time:      self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            rows.append((int(self_us), int(cumulative_us), name.strip()))
+        except ValueError:
+            continue
+    return rows
+
+
+def check_budget(rows):
+    """(số ms import main_app, các module trong LAZY_ONLY bị import sớm) từ kết quả run_importtime()."""
+    total_us = next((c for s, c, n in rows if n == 'main_app'), sum(s for s, c, n in rows))
+    loaded = {n for s, c, n in rows}
+    eager = sorted(m for m in LAZY_ONLY if any(n == m or n.startswith(m + '.') for n in loaded))
+    return total_us / 1000, eager
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Báo cáo và ngân sách thời gian import main_app")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    rows = run_importtime()
+    total_ms, eager = check_budget(rows)
+
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: -r[1])[:args.top]:
+        print(f"{cumulative_us / 1000:10.1f}ms {self_us / 1000:8.1f}ms  {name}")
+
+    print(f"\nimport main_app: {total_ms:.1f} ms (ngân sách {args.budget_ms:.0f} ms)")
+    ok = True
+    if total_ms > args.budget_ms:
+        print("✗ Vượt ngân sách thời gian khởi động")
+        ok = False
+    if eager:
+        print("✗ Các module lẽ ra chỉ import khi mở form: " + ", ".join(eager))
+        ok = False
+    if ok:
+        print("✓ Đạt ngân sách khởi động")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
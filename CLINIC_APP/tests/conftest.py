@@ -0,0 +1,20 @@
+import os
+import sqlite3
+import sys
+
+# Các module của ứng dụng nằm phẳng trong CLINIC_APP (import database, db_pool, forms.*...)
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+
+def copy_clinic_db(dst):
+    """Sao chép data/clinic.db sang `dst` (mở nguồn chỉ đọc; test không ghi vào DB thật)."""
+    source = sqlite3.connect(f"file:{os.path.join(APP_DIR, 'data', 'clinic.db')}?mode=ro", uri=True)
+    target = sqlite3.connect(dst)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return dst
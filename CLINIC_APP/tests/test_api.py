@@ -0,0 +1,102 @@
+import pytest
+
+import database
+from conftest import copy_clinic_db
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    from dat_lich_web import app
+    app.config['TESTING'] = True
+    with app.test_client() as c:
+        yield c
+    database.pool.reset(database.DB_NAME)
+
+
+def _add_visits(dates):
+    with database.pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO benh_nhan (ho_ten, so_cccd) VALUES ('Lê Thị Phân Trang', '001099000002')")
+        pid = cur.lastrowid
+        cur.executemany("INSERT INTO phieu_kham (benh_nhan_id, ngay_lap, bac_si) VALUES (?, ?, 'BS Kiểm Thử')",
+                        [(pid, d) for d in dates])
+    return pid
+
+
+def _add_visits_for(pid, ngay_lap):
+    with database.pool.write() as conn:
+        conn.execute("INSERT INTO phieu_kham (benh_nhan_id, ngay_lap) VALUES (?, ?)", (pid, ngay_lap))
+
+
+def _walk(client, url):
+    """Đi hết các trang theo next_cursor, trả về (danh sách item, số trang)."""
+    items, pages, cursor = [], 0, None
+    while True:
+        resp = client.get(url + (f"&cursor={cursor}" if cursor else ""))
+        assert resp.status_code == 200
+        body = resp.get_json()
+        items += body['items']
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor:
+            return items, pages
+
+
+def test_visits_keyset_paging_visits_every_row_once(client):
+    # Hai lần khám cùng ngay_lap: thứ tự (ngay_lap, id) vẫn tách được ở ranh giới trang
+    pid = _add_visits(['2026-01-01', '2026-01-03', '2026-01-03', '2026-01-02', '2026-01-03'])
+    with database.pool.read() as conn:
+        expected = [r[0] for r in conn.execute(
+            "SELECT id FROM phieu_kham WHERE benh_nhan_id = ? ORDER BY ngay_lap DESC, id DESC", (pid,))]
+
+    items, pages = _walk(client, f"/api/v1/patients/{pid}/visits?limit=2")
+    assert [v['id'] for v in items] == expected
+    assert pages == 3
+
+
+def test_visits_etag_returns_304_until_record_changes(client):
+    pid = _add_visits(['2026-01-01'])
+    url = f"/api/v1/patients/{pid}/visits?limit=5"
+    first = client.get(url)
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag
+
+    cached = client.get(url, headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.data == b''
+    # Trang khác (tham số khác) có ETag riêng
+    assert client.get(f"/api/v1/patients/{pid}/visits?limit=1", headers={'If-None-Match': etag}).status_code == 200
+
+    _add_visits_for(pid, '2026-02-01')
+    fresh = client.get(url, headers={'If-None-Match': etag})
+    assert fresh.status_code == 200 and fresh.headers['ETag'] != etag
+    assert len(fresh.get_json()['items']) == 2
+
+
+def test_appointments_paging_and_etag(client):
+    with database.pool.write() as conn:
+        conn.executemany("INSERT INTO lich_hen (ho_ten, ngay_gio, bac_si, trang_thai) VALUES (?, ?, ?, 'Đã hủy')",
+                         [('Phạm Keyset', f"2026-03-0{d} 08:00", 'BS Kiểm Thử') for d in (1, 2, 2, 3, 4)])
+        expected = [r[0] for r in conn.execute(
+            "SELECT id FROM lich_hen WHERE ho_ten = 'Phạm Keyset' ORDER BY ngay_gio DESC, id DESC")]
+
+    url = "/api/v1/appointments?ho_ten=Keyset&limit=2"
+    items, pages = _walk(client, url)
+    assert [a['id'] for a in items] == expected
+    assert pages == 3
+
+    etag = client.get(url).headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    with database.pool.write() as conn:
+        conn.execute("INSERT INTO lich_hen (ho_ten, ngay_gio, bac_si, trang_thai) "
+                     "VALUES ('Phạm Keyset', '2026-03-05 08:00', 'BS Kiểm Thử', 'Đã hủy')")
+    fresh = client.get(url, headers={'If-None-Match': etag})
+    assert fresh.status_code == 200 and fresh.headers['ETag'] != etag
+    assert fresh.get_json()['items'][0]['ngay_gio'] == '2026-03-05 08:00'
+
+
+def test_rejects_bad_cursor_and_missing_name(client):
+    assert client.get("/api/v1/appointments?ho_ten=An&cursor=khong-hop-le").status_code == 400
+    assert client.get("/api/v1/appointments").status_code == 400
+    assert client.get("/api/v1/patients/999999999/visits").status_code == 404
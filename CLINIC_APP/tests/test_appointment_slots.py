@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from conftest import copy_clinic_db
+from database import SlotFullError
+
+BAC_SI = 'BS Kiểm Thử'
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    # Mỗi khung của bác sĩ kiểm thử chỉ nhận 1 lịch hẹn
+    database.set_doctor_capacity(BAC_SI, 1)
+    yield path
+    database.pool.reset(database.DB_NAME)
+
+
+def _work_day(offset=7):
+    day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=offset)
+    while day.weekday() not in database.SLOT_WEEKDAYS:
+        day += timedelta(days=1)
+    first = database._work_periods()[0][0]
+    return day + timedelta(minutes=first)
+
+
+def _da_dat(khung):
+    with database.pool.read() as conn:
+        r = conn.execute("SELECT da_dat FROM khung_gio_kham WHERE bac_si = ? AND bat_dau = ?",
+                         (BAC_SI, khung)).fetchone()
+    return r[0] if r else 0
+
+
+def _trang_thai(lid):
+    with database.pool.read() as conn:
+        return conn.execute("SELECT trang_thai FROM lich_hen WHERE id = ?", (lid,)).fetchone()[0]
+
+
+def test_full_slot_rejects_booking_and_cancel_releases_it(db_path):
+    t = _work_day()
+    khung = t.strftime(database.SLOT_FORMAT)
+    first = database.book_appointment('Nguyễn Văn A', t, BAC_SI)
+    assert _da_dat(khung) == 1
+
+    with pytest.raises(SlotFullError) as e:
+        database.book_appointment('Trần Thị B', t + timedelta(minutes=5), BAC_SI)
+    assert e.value.bat_dau == khung
+    assert e.value.goi_y and e.value.goi_y[0][0] > khung
+    assert _da_dat(khung) == 1
+
+    database.set_appointment_status(first, 'Đã hủy')
+    assert _da_dat(khung) == 0
+    second = database.book_appointment('Trần Thị B', t, BAC_SI)
+    assert _da_dat(khung) == 1
+
+    # Mở lại lịch đã hủy khi khung đã kín: báo hết chỗ, trạng thái giữ nguyên
+    with pytest.raises(SlotFullError):
+        database.set_appointment_status(first, 'xác nhận')
+    assert _trang_thai(first) == 'Đã hủy'
+    database.set_appointment_status(second, 'xác nhận')
+    assert _da_dat(khung) == 1
+
+
+def test_reschedule_moves_seat_and_keeps_appointment_when_target_full(db_path):
+    t = _work_day()
+    a = database.book_appointment('Nguyễn Văn A', t, BAC_SI)
+    later = t + timedelta(minutes=database.SLOT_MINUTES)
+    database.book_appointment('Trần Thị B', later, BAC_SI)
+    khung_a = t.strftime(database.SLOT_FORMAT)
+    khung_b = later.strftime(database.SLOT_FORMAT)
+
+    with pytest.raises(SlotFullError):
+        database.reschedule_appointment(a, later)
+    with database.pool.read() as conn:
+        assert conn.execute("SELECT khung_gio FROM lich_hen WHERE id = ?", (a,)).fetchone()[0] == khung_a
+    assert (_da_dat(khung_a), _da_dat(khung_b)) == (1, 1)
+
+    # Cùng khung (khung đã kín bởi chính lịch này): sửa được
+    database.reschedule_appointment(a, t + timedelta(minutes=10), ghi_chu='đến muộn 10 phút')
+    assert _da_dat(khung_a) == 1
+
+    free = t + 2 * timedelta(minutes=database.SLOT_MINUTES)
+    database.reschedule_appointment(a, free)
+    assert (_da_dat(khung_a), _da_dat(free.strftime(database.SLOT_FORMAT))) == (0, 1)
+
+
+def test_rejects_times_outside_working_hours(db_path):
+    t = _work_day()
+    with database.pool.read() as conn:
+        before = conn.execute("SELECT COUNT(*) FROM lich_hen").fetchone()[0]
+
+    with pytest.raises(ValueError):
+        database.book_appointment('Nguyễn Văn A', t.replace(hour=3, minute=0), BAC_SI)
+    off = t
+    while off.weekday() in database.SLOT_WEEKDAYS:
+        off += timedelta(days=1)
+    with pytest.raises(ValueError):
+        database.book_appointment('Nguyễn Văn A', off, BAC_SI)
+    with pytest.raises(ValueError):
+        database.book_appointment('Nguyễn Văn A', 'không phải giờ', BAC_SI)
+
+    lid = database.book_appointment('Nguyễn Văn A', t, BAC_SI)
+    with pytest.raises(ValueError):
+        database.reschedule_appointment(lid, t.replace(hour=23))
+    with database.pool.read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM lich_hen").fetchone()[0] == before + 1
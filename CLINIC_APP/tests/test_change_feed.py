@@ -0,0 +1,55 @@
+import pytest
+
+import change_feed
+import database
+from change_feed import ChangeFeed
+from conftest import copy_clinic_db
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    yield path
+    database.pool.reset(database.DB_NAME)
+
+
+def test_poll_prunes_old_rows_periodically(db_path):
+    now = [0.0]
+    feed = ChangeFeed(db_path, clock=lambda: now[0])
+    feed.start()
+    with database.pool.write() as conn:
+        conn.execute("INSERT INTO change_log (bang, dong_id, thao_tac, thoi_gian) "
+                     "VALUES ('benh_nhan', 1, 'U', datetime('now', '-2 days'))")
+        conn.execute("INSERT INTO change_log (bang, dong_id, thao_tac) VALUES ('benh_nhan', 2, 'U')")
+
+    def old_rows():
+        with database.pool.read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM change_log WHERE thoi_gian < datetime('now', '-1 day')"
+                                ).fetchone()[0]
+
+    assert feed.poll() == {'benh_nhan': {1, 2}}
+    assert old_rows() == 1
+
+    now[0] = change_feed.PRUNE_INTERVAL_SECONDS + 1
+    feed.poll()
+    assert old_rows() == 0
+    with database.pool.read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM change_log WHERE dong_id = 2").fetchone()[0] == 1
+    feed.close()
+
+
+def test_poll_hands_prune_to_submit(db_path):
+    now = [0.0]
+    submitted = []
+    feed = ChangeFeed(db_path, clock=lambda: now[0], submit=submitted.append)
+    feed.start()
+    feed.poll()
+    assert submitted == []
+
+    now[0] = change_feed.PRUNE_INTERVAL_SECONDS + 1
+    feed.poll()
+    feed.poll()
+    # poll() không tự dọn trên thread gọi nó; chỉ giao một lần dọn cho mỗi chu kỳ
+    assert submitted == [feed.prune]
+    feed.close()
@@ -0,0 +1,90 @@
+import gc
+import os
+import threading
+
+import pytest
+
+from db_pool import ConnectionManager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    m = ConnectionManager(str(tmp_path / 'pool.db'))
+    with m.write() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(1000)])
+    yield m
+    m.close_all()
+
+
+def _query(m):
+    with m.read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM t a, t b WHERE a.x < 20").fetchone()[0]
+
+
+def test_connection_closed_when_owner_thread_exits(manager):
+    def work():
+        with manager.write() as conn:
+            conn.execute("INSERT INTO t VALUES (-1)")
+
+    for _ in range(20):
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+    gc.collect()
+    # Chỉ còn kết nối của thread chính; ident được cấp lại không làm rò kết nối
+    assert len(manager._all) == 1
+
+
+def test_reconnects_when_thread_connection_was_closed(manager):
+    conn = manager.connection()
+    conn.close()
+    assert _query(manager) == 20000
+    assert manager.connection() is not conn
+
+
+def test_qthreadpool_workers_keep_connections_while_others_connect(manager):
+    QtCore = pytest.importorskip('PyQt5.QtCore')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+    errors = []
+    results = []
+    lock = threading.Lock()
+
+    class Job(QtCore.QRunnable):
+        def run(self):
+            try:
+                for _ in range(20):
+                    value = _query(manager)
+                    with lock:
+                        results.append(value)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    stop = threading.Event()
+
+    def churn():
+        # Thread Python ngắn hạn liên tục mở kết nối mới trong lúc worker của Qt đang truy vấn
+        while not stop.is_set():
+            t = threading.Thread(target=manager.connection)
+            t.start()
+            t.join()
+            manager.connection()
+
+    qpool = QtCore.QThreadPool()
+    qpool.setMaxThreadCount(4)
+    churner = threading.Thread(target=churn)
+    churner.start()
+    try:
+        for _ in range(8):
+            qpool.start(Job())
+        assert qpool.waitForDone(60000)
+    finally:
+        stop.set()
+        churner.join()
+    app.processEvents()
+
+    assert errors == []
+    assert results == [20000] * 160
@@ -0,0 +1,149 @@
+import pytest
+
+import database
+from conftest import copy_clinic_db
+from database import StockError
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    yield path
+    database.pool.reset(database.DB_NAME)
+
+
+def _add_drug(ma_thuoc, ton_kho):
+    with database.pool.write() as conn:
+        conn.execute("INSERT INTO danh_muc_thuoc (ma_thuoc, ten_thuoc, don_vi, ton_kho) VALUES (?, ?, 'viên', ?)",
+                     (ma_thuoc, f"Thuốc {ma_thuoc}", ton_kho))
+
+
+def _add_order(items, source='don_thuoc'):
+    """Tạo bệnh nhân + phiếu khám + đơn (items: [(ma_thuoc, so_luong)]), trả về id đơn."""
+    table, _, detail_table, detail_fk = database._DISPENSE_SOURCES[source]
+    with database.pool.write() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO benh_nhan (ho_ten, so_cccd) VALUES ('Nguyễn Văn Kiểm', '001099000001')")
+        cur.execute("INSERT INTO phieu_kham (benh_nhan_id, ngay_lap) VALUES (?, '2026-01-05')", (cur.lastrowid,))
+        cur.execute(f"INSERT INTO {table} (phieu_kham_id, ngay_ke, bac_si) VALUES (?, '2026-01-05', 'BS Kiểm Thử')",
+                    (cur.lastrowid,))
+        don_id = cur.lastrowid
+        cur.executemany(f"INSERT INTO {detail_table} ({detail_fk}, ma_thuoc, ten_thuoc, so_luong) VALUES (?, ?, ?, ?)",
+                        [(don_id, ma, f"Thuốc {ma}", sl) for ma, sl in items])
+    return don_id
+
+
+def _stock(ma_thuoc):
+    with database.pool.read() as conn:
+        return conn.execute("SELECT ton_kho FROM danh_muc_thuoc WHERE ma_thuoc = ?", (ma_thuoc,)).fetchone()[0]
+
+
+def _da_xuat(don_id):
+    with database.pool.read() as conn:
+        return conn.execute("SELECT da_xuat FROM don_thuoc WHERE id = ?", (don_id,)).fetchone()[0]
+
+
+def _history(don_id):
+    with database.pool.read() as conn:
+        return conn.execute("""
+            SELECT dac_si, ho_ten_benh_nhan, so_cccd, xuat_boi FROM lich_su_xuat_thuoc WHERE don_thuoc_id = ?
+        """, (don_id,)).fetchall()
+
+
+def test_dispense_decrements_stock_and_writes_history(db_path):
+    _add_drug('KT01', 10)
+    _add_drug('KT02', 5)
+    don_id = _add_order([('KT01', 4), ('KT02', 5)])
+
+    dispensed, shortages = database.dispense_prescription('don_thuoc', don_id, 'duocsi')
+    assert sorted(ma for ma, _, _ in dispensed) == ['KT01', 'KT02'] and shortages == []
+    assert (_stock('KT01'), _stock('KT02'), _da_xuat(don_id)) == (6, 0, 1)
+    assert _history(don_id) == [('BS Kiểm Thử', 'Nguyễn Văn Kiểm', '001099000001', 'duocsi')]
+
+
+def test_second_dispense_of_same_order_is_rejected(db_path):
+    _add_drug('KT01', 10)
+    don_id = _add_order([('KT01', 4)])
+    database.dispense_prescription('don_thuoc', don_id)
+
+    with pytest.raises(StockError):
+        database.dispense_prescription('don_thuoc', don_id)
+    assert _stock('KT01') == 6
+    assert len(_history(don_id)) == 1
+
+
+def test_shortage_rolls_back_flag_stock_and_history(db_path):
+    _add_drug('KT01', 10)
+    _add_drug('KT02', 1)
+    don_id = _add_order([('KT01', 4), ('KT02', 3)])
+
+    with pytest.raises(StockError) as e:
+        database.dispense_prescription('don_thuoc', don_id)
+    assert [(ma, ton, sl) for ma, _, ton, sl in e.value.shortages] == [('KT02', 1, 3)]
+    assert (_stock('KT01'), _stock('KT02'), _da_xuat(don_id)) == (10, 1, 0)
+    assert _history(don_id) == []
+
+
+def test_partial_dispenses_only_drugs_in_stock(db_path):
+    _add_drug('KT01', 10)
+    _add_drug('KT02', 1)
+    don_id = _add_order([('KT01', 4), ('KT02', 3)])
+
+    dispensed, shortages = database.dispense_prescription('don_thuoc', don_id, partial=True)
+    assert [ma for ma, _, _ in dispensed] == ['KT01']
+    assert [ma for ma, _, _, _ in shortages] == ['KT02']
+    assert (_stock('KT01'), _stock('KT02'), _da_xuat(don_id)) == (6, 1, 1)
+    assert len(_history(don_id)) == 1
+
+    # Không thuốc nào đủ tồn: kể cả partial=True cũng huỷ toàn bộ
+    other = _add_order([('KT02', 3)])
+    with pytest.raises(StockError):
+        database.dispense_prescription('don_thuoc', other, partial=True)
+    assert (_stock('KT02'), _da_xuat(other)) == (1, 0)
+
+
+def test_batch_allocates_in_order_and_skips_whole_orders(db_path):
+    _add_drug('KT01', 10)
+    _add_drug('KT02', 2)
+    _add_drug('KT03', 5)
+    first = _add_order([('KT01', 6)])
+    short = _add_order([('KT01', 2), ('KT02', 3)])
+    late = _add_order([('KT01', 6)])
+    extra = _add_order([('KT01', 4)], source='don_thuoc_bo_sung')
+    done = _add_order([('KT03', 1)])
+    database.dispense_prescription('don_thuoc', done)
+
+    orders = [('don_thuoc', first), ('don_thuoc', short), ('don_thuoc', late),
+              ('don_thuoc_bo_sung', extra), ('don_thuoc', done)]
+    dispensed, skipped = database.dispense_batch(orders, 'duocsi')
+
+    # Đơn đến trước được cấp trước; đơn thiếu một thuốc bị bỏ cả đơn (không trừ KT01 của nó)
+    assert dispensed == [('don_thuoc', first), ('don_thuoc_bo_sung', extra)]
+    assert [key[:2] for key in skipped] == [('don_thuoc', short), ('don_thuoc', late), ('don_thuoc', done)]
+    assert (_stock('KT01'), _stock('KT02')) == (0, 2)
+    assert (_da_xuat(first), _da_xuat(short), _da_xuat(late)) == (1, 0, 0)
+    with database.pool.read() as conn:
+        assert conn.execute("SELECT xuat_thuoc FROM don_thuoc_bo_sung WHERE id = ?", (extra,)).fetchone()[0] == 1
+    # Lịch sử chỉ cho đơn thường đã xuất trong lô
+    assert _history(first) == [('BS Kiểm Thử', 'Nguyễn Văn Kiểm', '001099000001', 'duocsi')]
+    assert _history(short) == [] and _history(late) == []
+
+
+def test_batch_rolls_back_everything_when_stock_changes(db_path):
+    _add_drug('KT01', 10)
+    a = _add_order([('KT01', 3)])
+    b = _add_order([('KT01', 3)])
+    # Giả lập máy khác trừ kho giữa lúc đọc tồn và lúc trừ: UPDATE có điều kiện không khớp
+    with database.pool.write() as conn:
+        conn.execute("""
+            CREATE TRIGGER test_steal_stock AFTER UPDATE OF da_xuat ON don_thuoc
+            BEGIN UPDATE danh_muc_thuoc SET ton_kho = 1 WHERE ma_thuoc = 'KT01'; END
+        """)
+
+    with pytest.raises(StockError):
+        database.dispense_batch([('don_thuoc', a), ('don_thuoc', b)])
+    assert (_stock('KT01'), _da_xuat(a), _da_xuat(b)) == (10, 0, 0)
+    assert _history(a) == [] and _history(b) == []
+    with database.pool.read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM so_kho_thuoc WHERE nguon_id IN (?, ?)", (a, b)).fetchone()[0] == 0
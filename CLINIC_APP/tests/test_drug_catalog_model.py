@@ -0,0 +1,35 @@
+import importlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+
+def test_changes_listener_works_after_import_on_exited_thread(monkeypatch):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    from app_signals import app_signals
+
+    # Như pre-warm cũ: module được import lần đầu trên một thread rồi thread đó kết thúc
+    sys.modules.pop('forms.drug_catalog_model', None)
+    t = threading.Thread(target=importlib.import_module, args=('forms.drug_catalog_model',))
+    t.start()
+    t.join()
+    model = sys.modules['forms.drug_catalog_model']
+
+    calls = []
+    monkeypatch.setattr(model, 'drug_catalog', type('Catalog', (), {
+        'version': None, 'refresh': lambda self: calls.append('refresh'), 'all': lambda self: []})())
+    model.sync_drug_catalog()
+    calls.clear()
+
+    app_signals.post('danh_muc_thuoc', [1], signals=())
+    app_signals.flush()
+    deadline = time.time() + 2
+    while not calls and time.time() < deadline:
+        app.processEvents()
+    assert calls == ['refresh']
@@ -0,0 +1,31 @@
+import os
+import threading
+import time
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+from forms import lazy_pages  # noqa: E402
+
+
+def test_prewarm_imports_forms_on_gui_thread(monkeypatch):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    threads = {}
+    monkeypatch.setattr(lazy_pages, '_import',
+                        lambda name, source: threads.setdefault(name, threading.current_thread()))
+    warmed = []
+    t = lazy_pages.prewarm(['QuanLyXuatThuoc', 'QuanLyLichHen'],
+                           warmups=(lambda: warmed.append(threading.current_thread()),))
+
+    deadline = time.time() + 10
+    while len(threads) < 2 and time.time() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    t.join()
+
+    assert set(threads) == {'forms.quan_ly_xuat_thuoc', 'forms.quan_ly_lich_hen'}
+    assert all(th is threading.main_thread() for th in threads.values())
+    assert warmed == [t]
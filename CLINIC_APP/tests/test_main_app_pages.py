@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from conftest import APP_DIR, copy_clinic_db
+
+pytest.importorskip('PyQt5.QtWidgets')
+
+# Mở mọi trang của MainApp (admin) vài lượt liên tiếp trong khi các truy vấn nền (db_executor)
+# của trang trước vẫn đang chạy. Chạy trong tiến trình con: lỗi kết nối giữa các thread từng làm
+# tiến trình segfault (exit 139) thay vì ném exception.
+SCRIPT = textwrap.dedent('''
+    import sys, time
+    from PyQt5.QtWidgets import QApplication, QDialog, QMessageBox
+    app = QApplication(sys.argv)
+    errors = []
+    QMessageBox.critical = staticmethod(lambda *a, **k: errors.append(a[1:3]) or QMessageBox.Ok)
+    QMessageBox.warning = staticmethod(lambda *a, **k: QMessageBox.Ok)
+    QMessageBox.information = staticmethod(lambda *a, **k: QMessageBox.Ok)
+    QMessageBox.question = staticmethod(lambda *a, **k: QMessageBox.Yes)
+    QDialog.exec_ = lambda self: 0
+
+    import main_app
+    from db_executor import executor
+
+    def pump(seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            app.processEvents()
+            time.sleep(0.005)
+
+    w = main_app.MainApp('admin')
+    w.show()
+    pump(0.5)
+    pages = sorted(n for n in dir(w) if n.startswith('show_') and n != 'show_ai_dialog')
+    for _ in range(3):
+        for name in pages:
+            getattr(w, name)()
+            app.processEvents()
+        pump(0.2)
+    assert executor.wait(60000)
+    pump(0.3)
+    if errors:
+        sys.exit(f'Trang báo lỗi: {errors}')
+''')
+
+
+def test_open_every_page_with_background_loads(tmp_path):
+    db_path = str(tmp_path / 'clinic.db')
+    copy_clinic_db(db_path)
+    env = dict(os.environ, CLINIC_DB_PATH=db_path, QT_QPA_PLATFORM='offscreen', CLINIC_PREWARM='1')
+    proc = subprocess.run([sys.executable, '-c', SCRIPT], cwd=APP_DIR, env=env,
+                          capture_output=True, text=True, timeout=300)
+    assert proc.returncode == 0, proc.stderr[-3000:]
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+from PyQt5.QtCore import QObject, pyqtSignal  # noqa: E402
+
+from forms.page_cache import connect_global, teardown_page  # noqa: E402
+
+
+class _Hub(QObject):
+    changes = pyqtSignal(object)
+
+
+class _Page(QtWidgets.QWidget):
+    def __init__(self, hub):
+        super().__init__()
+        self.got = []
+        connect_global(self, hub.changes, self.on_changes)
+        # Widget con cũng tự nối signal toàn cục
+        self.child = QtWidgets.QWidget(self)
+        self.child.got = []
+        connect_global(self.child, hub.changes, self.child.got.append)
+
+    def on_changes(self, payload):
+        self.got.append(payload)
+
+
+def test_teardown_disconnects_only_recorded_connections():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])  # noqa: F841
+    hub = _Hub()
+    other = []
+    hub.changes.connect(other.append)
+    page = _Page(hub)
+
+    hub.changes.emit(1)
+    assert (page.got, page.child.got, other) == ([1], [1], [1])
+
+    teardown_page(page)
+    hub.changes.emit(2)
+    assert (page.got, page.child.got, other) == ([1], [1], [1, 2])
+    # Gọi lại không lỗi (không còn kết nối nào được ghi)
+    teardown_page(page)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+from PyQt5.QtCore import QModelIndex  # noqa: E402
+
+from forms import patient_search  # noqa: E402
+from patient_index import PatientIndex  # noqa: E402
+
+_app = None
+ROWS = [(i, f"Nguyễn Văn {i}", f"09{i:08d}", '1990-01-01', None, f"HS{i:05d}", 'Nam', 30, '', '')
+        for i in range(1, 201)]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    global _app
+    _app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    idx = PatientIndex()
+    idx._load_all(ROWS)
+    idx.version = 1
+    monkeypatch.setattr(idx, 'refresh', lambda: 0)
+    monkeypatch.setattr(patient_search, 'patient_index', idx)
+    return idx
+
+
+def _combo():
+    combo = QtWidgets.QComboBox()
+    combo.setEditable(True)
+    return combo
+
+
+def test_reset_keeps_only_placeholder(index):
+    combo = _combo()
+    patient_search.PatientCompleter(combo)
+    patient_search.reset_patient_combo(combo, "-- Chọn bệnh nhân --")
+    assert combo.count() == 1 and combo.itemData(0) is None
+
+
+def test_completer_selection_adds_and_selects_patient(index):
+    combo = _combo()
+    completer = patient_search.PatientCompleter(combo)
+    patient_search.reset_patient_combo(combo, "-- Chọn bệnh nhân --")
+    selected = []
+    combo.currentIndexChanged.connect(lambda _: selected.append(combo.currentData()))
+
+    completer._on_text_edited('nguyen van 12')
+    model = completer.completionModel()
+    completer.activated[QModelIndex].emit(model.index(0, 0))
+
+    assert combo.count() == 2
+    assert selected[-1] == 12
+
+
+def test_patient_item_index_adds_on_demand_and_stays_bounded(index):
+    combo = _combo()
+    combo.addItem("", None)
+    for pid in range(1, 121):
+        i = patient_search.patient_item_index(combo, pid)
+        assert combo.itemData(i) == pid
+    assert combo.count() <= patient_search.MAX_COMBO_PATIENTS + 1
+    assert patient_search.patient_item_index(combo, 9999) == -1
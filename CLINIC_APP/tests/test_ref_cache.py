@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+import database
+from conftest import copy_clinic_db
+from ref_cache import ReferenceCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_version_change_reloads_before_ttl():
+    cache, version, loads = ReferenceCache(clock=_Clock()), [1], []
+
+    def loader():
+        loads.append(version[0])
+        return f"v{version[0]}"
+
+    get = lambda: cache.get('k', loader, ttl=300, version=lambda: version[0])
+    assert (get(), get()) == ("v1", "v1")
+    version[0] = 2
+    assert get() == "v2"
+    assert loads == [1, 2]
+
+
+def test_ttl_still_applies_without_version():
+    clock = _Clock()
+    cache, loads = ReferenceCache(clock=clock), []
+    get = lambda: cache.get('k', lambda: loads.append(1) or len(loads), ttl=10)
+    assert (get(), get()) == (1, 1)
+    clock.now = 11
+    assert get() == 2
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    database.migrate()
+    database.reference_cache.invalidate()
+    yield path
+    database.reference_cache.invalidate()
+    database.pool.reset(database.DB_NAME)
+
+
+def test_doctor_names_see_writes_from_another_process(db_path):
+    before = database.get_doctor_names()
+    # Ghi thẳng bằng kết nối riêng (như tiến trình web/GUI khác): không có invalidate() trong tiến trình này
+    other = sqlite3.connect(db_path)
+    try:
+        with other:
+            other.execute("INSERT INTO nhan_su (ten, chuc_vu) VALUES ('BS Tiến Trình Khác', 'Bác sĩ')")
+    finally:
+        other.close()
+    after = database.get_doctor_names()
+    assert 'BS Tiến Trình Khác' in after and len(after) == len(before) + 1
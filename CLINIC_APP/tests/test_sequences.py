@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import database
+from conftest import copy_clinic_db
+
+
+class _Rollback(Exception):
+    pass
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = copy_clinic_db(str(tmp_path / 'clinic.db'))
+    database.pool.reset(path)
+    database._sequence_blocks.clear()
+    yield path
+    database._sequence_blocks.clear()
+    database.pool.reset(database.DB_NAME)
+
+
+def _gia_tri(ten):
+    with database.pool.read() as conn:
+        r = conn.execute("SELECT gia_tri FROM day_so WHERE ten = ?", (ten,)).fetchone()
+    return r[0] if r else 0
+
+
+def test_numbers_nested_in_caller_transaction_roll_back_with_it(db_path):
+    start = _gia_tri('so_phieu')
+    with pytest.raises(_Rollback):
+        with database.pool.write():
+            assert database.next_number('so_phieu') == start + 1
+            # Trong transaction của người gọi: không giữ lô, cấp từng số trong SAVEPOINT
+            assert database.next_number('so_phieu', block=10) == start + 2
+            assert database._sequence_blocks == {}
+            raise _Rollback()
+    assert _gia_tri('so_phieu') == start
+
+    with database.pool.write():
+        code = database.next_code('so_phieu')
+    assert code == database.SEQUENCE_FORMATS['so_phieu'].format(start + 1)
+    assert _gia_tri('so_phieu') == start + 1
+
+
+def test_block_reservation_outside_transaction(db_path):
+    start = _gia_tri('so_chi_dinh')
+    got = [database.next_number('so_chi_dinh', block=5) for _ in range(7)]
+    assert got == list(range(start + 1, start + 8))
+    # Hai lô đã được ghi (commit) ngay: 10 số đã giữ chỗ
+    assert _gia_tri('so_chi_dinh') == start + 10
+
+
+def test_concurrent_allocation_never_repeats(db_path):
+    results, errors = [], []
+
+    def worker():
+        try:
+            for _ in range(20):
+                results.append(database.reserve_numbers('stt:test'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert sorted(results) == list(range(1, 81))
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+
+import pytest
+
+from conftest import APP_DIR
+
+pytest.importorskip('PyQt5.QtWidgets')
+
+
+def _startup_budget():
+    path = os.path.join(APP_DIR, 'scripts', 'startup_budget.py')
+    spec = importlib.util.spec_from_file_location('startup_budget', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_import_main_app_within_budget():
+    budget = _startup_budget()
+    total_ms, eager = budget.check_budget(budget.run_importtime())
+    assert eager == [], f"main_app import sớm các module chỉ dùng khi mở form: {eager}"
+    assert total_ms <= budget.DEFAULT_BUDGET_MS
@@ -0,0 +1,133 @@
+"""
+Chạy web đặt lịch (dat_lich_web.py) ở chế độ production: không debugger, nhiều luồng / nhiều tiến trình.
+
+    python wsgi.py                         # server WSGI đa luồng, cấu hình qua biến môi trường
+    gunicorn -w 4 -b 0.0.0.0:5000 wsgi:application
+
+Biến môi trường:
+- CLINIC_WEB_SECRET_KEY (bắt buộc): khoá ký cookie phiên / flash, vd. `python -c "import secrets; print(secrets.token_hex(32))"`.
+  Không đặt thì server không khởi động.
+- CLINIC_WEB_HOST (127.0.0.1), CLINIC_WEB_PORT (5000)
+- CLINIC_WEB_THREADS (8): số luồng xử lý cố định của mỗi tiến trình. Luồng sống suốt đời server
+  nên mỗi luồng giữ một kết nối SQLite của pool (không mở lại kết nối + PRAGMA cho từng request).
+- CLINIC_WEB_WORKERS (1): số tiến trình con dùng chung socket (chỉ hệ có os.fork, vd. Linux);
+  trên Windows luôn chạy một tiến trình.
+- CLINIC_WEB_ACCESS_LOG (0): 1 = in log từng request
+- CLINIC_DB_PATH, CLINIC_DB_BUSY_TIMEOUT: xem database.py
+
+Có waitress thì dùng waitress (CLINIC_WEB_SERVER=stdlib để ép dùng server có sẵn bên dưới).
+"""
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from database import initialize_database, pool
+from dat_lich_web import app
+
+HOST = os.environ.get('CLINIC_WEB_HOST', '127.0.0.1')
+PORT = int(os.environ.get('CLINIC_WEB_PORT', '5000') or 5000)
+THREADS = max(1, int(os.environ.get('CLINIC_WEB_THREADS', '8') or 8))
+WORKERS = max(1, int(os.environ.get('CLINIC_WEB_WORKERS', '1') or 1))
+ACCESS_LOG = os.environ.get('CLINIC_WEB_ACCESS_LOG', '0') == '1'
+
+if not app.secret_key:
+    sys.exit("Thiếu biến môi trường CLINIC_WEB_SECRET_KEY: không khởi động web đặt lịch khi chưa có khoá bí mật.")
+
+# Lược đồ phải ở phiên bản mới nhất trước khi nhận request (FTS, change_log...)
+initialize_database()
+application = app
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGIServer của thư viện chuẩn, xử lý request trên một nhóm luồng cố định."""
+
+    request_queue_size = 128
+
+    def __init__(self, *args, threads=THREADS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='web')
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        if ACCESS_LOG:
+            super().log_message(format, *args)
+
+
+def _serve_waitress():
+    try:
+        from waitress import serve
+    except ImportError:
+        return False
+    print(f"Web đặt lịch (waitress, {THREADS} luồng): http://{HOST}:{PORT}")
+    serve(application, host=HOST, port=PORT, threads=THREADS)
+    return True
+
+
+def _prefork(server):
+    """Tạo WORKERS tiến trình con cùng accept() trên socket của `server`; chờ đến khi bị dừng."""
+    # Kết nối SQLite không được mang qua fork: mỗi tiến trình con tự mở trong luồng của nó
+    pool.close_all()
+    children = []
+    for _ in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(*_):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, lambda *_: (stop(), sys.exit(0)))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop()
+
+
+def main():
+    if os.environ.get('CLINIC_WEB_SERVER', '') != 'stdlib' and WORKERS == 1 and _serve_waitress():
+        return 0
+    server = make_server(HOST, PORT, application, server_class=PooledWSGIServer, handler_class=_RequestHandler)
+    workers = WORKERS if hasattr(os, 'fork') else 1
+    print(f"Web đặt lịch ({workers} tiến trình x {THREADS} luồng): http://{HOST}:{PORT}")
+    try:
+        if workers > 1:
+            _prefork(server)
+        else:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())